@@ -12,20 +12,36 @@ import requests
 import json
 import sqlite3
 import logging
+import queue
+import atexit
 import shutil
 import re
 import csv
+import io
+import zipfile
+import itertools
+import tempfile
 import gc
+import hashlib
+import hmac
+import random
+import signal
+import contextvars
 import psutil
+from array import array
 from datetime import datetime, timedelta
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, NetworkError, BadRequest
+from telegram.request import HTTPXRequest
 from functools import wraps
-from flask import Flask, request
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 
 # ==================== HÀM ESCAPE MARKDOWN ====================
@@ -139,14 +155,11 @@ def is_main_owner(user_id):
 def load_co_owners():
     global CO_OWNERS
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS co_owners
-                     (user_id INTEGER PRIMARY KEY, username TEXT, added_by INTEGER, added_at TEXT)''')
-        c.execute("SELECT user_id FROM co_owners")
+        c.execute("SELECT user_id FROM co_owners")   # Bảng tạo bởi migration v9
         rows = c.fetchall()
         CO_OWNERS = {row[0] for row in rows}
-        conn.commit()
         conn.close()
         logger.info(f"✅ Loaded {len(CO_OWNERS)} co-owners: {CO_OWNERS}")
     except Exception as e:
@@ -157,7 +170,7 @@ GROUP_OWNERS = {}
 
 def load_group_owners():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT group_id, owner_id FROM group_owners")
         rows = c.fetchall()
@@ -170,7 +183,7 @@ def load_group_owners():
         
 def set_group_owner(group_id, owner_id):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
         c.execute('''INSERT OR REPLACE INTO group_owners (group_id, owner_id, created_at) VALUES (?, ?, ?)''', (group_id, owner_id, created_at))
@@ -192,7 +205,7 @@ def get_group_owner(group_id):
     
     # Nếu không có trong RAM, đọc từ database
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT owner_id FROM group_owners WHERE group_id = ?", (group_id,))
         result = c.fetchone()
@@ -213,7 +226,7 @@ def get_group_owner(group_id):
 def load_group_owner(group_id):
     """Load một group cụ thể vào RAM"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT owner_id FROM group_owners WHERE group_id = ?", (group_id,))
         result = c.fetchone()
@@ -359,7 +372,7 @@ def get_user_id_by_username(username):
             return cached_id
         
         # Nếu không có trong cache, tìm trong database
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         
         # Tìm chính xác username
@@ -415,16 +428,131 @@ class RenderConfig:
 render_config = RenderConfig()
 
 # ==================== THIẾT LẬP LOGGING ====================
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Code chỉ đẩy record vào queue (QueueHandler), ghi file/stdout do QueueListener
+# làm ở thread riêng nên handler không bao giờ chờ I/O đĩa. File xoay vòng theo
+# dung lượng (RotatingFileHandler), có thể xuất JSON (LOG_FORMAT=json).
+# Mỗi subsystem là 1 logger con (get_log): chỉnh level riêng qua LOG_LEVELS
+# ("callback=DEBUG,db=WARNING") và lấy mẫu record DEBUG qua LOG_SAMPLE ("message=20").
+LOG_FILE = os.environ.get('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 5 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', 3))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_SAMPLE = os.environ.get('LOG_SAMPLE', 'message=20,callback=20,flood=50,db=50')
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """1 dòng JSON / record: ts, level, logger, subsystem, msg + các field truyền qua extra={...}"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'subsystem': record.name.split('.', 1)[1] if '.' in record.name else 'main',
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogSampler(logging.Filter):
+    """Chỉ giữ 1/every record DEBUG của 1 logger (record INFO trở lên luôn qua)"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        self.seen += 1
+        if self.seen % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue đầy (đĩa nghẽn) thì bỏ record và đếm, không chặn thread đang log"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _parse_log_map(spec):
+    result = {}
+    for item in spec.split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            result[name.strip()] = value.strip()
+    return result
+
+def setup_logging():
+    formatter = JsonLogFormatter() if LOG_FORMAT == 'json' else logging.Formatter(LOG_TEXT_FORMAT)
+    targets = [logging.StreamHandler(sys.stdout)]
+    try:
+        targets.append(RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'))
+    except OSError as e:
+        print(f"⚠️ Không mở được {LOG_FILE}: {e}", file=sys.stderr)
+    for target in targets:
+        target.setFormatter(formatter)
+    
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = QueueListener(queue_handler.queue, *targets, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    
+    listener.start()
+    atexit.register(stop_logging, listener)    # flush phần còn trong queue khi thoát
+    return queue_handler, listener
+
+def stop_logging(listener):
+    """Dừng listener và ghi nốt record trong queue (gọi nhiều lần vẫn an toàn)"""
+    if listener._thread is not None:
+        listener.stop()
+
+log_queue_handler, log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+_log_levels = _parse_log_map(LOG_LEVELS)
+_log_samples = _parse_log_map(LOG_SAMPLE)
+
+def get_log(subsystem):
+    """Logger con cho 1 subsystem, áp level/lấy mẫu theo LOG_LEVELS/LOG_SAMPLE"""
+    child = logger.getChild(subsystem)
+    if subsystem in _log_levels:
+        child.setLevel(getattr(logging, _log_levels[subsystem].upper(), logging.NOTSET))
+    if subsystem in _log_samples and not any(isinstance(f, LogSampler) for f in child.filters):
+        try:
+            child.addFilter(LogSampler(int(_log_samples[subsystem])))
+        except ValueError:
+            pass
+    return child
+
+log_message = get_log('message')
+log_callback = get_log('callback')
+log_db = get_log('db')
+log_flood = get_log('flood')
+log_auth = get_log('auth')
+
 # ==================== KIỂM TRA THƯ VIỆN ====================
 # Kiểm tra pyzipper cho tính năng xuất file có mật khẩu
 try:
@@ -437,6 +565,36 @@ except ImportError:
     logger.warning("⚠️ pyzipper NOT installed - Secure export feature disabled")
     logger.warning("   • To enable: add 'pyzipper==0.3.6' to requirements.txt")
 
+# Kiểm tra pyarrow cho xuất dữ liệu dạng cột (Parquet / Arrow IPC) - tùy chọn, khá nặng RAM
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+    logger.info(f"✅ pyarrow installed - Columnar export enabled (v{pa.__version__})")
+except ImportError:
+    HAS_PYARROW = False
+    logger.info("ℹ️ pyarrow NOT installed - /export_data disabled (optional: pip install pyarrow)")
+
+# Kiểm tra numpy cho phân tích danh mục dạng vector - tùy chọn, thiếu thì dùng array('d')
+try:
+    import numpy as np
+    HAS_NUMPY = True
+    logger.info(f"✅ numpy installed - Vectorized portfolio analytics (v{np.__version__})")
+except ImportError:
+    HAS_NUMPY = False
+    logger.info("ℹ️ numpy NOT installed - Portfolio analytics dùng array('d') thuần Python")
+
+# Kiểm tra matplotlib cho /chart (vẽ PNG phía server) - tùy chọn
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    HAS_MATPLOTLIB = True
+    logger.info(f"✅ matplotlib installed - /chart enabled (v{matplotlib.__version__})")
+except ImportError:
+    HAS_MATPLOTLIB = False
+    logger.info("ℹ️ matplotlib NOT installed - /chart disabled (optional: pip install matplotlib)")
+
 # Kiểm tra cryptography (dự phòng nếu cần)
 try:
     from cryptography.fernet import Fernet
@@ -489,6 +647,17 @@ class AdvancedCache:
         self.misses = 0
         logger.info(f"🧹 Cache {self.name} cleared")
     
+    def shrink(self, keep=0.5):
+        """Bỏ các entry cũ nhất, giữ lại tỉ lệ keep - dùng khi thiếu bộ nhớ"""
+        # Chụp snapshot trước: thread report/chart có thể ghi cache trong lúc sort
+        items = list(self.cache.items())
+        drop = len(items) - int(len(items) * keep)
+        if drop <= 0:
+            return 0
+        for key, _ in sorted(items, key=lambda item: item[1][1])[:drop]:
+            self.cache.pop(key, None)
+        return drop
+    
     def get_stats(self):
         total = self.hits + self.misses
         hit_rate = (self.hits / total * 100) if total > 0 else 0
@@ -551,6 +720,7 @@ _FUNC_FEATURE_MAP = {
     'alert_command':          'crypto_alert',
     'alerts_command':         'crypto_alert',
     'export_master_command':  'crypto_export',
+    'export_data_command':    'crypto_export',
     # Thu chi
     'balance_command':        'expense_view',
     'export_expense_command': 'expense_export',
@@ -590,6 +760,7 @@ _FUNC_DISPLAY_MAP = {
     'alert_command':          'tạo cảnh báo giá',
     'alerts_command':         'xem cảnh báo',
     'export_master_command':  'xuất báo cáo crypto',
+    'export_data_command':    'xuất dữ liệu phân tích',
     'balance_command':        'xem cân đối thu chi',
     'export_expense_command': 'xuất báo cáo thu chi',
     'mod_ban_command':        'ban thành viên',
@@ -742,207 +913,927 @@ try:
     logger.info(f"🚀 Render mode: {render_config.is_render}")
 
     app = None
-    webhook_app = Flask(__name__)
+
+    # ==================== METRICS ====================
+    # Bộ đếm/histogram dạng Prometheus, không cần prometheus_client.
+    # Ghi từ mọi thread (handler, executor, worker) nên dùng chung 1 lock.
+    METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def _metric_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    class MetricsRegistry:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.meta = {}          # name -> (type, help, buckets)
+            self.counters = {}      # (name, labels) -> value
+            self.histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+            self.gauges = {}        # name -> hàm trả về số hoặc [(labels dict, số)]
+
+        def counter(self, name, help_text):
+            self.meta[name] = ('counter', help_text, None)
+
+        def histogram(self, name, help_text, buckets=METRIC_BUCKETS):
+            self.meta[name] = ('histogram', help_text, tuple(buckets))
+
+        def gauge(self, name, help_text, fn):
+            self.meta[name] = ('gauge', help_text, None)
+            self.gauges[name] = fn
+
+        def inc(self, name, labels=None, value=1):
+            key = (name, tuple(sorted(labels.items())) if labels else ())
+            with self.lock:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+        def observe(self, name, value, labels=None):
+            buckets = self.meta[name][2]
+            key = (name, tuple(sorted(labels.items())) if labels else ())
+            with self.lock:
+                row = self.histograms.get(key)
+                if row is None:
+                    row = self.histograms[key] = [0] * (len(buckets) + 2)
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        row[i] += 1
+                        break
+                row[-2] += value
+                row[-1] += 1
+
+        def snapshot(self, name):
+            """{labels: (sum, count)} của 1 histogram - dùng cho /metrics dạng bảng"""
+            with self.lock:
+                return {labels: (row[-2], row[-1]) for (n, labels), row in self.histograms.items() if n == name}
+
+        def render(self):
+            with self.lock:
+                counters = dict(self.counters)
+                histograms = {key: list(row) for key, row in self.histograms.items()}
+            lines = []
+            for name, (mtype, help_text, buckets) in self.meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {mtype}")
+                if mtype == 'counter':
+                    for (n, labels), value in counters.items():
+                        if n == name:
+                            lines.append(f"{name}{_metric_labels(labels)} {value}")
+                elif mtype == 'histogram':
+                    for (n, labels), row in histograms.items():
+                        if n != name:
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(buckets, row):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{_metric_labels(labels + (('le', bound),))} {cumulative}")
+                        lines.append(f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {row[-1]}")
+                        lines.append(f"{name}_sum{_metric_labels(labels)} {row[-2]}")
+                        lines.append(f"{name}_count{_metric_labels(labels)} {row[-1]}")
+                else:
+                    try:
+                        value = self.gauges[name]()
+                    except Exception:
+                        continue
+                    if isinstance(value, (list, tuple)):
+                        for labels, v in value:
+                            lines.append(f"{name}{_metric_labels(tuple(sorted(labels.items())))} {v}")
+                    else:
+                        lines.append(f"{name} {value}")
+                lines.append('')
+            return '\n'.join(lines)
+
+    metrics = MetricsRegistry()
+    metrics.histogram('bot_handler_seconds', 'Handler latency by kind (command/callback/message) and name')
+    metrics.counter('bot_handler_errors_total', 'Handler exceptions by kind and name')
+    metrics.histogram('bot_db_query_seconds', 'SQLite execute time by calling helper')
+    metrics.counter('bot_db_queries_total', 'SQLite statements by calling helper')
+    metrics.counter('bot_db_errors_total', 'SQLite errors by calling helper')
+    metrics.histogram('bot_cmc_seconds', 'CoinMarketCap request latency by endpoint')
+    metrics.counter('bot_cmc_requests_total', 'CoinMarketCap requests by endpoint and HTTP status or error')
+    metrics.histogram('bot_telegram_api_seconds', 'Telegram Bot API latency by method')
+    metrics.counter('bot_telegram_429_total', 'Telegram Bot API 429 (flood control) responses by method')
+    metrics.histogram('bot_alert_cycle_seconds', 'Duration of one alert engine pass', (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+    # ----- SQLite: đo từng execute, gán cho hàm helper gọi nó -----
+    def _db_caller():
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code in _DB_WRAPPER_CODES:
+            frame = frame.f_back
+        if frame is None:
+            return 'unknown'
+        return getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+
+    def _db_timed(method, sql, args):
+        start = time.perf_counter()
+        helper = _db_caller()
+        try:
+            if current_span.get() is not None:
+                with tracer.span(helper, 'db'):
+                    return method(sql, *args)
+            return method(sql, *args)
+        except sqlite3.Error:
+            metrics.inc('bot_db_errors_total', {'helper': helper})
+            raise
+        finally:
+            metrics.observe('bot_db_query_seconds', time.perf_counter() - start, {'helper': helper})
+            metrics.inc('bot_db_queries_total', {'helper': helper})
+
+    class MeteredCursor(sqlite3.Cursor):
+        def execute(self, sql, *args):
+            return _db_timed(super().execute, sql, args)
+
+        def executemany(self, sql, *args):
+            return _db_timed(super().executemany, sql, args)
+
+    class MeteredConnection(sqlite3.Connection):
+        def cursor(self, factory=MeteredCursor):
+            return super().cursor(factory)
+
+        def execute(self, sql, *args):
+            return self.cursor().execute(sql, *args)
+
+        def executemany(self, sql, *args):
+            return self.cursor().executemany(sql, *args)
+
+    _DB_WRAPPER_CODES = {
+        _db_timed.__code__,
+        MeteredCursor.execute.__code__, MeteredCursor.executemany.__code__,
+        MeteredConnection.execute.__code__, MeteredConnection.executemany.__code__
+    }
+
+    def db_connect(path, **kwargs):
+        """sqlite3.connect + đo thời gian từng câu lệnh"""
+        kwargs.setdefault('factory', MeteredConnection)
+        return sqlite3.connect(path, **kwargs)
+
+    # ----- CoinMarketCap -----
+    def cmc_get(endpoint, params=None, timeout=10):
+        """GET 1 endpoint CMC (vd '/cryptocurrency/quotes/latest'), ghi latency + mã trả về"""
+        start = time.perf_counter()
+        code = 'error'
+        try:
+            with tracer.span(f"cmc{endpoint}", 'http'):
+                res = requests.get(f"{CMC_API_URL}{endpoint}", headers={'X-CMC_PRO_API_KEY': CMC_API_KEY}, params=params, timeout=timeout)
+            code = str(res.status_code)
+            return res
+        except requests.RequestException as e:
+            code = type(e).__name__
+            raise
+        finally:
+            metrics.observe('bot_cmc_seconds', time.perf_counter() - start, {'endpoint': endpoint})
+            metrics.inc('bot_cmc_requests_total', {'endpoint': endpoint, 'code': code})
+
+    # ----- Telegram Bot API -----
+    class MeteredHTTPXRequest(HTTPXRequest):
+        """HTTPXRequest đếm latency theo method và số lần bị 429"""
+
+        async def do_request(self, url, method, *args, **kwargs):
+            api_method = url.rsplit('/', 1)[-1]
+            start = time.perf_counter()
+            with tracer.span(f"telegram.{api_method}", 'http'):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            metrics.observe('bot_telegram_api_seconds', time.perf_counter() - start, {'method': api_method})
+            if code == 429:
+                metrics.inc('bot_telegram_429_total', {'method': api_method})
+            return code, payload
+
+    # ----- Handler -----
+    def callback_route(data):
+        """'confirm_sell_12345678' -> 'confirm_sell': bỏ phần tham số để nhãn không bùng nổ"""
+        parts = []
+        for part in (data or '').split('_')[:4]:
+            if not part.isalpha() or not part.islower():
+                break
+            parts.append(part)
+        return '_'.join(parts) or 'other'
+
+    def handler_metric_labels(handler, update):
+        if isinstance(handler, CommandHandler):
+            text = (update.effective_message.text or '') if update.effective_message else ''
+            command = text.split(maxsplit=1)[0].lstrip('/').split('@')[0].lower() if text else ''
+            return 'command', command if command in handler.commands else sorted(handler.commands)[0]
+        if isinstance(handler, CallbackQueryHandler):
+            data = update.callback_query.data if update.callback_query else ''
+            route, _ = callback_router.resolve(data or '')
+            return 'callback', route.key.rstrip('_') if route else callback_route(data)
+        return 'message', getattr(handler.callback, '__name__', 'handler')
+
+    def instrument_handlers(application):
+        """Bọc callback của mọi handler đã đăng ký để đo latency/lỗi"""
+        def wrap(handler):
+            callback = handler.callback
+
+            @wraps(callback)
+            async def timed(update, ctx):
+                kind, name = handler_metric_labels(handler, update) if isinstance(update, Update) else ('other', callback.__name__)
+                labels = {'kind': kind, 'name': name}
+                start = time.perf_counter()
+                try:
+                    with tracer.span(f"{kind}:{name}", 'handler', root=True):
+                        return await callback(update, ctx)
+                except Exception:
+                    metrics.inc('bot_handler_errors_total', labels)
+                    raise
+                finally:
+                    metrics.observe('bot_handler_seconds', time.perf_counter() - start, labels)
+            handler.callback = timed
+
+        count = 0
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                wrap(handler)
+                count += 1
+        logger.info(f"📈 Đo latency cho {count} handler")
+
+    # ----- Alert engine -----
+    ALERT_INTERVAL = 60
+    alert_engine_state = {'last_run': None, 'checked': 0}
+
+    def alert_engine_lag():
+        """Số giây alert engine chậm so với lịch (0 nếu đúng hẹn)"""
+        last = alert_engine_state['last_run']
+        if last is None:
+            return 0
+        return max(0.0, time.time() - last - ALERT_INTERVAL)
+
+    metrics.gauge('bot_alert_lag_seconds', 'Seconds the alert engine is behind its schedule', alert_engine_lag)
+
+    # ==================== TRACING ====================
+    # Span theo contextvars: handler là gốc, DB/HTTP bên trong là span con.
+    # contextvars tự đi theo await/task và qua các decorator bọc handler; với
+    # executor thì phải gói bằng with_trace_context(). Chỉ 1 phần update được
+    # lấy mẫu (TRACE_SAMPLE_RATE, 0 = tắt), update không lấy mẫu gần như không tốn gì.
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+    TRACE_KEEP = 200
+    PROFILE_MAX_SECONDS = 60
+    PROFILE_INTERVAL = 0.005
+    PROFILE_IDLE_FRAMES = {'wait', 'select', '_worker', 'serve_forever', '_wait_for_tstate_lock', 'run_forever', '_run_once'}
+
+    current_span = contextvars.ContextVar('current_span', default=None)
+
+    class Span:
+        __slots__ = ('name', 'kind', 'start', 'duration', 'children', 'error', 'started_at')
+
+        def __init__(self, name, kind):
+            self.name = name
+            self.kind = kind
+            self.start = time.perf_counter()
+            self.started_at = time.time()
+            self.duration = None
+            self.children = []
+            self.error = None
+
+        def self_time(self):
+            return max(0.0, (self.duration or 0) - sum(child.duration or 0 for child in self.children))
+
+    class Tracer:
+        def __init__(self, sample_rate=TRACE_SAMPLE_RATE, keep=TRACE_KEEP):
+            self.sample_rate = sample_rate
+            self.traces = deque(maxlen=keep)
+            self.rng = random.Random()
+            self.roots_seen = 0
+            self.roots_sampled = 0
+
+        @contextmanager
+        def span(self, name, kind='internal', root=False):
+            """Span con nếu đang trong 1 trace; root=True thì có thể mở trace mới (theo tỉ lệ mẫu)"""
+            parent = current_span.get()
+            if parent is None:
+                if not root:
+                    yield None
+                    return
+                self.roots_seen += 1
+                if self.sample_rate <= 0 or self.rng.random() >= self.sample_rate:
+                    yield None
+                    return
+                self.roots_sampled += 1
+            
+            span = Span(name, kind)
+            token = current_span.set(span)
+            try:
+                yield span
+            except BaseException as e:
+                span.error = type(e).__name__
+                raise
+            finally:
+                span.duration = time.perf_counter() - span.start
+                current_span.reset(token)
+                if parent is None:
+                    self.traces.append(span)
+                else:
+                    parent.children.append(span)
+
+        def slowest(self, limit=10):
+            return sorted(list(self.traces), key=lambda s: s.duration or 0, reverse=True)[:limit]
+
+        def folded(self):
+            """Gộp mọi trace thành dạng collapsed stack (flamegraph.pl / speedscope), đơn vị µs"""
+            stacks = Counter()
+
+            def walk(span, prefix):
+                path = f"{prefix};{span.kind}:{span.name}" if prefix else f"{span.kind}:{span.name}"
+                stacks[path] += int(span.self_time() * 1_000_000)
+                for child in span.children:
+                    walk(child, path)
+
+            for root in list(self.traces):
+                walk(root, '')
+            return '\n'.join(f"{path} {value}" for path, value in stacks.items() if value > 0) + '\n'
+
+    tracer = Tracer()
+
+    def with_trace_context(fn, *args):
+        """Gói fn để chạy trong executor mà vẫn thấy span hiện tại (executor không tự copy contextvars)"""
+        ctx = contextvars.copy_context()
+        return lambda: ctx.run(fn, *args)
+
+    class StackSampler:
+        """Chụp stack mọi thread mỗi PROFILE_INTERVAL giây, đếm theo collapsed stack"""
+
+        def __init__(self, interval=PROFILE_INTERVAL):
+            self.interval = interval
+            self.stacks = Counter()
+            self.samples = 0
+
+        def run(self, seconds):
+            me = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+                time.sleep(self.interval)
+            return self
+
+        def folded(self):
+            return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+        def hottest(self, limit=8):
+            """Hàm đang chạy (đỉnh stack) xuất hiện nhiều nhất, bỏ các thread đang ngủ chờ"""
+            leaves = Counter()
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(';', 1)[-1]
+                if leaf.split(' (', 1)[0].rsplit('.', 1)[-1] in PROFILE_IDLE_FRAMES:
+                    continue
+                leaves[leaf] += count
+            return leaves.most_common(limit)
+
+    async def profile_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/profile [giây] | /profile trace [tỉ lệ] | /profile spans - Owner đo CPU / xem trace"""
+        if not is_owner(update.effective_user.id):
+            await update.message.reply_text("❌ Chỉ Owner mới có quyền sử dụng lệnh này!")
+            return
+        
+        action = ctx.args[0].lower() if ctx.args else ''
+        
+        if action == 'trace':
+            if len(ctx.args) > 1:
+                try:
+                    tracer.sample_rate = max(0.0, min(1.0, float(ctx.args[1])))
+                except ValueError:
+                    await update.message.reply_text("❌ /profile trace [0..1]")
+                    return
+            await update.message.reply_text(
+                f"🧵 *TRACING*\n━━━━━━━━━━━━━━━━\n\n"
+                f"• Tỉ lệ lấy mẫu: `{tracer.sample_rate:g}`\n"
+                f"• Update đã thấy: `{tracer.roots_seen}` | lấy mẫu: `{tracer.roots_sampled}`\n"
+                f"• Trace đang giữ: `{len(tracer.traces)}`/{TRACE_KEEP}\n\n"
+                f"🕐 {format_vn_time()}",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        if action == 'spans':
+            if not tracer.traces:
+                await update.message.reply_text("📭 Chưa có trace nào. Bật bằng /profile trace 0.1")
+                return
+            msg = "🧵 *TRACE CHẬM NHẤT*\n━━━━━━━━━━━━━━━━\n\n"
+            for span in tracer.slowest(8):
+                db_ms = sum(c.duration for c in span.children if c.kind == 'db') * 1000
+                http_ms = sum(c.duration for c in span.children if c.kind == 'http') * 1000
+                msg += (f"• `{span.name}` {span.duration * 1000:.0f}ms"
+                        f" (db {db_ms:.0f}ms, http {http_ms:.0f}ms, {len(span.children)} span)"
+                        f"{' ❌' + span.error if span.error else ''}\n")
+            await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_document(
+                document=io.BytesIO(tracer.folded().encode()),
+                filename=f"spans_{get_vn_time().strftime('%Y%m%d_%H%M%S')}.folded",
+                caption="🔥 Collapsed stacks (µs) - mở bằng speedscope.app hoặc flamegraph.pl"
+            )
+            return
+        
+        try:
+            seconds = float(action) if action else 10
+        except ValueError:
+            await update.message.reply_text("❌ /profile [giây] | /profile trace [tỉ lệ] | /profile spans")
+            return
+        seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+        
+        msg = await update.message.reply_text(f"⏱ Đang lấy mẫu CPU trong {seconds:g}s...")
+        sampler = await asyncio.to_thread(StackSampler().run, seconds)
+        
+        text = (f"🔥 *CPU PROFILE*\n━━━━━━━━━━━━━━━━\n\n"
+                f"• Thời gian: `{seconds:g}s` | Mẫu: `{sampler.samples}` | Stack: `{len(sampler.stacks)}`\n\n")
+        for leaf, count in sampler.hottest():
+            text += f"• `{leaf[:60]}` {count}\n"
+        await msg.edit_text(text + f"\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
+        await update.message.reply_document(
+            document=io.BytesIO(sampler.folded().encode()),
+            filename=f"profile_{get_vn_time().strftime('%Y%m%d_%H%M%S')}.folded",
+            caption="🔥 Collapsed stacks - mở bằng speedscope.app hoặc flamegraph.pl"
+        )
 
     # ==================== DATABASE OPTIMIZATION ====================
-    def optimize_database():
+    VACUUM_INTERVAL_DAYS = int(os.environ.get('VACUUM_INTERVAL_DAYS', 7))
+    VACUUM_MIN_FREE_RATIO = float(os.environ.get('VACUUM_MIN_FREE_RATIO', 0.2))
+
+    def optimize_database(force=False):
+        """Dọn alert cũ; VACUUM chỉ khi đến hạn và file có đủ trang trống để đáng khoá DB"""
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
-            c.execute("VACUUM")
             c.execute('''DELETE FROM alerts WHERE triggered_at IS NOT NULL AND date(triggered_at) < date('now', '-30 days')''')
             conn.commit()
-            conn.close()
             
-            if os.path.exists('bot.log'):
-                with open('bot.log', 'r') as f:
-                    lines = f.readlines()
-                if len(lines) > 1000:
-                    with open('bot.log', 'w') as f:
-                        f.writelines(lines[-1000:])
+            page_count = c.execute("PRAGMA page_count").fetchone()[0]
+            free_ratio = c.execute("PRAGMA freelist_count").fetchone()[0] / page_count if page_count else 0
+            due = time.time() - lifecycle.state.get('last_vacuum', 0) >= VACUUM_INTERVAL_DAYS * 86400
+            vacuumed = force or (due and free_ratio >= VACUUM_MIN_FREE_RATIO)
+            if vacuumed:
+                c.execute("VACUUM")
+                lifecycle.update_state(last_vacuum=time.time())
+            conn.close()
             
             size_mb = os.path.getsize(DB_PATH) / (1024 * 1024)
-            logger.info(f"✅ Database optimized: {size_mb:.2f}MB")
+            logger.info(f"✅ Database optimized: {size_mb:.2f}MB (free {free_ratio:.0%}, vacuum={vacuumed})")
+            return {'size_mb': round(size_mb, 2), 'free_ratio': round(free_ratio, 3), 'vacuumed': vacuumed}
         except Exception as e:
             logger.error(f"❌ Lỗi optimize DB: {e}")
+            return {'error': str(e)}
+
+    # ==================== MEMORY GOVERNOR ====================
+    # Lấy mẫu RSS mỗi MEMORY_SAMPLE_INTERVAL giây và giảm tải theo bậc (tỉ lệ so với MEMORY_LIMIT):
+    #   1 shrink  - bỏ nửa entry cũ nhất của các AdvancedCache
+    #   2 drop    - xả hết cache RAM, flood tracker, username cache
+    #   3 pause   - job báo cáo chưa chạy phải chờ tới khi bộ nhớ hạ
+    #   4 reject  - từ chối lệnh nặng (export, chart, benchmark...)
+    # Trên MEMORY_RESTART_RATIO thì restart session qua lifecycle. Hạ bậc cần xuống dưới
+    # ngưỡng - MEMORY_HYSTERESIS để không bật/tắt liên tục quanh 1 mốc.
+    MEMORY_SAMPLE_INTERVAL = int(os.environ.get('MEMORY_SAMPLE_INTERVAL', 10))
+    MEMORY_LOG_INTERVAL = int(os.environ.get('MEMORY_LOG_INTERVAL', 300))
+    MEMORY_ESTIMATE_INTERVAL = int(os.environ.get('MEMORY_ESTIMATE_INTERVAL', 60))
+    MEMORY_TIERS = (
+        (1, 'shrink', float(os.environ.get('MEMORY_TIER_SHRINK', 0.60))),
+        (2, 'drop', float(os.environ.get('MEMORY_TIER_DROP', 0.70))),
+        (3, 'pause_reports', float(os.environ.get('MEMORY_TIER_PAUSE', 0.80))),
+        (4, 'reject_heavy', float(os.environ.get('MEMORY_TIER_REJECT', 0.85))),
+    )
+    MEMORY_RESTART_RATIO = float(os.environ.get('MEMORY_RESTART_RATIO', 0.90))
+    MEMORY_HYSTERESIS = float(os.environ.get('MEMORY_HYSTERESIS', 0.05))
+    MEMORY_BUSY_TEXT = "⚠️ Máy chủ đang thiếu bộ nhớ, tạm ngưng xuất báo cáo/biểu đồ. Vui lòng thử lại sau ít phút!"
+
+    def deep_sizeof(obj, max_objects=5000):
+        """Ước lượng bytes của 1 cấu trúc: duyệt container + object của module này,
+        quá max_objects thì ngoại suy theo phần chưa duyệt"""
+        seen = set()
+        stack = [obj]
+        size = visited = 0
+        while stack and visited < max_objects:
+            item = stack.pop()
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            visited += 1
+            size += sys.getsizeof(item)
+            try:
+                if isinstance(item, dict):
+                    for key, value in list(item.items()):
+                        stack.append(key)
+                        stack.append(value)
+                elif isinstance(item, (list, tuple, set, frozenset, deque)):
+                    stack.extend(list(item))
+                elif type(item).__module__ == __name__ and hasattr(item, '__dict__'):
+                    stack.append(vars(item))
+            except RuntimeError:
+                pass  # Thread khác đang sửa - bỏ qua phần còn lại của object này
+        if stack and visited:
+            size = size * (visited + len(stack)) / visited
+        return int(size)
+
+    def memory_structures():
+        """Các cấu trúc sống lâu trong RAM cần theo dõi khi chỉnh cho gói 512MB"""
+        candidates = {
+            'price_cache': lambda: price_cache.cache,
+            'usdt_cache': lambda: usdt_cache.cache,
+            'user_touch_cache': lambda: _user_touch_cache.cache,
+            'feature_cache': lambda: _feature_cache.cache,
+            'chat_admins_cache': lambda: _chat_admins_cache.cache,
+            'master_of_cache': lambda: _master_of_cache.cache,
+            'username_cache': lambda: (username_cache.cache, username_cache.last_update),
+            'flood_tracker': lambda: _flood_tracker,
+            'mod_config_cache': lambda: (_captcha_config_cache, _flood_config_cache),
+            'price_history_buffer': lambda: price_history.pending,
+            'report_index': lambda: report_cache.index.cache,
+            'chart_index': lambda: chart_cache.index.cache,
+            'sanctions': lambda: sanctions.active,
+            'fed_index': lambda: fed_index,
+            'traces': lambda: tracer.traces,
+        }
+        result = {}
+        for name, get in candidates.items():
+            try:
+                result[name] = get()
+            except NameError:
+                pass  # Chưa định nghĩa (đang import dở)
+        return result
+
+    def memory_estimates():
+        return {name: deep_sizeof(obj) for name, obj in memory_structures().items()}
+
+    class MemoryGovernor:
+        def __init__(self):
+            self.tier = 0
+            self.rss_mb = 0.0
+            self.peak_mb = 0.0
+            self.samples = 0
+            self.changed_at = None
+            self.entered = Counter()    # tên bậc -> số lần vào
+            self.rejected = 0
+            self.reports_open = threading.Event()
+            self.reports_open.set()
+            self.last_log = 0
+            self.estimates = {}         # Ước lượng theo cấu trúc, làm mới trong thread memory_monitor
+            self.estimated_at = 0
+
+        def target_tier(self, rss_mb):
+            limit = render_config.memory_limit
+            tier = 0
+            for level, _, ratio in MEMORY_TIERS:
+                threshold = limit * ratio
+                if self.tier >= level:
+                    threshold -= limit * MEMORY_HYSTERESIS
+                if rss_mb >= threshold:
+                    tier = level
+            return tier
+
+        def sample(self):
+            rss_mb = psutil.Process().memory_info().rss / 1024 / 1024
+            self.rss_mb = rss_mb
+            self.peak_mb = max(self.peak_mb, rss_mb)
+            self.samples += 1
+            
+            tier = self.target_tier(rss_mb)
+            if tier != self.tier:
+                names = [name for level, name, _ in MEMORY_TIERS if self.tier < level <= tier]
+                log = logger.warning if tier > self.tier else logger.info
+                log(f"🧠 Memory tier {self.tier} → {tier} ({rss_mb:.0f}MB/{render_config.memory_limit}MB) {' '.join(names)}")
+                for level, name, _ in MEMORY_TIERS:
+                    if self.tier < level <= tier:
+                        self.entered[name] += 1
+                        self.run_on_loop(self.shed, level)
+                self.tier = tier
+                self.changed_at = time.time()
+            
+            if tier >= 3:
+                self.reports_open.clear()
+            else:
+                self.reports_open.set()
+            
+            if rss_mb > render_config.memory_limit * MEMORY_RESTART_RATIO:
+                lifecycle.request_stop(f"memory {rss_mb:.0f}MB", restart=True)
+            return rss_mb
+
+        def run_on_loop(self, fn, *args):
+            """Dọn cấu trúc của handler trên chính event loop để không đua với handler đang chạy"""
+            loop = lifecycle.loop
+            if loop and loop.is_running():
+                loop.call_soon_threadsafe(fn, *args)
+            else:
+                fn(*args)
+
+        def shed(self, level):
+            if level == 1:
+                removed = sum(cache.shrink(0.5) for cache in (price_cache, _user_touch_cache, _feature_cache,
+                                                              _chat_admins_cache, _master_of_cache))
+                logger.info(f"🧹 Shrink cache: bỏ {removed} entry")
+            elif level == 2:
+                freed = release_memory()
+                logger.info(f"🧹 Đã xả cache/flood tracker, gc thu hồi {freed} object")
+
+        def refresh_estimates(self):
+            """deep_sizeof duyệt toàn bộ container nên chỉ chạy ở thread monitor hoặc /memory, không chạy trên event loop"""
+            self.estimates = memory_estimates()
+            self.estimated_at = time.time()
+            return self.estimates
+
+        def rejecting_heavy(self):
+            return self.tier >= 4
+
+        def wait_reports(self):
+            """Gọi trong worker báo cáo: chờ khi đang ở bậc pause (trừ lúc đang drain để restart)"""
+            while not self.reports_open.wait(5):
+                if lifecycle.phase != 'running':
+                    return
+
+        def get_stats(self, estimates=False):
+            stats = {
+                'rss_mb': round(self.rss_mb, 1),
+                'peak_mb': round(self.peak_mb, 1),
+                'limit_mb': render_config.memory_limit,
+                'tier': self.tier,
+                'tier_name': next((name for level, name, _ in MEMORY_TIERS if level == self.tier), 'normal'),
+                'entered': dict(self.entered),
+                'rejected_heavy': self.rejected,
+                'reports_paused': not self.reports_open.is_set(),
+            }
+            if estimates:
+                stats['estimates_kb'] = {name: round(size / 1024, 1) for name, size in self.estimates.items()}
+            return stats
+
+    memory_governor = MemoryGovernor()
+    metrics.gauge('bot_memory_tier', 'Memory governor shedding tier (0 = normal)', lambda: memory_governor.tier)
+    metrics.gauge('bot_memory_structure_bytes', 'Estimated bytes held by long-lived in-memory structures',
+                  lambda: [({'structure': name}, size) for name, size in memory_governor.estimates.items()])
+
+    def heavy_command(func):
+        """Lệnh tốn RAM: từ chối khi governor đang ở bậc reject"""
+        @wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+            if memory_governor.rejecting_heavy():
+                memory_governor.rejected += 1
+                if update.callback_query:
+                    await update.callback_query.answer(MEMORY_BUSY_TEXT, show_alert=True)
+                elif update.effective_message:
+                    await update.effective_message.reply_text(MEMORY_BUSY_TEXT)
+                return
+            return await func(update, context, *args, **kwargs)
+        return wrapper
 
     # ==================== BACKGROUND TASKS ====================
     def check_memory_usage():
         try:
-            process = psutil.Process()
-            memory_info = process.memory_info()
-            memory_mb = memory_info.rss / 1024 / 1024
-            cpu_percent = process.cpu_percent()
-            
-            logger.info(f"📊 Memory: {memory_mb:.2f}MB | CPU: {cpu_percent:.1f}% | Cache: P{price_cache.get_stats()['size']}/U{usdt_cache.get_stats()['size']}")
-            
-            if memory_mb > render_config.memory_limit * 0.7:
-                logger.warning("⚠️ Memory high, cleaning caches...")
-                price_cache.clear()
-                usdt_cache.clear()
-                gc.collect()
-                
-            if memory_mb > render_config.memory_limit * 0.9:
-                logger.critical("💥 Memory critical, restarting...")
-                sys.exit(1)
+            rss_mb = memory_governor.sample()
+            if time.time() - memory_governor.last_log >= MEMORY_LOG_INTERVAL:
+                memory_governor.last_log = time.time()
+                logger.info(f"📊 Memory: {rss_mb:.2f}MB | CPU: {psutil.Process().cpu_percent():.1f}% | "
+                            f"Tier: {memory_governor.tier} | Cache: P{price_cache.get_stats()['size']}/U{usdt_cache.get_stats()['size']}")
+            if time.time() - memory_governor.estimated_at >= MEMORY_ESTIMATE_INTERVAL:
+                memory_governor.refresh_estimates()
         except Exception as e:
             logger.error(f"❌ Memory check error: {e}")
 
     def memory_monitor():
         while True:
             check_memory_usage()
-            time.sleep(300)
+            time.sleep(MEMORY_SAMPLE_INTERVAL)
 
-    # ==================== DATABASE SETUP ====================
-    def init_database():
-        conn = None
-        try:
-            conn = sqlite3.connect(DB_PATH, timeout=10)
-            c = conn.cursor()
-            
-            c.execute('''CREATE TABLE IF NOT EXISTS portfolio (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, symbol TEXT, amount REAL, buy_price REAL, buy_date TEXT, total_cost REAL)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, symbol TEXT, target_price REAL, condition TEXT, is_active INTEGER DEFAULT 1, created_at TEXT, triggered_at TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS expense_categories (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, name TEXT, budget REAL, created_at TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, category_id INTEGER, amount REAL, currency TEXT DEFAULT 'VND', note TEXT, expense_date TEXT, created_at TEXT, FOREIGN KEY (category_id) REFERENCES expense_categories(id))''')
-            c.execute('''CREATE TABLE IF NOT EXISTS incomes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, currency TEXT DEFAULT 'VND', source TEXT, income_date TEXT, note TEXT, created_at TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, last_seen TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS group_admins (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, admin_id INTEGER, granted_by INTEGER, can_view INTEGER DEFAULT 0, can_edit INTEGER DEFAULT 0, can_delete INTEGER DEFAULT 0, can_manage INTEGER DEFAULT 0, created_at TEXT, UNIQUE(group_id, admin_id))''')
-            c.execute('''CREATE TABLE IF NOT EXISTS permission_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, action_by INTEGER, target_user INTEGER, action TEXT, old_role TEXT, new_role TEXT, created_at TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS group_owners (group_id INTEGER PRIMARY KEY, owner_id INTEGER, created_at TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS permissions (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, user_id INTEGER, granted_by INTEGER, is_approved INTEGER DEFAULT 1, role TEXT DEFAULT 'user', can_view_all INTEGER DEFAULT 0, can_edit_all INTEGER DEFAULT 0, can_delete_all INTEGER DEFAULT 0, can_manage_perms INTEGER DEFAULT 0, created_at TEXT, approved_at TEXT, UNIQUE(group_id, user_id))''')
-            c.execute('''CREATE TABLE IF NOT EXISTS sell_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                symbol TEXT,
-                amount REAL,
-                sell_price REAL,
-                buy_price REAL,
-                total_sold REAL,
-                total_cost REAL,
-                profit REAL,
-                profit_percent REAL,
-                sell_date TEXT,
-                created_at TEXT
-            )''')
-            conn.commit()
-            mod_init_tables()
-            logger.info(f"✅ Database initialized")
+    async def memory_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/memory - RSS, bậc giảm tải và ước lượng RAM từng cấu trúc (Owner)"""
+        if not is_owner(update.effective_user.id):
+            await update.message.reply_text("❌ Chỉ Owner mới có quyền sử dụng lệnh này!")
+            return
+        await asyncio.to_thread(memory_governor.refresh_estimates)
+        stats = memory_governor.get_stats(estimates=True)
+        text = (f"🧠 *BỘ NHỚ*\n━━━━━━━━━━━━━━━━\n\n"
+                f"• RSS: `{stats['rss_mb']}MB` / `{stats['limit_mb']}MB` (đỉnh `{stats['peak_mb']}MB`)\n"
+                f"• Bậc: `{stats['tier']}` ({stats['tier_name']})\n"
+                f"• Báo cáo tạm dừng: {'có' if stats['reports_paused'] else 'không'} | Lệnh nặng bị từ chối: `{stats['rejected_heavy']}`\n\n"
+                f"*Ước lượng theo cấu trúc:*\n")
+        for name, kb in sorted(stats['estimates_kb'].items(), key=lambda item: -item[1]):
+            text += f"• `{name}`: {kb:g} KB\n"
+        await update.message.reply_text(text + f"\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
+
+    # ==================== SCHEMA MIGRATIONS ====================
+    # Schema đi theo PRAGMA user_version: mỗi bước @schema_migration(n, tên) chạy đúng 1 lần,
+    # trong transaction riêng cùng với việc nâng user_version lên n. Khi schema đã mới nhất,
+    # khởi động chỉ tốn 1 lần đọc user_version. Thêm bảng/cột/index = thêm bước mới với
+    # version kế tiếp, không sửa bước cũ. Bước 1-9 dựng lại schema có từ trước khi có version
+    # nên viết idempotent (IF NOT EXISTS / kiểm tra cột) để chạy an toàn trên DB cũ.
+    # Mỗi file SQLite có danh sách migration + user_version riêng (xem schema_targets).
+    SCHEMA_MIGRATIONS = []   # [(version, name, fn(cursor))]
+
+    def schema_migration(version, name, registry=None):
+        def register(fn):
+            (SCHEMA_MIGRATIONS if registry is None else registry).append((version, name, fn))
+            return fn
+        return register
+
+    def add_column_if_missing(c, table, column, decl):
+        """ALTER TABLE ADD COLUMN nếu bảng có mà chưa có cột (chỉ dùng trong migration)"""
+        c.execute(f"PRAGMA table_info({table})")
+        columns = [col[1] for col in c.fetchall()]
+        if columns and column not in columns:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            logger.info(f"✅ Migration: thêm cột {column} vào {table}")
             return True
-        except Exception as e:
-            logger.error(f"❌ Lỗi database: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
+        return False
 
-    def migrate_database():
-        conn = None
+    def latest_schema_version(migrations=None):
+        return max((version for version, _, _ in (migrations or SCHEMA_MIGRATIONS)), default=0)
+
+    def run_migrations(path=None, migrations=None, journal_mode=None):
+        """Đưa DB lên version mới nhất, trả về [(version, name, ms)] các bước đã chạy"""
+        steps = sorted(migrations or SCHEMA_MIGRATIONS, key=lambda step: step[0])
+        if [step[0] for step in steps] != list(range(1, len(steps) + 1)):
+            raise RuntimeError(f"Schema migration phải đánh số liên tục từ 1: {[step[0] for step in steps]}")
+        
+        conn = db_connect(path or DB_PATH, timeout=30, isolation_level=None)
+        applied = []
         try:
-            conn = sqlite3.connect(DB_PATH, timeout=10)
             c = conn.cursor()
-            
-            c.execute("PRAGMA table_info(incomes)")
-            columns = [column[1] for column in c.fetchall()]
-            if 'currency' not in columns:
-                c.execute("ALTER TABLE incomes ADD COLUMN currency TEXT DEFAULT 'VND'")
-            
-            c.execute("PRAGMA table_info(expenses)")
-            columns = [column[1] for column in c.fetchall()]
-            if 'currency' not in columns:
-                c.execute("ALTER TABLE expenses ADD COLUMN currency TEXT DEFAULT 'VND'")
-
-            c.execute('''CREATE TABLE IF NOT EXISTS sell_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                symbol TEXT,
-                amount REAL,
-                sell_price REAL,
-                buy_price REAL,
-                total_sold REAL,
-                total_cost REAL,
-                profit REAL,
-                profit_percent REAL,
-                sell_date TEXT,
-                created_at TEXT
-            )''')
-
-            # === MULTI-GROUP SYSTEM TABLES ===
-            c.execute('''CREATE TABLE IF NOT EXISTS master_groups (
-                group_id INTEGER PRIMARY KEY,
-                group_name TEXT,
-                set_by INTEGER,
-                created_at TEXT
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS group_hierarchy (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                master_group_id INTEGER,
-                child_group_id INTEGER,
-                child_group_name TEXT,
-                autonomy_level INTEGER DEFAULT 0,
-                added_by INTEGER,
-                created_at TEXT,
-                UNIQUE(master_group_id, child_group_id)
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS group_features (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                feature_key TEXT,
-                is_enabled INTEGER DEFAULT 0,
-                set_by INTEGER,
-                updated_at TEXT,
-                UNIQUE(group_id, feature_key)
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS cross_bans (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                master_group_id INTEGER,
-                banned_user_id INTEGER,
-                banned_by INTEGER,
-                reason TEXT,
-                banned_at TEXT,
-                is_active INTEGER DEFAULT 1,
-                UNIQUE(master_group_id, banned_user_id)
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                master_group_id INTEGER,
-                message TEXT,
-                sent_by INTEGER,
-                target_groups TEXT,
-                sent_at TEXT,
-                success_count INTEGER DEFAULT 0,
-                fail_count INTEGER DEFAULT 0
-            )''')
+            current = c.execute("PRAGMA user_version").fetchone()[0]
+            if journal_mode and current < steps[-1][0]:
+                c.execute(f"PRAGMA journal_mode={journal_mode}")   # Lưu trong file, không chạy được trong transaction
+            for version, name, fn in steps:
+                if version <= current:
+                    continue
+                started = time.perf_counter()
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    fn(c)
+                    c.execute(f"PRAGMA user_version = {int(version)}")
+                    c.execute("COMMIT")
+                except Exception:
+                    c.execute("ROLLBACK")
+                    logger.error(f"❌ Migration v{version} {name} lỗi, DB giữ ở v{current}")
+                    raise
+                current = version
+                ms = round((time.perf_counter() - started) * 1000, 1)
+                applied.append((version, name, ms))
+                logger.info(f"✅ Migration v{version} {name}: {ms:g}ms")
+        finally:
+            conn.close()
+        return applied
 
-            conn.commit()
-            logger.info(f"✅ Database initialized with sell_history + multi-group tables")
-
-            # Migration: thêm cột mute_duration vào mod_flood_config nếu chưa có
-            c.execute("PRAGMA table_info(mod_flood_config)")
-            flood_cols = [col[1] for col in c.fetchall()]
-            if 'mute_duration' not in flood_cols and flood_cols:
-                c.execute("ALTER TABLE mod_flood_config ADD COLUMN mute_duration INTEGER DEFAULT 300")
-                logger.info("✅ Migration: thêm cột mute_duration vào mod_flood_config")
-
-            # Migration: thêm cột mute_duration vào mod_warn_config nếu chưa có
-            c.execute("PRAGMA table_info(mod_warn_config)")
-            warn_cols = [col[1] for col in c.fetchall()]
-            if 'mute_duration' not in warn_cols and warn_cols:
-                c.execute("ALTER TABLE mod_warn_config ADD COLUMN mute_duration INTEGER DEFAULT 3600")
-                logger.info("✅ Migration: thêm cột mute_duration vào mod_warn_config")
-
-            # Migration: tạo bảng co_owners nếu chưa có
-            c.execute('''CREATE TABLE IF NOT EXISTS co_owners
-                         (user_id INTEGER PRIMARY KEY, username TEXT, added_by INTEGER, added_at TEXT)''')
+    # ==================== DATABASE SETUP ====================
+    @schema_migration(1, 'core_tables')
+    def _migrate_core_tables(c):
+        c.execute('''CREATE TABLE IF NOT EXISTS portfolio (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, symbol TEXT, amount REAL, buy_price REAL, buy_date TEXT, total_cost REAL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, symbol TEXT, target_price REAL, condition TEXT, is_active INTEGER DEFAULT 1, created_at TEXT, triggered_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS expense_categories (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, name TEXT, budget REAL, created_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, category_id INTEGER, amount REAL, currency TEXT DEFAULT 'VND', note TEXT, expense_date TEXT, created_at TEXT, FOREIGN KEY (category_id) REFERENCES expense_categories(id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS incomes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, currency TEXT DEFAULT 'VND', source TEXT, income_date TEXT, note TEXT, created_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, last_seen TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS group_admins (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, admin_id INTEGER, granted_by INTEGER, can_view INTEGER DEFAULT 0, can_edit INTEGER DEFAULT 0, can_delete INTEGER DEFAULT 0, can_manage INTEGER DEFAULT 0, created_at TEXT, UNIQUE(group_id, admin_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS permission_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, action_by INTEGER, target_user INTEGER, action TEXT, old_role TEXT, new_role TEXT, created_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS group_owners (group_id INTEGER PRIMARY KEY, owner_id INTEGER, created_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS permissions (id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER, user_id INTEGER, granted_by INTEGER, is_approved INTEGER DEFAULT 1, role TEXT DEFAULT 'user', can_view_all INTEGER DEFAULT 0, can_edit_all INTEGER DEFAULT 0, can_delete_all INTEGER DEFAULT 0, can_manage_perms INTEGER DEFAULT 0, created_at TEXT, approved_at TEXT, UNIQUE(group_id, user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sell_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            symbol TEXT,
+            amount REAL,
+            sell_price REAL,
+            buy_price REAL,
+            total_sold REAL,
+            total_cost REAL,
+            profit REAL,
+            profit_percent REAL,
+            sell_date TEXT,
+            created_at TEXT
+        )''')
+
+    # v2 moderation_tables: xem MODERATION: DATABASE TABLES
+
+    @schema_migration(3, 'currency_columns')
+    def _migrate_currency_columns(c):
+        add_column_if_missing(c, 'incomes', 'currency', "TEXT DEFAULT 'VND'")
+        add_column_if_missing(c, 'expenses', 'currency', "TEXT DEFAULT 'VND'")
+
+    @schema_migration(4, 'sell_lots')
+    def _migrate_sell_lots(c):
+        add_column_if_missing(c, 'sell_history', 'cost_method', "TEXT DEFAULT 'fifo'")
+
+        # Lot đã tiêu thụ bởi từng lệnh bán (lot_id có thể đã bị xóa nếu bán hết)
+        c.execute('''CREATE TABLE IF NOT EXISTS sell_lots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sell_id INTEGER,
+            lot_id INTEGER,
+            user_id INTEGER,
+            symbol TEXT,
+            amount REAL,
+            buy_price REAL,
+            cost REAL,
+            buy_date TEXT
+        )''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_sell_lots_sell ON sell_lots(sell_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_portfolio_user_symbol ON portfolio(user_id, symbol, buy_date)")
+        c.execute("CREATE TRIGGER IF NOT EXISTS trg_sell_history_delete_lots AFTER DELETE ON sell_history "
+                  "BEGIN DELETE FROM sell_lots WHERE sell_id = OLD.id; END")
+    @schema_migration(5, 'multi_group_tables')
+    def _migrate_multi_group_tables(c):
+        c.execute('''CREATE TABLE IF NOT EXISTS master_groups (
+            group_id INTEGER PRIMARY KEY,
+            group_name TEXT,
+            set_by INTEGER,
+            created_at TEXT
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS group_hierarchy (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_group_id INTEGER,
+            child_group_id INTEGER,
+            child_group_name TEXT,
+            autonomy_level INTEGER DEFAULT 0,
+            added_by INTEGER,
+            created_at TEXT,
+            UNIQUE(master_group_id, child_group_id)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS group_features (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER,
+            feature_key TEXT,
+            is_enabled INTEGER DEFAULT 0,
+            set_by INTEGER,
+            updated_at TEXT,
+            UNIQUE(group_id, feature_key)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS cross_bans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_group_id INTEGER,
+            banned_user_id INTEGER,
+            banned_by INTEGER,
+            reason TEXT,
+            banned_at TEXT,
+            is_active INTEGER DEFAULT 1,
+            UNIQUE(master_group_id, banned_user_id)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_group_id INTEGER,
+            message TEXT,
+            sent_by INTEGER,
+            target_groups TEXT,
+            sent_at TEXT,
+            success_count INTEGER DEFAULT 0,
+            fail_count INTEGER DEFAULT 0
+        )''')
+    @schema_migration(6, 'data_versions')
+    def _migrate_data_versions(c):
+        """Version dữ liệu theo user: tăng mỗi lần user ghi dữ liệu (khoá cache báo cáo)"""
+        c.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER DEFAULT 0
+        )''')
+        create_data_version_triggers(c, ('portfolio', 'sell_history', 'incomes', 'expenses'))
+
+    def create_data_version_triggers(c, tables):
+        """Trigger tăng data_versions của user mỗi khi INSERT/UPDATE/DELETE trên các bảng này"""
+        for table in tables:
+            for op, rows in (('INSERT', ('NEW',)), ('UPDATE', ('NEW', 'OLD')), ('DELETE', ('OLD',))):
+                bumps = ''.join(
+                    f"INSERT INTO data_versions (user_id, version) VALUES ({row}.user_id, 1) "
+                    f"ON CONFLICT(user_id) DO UPDATE SET version = version + 1; "
+                    for row in rows
+                )
+                c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_version "
+                          f"AFTER {op} ON {table} BEGIN {bumps}END")
+
+    @schema_migration(7, 'positions')
+    def _migrate_positions(c):
+        """Bảng tổng hợp theo (user, symbol) do trigger duy trì"""
+        if create_positions_schema(c):
+            logger.info("✅ Migration: tạo bảng positions và backfill từ portfolio + sell_history")
+
+    @schema_migration(8, 'mod_mute_duration')
+    def _migrate_mod_mute_duration(c):
+        add_column_if_missing(c, 'mod_flood_config', 'mute_duration', "INTEGER DEFAULT 300")
+        add_column_if_missing(c, 'mod_warn_config', 'mute_duration', "INTEGER DEFAULT 3600")
+
+    @schema_migration(9, 'co_owners')
+    def _migrate_co_owners(c):
+        c.execute('''CREATE TABLE IF NOT EXISTS co_owners
+                     (user_id INTEGER PRIMARY KEY, username TEXT, added_by INTEGER, added_at TEXT)''')
+
+    @schema_migration(10, 'hot_path_indexes')
+    def _migrate_hot_path_indexes(c):
+        """Index cho truy vấn chạy thường xuyên: thu chi theo user, alert đang bật, cảnh cáo"""
+        c.execute("CREATE INDEX IF NOT EXISTS idx_incomes_user_date ON incomes(user_id, income_date)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses(user_id, expense_date)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses(category_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_alerts_user ON alerts(user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_alerts_active ON alerts(is_active) WHERE is_active = 1")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mod_warns_group_user ON mod_warns(group_id, user_id)")
+
+    # v11 mod_sanctions_expiry: xem MODERATION: DATABASE TABLES
+
+    @schema_migration(12, 'category_data_version')
+    def _migrate_category_data_version(c):
+        """Đổi tên/ngân sách danh mục cũng làm báo cáo thu chi cũ đi"""
+        create_data_version_triggers(c, ('expense_categories',))
 
-            conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"❌ Lỗi database: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
-                
     def backup_database():
         try:
             if os.path.exists(DB_PATH) and os.path.getsize(DB_PATH) > 1024 * 1024:
@@ -960,8 +1851,12 @@ try:
     def schedule_backup():
         while True:
             try:
+                # Mốc backup lưu trong lifecycle.json nên restart không backup dồn dập
+                since = time.time() - lifecycle.state.get('last_backup', 0)
+                if since < 86400:
+                    time.sleep(86400 - since)
                 backup_database()
-                time.sleep(86400)
+                lifecycle.update_state(last_backup=time.time())
             except:
                 time.sleep(3600)
 
@@ -986,10 +1881,9 @@ try:
                     batch = uncached[i:i+10]
                     symbols_str = ','.join(batch)
                     
-                    headers = {'X-CMC_PRO_API_KEY': CMC_API_KEY}
                     params = {'symbol': symbols_str, 'convert': 'USD'}
                     
-                    res = requests.get(f"{CMC_API_URL}/cryptocurrency/quotes/latest", headers=headers, params=params, timeout=10)
+                    res = cmc_get('/cryptocurrency/quotes/latest', params=params)
                     
                     if res.status_code == 200:
                         data = res.json()
@@ -1007,6 +1901,7 @@ try:
                                 }
                                 results[symbol] = result
                                 price_cache.set(symbol, result)
+                                price_history.record(symbol, result['p'])
                     
                     time.sleep(0.5)
             
@@ -1030,10 +1925,9 @@ try:
             else:
                 clean = clean_symbol.replace('USDT', '').replace('USD', '')
             
-            headers = {'X-CMC_PRO_API_KEY': CMC_API_KEY}
             params = {'symbol': clean, 'convert': 'USD'}
             
-            res = requests.get(f"{CMC_API_URL}/cryptocurrency/quotes/latest", headers=headers, params=params, timeout=10)
+            res = cmc_get('/cryptocurrency/quotes/latest', params=params)
             
             if res.status_code == 200:
                 data = res.json()
@@ -1052,6 +1946,7 @@ try:
                     'r': coin_data.get('cmc_rank', 'N/A')
                 }
                 price_cache.set(symbol, result)
+                price_history.record(clean, result['p'])
                 return result
             else:
                 return None
@@ -1094,11 +1989,264 @@ try:
             logger.error(f"❌ Lỗi get_usdt_vnd_rate: {e}")
             return {'source': 'Error', 'vnd': 25000, 'update_time': format_vn_time()}
 
+    # ==================== PRICE HISTORY ====================
+    # Lưu lại mọi giá vừa lấy từ API (thay vì bỏ đi sau TTL 60s của price_cache)
+    # File SQLite riêng (prices.db) để ghi liên tục không tranh khóa với DB chính và không phình backup
+    # - price_ticks: giá thô append-only, giữ PRICE_HISTORY_RAW_DAYS ngày
+    # - price_ohlc: nến gộp theo giờ / ngày (theo giờ VN), cập nhật cộng dồn khi flush
+    # Chỉ ghi giá bot đã lấy sẵn (get_price / get_prices_batch), không tự gọi thêm API.
+    # record() chỉ đẩy vào buffer trong RAM, price_history_worker flush định kỳ
+    PRICE_DB_PATH = os.path.join(DATA_DIR, 'prices.db')
+    PRICE_HISTORY_MIN_GAP = int(os.environ.get('PRICE_HISTORY_MIN_GAP', 60))        # Giây tối thiểu giữa 2 mẫu / coin
+    PRICE_HISTORY_FLUSH = int(os.environ.get('PRICE_HISTORY_FLUSH', 60))            # Chu kỳ ghi buffer xuống đĩa
+    PRICE_HISTORY_RAW_DAYS = int(os.environ.get('PRICE_HISTORY_RAW_DAYS', 7))
+    PRICE_HISTORY_HOURLY_DAYS = int(os.environ.get('PRICE_HISTORY_HOURLY_DAYS', 90))  # Nến ngày giữ vĩnh viễn
+    PRICE_INTERVALS = {'1h': 3600, '1d': 86400}
+    VN_OFFSET = 7 * 3600
+
+    def price_bucket(ts, interval):
+        """Đầu kỳ (epoch) của nến chứa ts - căn theo giờ Việt Nam"""
+        return (int(ts) + VN_OFFSET) // interval * interval - VN_OFFSET
+
+    def vn_time_to_ts(value):
+        """'%Y-%m-%d %H:%M:%S' giờ VN (định dạng buy_date) -> epoch"""
+        try:
+            return int((datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S") - datetime(1970, 1, 1)).total_seconds()) - VN_OFFSET
+        except Exception:
+            return 0
+
+    PRICE_SCHEMA_MIGRATIONS = []   # Migration của prices.db (user_version riêng)
+
+    @schema_migration(1, 'price_history', PRICE_SCHEMA_MIGRATIONS)
+    def _migrate_price_history(c):
+        c.execute('''CREATE TABLE IF NOT EXISTS price_ticks (
+            symbol TEXT,
+            ts INTEGER,
+            price REAL,
+            PRIMARY KEY (symbol, ts)
+        ) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS price_ohlc (
+            symbol TEXT,
+            interval INTEGER,
+            bucket INTEGER,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            first_ts INTEGER,
+            last_ts INTEGER,
+            samples INTEGER,
+            PRIMARY KEY (symbol, interval, bucket)
+        ) WITHOUT ROWID''')
+
+    class PriceHistory:
+        """Kho lịch sử giá: buffer RAM + SQLite (tick thô + nến OHLC giờ/ngày)"""
+
+        def __init__(self, path):
+            self.path = path
+            self.lock = threading.Lock()
+            self.pending = []      # (symbol, ts, price) chờ flush
+            self.last_seen = {}    # symbol -> ts mẫu gần nhất (chống ghi dày)
+            self.recorded = 0
+            self.flushed = 0
+            self.last_prune = 0
+
+        def connect(self):
+            return db_connect(self.path, timeout=10)
+
+        def record(self, symbol, price, ts=None):
+            """Ghi nhận 1 giá vừa lấy từ API - rẻ, chỉ append vào buffer"""
+            if not price or price <= 0:
+                return
+            ts = int(ts if ts is not None else time.time())
+            with self.lock:
+                if abs(ts - self.last_seen.get(symbol, 0)) < PRICE_HISTORY_MIN_GAP:
+                    return
+                self.last_seen[symbol] = ts
+                self.pending.append((symbol, ts, float(price)))
+                self.recorded += 1
+
+        def flush(self):
+            """Ghi buffer xuống đĩa: tick thô + upsert nến giờ/ngày trong 1 transaction"""
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            batch.sort(key=lambda row: row[1])
+            conn = None
+            try:
+                conn = self.connect()
+                c = conn.cursor()
+                c.executemany("INSERT OR IGNORE INTO price_ticks (symbol, ts, price) VALUES (?, ?, ?)", batch)
+                candles = [(symbol, interval, price_bucket(ts, interval), price, price, price, price, ts, ts)
+                           for symbol, ts, price in batch for interval in PRICE_INTERVALS.values()]
+                c.executemany('''INSERT INTO price_ohlc (symbol, interval, bucket, open, high, low, close, first_ts, last_ts, samples)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                                 ON CONFLICT(symbol, interval, bucket) DO UPDATE SET
+                                     open = CASE WHEN excluded.first_ts < first_ts THEN excluded.open ELSE open END,
+                                     first_ts = MIN(first_ts, excluded.first_ts),
+                                     high = MAX(high, excluded.high),
+                                     low = MIN(low, excluded.low),
+                                     close = CASE WHEN excluded.last_ts >= last_ts THEN excluded.close ELSE close END,
+                                     last_ts = MAX(last_ts, excluded.last_ts),
+                                     samples = samples + 1''', candles)
+                conn.commit()
+                self.flushed += len(batch)
+                return len(batch)
+            except Exception as e:
+                logger.error(f"❌ Lỗi flush price history: {e}")
+                with self.lock:
+                    self.pending[:0] = batch  # Giữ lại để lần sau ghi tiếp
+                return 0
+            finally:
+                if conn:
+                    conn.close()
+
+        def prune(self):
+            """Xóa tick thô quá PRICE_HISTORY_RAW_DAYS và nến giờ quá PRICE_HISTORY_HOURLY_DAYS"""
+            now = int(time.time())
+            conn = None
+            try:
+                conn = self.connect()
+                c = conn.cursor()
+                c.execute("DELETE FROM price_ticks WHERE ts < ?", (now - PRICE_HISTORY_RAW_DAYS * 86400,))
+                ticks = c.rowcount
+                c.execute("DELETE FROM price_ohlc WHERE interval = ? AND bucket < ?",
+                          (PRICE_INTERVALS['1h'], now - PRICE_HISTORY_HOURLY_DAYS * 86400))
+                conn.commit()
+                self.last_prune = now
+                if ticks or c.rowcount:
+                    logger.info(f"🧹 Price history: xóa {ticks} tick, {c.rowcount} nến giờ cũ")
+            except Exception as e:
+                logger.error(f"❌ Lỗi prune price history: {e}")
+            finally:
+                if conn:
+                    conn.close()
+
+        def candles(self, symbol, interval='1d', since=None):
+            """[(bucket, open, high, low, close)] tăng dần theo thời gian"""
+            self.flush()
+            conn = self.connect()
+            try:
+                c = conn.cursor()
+                c.execute('''SELECT bucket, open, high, low, close FROM price_ohlc
+                             WHERE symbol = ? AND interval = ? AND bucket >= ? ORDER BY bucket''',
+                          (symbol, PRICE_INTERVALS[interval], since or 0))
+                return c.fetchall()
+            finally:
+                conn.close()
+
+        def closes(self, symbols, interval='1d', since=None):
+            """{symbol: [(bucket, close)]} cho nhiều coin trong 1 query"""
+            result = {symbol: [] for symbol in symbols}
+            if not symbols:
+                return result
+            self.flush()
+            conn = self.connect()
+            try:
+                c = conn.cursor()
+                marks = ','.join('?' * len(symbols))
+                c.execute(f'''SELECT symbol, bucket, close FROM price_ohlc
+                              WHERE interval = ? AND bucket >= ? AND symbol IN ({marks}) ORDER BY symbol, bucket''',
+                          (PRICE_INTERVALS[interval], since or 0, *symbols))
+                for symbol, bucket, close in c.fetchall():
+                    result[symbol].append((bucket, close))
+                return result
+            finally:
+                conn.close()
+
+        def get_stats(self):
+            stats = {'recorded': self.recorded, 'flushed': self.flushed, 'pending': len(self.pending),
+                     'symbols': len(self.last_seen), 'size_mb': 0}
+            if os.path.exists(self.path):
+                stats['size_mb'] = round(os.path.getsize(self.path) / (1024 * 1024), 2)
+            return stats
+
+    price_history = PriceHistory(PRICE_DB_PATH)
+
+    def price_change(series, seconds, now=None):
+        """% thay đổi giữa close hiện tại và close gần nhất trước mốc now - seconds (None nếu thiếu dữ liệu)"""
+        if not series:
+            return None
+        now = now or time.time()
+        cutoff = now - seconds
+        base = None
+        for bucket, close in series:
+            if bucket > cutoff:
+                break
+            base = close
+        if not base:
+            return None
+        return (series[-1][1] - base) / base * 100
+
+    def portfolio_value_series(user_id, days=30, interval='1d'):
+        """
+        Giá trị danh mục hiện tại theo thời gian từ lịch sử giá local (không gọi API):
+        mỗi kỳ = tổng lot đã mua trước cuối kỳ × close gần nhất của coin (forward-fill).
+        Lot đã bán hết không còn trong portfolio nên không được tính.
+        Trả về [(bucket, value)]
+        """
+        step = PRICE_INTERVALS[interval]
+        since = price_bucket(time.time() - days * 86400, step)
+        lots = iter_rows("SELECT symbol, amount, buy_date FROM portfolio WHERE user_id = ?", (user_id,))
+        held = {}
+        for symbol, amount, buy_date in lots:
+            held.setdefault(symbol, []).append((vn_time_to_ts(buy_date or ''), amount or 0))
+        if not held:
+            return []
+
+        series = price_history.closes(list(held), interval, since)
+        buckets = sorted({bucket for points in series.values() for bucket, _ in points})
+        cursor = {symbol: 0 for symbol in held}
+        last_close = {}
+        values = []
+        for bucket in buckets:
+            end = bucket + step
+            value = 0
+            for symbol, symbol_lots in held.items():
+                points = series[symbol]
+                i = cursor[symbol]
+                while i < len(points) and points[i][0] <= bucket:
+                    last_close[symbol] = points[i][1]
+                    i += 1
+                cursor[symbol] = i
+                price = last_close.get(symbol)
+                if price:
+                    value += price * sum(amount for ts, amount in symbol_lots if ts < end)
+            values.append((bucket, value))
+        return values
+
+    def max_drawdown(values):
+        """Sụt giảm lớn nhất từ đỉnh (%) trên chuỗi [(bucket, value)] - trả về (pct, đỉnh, đáy)"""
+        peak = None
+        worst = (0.0, None, None)
+        for bucket, value in values:
+            if peak is None or value > peak[1]:
+                peak = (bucket, value)
+            elif peak[1] > 0:
+                drop = (value - peak[1]) / peak[1] * 100
+                if drop < worst[0]:
+                    worst = (drop, peak[0], bucket)
+        return worst
+
+    def price_history_worker():
+        """Thread nền: flush buffer, dọn dữ liệu cũ mỗi ngày"""
+        while True:
+            try:
+                time.sleep(PRICE_HISTORY_FLUSH)
+                now = time.time()
+                price_history.flush()
+                if now - price_history.last_prune >= 86400:
+                    price_history.prune()
+            except Exception as e:
+                logger.error(f"❌ Lỗi price_history_worker: {e}")
+                time.sleep(10)
+
     # ==================== PORTFOLIO FUNCTIONS ====================
     def add_transaction(user_id, symbol, amount, buy_price):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             buy_date = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             total_cost = amount * buy_price
@@ -1118,7 +2266,7 @@ try:
     def get_portfolio(user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT symbol, amount, buy_price, buy_date, total_cost FROM portfolio WHERE user_id = ? ORDER BY buy_date''', (user_id,))
             return c.fetchall()
@@ -1132,16 +2280,13 @@ try:
     def get_transaction_detail(user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id, symbol, amount, buy_price, buy_date, total_cost 
                         FROM portfolio WHERE user_id = ? ORDER BY buy_date''', (user_id,))
             transactions = c.fetchall()
             
-            # THÊM LOG ĐỂ DEBUG
-            logger.info(f"🔍 get_transaction_detail: user_id={user_id}, found={len(transactions)} transactions")
-            for tx in transactions:
-                logger.info(f"   • #{tx[0]}: {tx[1]} {tx[2]} @ {tx[3]}")
+            log_db.debug("🔍 get_transaction_detail: user_id=%s, found=%s transactions", user_id, len(transactions))
                 
             return transactions
         except sqlite3.Error as e:  # <-- THÊM DÒNG NÀY
@@ -1157,7 +2302,7 @@ try:
     def delete_transaction(transaction_id, user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''DELETE FROM portfolio WHERE id = ? AND user_id = ?''', (transaction_id, user_id))
             conn.commit()
@@ -1169,62 +2314,382 @@ try:
             if conn:
                 conn.close()
 
-    # ==================== ALERTS FUNCTIONS ====================
-    def add_alert(user_id, symbol, target_price, condition):
+    # ==================== LOT MATCHING (FIFO / LIFO / AVG) ====================
+    # Bán chỉ đụng tới lot của đúng symbol đó, trong 1 transaction:
+    # lot bị ăn hết thì DELETE, ăn một phần thì UPDATE - id lot còn lại giữ nguyên cho /edit, /del
+    # Mỗi lệnh bán ghi 1 dòng sell_history + các dòng sell_lots trỏ về lot đã tiêu thụ
+    SELL_COST_METHODS = {
+        'fifo': 'Nhập trước - xuất trước',
+        'lifo': 'Nhập sau - xuất trước',
+        'avg': 'Giá vốn bình quân',
+    }
+    SELL_COST_METHOD = os.environ.get('SELL_COST_METHOD', 'fifo').lower()
+    if SELL_COST_METHOD not in SELL_COST_METHODS:
+        SELL_COST_METHOD = 'fifo'
+    SELL_DUST = 1e-10  # Phần lot còn lại nhỏ hơn mức này coi như đã bán hết
+
+    def parse_sell_method(args):
+        """Tách fifo/lifo/avg khỏi danh sách tham số /sell - trả về (method, args còn lại)"""
+        method = SELL_COST_METHOD
+        rest = []
+        for arg in args:
+            if arg.lower() in SELL_COST_METHODS:
+                method = arg.lower()
+            else:
+                rest.append(arg)
+        return method, rest
+
+    def match_sell_lots(user_id, symbol, sell_amount, sell_price, method=SELL_COST_METHOD):
+        """
+        Khớp lệnh bán với các lot của symbol theo method và ghi DB trong 1 transaction.
+        Trả về dict kết quả, hoặc None nếu không đủ số lượng (không ghi gì).
+        """
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH, timeout=10)
             c = conn.cursor()
-            created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
-            symbol_upper = symbol.upper()
+            c.execute("BEGIN IMMEDIATE")
+            order = "DESC" if method == 'lifo' else "ASC"
+            c.execute(f'''SELECT id, amount, buy_price, buy_date, total_cost FROM portfolio
+                          WHERE user_id = ? AND symbol = ? ORDER BY buy_date {order}, id {order}''',
+                      (user_id, symbol))
+            lots = c.fetchall()
+            
+            held = sum(lot[1] for lot in lots)
+            if not lots or sell_amount <= 0 or sell_amount > held + SELL_DUST:
+                conn.rollback()
+                return None
+            sell_amount = min(sell_amount, held)
+            
+            # (lot_id, buy_date, buy_price, số lượng lấy, vốn lấy)
+            consumed = []
+            if method == 'avg':
+                # Bình quân: mọi lot giảm cùng tỷ lệ -> giá vốn TB của phần còn lại không đổi
+                ratio = sell_amount / held
+                for lot_id, amount, buy_price, buy_date, total_cost in lots:
+                    consumed.append((lot_id, buy_date, buy_price, amount * ratio, total_cost * ratio))
+            else:
+                remaining = sell_amount
+                for lot_id, amount, buy_price, buy_date, total_cost in lots:
+                    if remaining <= SELL_DUST:
+                        break
+                    part = min(amount, remaining)
+                    consumed.append((lot_id, buy_date, buy_price, part, total_cost * part / amount if amount else 0))
+                    remaining -= part
+            
+            lot_amounts = {lot[0]: (lot[1], lot[4]) for lot in lots}
+            for lot_id, buy_date, buy_price, part, part_cost in consumed:
+                amount, total_cost = lot_amounts[lot_id]
+                left = amount - part
+                if left <= SELL_DUST:
+                    c.execute("DELETE FROM portfolio WHERE id = ?", (lot_id,))
+                else:
+                    c.execute("UPDATE portfolio SET amount = ?, total_cost = ? WHERE id = ?",
+                              (left, total_cost - part_cost, lot_id))
+            
+            sold_value = sell_amount * sell_price
+            sold_cost = sum(item[4] for item in consumed)
+            profit = sold_value - sold_cost
+            profit_percent = (profit / sold_cost * 100) if sold_cost > 0 else 0
+            avg_buy_price = sold_cost / sell_amount if sell_amount > 0 else 0
+            now = get_vn_time()
             
-            c.execute('''INSERT INTO alerts (user_id, symbol, target_price, condition, created_at) VALUES (?, ?, ?, ?, ?)''',
-                      (user_id, symbol_upper, target_price, condition, created_at))
+            c.execute('''INSERT INTO sell_history 
+                        (user_id, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_percent, sell_date, created_at, cost_method) 
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (user_id, symbol, sell_amount, sell_price, avg_buy_price,
+                       sold_value, sold_cost, profit, profit_percent,
+                       now.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d %H:%M:%S"), method))
+            sell_id = c.lastrowid
+            c.executemany('''INSERT INTO sell_lots (sell_id, lot_id, user_id, symbol, amount, buy_price, cost, buy_date)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                          [(sell_id, lot_id, user_id, symbol, part, buy_price, part_cost, buy_date)
+                           for lot_id, buy_date, buy_price, part, part_cost in consumed])
             conn.commit()
-            return True
+            
+            return {
+                'sell_id': sell_id,
+                'method': method,
+                'amount': sell_amount,
+                'sold_value': sold_value,
+                'sold_cost': sold_cost,
+                'profit': profit,
+                'profit_percent': profit_percent,
+                'avg_buy_price': avg_buy_price,
+                'lots': [{
+                    'lot_id': lot_id,
+                    'amount': part,
+                    'buy_price': buy_price,
+                    'cost': part_cost,
+                    'profit': part * sell_price - part_cost
+                } for lot_id, buy_date, buy_price, part, part_cost in consumed]
+            }
         except Exception as e:
-            logger.error(f"❌ Lỗi thêm alert: {e}")
-            return False
+            if conn:
+                conn.rollback()
+            logger.error(f"❌ Lỗi khớp lot bán {symbol}: {e}")
+            raise
         finally:
             if conn:
                 conn.close()
 
-    def get_user_alerts(user_id):
+    def format_sell_lots(sell_id):
+        """Khối 'Lot đã bán' cho màn chi tiết lệnh bán - rỗng với lệnh bán cũ/nhập tay"""
+        lots = get_sell_lots(sell_id)
+        if not lots:
+            return ""
+        msg = "*📋 LOT ĐÃ BÁN:*\n"
+        for lot_id, amount, buy_price, cost, buy_date in lots:
+            msg += f"• #{lot_id} ({(buy_date or '')[:10]}): `{amount:.4f}` @ `{fmt_price(buy_price)}`\n"
+        return msg + "\n"
+
+    def get_symbol_holding(user_id, symbol):
+        """Tổng số lượng đang giữ của 1 coin"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
-            c.execute('''SELECT id, symbol, target_price, condition, created_at FROM alerts WHERE user_id = ? AND is_active = 1 ORDER BY created_at''', (user_id,))
+            c.execute("SELECT COALESCE(SUM(amount), 0) FROM portfolio WHERE user_id = ? AND symbol = ?", (user_id, symbol))
+            return c.fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy số lượng {symbol}: {e}")
+            return 0
+        finally:
+            if conn:
+                conn.close()
+
+    def get_sell_lots(sell_id):
+        """Các lot đã tiêu thụ bởi 1 lệnh bán"""
+        conn = None
+        try:
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            c.execute('''SELECT lot_id, amount, buy_price, cost, buy_date FROM sell_lots
+                         WHERE sell_id = ? ORDER BY id''', (sell_id,))
             return c.fetchall()
         except Exception as e:
-            logger.error(f"❌ Lỗi lấy alerts: {e}")
+            logger.error(f"❌ Lỗi lấy sell lots: {e}")
             return []
         finally:
             if conn:
                 conn.close()
 
-    def delete_alert(alert_id, user_id):
+    # ==================== POSITIONS (MATERIALIZED) ====================
+    # Bảng positions giữ sẵn tổng hợp theo (user, symbol): số lượng, vốn, số lot, LN đã chốt
+    # Trigger trên portfolio / sell_history cập nhật cộng dồn ngay trong transaction ghi dữ liệu,
+    # nên mọi đường ghi (/buy, /sell, /del, /edit, /editsell, /delsell, callback) đều được phủ
+    # /positions verify đối chiếu với dữ liệu gốc, /positions rebuild dựng lại từ đầu
+    POSITIONS_SOURCE_SQL = '''
+        SELECT user_id, symbol, SUM(amount), SUM(cost), SUM(lots), SUM(realized), SUM(sells), SUM(sold_value), SUM(sold_cost)
+        FROM (
+            SELECT user_id, symbol, COALESCE(amount, 0) AS amount, COALESCE(total_cost, 0) AS cost, 1 AS lots,
+                   0 AS realized, 0 AS sells, 0 AS sold_value, 0 AS sold_cost
+            FROM portfolio
+            UNION ALL
+            SELECT user_id, symbol, 0, 0, 0, COALESCE(profit, 0), 1,
+                   COALESCE(amount * sell_price, 0), COALESCE(amount * buy_price, 0)
+            FROM sell_history
+        )
+        WHERE {where}
+        GROUP BY user_id, symbol
+    '''
+    POSITIONS_COLUMNS = ('amount', 'cost', 'lots', 'realized', 'sells', 'sold_value', 'sold_cost')
+
+    def create_positions_schema(c):
+        """Tạo bảng positions + trigger; bảng mới tạo thì backfill từ dữ liệu gốc. Trả về True nếu vừa backfill"""
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='positions'")
+        is_new = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS positions (
+            user_id INTEGER,
+            symbol TEXT,
+            amount REAL DEFAULT 0,
+            cost REAL DEFAULT 0,
+            lots INTEGER DEFAULT 0,
+            realized REAL DEFAULT 0,
+            sells INTEGER DEFAULT 0,
+            sold_value REAL DEFAULT 0,
+            sold_cost REAL DEFAULT 0,
+            PRIMARY KEY (user_id, symbol)
+        )''')
+
+        add_lot = ("INSERT INTO positions (user_id, symbol, amount, cost, lots) "
+                   "VALUES (NEW.user_id, NEW.symbol, COALESCE(NEW.amount, 0), COALESCE(NEW.total_cost, 0), 1) "
+                   "ON CONFLICT(user_id, symbol) DO UPDATE SET amount = amount + excluded.amount, "
+                   "cost = cost + excluded.cost, lots = lots + 1; ")
+        # Lot cuối cùng bị xóa -> đưa về 0 tuyệt đối, tránh sai số float tích lũy
+        remove_lot = ("UPDATE positions SET "
+                      "amount = CASE WHEN lots <= 1 THEN 0 ELSE amount - COALESCE(OLD.amount, 0) END, "
+                      "cost = CASE WHEN lots <= 1 THEN 0 ELSE cost - COALESCE(OLD.total_cost, 0) END, "
+                      "lots = lots - 1 WHERE user_id = OLD.user_id AND symbol = OLD.symbol; ")
+        add_sell = ("INSERT INTO positions (user_id, symbol, realized, sells, sold_value, sold_cost) "
+                    "VALUES (NEW.user_id, NEW.symbol, COALESCE(NEW.profit, 0), 1, "
+                    "COALESCE(NEW.amount * NEW.sell_price, 0), COALESCE(NEW.amount * NEW.buy_price, 0)) "
+                    "ON CONFLICT(user_id, symbol) DO UPDATE SET realized = realized + excluded.realized, "
+                    "sells = sells + 1, sold_value = sold_value + excluded.sold_value, "
+                    "sold_cost = sold_cost + excluded.sold_cost; ")
+        remove_sell = ("UPDATE positions SET realized = realized - COALESCE(OLD.profit, 0), sells = sells - 1, "
+                       "sold_value = sold_value - COALESCE(OLD.amount * OLD.sell_price, 0), "
+                       "sold_cost = sold_cost - COALESCE(OLD.amount * OLD.buy_price, 0) "
+                       "WHERE user_id = OLD.user_id AND symbol = OLD.symbol; ")
+        for table, add, remove in (('portfolio', add_lot, remove_lot), ('sell_history', add_sell, remove_sell)):
+            for op, body in (('INSERT', add), ('UPDATE', remove + add), ('DELETE', remove)):
+                c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_positions "
+                          f"AFTER {op} ON {table} BEGIN {body}END")
+
+        if is_new:
+            c.execute("INSERT INTO positions (user_id, symbol, " + ", ".join(POSITIONS_COLUMNS) + ") "
+                      + POSITIONS_SOURCE_SQL.format(where="1 = 1"))
+        return is_new
+
+    def rebuild_positions(user_id=None):
+        """Dựng lại positions từ portfolio + sell_history (1 user hoặc tất cả). Trả về số dòng"""
+        where, params = ("user_id = ?", (user_id,)) if user_id is not None else ("1 = 1", ())
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH, timeout=10)
             c = conn.cursor()
-            c.execute("DELETE FROM alerts WHERE id = ? AND user_id = ?", (alert_id, user_id))
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(f"DELETE FROM positions WHERE {where}", params)
+            c.execute("INSERT INTO positions (user_id, symbol, " + ", ".join(POSITIONS_COLUMNS) + ") "
+                      + POSITIONS_SOURCE_SQL.format(where=where), params)
+            count = c.rowcount
             conn.commit()
-            return c.rowcount > 0
+            logger.info(f"✅ Rebuild positions ({'user ' + str(user_id) if user_id is not None else 'tất cả'}): {count} dòng")
+            return count
         except Exception as e:
-            logger.error(f"❌ Lỗi xóa alert: {e}")
-            return False
+            if conn:
+                conn.rollback()
+            logger.error(f"❌ Lỗi rebuild positions: {e}")
+            return -1
         finally:
             if conn:
                 conn.close()
 
-    def check_alerts():
-        global app
-        while True:
-            try:
-                time.sleep(60)
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
+    def verify_positions(user_id=None, tolerance=1e-6):
+        """Đối chiếu positions với dữ liệu gốc - trả về (số key đã kiểm, [(user_id, symbol, cột, lưu, đúng)])"""
+        where, params = ("user_id = ?", (user_id,)) if user_id is not None else ("1 = 1", ())
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute(POSITIONS_SOURCE_SQL.format(where=where), params)
+            expected = {(row[0], row[1]): row[2:] for row in c.fetchall()}
+            c.execute("SELECT user_id, symbol, " + ", ".join(POSITIONS_COLUMNS) + f" FROM positions WHERE {where}", params)
+            stored = {(row[0], row[1]): row[2:] for row in c.fetchall()}
+        finally:
+            conn.close()
+
+        zero = (0,) * len(POSITIONS_COLUMNS)
+        mismatches = []
+        for key in expected.keys() | stored.keys():
+            want = expected.get(key, zero)
+            have = stored.get(key, zero)
+            for col, h, w in zip(POSITIONS_COLUMNS, have, want):
+                if abs((h or 0) - (w or 0)) > tolerance * max(1, abs(w or 0)):
+                    mismatches.append((key[0], key[1], col, h, w))
+        return len(expected.keys() | stored.keys()), mismatches
+
+    async def positions_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/positions verify|rebuild [user_id] - Owner kiểm tra / dựng lại bảng positions"""
+        if not is_owner(update.effective_user.id):
+            await update.message.reply_text("❌ Chỉ Owner mới có quyền sử dụng lệnh này!")
+            return
+        
+        action = ctx.args[0].lower() if ctx.args else 'verify'
+        target = None
+        if len(ctx.args) > 1:
+            try:
+                target = int(ctx.args[1])
+            except ValueError:
+                await update.message.reply_text("❌ /positions verify|rebuild [user_id]")
+                return
+        if action not in ('verify', 'rebuild'):
+            await update.message.reply_text("❌ /positions verify|rebuild [user_id]")
+            return
+        
+        scope = f"user `{target}`" if target is not None else "tất cả user"
+        loop = asyncio.get_running_loop()
+        if action == 'rebuild':
+            count = await loop.run_in_executor(None, rebuild_positions, target)
+            if count < 0:
+                await update.message.reply_text("❌ Rebuild positions thất bại, xem log!")
+                return
+            await update.message.reply_text(
+                f"✅ *ĐÃ DỰNG LẠI POSITIONS*\n━━━━━━━━━━━━━━━━\n\n"
+                f"• Phạm vi: {scope}\n• Số dòng: `{count}`\n\n🕐 {format_vn_time()}",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        checked, mismatches = await loop.run_in_executor(None, verify_positions, target)
+        msg = (f"🔍 *KIỂM TRA POSITIONS*\n━━━━━━━━━━━━━━━━\n\n"
+               f"• Phạm vi: {scope}\n• Đã kiểm: `{checked}` (user, coin)\n")
+        if not mismatches:
+            msg += "✅ Khớp hoàn toàn với portfolio + sell\\_history\n"
+        else:
+            msg += f"❌ Lệch: `{len(mismatches)}`\n\n"
+            for uid, symbol, col, have, want in mismatches[:10]:
+                msg += f"• `{uid}` {symbol}.{col}: `{have}` ≠ `{want}`\n"
+            msg += "\nDùng `/positions rebuild` để sửa\n"
+        msg += f"\n🕐 {format_vn_time()}"
+        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+
+    # ==================== ALERTS FUNCTIONS ====================
+    def add_alert(user_id, symbol, target_price, condition):
+        conn = None
+        try:
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
+            symbol_upper = symbol.upper()
+            
+            c.execute('''INSERT INTO alerts (user_id, symbol, target_price, condition, created_at) VALUES (?, ?, ?, ?, ?)''',
+                      (user_id, symbol_upper, target_price, condition, created_at))
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Lỗi thêm alert: {e}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def get_user_alerts(user_id):
+        conn = None
+        try:
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            c.execute('''SELECT id, symbol, target_price, condition, created_at FROM alerts WHERE user_id = ? AND is_active = 1 ORDER BY created_at''', (user_id,))
+            return c.fetchall()
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy alerts: {e}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    def delete_alert(alert_id, user_id):
+        conn = None
+        try:
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            c.execute("DELETE FROM alerts WHERE id = ? AND user_id = ?", (alert_id, user_id))
+            conn.commit()
+            return c.rowcount > 0
+        except Exception as e:
+            logger.error(f"❌ Lỗi xóa alert: {e}")
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def check_alerts():
+        global app
+        while True:
+            try:
+                time.sleep(ALERT_INTERVAL)
+                cycle_start = time.perf_counter()
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
                 c.execute('''SELECT id, user_id, symbol, target_price, condition FROM alerts WHERE is_active = 1''')
                 alerts = c.fetchall()
                 conn.close()
@@ -1253,7 +2718,7 @@ try:
                         
                         try:
                             app.bot.send_message(user_id, msg, parse_mode='Markdown')
-                            conn = sqlite3.connect(DB_PATH)
+                            conn = db_connect(DB_PATH)
                             c = conn.cursor()
                             c.execute('''UPDATE alerts SET is_active = 0, triggered_at = ? WHERE id = ?''', 
                                       (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), alert_id))
@@ -1261,6 +2726,10 @@ try:
                             conn.close()
                         except Exception as e:
                             logger.error(f"❌ Lỗi gửi alert {alert_id}: {e}")
+                
+                metrics.observe('bot_alert_cycle_seconds', time.perf_counter() - cycle_start)
+                alert_engine_state['last_run'] = time.time()
+                alert_engine_state['checked'] += len(alerts)
             except Exception as e:
                 logger.error(f"❌ Lỗi check_alerts: {e}")
                 time.sleep(10)
@@ -1269,7 +2738,7 @@ try:
     def grant_permission(group_id, user_id, granted_by, permissions):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             
@@ -1294,7 +2763,7 @@ try:
     def revoke_permission(group_id, user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("DELETE FROM permissions WHERE group_id = ? AND user_id = ?", (group_id, user_id))
             conn.commit()
@@ -1324,7 +2793,7 @@ try:
             if user_id == owner_id:
                 return True
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
@@ -1361,7 +2830,7 @@ try:
             if is_owner(user_id):
                 return True
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             c.execute('''SELECT role, is_approved, can_view_all, can_edit_all, can_delete_all, can_manage_perms FROM permissions WHERE group_id = ? AND user_id = ?''', (group_id, user_id))
@@ -1390,7 +2859,7 @@ try:
 
     def grant_user_access(group_id, target_user_id, granted_by, role='user'):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             
@@ -1423,7 +2892,7 @@ try:
     def migrate_admin_data():
         """Di chuyển dữ liệu admin từ bảng cũ sang bảng mới"""
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # Kiểm tra xem bảng group_admins có dữ liệu không
@@ -1470,7 +2939,7 @@ try:
     # ==================== USER FUNCTIONS WITH AUTO-UPDATE ====================
     async def update_user_info_async(user):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             current_time = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
@@ -1491,12 +2960,34 @@ try:
             if user.username:
                 username_cache.set(user.username, user.id)
             
-            logger.info(f"✅ Updated user {user.id} (@{user.username})")
+            log_db.debug("✅ Updated user %s (@%s)", user.id, user.username)
             return True
         except Exception as e:
             logger.error(f"❌ Lỗi cập nhật user {user.id}: {e}")
             return False
 
+    def update_users_batch(users):
+        """Upsert nhiều user trong 1 transaction (dùng cho join hàng loạt)"""
+        if not users:
+            return True
+        try:
+            current_time = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            c.executemany('''INSERT INTO users (user_id, username, first_name, last_name, last_seen) VALUES (?, ?, ?, ?, ?)
+                             ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+                             last_name = excluded.last_name, last_seen = excluded.last_seen''',
+                          [(u.id, u.username, u.first_name, u.last_name, current_time) for u in users])
+            conn.commit()
+            conn.close()
+            for u in users:
+                if u.username:
+                    username_cache.set(u.username, u.id)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Lỗi cập nhật batch {len(users)} users: {e}")
+            return False
+
     def get_user_id_by_username(username):
         conn = None
         try:
@@ -1507,7 +2998,7 @@ try:
                 logger.info(f"Cache hit for @{clean_username}: {cached_id}")
                 return cached_id
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             c.execute("SELECT user_id FROM users WHERE username = ?", (clean_username,))
@@ -1559,7 +3050,7 @@ try:
                 context.bot_data['chat_type'] = chat_type
                 context.bot_data['is_admin'] = False  # LUÔN FALSE
                 context.bot_data['is_owner'] = False
-                logger.info(f"💬 PRIVATE CHAT: user {current_user_id} tự quản lý (KHÔNG phải admin)")
+                log_auth.debug("💬 PRIVATE CHAT: user %s tự quản lý", current_user_id)
                 return await func(update, context, *args, **kwargs)
             
             # TRONG GROUP
@@ -1588,7 +3079,7 @@ try:
                     context.bot_data['chat_type'] = chat_type
                     context.bot_data['is_admin'] = False
                     context.bot_data['is_owner'] = (current_user_id == owner_id)
-                    logger.info(f"👤 GROUP: user {current_user_id} chưa có quyền, tự quản lý")
+                    log_auth.debug("👤 GROUP: user %s chưa có quyền, tự quản lý", current_user_id)
                     return await func(update, context, *args, **kwargs)
                 
                 # Kiểm tra quyền admin
@@ -1601,13 +3092,13 @@ try:
                     context.bot_data['effective_user_id'] = owner_id
                     context.bot_data['is_admin'] = True
                     context.bot_data['is_owner'] = (current_user_id == owner_id)
-                    logger.info(f"👑 GROUP: admin {current_user_id} thao tác trên dữ liệu owner {owner_id}")
+                    log_auth.debug("👑 GROUP: admin %s thao tác trên dữ liệu owner %s", current_user_id, owner_id)
                 else:
                     # User thường có quyền view: tự quản lý
                     context.bot_data['effective_user_id'] = current_user_id
                     context.bot_data['is_admin'] = False
                     context.bot_data['is_owner'] = False
-                    logger.info(f"👤 GROUP: user {current_user_id} có quyền view, tự quản lý")
+                    log_auth.debug("👤 GROUP: user %s có quyền view, tự quản lý", current_user_id)
                 
                 context.bot_data['current_user_id'] = current_user_id
                 context.bot_data['chat_type'] = chat_type
@@ -1695,7 +3186,7 @@ try:
     def add_expense_category(user_id, name, budget=0):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             
@@ -1713,7 +3204,7 @@ try:
     def get_expense_categories(owner_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id, name, budget, created_at FROM expense_categories WHERE user_id = ? ORDER BY name''', (owner_id,))
             return c.fetchall()
@@ -1727,7 +3218,7 @@ try:
     def add_income(owner_id, amount, source, currency='VND', note=""):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             now = get_vn_time()
             income_date = now.strftime("%Y-%m-%d")
@@ -1747,7 +3238,7 @@ try:
     def add_expense(owner_id, category_id, amount, currency='VND', note=""):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             now = get_vn_time()
             expense_date = now.strftime("%Y-%m-%d")
@@ -1767,7 +3258,7 @@ try:
     def get_recent_incomes(user_id, limit=10):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id, amount, source, note, income_date, currency FROM incomes WHERE user_id = ? ORDER BY income_date DESC, created_at DESC LIMIT ?''', (user_id, limit))
             return c.fetchall()
@@ -1781,7 +3272,7 @@ try:
     def get_recent_expenses(user_id, limit=10):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT e.id, ec.name, e.amount, e.note, e.expense_date, e.currency FROM expenses e JOIN expense_categories ec ON e.category_id = ec.id WHERE e.user_id = ? ORDER BY e.expense_date DESC, e.created_at DESC LIMIT ?''', (user_id, limit))
             return c.fetchall()
@@ -1795,7 +3286,7 @@ try:
     def get_income_by_period(user_id, period='month'):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             now = get_vn_time()
             
@@ -1832,7 +3323,7 @@ try:
     def get_expenses_by_period(user_id, period='month'):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             now = get_vn_time()
             
@@ -1895,7 +3386,7 @@ try:
                 expenses = get_expenses_by_period(user_id, 'year')
                 title = f"NĂM {get_vn_time().strftime('%Y')}"
             else:
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 
                 c.execute('''SELECT currency, SUM(amount) FROM incomes WHERE user_id = ? GROUP BY currency''', (user_id,))
@@ -2023,7 +3514,7 @@ try:
     def delete_expense(expense_id, user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''DELETE FROM expenses WHERE id = ? AND user_id = ?''', (expense_id, user_id))
             conn.commit()
@@ -2038,7 +3529,7 @@ try:
     def delete_income(income_id, user_id):
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''DELETE FROM incomes WHERE id = ? AND user_id = ?''', (income_id, user_id))
             conn.commit()
@@ -2055,7 +3546,7 @@ try:
         logger.info(f"🔍 delete_category được gọi với category_id={category_id}, owner_id={owner_id}")
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # BẬT KHÓA NGOẠI
@@ -2121,7 +3612,7 @@ try:
             # Thử cách khác: xóa từng bước
             try:
                 logger.info("🔄 Thử xóa bằng cách 2 (không dùng transaction)...")
-                conn2 = sqlite3.connect(DB_PATH)
+                conn2 = db_connect(DB_PATH)
                 c2 = conn2.cursor()
                 
                 # Xóa chi tiêu trước
@@ -2164,7 +3655,7 @@ try:
         """Lấy lịch sử bán của user"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id, symbol, amount, sell_price, buy_price, profit, profit_percent, sell_date, created_at 
                         FROM sell_history 
@@ -2183,9 +3674,10 @@ try:
         """Lấy chi tiết một lệnh bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
-            c.execute('''SELECT * FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
+            c.execute('''SELECT id, user_id, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_percent, sell_date, created_at
+                        FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
             return c.fetchone()
         except Exception as e:
             logger.error(f"❌ Lỗi lấy sell detail: {e}")
@@ -2198,7 +3690,7 @@ try:
         """Xóa lịch sử bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''DELETE FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
             conn.commit()
@@ -2214,7 +3706,7 @@ try:
         """Cập nhật lịch sử bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # Lấy thông tin cũ
@@ -2249,7 +3741,7 @@ try:
         """Thêm lịch sử bán thủ công (cho dữ liệu cũ)"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             total_sold = amount * sell_price
@@ -2276,7 +3768,7 @@ try:
         """Lấy lịch sử bán của user"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id, symbol, amount, sell_price, buy_price, profit, profit_percent, sell_date, created_at 
                         FROM sell_history 
@@ -2295,9 +3787,10 @@ try:
         """Lấy chi tiết một lệnh bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
-            c.execute('''SELECT * FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
+            c.execute('''SELECT id, user_id, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_percent, sell_date, created_at
+                        FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
             return c.fetchone()
         except Exception as e:
             logger.error(f"❌ Lỗi lấy sell detail: {e}")
@@ -2310,7 +3803,7 @@ try:
         """Xóa lịch sử bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''DELETE FROM sell_history WHERE id = ? AND user_id = ?''', (sell_id, user_id))
             conn.commit()
@@ -2326,7 +3819,7 @@ try:
         """Cập nhật lịch sử bán"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # Lấy thông tin cũ
@@ -2373,7 +3866,7 @@ try:
         """
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # Kiểm tra khoản thu có tồn tại không
@@ -2440,7 +3933,7 @@ try:
         """
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             # Kiểm tra khoản chi có tồn tại không
@@ -2697,7 +4190,7 @@ try:
             
             if success:
                 # Lấy thông tin mới để hiển thị
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute('''SELECT amount, source, note, currency FROM incomes WHERE id = ?''', (income_id,))
                 updated = c.fetchone()
@@ -2783,7 +4276,7 @@ try:
             
             if success:
                 # Lấy thông tin mới để hiển thị
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute('''SELECT e.amount, ec.name, e.note, e.currency 
                            FROM expenses e 
@@ -2838,7 +4331,7 @@ try:
         # Nếu không có tham số, hiển thị hướng dẫn
         if not ctx.args:
             # Lấy danh sách user đã có quyền
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''
                 SELECT p.user_id, p.can_view_all, p.can_edit_all, p.can_delete_all, p.can_manage_perms, 
@@ -2931,7 +4424,7 @@ try:
         # Cấp quyền
         if grant_permission(chat_id, target_id, user_id, permissions):
             # Lấy tên hiển thị
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_id,))
             user_info = c.fetchone()
@@ -3016,7 +4509,7 @@ try:
             is_group_owner = (user_id == owner_id)
             
             # Lấy thông tin quyền từ database
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
                         FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, user_id))
@@ -3056,7 +4549,7 @@ try:
     async def whoami_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''SELECT user_id, username, first_name, last_name, last_seen FROM users WHERE user_id = ?''', (user.id,))
         db_user = c.fetchone()
@@ -3224,7 +4717,7 @@ try:
             await update.message.reply_text("❌ Bạn đã là owner chính rồi!")
             return
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             added_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             username = ctx.args[0].lstrip('@') if ctx.args[0].startswith('@') else None
@@ -3260,7 +4753,7 @@ try:
                 await update.message.reply_text("❌ Không tìm thấy user!")
                 return
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("DELETE FROM co_owners WHERE user_id = ?", (target_id,))
             deleted = c.rowcount
@@ -3284,7 +4777,7 @@ try:
             await update.message.reply_text("❌ Chỉ owner chính mới xem được!")
             return
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT user_id, username, added_at FROM co_owners ORDER BY added_at")
             rows = c.fetchall()
@@ -3324,7 +4817,7 @@ try:
             return
 
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
 
             # Tìm nhóm tổng hiện tại
@@ -3393,11 +4886,12 @@ try:
             # Update RAM cache
             if old_id in GROUP_OWNERS:
                 GROUP_OWNERS[new_group_id] = GROUP_OWNERS.pop(old_id)
+            _master_of_cache.clear()
 
             logger.info(f"✅ Chuyển nhóm tổng: {old_id} → {new_group_id}")
 
             # Báo kết quả
-            c2 = sqlite3.connect(DB_PATH)
+            c2 = db_connect(DB_PATH)
             cur = c2.cursor()
             cur.execute("SELECT COUNT(*) FROM group_hierarchy WHERE master_group_id = ?", (new_group_id,))
             child_count = cur.fetchone()[0]
@@ -3467,7 +4961,7 @@ try:
             
             chat_id = update.effective_chat.id
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT role FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
             result = c.fetchone()
@@ -3486,7 +4980,7 @@ try:
         elif action == "liststaff":
             chat_id = update.effective_chat.id
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT p.user_id, p.can_view_all, p.can_edit_all, p.can_delete_all, p.can_manage_perms, u.username, u.first_name FROM permissions p LEFT JOIN users u ON p.user_id = u.user_id WHERE p.group_id = ? AND p.role = 'staff' ORDER BY p.created_at''', (chat_id,))
             staff_list = c.fetchall()
@@ -3528,7 +5022,7 @@ try:
             
             chat_id = update.effective_chat.id
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT role FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
             result = c.fetchone()
@@ -3565,7 +5059,7 @@ try:
         elif action == "listpending":
             chat_id = update.effective_chat.id
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT user_id, username, first_name, created_at FROM permissions WHERE group_id = ? AND is_approved = 0 AND role = 'user' ORDER BY created_at''', (chat_id,))
             pending = c.fetchall()
@@ -3585,7 +5079,7 @@ try:
             await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
         
         elif action == "stats":
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             c.execute("SELECT COUNT(DISTINCT user_id) FROM users")
@@ -3814,10 +5308,14 @@ try:
             crypto_lines.append("• `/view` — Xem danh mục đầu tư")
         if feat('crypto_profit') and perm('view'):
             crypto_lines.append("• `/stats` — Thống kê lợi nhuận")
+            if HAS_MATPLOTLIB:
+                crypto_lines.append("• `/chart pie|pnl` — Biểu đồ tỷ trọng / lãi lỗ")
         if feat('crypto_alert') and perm('view'):
             crypto_lines += ["• `/alert BTC above 50000` — Đặt cảnh báo giá", "• `/alerts` — Xem danh sách cảnh báo"]
         if feat('crypto_export') and perm('view'):
             crypto_lines.append("• `/export` — Xuất báo cáo crypto")
+            if HAS_PYARROW:
+                crypto_lines.append("• `/export_data` — Xuất dữ liệu Parquet/Arrow")
         if crypto_lines:
             sections.append("*💰 ĐẦU TƯ COIN:*\n" + "\n".join(crypto_lines))
 
@@ -3827,6 +5325,8 @@ try:
             expense_lines += ["• `tn 500k nguồn` — Thêm thu nhập", "• `dm Ăn uống 3tr` — Tạo danh mục", "• `ct 1 50k ghi chú` — Thêm chi tiêu", "• `ds` — Xem giao dịch gần đây"]
         if feat('expense_view') and perm('view'):
             expense_lines.append("• `/balance` — Xem cân đối thu chi")
+            if HAS_MATPLOTLIB:
+                expense_lines.append("• `/chart expense` — Biểu đồ thu chi theo tháng")
         if feat('expense_export') and perm('view'):
             expense_lines.append("• `/export_expense` — Xuất báo cáo thu chi")
         if expense_lines:
@@ -3960,6 +5460,14 @@ try:
         else:
             await update.message.reply_text(f"❌ Lỗi khi thêm giao dịch *{symbol}*", parse_mode='Markdown')
 
+    # Lệnh bán chờ xác nhận giữ trong RAM, nút chỉ mang token ngắn (callback_data tối đa 64 byte)
+    _pending_sells = AdvancedCache('pending_sells', max_size=500, ttl=600)
+
+    def stash_pending_sell(symbol, sell_amount, sell_price, method):
+        token = str(random.randint(10 ** 7, 10 ** 8 - 1))
+        _pending_sells.set(token, (symbol, sell_amount, sell_price, method))
+        return token
+
     @auto_update_user
     @require_permission('edit')
     async def sell_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -3974,8 +5482,11 @@ try:
             target_user_id = ctx.bot_data.get('effective_user_id', current_user_id)
             logger.info(f"👥 GROUP: bán coin cho owner {target_user_id}")
         
+        # fifo / lifo / avg có thể đặt ở bất kỳ vị trí nào sau tên coin
+        method, args = parse_sell_method(ctx.args)
+        
         # Hiển thị hướng dẫn nếu không có tham số
-        if len(ctx.args) < 1:
+        if len(args) < 1:
             keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
             msg = (
                 "📝 *HƯỚNG DẪN BÁN COIN*\n"
@@ -3992,12 +5503,14 @@ try:
                 "*Cách 4: Bán theo giá trị USD*\n"
                 "`/sell [coin] $[giá trị]`\n"
                 "📌 Ví dụ: `/sell btc $1000`\n\n"
+                "*Cách tính giá vốn:* thêm `fifo` (mặc định), `lifo` hoặc `avg`\n"
+                "📌 Ví dụ: `/sell btc 0.5 lifo`\n\n"
                 f"🕐 {format_vn_time_short()}"
             )
             await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard))
             return
         
-        symbol = ctx.args[0].upper()
+        symbol = args[0].upper()
         
         # Kiểm tra coin có tồn tại không
         price_data = get_price(symbol)
@@ -4007,38 +5520,19 @@ try:
         
         current_price = price_data['p']
         
-        # Lấy portfolio
-        portfolio_data = get_portfolio(target_user_id)
-        if not portfolio_data:
-            await update.message.reply_text("📭 Danh mục trống!")
-            return
-        
-        # Chuyển đổi portfolio thành list dict
-        portfolio = []
-        for row in portfolio_data:
-            portfolio.append({
-                'symbol': row[0], 
-                'amount': row[1], 
-                'buy_price': row[2], 
-                'buy_date': row[3], 
-                'total_cost': row[4]
-            })
-        
-        # Lọc các giao dịch của coin cần bán
-        symbol_txs = [tx for tx in portfolio if tx['symbol'] == symbol]
-        if not symbol_txs:
+        # Chỉ cần tổng số lượng đang giữ của coin này
+        total_amount = get_symbol_holding(target_user_id, symbol)
+        if total_amount <= 0:
             await update.message.reply_text(f"❌ Không có *{symbol}* trong danh mục", parse_mode='Markdown')
             return
         
-        total_amount = sum(tx['amount'] for tx in symbol_txs)
-        
         # Xác định số lượng cần bán
         sell_amount = 0
         sell_price = current_price  # Mặc định là giá thị trường
         
         # Xử lý tham số
-        if len(ctx.args) >= 2:
-            amount_arg = ctx.args[1].lower()
+        if len(args) >= 2:
+            amount_arg = args[1].lower()
             
             # Kiểm tra nếu là "all" - bán toàn bộ
             if amount_arg == 'all':
@@ -4065,9 +5559,9 @@ try:
                     return
         
         # Nếu có tham số giá bán
-        if len(ctx.args) >= 3:
+        if len(args) >= 3:
             try:
-                sell_price = float(ctx.args[2])
+                sell_price = float(args[2])
                 if sell_price <= 0:
                     await update.message.reply_text("❌ Giá bán phải > 0!")
                     return
@@ -4098,10 +5592,11 @@ try:
             return
         
         # Xác nhận trước khi bán (nếu bán số lượng lớn > 10% portfolio)
-        if sell_amount > total_amount * 0.1 and len(ctx.args) < 3:
+        if sell_amount > total_amount * 0.1 and len(args) < 3:
+            token = stash_pending_sell(symbol, sell_amount, sell_price, method)
             keyboard = [[
-                InlineKeyboardButton("✅ Xác nhận", callback_data=f"confirm_sell_{symbol}_{sell_amount}_{sell_price}"),
-                InlineKeyboardButton("❌ Hủy", callback_data="cancel_sell")
+                InlineKeyboardButton("✅ Xác nhận", callback_data=f"confirm_sell_{token}"),
+                InlineKeyboardButton("❌ Hủy", callback_data=f"cancel_sell_{token}")
             ]]
             
             msg = (
@@ -4111,7 +5606,8 @@ try:
                 f"💰 Giá bán: `{fmt_price(sell_price)}`\n"
                 f"💵 Tổng giá trị: `{fmt_price(sell_amount * sell_price)}`\n"
                 f"📈 Giá thị trường: `{fmt_price(current_price)}`\n"
-                f"📊 Tỷ lệ trong portfolio: `{(sell_amount/total_amount*100):.1f}%`\n\n"
+                f"📊 Tỷ lệ trong portfolio: `{(sell_amount/total_amount*100):.1f}%`\n"
+                f"🧮 Giá vốn: `{method.upper()}` - {SELL_COST_METHODS[method]}\n\n"
                 f"Bạn có chắc muốn bán?"
             )
             
@@ -4119,88 +5615,28 @@ try:
             return
         
         # Thực hiện bán
-        await execute_sell(update, ctx, target_user_id, symbol, sell_amount, sell_price, current_price, portfolio, current_user_id)
-
-    async def execute_sell(update, ctx, target_user_id, symbol, sell_amount, sell_price, current_price, portfolio, current_user_id):
-        """Thực thi lệnh bán coin"""
-        remaining_sell = sell_amount
-        new_portfolio = []
-        sold_value = 0
-        sold_cost = 0
-        sold_transactions = []
-        
-        # Sắp xếp giao dịch theo FIFO
-        portfolio.sort(key=lambda x: x['buy_date'])
-        
-        for tx in portfolio:
-            if tx['symbol'] == symbol and remaining_sell > 0:
-                if tx['amount'] <= remaining_sell:
-                    # Bán toàn bộ giao dịch này
-                    sold_cost += tx['total_cost']
-                    sold_value += tx['amount'] * sell_price
-                    remaining_sell -= tx['amount']
-                    
-                    sold_transactions.append({
-                        'amount': tx['amount'],
-                        'buy_price': tx['buy_price'],
-                        'profit': (sell_price - tx['buy_price']) * tx['amount']
-                    })
-                else:
-                    # Bán một phần
-                    sell_part = remaining_sell
-                    part_cost = sell_part * tx['buy_price']
-                    sold_cost += part_cost
-                    sold_value += sell_part * sell_price
-                    
-                    tx['amount'] -= sell_part
-                    tx['total_cost'] = tx['amount'] * tx['buy_price']
-                    new_portfolio.append(tx)
-                    
-                    sold_transactions.append({
-                        'amount': sell_part,
-                        'buy_price': tx['buy_price'],
-                        'profit': (sell_price - tx['buy_price']) * sell_part
-                    })
-                    
-                    remaining_sell = 0
-            else:
-                new_portfolio.append(tx)
-        
-        # Cập nhật database
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # Xóa tất cả giao dịch cũ
-        c.execute("DELETE FROM portfolio WHERE user_id = ?", (target_user_id,))
-        
-        # Thêm lại các giao dịch còn lại
-        for tx in new_portfolio:
-            c.execute('''INSERT INTO portfolio (user_id, symbol, amount, buy_price, buy_date, total_cost) 
-                        VALUES (?, ?, ?, ?, ?, ?)''',
-                      (target_user_id, tx['symbol'], tx['amount'], tx['buy_price'], tx['buy_date'], tx['total_cost']))
-        
-        # ===== THÊM CODE LƯU LỊCH SỬ BÁN =====
-        profit = sold_value - sold_cost
-        profit_percent = (profit / sold_cost * 100) if sold_cost > 0 else 0
-        
-        # Tính giá vốn trung bình
-        avg_buy_price = sold_cost / sell_amount if sell_amount > 0 else 0
-        
-        created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
-        sell_date = get_vn_time().strftime("%Y-%m-%d")
-        
-        c.execute('''INSERT INTO sell_history 
-                    (user_id, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_percent, sell_date, created_at) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (target_user_id, symbol, sell_amount, sell_price, avg_buy_price, 
-                   sold_value, sold_cost, profit, profit_percent, sell_date, created_at))
+        await execute_sell(update, ctx, target_user_id, symbol, sell_amount, sell_price, current_price, current_user_id, method)
+
+    async def execute_sell(update, ctx, target_user_id, symbol, sell_amount, sell_price, current_price, current_user_id, method=SELL_COST_METHOD):
+        """Thực thi lệnh bán coin - khớp lot theo method (fifo/lifo/avg)"""
+        reply = update.effective_message.reply_text
+        try:
+            result = match_sell_lots(target_user_id, symbol, sell_amount, sell_price, method)
+        except Exception:
+            await reply("❌ Lỗi khi ghi lệnh bán, dữ liệu chưa thay đổi. Vui lòng thử lại!")
+            return
         
-        conn.commit()
-        conn.close()
+        if not result:
+            held = get_symbol_holding(target_user_id, symbol)
+            await reply(f"❌ Bạn chỉ có {held:.4f} {symbol}")
+            return
         
-        # Tính toán lợi nhuận
-        profit = sold_value - sold_cost
-        profit_percent = (profit / sold_cost * 100) if sold_cost > 0 else 0
+        sell_amount = result['amount']
+        sold_value = result['sold_value']
+        sold_cost = result['sold_cost']
+        profit = result['profit']
+        profit_percent = result['profit_percent']
+        sold_transactions = result['lots']
         
         # Thông tin người bán
         sold_by = f" (bán bởi @{update.effective_user.username})" if update.effective_user.username else ""
@@ -4216,19 +5652,20 @@ try:
                f"💰 Giá bán: `{fmt_price(sell_price)}`\n"
                f"💵 Giá trị bán: `{fmt_price(sold_value)}`\n"
                f"📊 Vốn gốc: `{fmt_price(sold_cost)}`\n"
-               f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n")
+               f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n"
+               f"🧮 Giá vốn: `{method.upper()}` - {SELL_COST_METHODS[method]}\n")
         
         # Thêm chi tiết từng giao dịch nếu bán nhiều
         if len(sold_transactions) > 1:
             msg += f"\n*📋 CHI TIẾT GIAO DỊCH:*\n"
             for i, tx in enumerate(sold_transactions, 1):
                 tx_profit = tx['profit']
-                tx_profit_pct = ((sell_price - tx['buy_price']) / tx['buy_price']) * 100
-                msg += f"{i}. SL: `{tx['amount']:.4f}` - Giá mua: `{fmt_price(tx['buy_price'])}`\n"
+                tx_profit_pct = (tx_profit / tx['cost'] * 100) if tx['cost'] > 0 else 0
+                msg += f"{i}. #{tx['lot_id']} SL: `{tx['amount']:.4f}` - Giá mua: `{fmt_price(tx['buy_price'])}`\n"
                 msg += f"   {'✅' if tx_profit>=0 else '❌'} LN: `{fmt_price(tx_profit)}` ({tx_profit_pct:+.2f}%)\n"
         
         # So sánh với giá thị trường
-        if abs(sell_price - current_price) > 0.01:
+        if current_price and abs(sell_price - current_price) > 0.01:
             price_diff = sell_price - current_price
             price_diff_pct = (price_diff / current_price) * 100
             if price_diff > 0:
@@ -4238,10 +5675,10 @@ try:
         
         msg += f"{owner_info}\n\n🕐 {format_vn_time()}"
         
-        await update.message.reply_text(msg, parse_mode='Markdown')
+        await reply(msg, parse_mode='Markdown')
         
         # Ghi log giao dịch
-        logger.info(f"💰 SELL: User {target_user_id} bán {sell_amount} {symbol} @ {sell_price}, profit: {profit}")
+        logger.info(f"💰 SELL: User {target_user_id} bán {sell_amount} {symbol} @ {sell_price} ({method}, {len(sold_transactions)} lot), profit: {profit}")
 
     @auto_update_user
     @require_permission('view')
@@ -4403,6 +5840,7 @@ try:
                        f"💵 Giá vốn: `{fmt_price(buy_price)}`\n"
                        f"💎 Giá trị bán: `{fmt_price(total_sold)}`\n"
                        f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n\n"
+                       f"{format_sell_lots(sell_id)}"
                        f"*Sửa:* `/editsell {sell_id} [sl] [giá]`\n"
                        f"*Xóa:* `/delsell {sell_id}`\n\n"
                        f"🕐 {format_vn_time()}")
@@ -4556,7 +5994,7 @@ try:
                 tx_id = int(ctx.args[0])
                 
                 # Lấy chi tiết giao dịch từ database
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute('''SELECT id, symbol, amount, buy_price, buy_date, total_cost, user_id 
                             FROM portfolio WHERE id = ?''', (tx_id,))
@@ -4624,7 +6062,7 @@ try:
                     return
                 
                 # Kiểm tra giao dịch có tồn tại không
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute('''SELECT user_id FROM portfolio WHERE id = ?''', (tx_id,))
                 result = c.fetchone()
@@ -4735,7 +6173,7 @@ try:
             tx_id = int(ctx.args[0])
             
             # Kiểm tra giao dịch có tồn tại không
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT user_id FROM portfolio WHERE id = ?''', (tx_id,))
             result = c.fetchone()
@@ -4873,72 +6311,665 @@ try:
         if count == 0:
             stats_msg += "Không có coin lỗ\n"
         
+        if HAS_MATPLOTLIB:
+            stats_msg += f"\n🖼 Biểu đồ: /chart pie · /chart pnl\n"
         stats_msg += f"\n🕐 {format_vn_time()}"
         
         await msg.edit_text(stats_msg, parse_mode=ParseMode.MARKDOWN)
 
+    # ==================== PORTFOLIO ANALYTICS ====================
+    # Một chỗ tính duy nhất cho /stats, /view, nút "Danh mục" và báo cáo master
+    # Lot của user nạp thành mảng cột (chỉ số symbol, số lượng, vốn) rồi gom theo symbol trong 1 lượt:
+    # NumPy (bincount) nếu có, không thì array('d') cộng dồn - kết quả cuối luôn là list float
+    # Coin chưa lấy được giá được định giá bằng vốn (LN = 0) để tổng không bị lệch
+
+    class PortfolioAnalytics:
+        """Tổng hợp danh mục theo symbol: vốn, giá trị, lãi/lỗ chưa chốt + đã chốt, tỷ trọng"""
+
+        def __init__(self, symbols, codes, amounts, costs, lot_counts=None):
+            self.symbols = symbols        # Theo thứ tự xuất hiện đầu tiên
+            self.held = len(symbols)      # symbols[:held] là coin đang có lot
+            self.codes = codes            # array('l') - chỉ số symbol của từng lot
+            self.amounts = amounts        # array('d') - số lượng từng lot
+            self.costs = costs            # array('d') - vốn từng lot
+            self.lot_counts = lot_counts  # Số lot mỗi symbol khi nạp từ positions (mỗi dòng = 1 symbol)
+            self.sells = {}               # symbol -> (số lệnh, LN đã chốt, giá trị bán, vốn đã bán)
+            self.totals = {}
+
+        @classmethod
+        def from_rows(cls, rows):
+            """rows: (symbol, amount, total_cost) cho từng lot"""
+            index = {}
+            symbols = []
+            codes = array('l')
+            amounts = array('d')
+            costs = array('d')
+            for symbol, amount, cost in rows:
+                code = index.get(symbol)
+                if code is None:
+                    code = index[symbol] = len(symbols)
+                    symbols.append(symbol)
+                codes.append(code)
+                amounts.append(amount or 0.0)
+                costs.append(cost or 0.0)
+            return cls(symbols, codes, amounts, costs)
+
+        @classmethod
+        def from_positions(cls, rows):
+            """rows: (symbol, amount, cost, lots, sells, realized, sold_value, sold_cost) từ bảng positions"""
+            held = [row for row in rows if row[3] > 0]
+            book = cls([row[0] for row in held], array('l', range(len(held))),
+                       array('d', [row[1] for row in held]), array('d', [row[2] for row in held]),
+                       lot_counts=[row[3] for row in held])
+            book.add_realized([(row[0], row[4], row[5], row[6], row[7]) for row in rows if row[4] > 0])
+            return book
+
+        @classmethod
+        def load(cls, user_id, prices=None, with_realized=False):
+            """Đọc positions (O(số coin), không quét lot) của user, lấy giá 1 lần rồi tính toàn bộ"""
+            conn = db_connect(DB_PATH)
+            try:
+                c = conn.cursor()
+                c.execute('''SELECT symbol, amount, cost, lots, sells, realized, sold_value, sold_cost
+                             FROM positions WHERE user_id = ? AND (lots > 0 OR sells > 0) ORDER BY rowid''', (user_id,))
+                rows = c.fetchall()
+            finally:
+                conn.close()
+            if not with_realized:
+                rows = [row for row in rows if row[3] > 0]
+            book = cls.from_positions(rows)
+            if prices is None:
+                prices = get_prices_batch(book.symbols[:book.held]) if book.held else {}
+            book.compute(prices)
+            return book
+
+        def add_realized(self, rows):
+            """rows: (symbol, số lệnh bán, LN đã chốt, giá trị bán, vốn đã bán) - coin đã bán hết vẫn được giữ lại"""
+            known = set(self.symbols)
+            for symbol, count, profit, sold_value, sold_cost in rows:
+                if symbol not in known:
+                    known.add(symbol)
+                    self.symbols.append(symbol)
+                self.sells[symbol] = (count, profit, sold_value, sold_cost)
+
+        def compute(self, prices):
+            n = len(self.symbols)
+            quotes = []
+            for symbol in self.symbols[:self.held]:
+                price_data = prices.get(symbol)
+                quotes.append(price_data['p'] if price_data else None)
+            quotes.extend([None] * (n - self.held))
+
+            if HAS_NUMPY:
+                codes = np.frombuffer(self.codes, dtype=f'i{self.codes.itemsize}') if self.codes else np.zeros(0, dtype=int)
+                amounts = np.frombuffer(self.amounts, dtype=np.float64) if self.amounts else np.zeros(0)
+                costs = np.frombuffer(self.costs, dtype=np.float64) if self.costs else np.zeros(0)
+                amount = np.bincount(codes, weights=amounts, minlength=n)
+                cost = np.bincount(codes, weights=costs, minlength=n)
+                price = np.array([q if q is not None else np.nan for q in quotes], dtype=np.float64)
+                has_price = ~np.isnan(price)
+                value = np.where(has_price, amount * np.nan_to_num(price), cost)
+                profit = value - cost
+                profit_pct = np.divide(profit * 100, cost, out=np.zeros(n), where=cost > 0)
+                avg_price = np.divide(cost, amount, out=np.zeros(n), where=amount > 0)
+                total_value = float(value.sum())
+                weight = value * (100 / total_value) if total_value > 0 else np.zeros(n)
+                self.amount, self.cost, self.value = amount.tolist(), cost.tolist(), value.tolist()
+                self.profit, self.profit_pct = profit.tolist(), profit_pct.tolist()
+                self.avg_price, self.weight = avg_price.tolist(), weight.tolist()
+                self.has_price = has_price.tolist()
+                if self.lot_counts is None:
+                    self.lots = np.bincount(codes, minlength=n).tolist()
+            else:
+                # Cộng dồn vào list (ghi phần tử array('d') phải box/unbox float - chậm gấp ~3 lần)
+                amount = [0.0] * n
+                cost = [0.0] * n
+                for code, lot_amount, lot_cost in zip(self.codes, self.amounts, self.costs):
+                    amount[code] += lot_amount
+                    cost[code] += lot_cost
+                self.amount, self.cost = amount, cost
+                if self.lot_counts is None:
+                    lot_counts = Counter(self.codes)
+                    self.lots = [lot_counts[i] for i in range(n)]
+                self.has_price = [q is not None for q in quotes]
+                self.value = [a * q if q is not None else c for a, c, q in zip(self.amount, self.cost, quotes)]
+                self.profit = [v - c for v, c in zip(self.value, self.cost)]
+                self.profit_pct = [p * 100 / c if c > 0 else 0.0 for p, c in zip(self.profit, self.cost)]
+                self.avg_price = [c / a if a > 0 else 0.0 for a, c in zip(self.amount, self.cost)]
+                total_value = sum(self.value)
+                self.weight = [v * 100 / total_value if total_value > 0 else 0.0 for v in self.value]
+            self.price = [q if q is not None else 0.0 for q in quotes]
+            if self.lot_counts is not None:
+                self.lots = self.lot_counts + [0] * (n - len(self.lot_counts))
+
+            no_sell = (0, 0.0, 0.0, 0.0)
+            self.sell_count = [self.sells.get(s, no_sell)[0] for s in self.symbols]
+            self.realized = [self.sells.get(s, no_sell)[1] for s in self.symbols]
+
+            total_invest = sum(self.cost)
+            total_profit = total_value - total_invest
+            self.totals = {
+                'invest': total_invest,
+                'value': total_value,
+                'profit': total_profit,
+                'profit_pct': (total_profit / total_invest * 100) if total_invest > 0 else 0,
+                'realized': sum(self.realized),
+                'sold_value': sum(s[2] for s in self.sells.values()),
+                'sold_cost': sum(s[3] for s in self.sells.values()),
+            }
+            return self
+
+        def positions(self, held_only=True):
+            """Từng coin dưới dạng dict - mặc định chỉ coin còn lot"""
+            for i, symbol in enumerate(self.symbols):
+                if held_only and not self.lots[i]:
+                    continue
+                yield {
+                    'symbol': symbol,
+                    'amount': self.amount[i],
+                    'cost': self.cost[i],
+                    'avg_price': self.avg_price[i],
+                    'price': self.price[i],
+                    'has_price': self.has_price[i],
+                    'value': self.value[i],
+                    'profit': self.profit[i],
+                    'profit_pct': self.profit_pct[i],
+                    'weight': self.weight[i],
+                    'lots': self.lots[i],
+                    'realized': self.realized[i],
+                    'sell_count': self.sell_count[i],
+                }
+
+        def coin_profits(self):
+            """[(symbol, profit, profit_pct, value, cost)] sắp theo lợi nhuận giảm dần"""
+            rows = [(p['symbol'], p['profit'], p['profit_pct'], p['value'], p['cost']) for p in self.positions()]
+            rows.sort(key=lambda x: x[1], reverse=True)
+            return rows
+
+    def render_portfolio_body(book, separator):
+        """Khối từng coin + tổng kết dùng chung cho /view và nút Danh mục (coin chưa có giá thì ẩn dòng)"""
+        msg = ""
+        for pos in book.positions():
+            if not pos['has_price']:
+                continue
+            msg += f"*{pos['symbol']}*\n"
+            msg += f"📊 SL: `{pos['amount']:.4f}`\n"
+            msg += f"💰 TB: `{fmt_price(pos['avg_price'])}`\n"
+            msg += f"💎 TT: `{fmt_price(pos['value'])}`\n"
+            msg += f"{'✅' if pos['profit']>=0 else '❌'} LN: `{fmt_price(pos['profit'])}` ({pos['profit_pct']:+.2f}%)\n\n"
+
+        totals = book.totals
+        msg += f"{separator}\n"
+        msg += f"💵 Vốn: `{fmt_price(totals['invest'])}`\n"
+        msg += f"💰 GT: `{fmt_price(totals['value'])}`\n"
+        msg += f"{'✅' if totals['profit']>=0 else '❌'} Tổng LN: `{fmt_price(totals['profit'])}` ({totals['profit_pct']:+.2f}%)\n\n"
+        return msg
+
     def get_portfolio_stats(user_id):
         try:
-            portfolio_data = get_portfolio(user_id)
-            if not portfolio_data:
+            book = PortfolioAnalytics.load(user_id)
+            if not book.held:
                 return None
-            
-            total_invest = 0
-            total_value = 0
-            coins = {}
-            
-            for row in portfolio_data:
-                symbol, amount, price, date, cost = row[0], row[1], row[2], row[3], row[4]
-                
-                if symbol not in coins:
-                    coins[symbol] = {'amount': 0, 'cost': 0}
-                coins[symbol]['amount'] += amount
-                coins[symbol]['cost'] += cost
-                total_invest += cost
-                
-                price_data = get_price(symbol)
-                current_price = price_data['p'] if price_data else price
-                total_value += amount * current_price
-            
-            total_profit = total_value - total_invest
-            total_profit_percent = (total_profit / total_invest * 100) if total_invest > 0 else 0
-            
-            coin_profits = []
-            for symbol, data in coins.items():
-                price_data = get_price(symbol)
-                current_price = price_data['p'] if price_data else 0
-                current_value = data['amount'] * current_price
-                profit = current_value - data['cost']
-                profit_pct = (profit / data['cost'] * 100) if data['cost'] > 0 else 0
-                coin_profits.append((symbol, profit, profit_pct, current_value, data['cost']))
-            
-            coin_profits.sort(key=lambda x: x[1], reverse=True)
-            
+
+            totals = book.totals
             return {
-                'total_invest': total_invest,
-                'total_value': total_value,
-                'total_profit': total_profit,
-                'total_profit_percent': total_profit_percent,
-                'coins': coins,
-                'coin_profits': coin_profits
+                'total_invest': totals['invest'],
+                'total_value': totals['value'],
+                'total_profit': totals['profit'],
+                'total_profit_percent': totals['profit_pct'],
+                'coins': {p['symbol']: {'amount': p['amount'], 'cost': p['cost']} for p in book.positions()},
+                'coin_profits': book.coin_profits()
             }
         except Exception as e:
             logger.error(f"❌ Lỗi get_portfolio_stats: {e}")
             return None
 
+    def _legacy_portfolio_summary(rows, prices):
+        """Vòng lặp dict kiểu cũ (trước PortfolioAnalytics) - chỉ giữ để benchmark so sánh"""
+        summary = {}
+        total_invest = 0
+        total_value = 0
+        for symbol, amount, cost in rows:
+            if symbol not in summary:
+                summary[symbol] = {'amount': 0, 'cost': 0}
+            summary[symbol]['amount'] += amount
+            summary[symbol]['cost'] += cost
+            total_invest += cost
+        coin_profits = []
+        for symbol, data in summary.items():
+            price_data = prices.get(symbol)
+            current = data['amount'] * price_data['p'] if price_data else data['cost']
+            profit = current - data['cost']
+            profit_pct = (profit / data['cost'] * 100) if data['cost'] > 0 else 0
+            total_value += current
+            coin_profits.append((symbol, profit, profit_pct, current, data['cost']))
+        coin_profits.sort(key=lambda x: x[1], reverse=True)
+        return total_invest, total_value, coin_profits
+
+    def benchmark_portfolio_analytics(lots=20000, symbols=50, rounds=5):
+        """Đo vòng lặp cũ vs PortfolioAnalytics trên dữ liệu giả lập (không đụng DB, không gọi API)"""
+        import random
+        rng = random.Random(42)
+        names = [f"C{i}" for i in range(symbols)]
+        rows = []
+        for _ in range(lots):
+            amount = rng.uniform(0.01, 10)
+            rows.append((rng.choice(names), amount, amount * rng.uniform(1, 1000)))
+        prices = {name: {'p': rng.uniform(1, 1000)} for name in names[1:]}  # 1 coin thiếu giá
+
+        def timed(fn):
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                out = fn()
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            return best, out
+
+        legacy_ms, (invest, value, _) = timed(lambda: _legacy_portfolio_summary(rows, prices))
+        book = PortfolioAnalytics.from_rows(rows)
+        build_ms, _ = timed(lambda: PortfolioAnalytics.from_rows(rows))
+        compute_ms, _ = timed(lambda: book.compute(prices))
+        return {
+            'lots': lots,
+            'symbols': symbols,
+            'rounds': rounds,
+            'backend': 'numpy' if HAS_NUMPY else 'array',
+            'legacy_ms': legacy_ms,
+            'build_ms': build_ms,
+            'compute_ms': compute_ms,
+            'speedup': legacy_ms / compute_ms if compute_ms > 0 else 0,
+            'max_diff': max(abs(book.totals['invest'] - invest), abs(book.totals['value'] - value)),
+        }
+
+    @heavy_command
+    async def bench_analytics_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/benchanalytics [số lot] [số coin] - Owner đo vòng lặp cũ vs PortfolioAnalytics"""
+        if not is_owner(update.effective_user.id):
+            await update.message.reply_text("❌ Chỉ Owner mới có quyền sử dụng lệnh này!")
+            return
+        
+        try:
+            lots = int(ctx.args[0]) if ctx.args else 20000
+            symbols = int(ctx.args[1]) if len(ctx.args) > 1 else 50
+        except ValueError:
+            await update.message.reply_text("❌ /benchanalytics [số lot] [số coin]")
+            return
+        lots = max(1, min(lots, 500000))
+        symbols = max(1, min(symbols, lots))
+        
+        msg = await update.message.reply_text("⏱ Đang benchmark...")
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, lambda: benchmark_portfolio_analytics(lots, symbols))
+        
+        await msg.edit_text(
+            f"⏱ *BENCHMARK PORTFOLIO ANALYTICS*\n━━━━━━━━━━━━━━━━\n\n"
+            f"• Dữ liệu: `{result['lots']}` lot / `{result['symbols']}` coin\n"
+            f"• Backend: `{result['backend']}`\n"
+            f"• Vòng lặp cũ: `{result['legacy_ms']:.2f} ms`\n"
+            f"• Nạp mảng: `{result['build_ms']:.2f} ms`\n"
+            f"• Tính toán: `{result['compute_ms']:.2f} ms` (x{result['speedup']:.1f})\n"
+            f"• Sai lệch tổng: `{result['max_diff']:.2e}`\n\n"
+            f"🕐 {format_vn_time()}",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    # ==================== STREAMING EXPORT ====================
+    # Báo cáo ghi từng dòng từ cursor -> csv.writer -> SpooledTemporaryFile
+    # Nhỏ thì nằm trong RAM, vượt REPORT_SPOOL_MAX thì tự tràn xuống đĩa (EXPORT_DIR)
+    REPORT_SPOOL_MAX = int(os.environ.get('REPORT_SPOOL_MAX', 1024 * 1024))
+    REPORT_FETCH_BATCH = 500
+    REPORT_COPY_CHUNK = 64 * 1024
+
+    def iter_rows(query, params=(), batch_size=REPORT_FETCH_BATCH):
+        """Đọc kết quả SQL theo từng lô fetchmany - không giữ cả lịch sử trong RAM"""
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute(query, params)
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            conn.close()
+
+    def iter_buy_rows(user_id):
+        """(id, symbol, amount, buy_price, buy_date, total_cost) - như get_transaction_detail"""
+        return iter_rows('''SELECT id, symbol, amount, buy_price, buy_date, total_cost
+                            FROM portfolio WHERE user_id = ? ORDER BY buy_date''', (user_id,))
+
+    def iter_sell_rows(user_id):
+        """(id, symbol, amount, sell_price, buy_price, profit, profit_pct, sell_date, created_at) - như get_sell_history"""
+        return iter_rows('''SELECT id, symbol, amount, sell_price, buy_price, profit, profit_percent, sell_date, created_at
+                            FROM sell_history WHERE user_id = ?
+                            ORDER BY sell_date DESC, created_at DESC''', (user_id,))
+
+    def iter_income_rows(user_id):
+        """(id, amount, source, note, date, currency) - như get_recent_incomes"""
+        return iter_rows('''SELECT id, amount, source, note, income_date, currency FROM incomes
+                            WHERE user_id = ? ORDER BY income_date DESC, created_at DESC''', (user_id,))
+
+    def iter_expense_rows(user_id):
+        """(id, cat_name, amount, note, date, currency) - như get_recent_expenses"""
+        return iter_rows('''SELECT e.id, ec.name, e.amount, e.note, e.expense_date, e.currency
+                            FROM expenses e JOIN expense_categories ec ON e.category_id = ec.id
+                            WHERE e.user_id = ? ORDER BY e.expense_date DESC, e.created_at DESC''', (user_id,))
+
+    def get_report_prices(user_id):
+        """Giá hiện tại cho mọi coin user đang giữ - 1 lần get_prices_batch thay vì get_price từng giao dịch"""
+        symbols = [row[0] for row in iter_rows('''SELECT DISTINCT symbol FROM portfolio WHERE user_id = ?''', (user_id,))]
+        prices = get_prices_batch(symbols)
+        
+        # Coin batch không trả về -> thử lẻ 1 lần cho mỗi symbol (không phải mỗi dòng)
+        for symbol in symbols:
+            if symbol not in prices:
+                price_data = get_price(symbol)
+                if price_data:
+                    prices[symbol] = price_data
+        return prices
+
+    def iter_sell_rows_by_coin(user_id):
+        """Lịch sử bán gom theo coin trong 1 query: (symbol, [(id, amount, sell_price, buy_price, profit, profit_pct, sell_date), ...])"""
+        rows = iter_rows('''SELECT symbol, id, amount, sell_price, buy_price, profit, profit_percent, sell_date
+                            FROM sell_history WHERE user_id = ?
+                            ORDER BY symbol, sell_date DESC''', (user_id,))
+        for symbol, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield symbol, [row[1:] for row in group]
+
+    def get_category_budgets(user_id):
+        """Budget theo tên danh mục - 1 query thay vì query lại mỗi dòng chi tiêu"""
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute('''SELECT name, budget FROM expense_categories WHERE user_id = ?''', (user_id,))
+            return {name: budget or 0 for name, budget in c.fetchall()}
+        finally:
+            conn.close()
+
+    def peek_rows(rows):
+        """None nếu iterator rỗng, ngược lại trả iterator đầy đủ (kể cả dòng đã đọc thử)"""
+        first = next(rows, None)
+        if first is None:
+            return None
+        return itertools.chain((first,), rows)
+
+    class ReportStream:
+        """Luồng ghi CSV cho báo cáo xuất file"""
+        def __init__(self, filename, encoding='utf-8-sig'):
+            self.filename = filename
+            self.stats = {}
+            self.raw = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX, mode='w+b', dir=EXPORT_DIR)
+            self.text = io.TextIOWrapper(self.raw, encoding=encoding, newline='')
+            self.writer = csv.writer(self.text)
+
+        def finish(self, password=None):
+            """Trả về {'content', 'filename', 'stats'} - content là file nhị phân đã tua về đầu.
+            Có password thì nén AES-256 theo từng khối, không dựng lại CSV trong RAM."""
+            self.text.flush()
+            self.text.detach()
+            self.raw.seek(0)
+
+            if not (password and HAS_PYZIPPER):
+                return {'content': self.raw, 'filename': self.filename, 'stats': self.stats}
+
+            zip_raw = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX, mode='w+b', dir=EXPORT_DIR)
+            try:
+                with pyzipper.AESZipFile(
+                    zip_raw, 'w',
+                    compression=pyzipper.ZIP_DEFLATED,
+                    encryption=pyzipper.WZ_AES
+                ) as zip_file:
+                    zip_file.setpassword(password.encode('utf-8'))
+                    with zip_file.open(self.filename, 'w') as dest:
+                        shutil.copyfileobj(self.raw, dest, REPORT_COPY_CHUNK)
+            except Exception:
+                zip_raw.close()
+                raise
+            finally:
+                self.raw.close()
+
+            zip_raw.seek(0)
+            zip_filename = f"{os.path.splitext(self.filename)[0]}.zip"
+            return {'content': zip_raw, 'filename': zip_filename, 'stats': self.stats}
+
+        def append(self, other):
+            """Nối nguyên nội dung đã ghi của một stream khác (không BOM) vào sau phần đã ghi"""
+            self.text.flush()
+            other.text.flush()
+            other.raw.seek(0)
+            shutil.copyfileobj(other.raw, self.raw, REPORT_COPY_CHUNK)
+
+        def append_file(self, path):
+            """Nối nội dung file trên đĩa (phần thân lấy từ cache)"""
+            self.text.flush()
+            with open(path, 'rb') as src:
+                shutil.copyfileobj(src, self.raw, REPORT_COPY_CHUNK)
+
+        def close(self):
+            """Dọn file tạm khi tạo báo cáo lỗi giữa chừng"""
+            try:
+                self.raw.close()
+            except Exception:
+                pass
+
+    # ==================== REPORT CACHE ====================
+    # Phần thân báo cáo (mọi thứ sau header) được lưu ra đĩa, khoá theo
+    # (data version của user, snapshot giá, ngày). Header luôn ghi mới.
+    REPORT_CACHE_DIR = os.path.join(EXPORT_DIR, 'cache')
+    shutil.rmtree(REPORT_CACHE_DIR, ignore_errors=True)  # index nằm trong RAM, file cũ vô dụng sau restart
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+
+    def get_data_version(user_id):
+        """Version dữ liệu của user - trigger tăng mỗi khi ghi portfolio/sell_history/incomes/expenses/expense_categories"""
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute('''SELECT version FROM data_versions WHERE user_id = ?''', (user_id,))
+            row = c.fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error:
+            return 0
+        finally:
+            conn.close()
+
+    def price_snapshot(prices):
+        """Khoá ngắn cho bộ giá đang dùng - giá đổi thì phần thân phải tính lại"""
+        items = tuple(sorted((symbol, round(data['p'], 8)) for symbol, data in prices.items() if data))
+        return hash(items)
+
+    class ReportCache:
+        """Cache phần thân báo cáo trên đĩa: (kind, user_id) -> {'key', 'path', 'stats'}"""
+        def __init__(self, directory, max_entries=200, ttl=6 * 3600):
+            self.directory = directory
+            self.index = AdvancedCache('report_sections', max_size=max_entries, ttl=ttl)
+            self.lock = threading.Lock()
+            self.hits = 0
+            self.misses = 0
+
+        def path_for(self, kind, user_id):
+            return os.path.join(self.directory, f"{kind}_{user_id}.csv")
+
+        def drop(self, kind, user_id):
+            """Bỏ entry khỏi index và xoá file của nó (gọi khi đang giữ self.lock)"""
+            self.index.cache.pop((kind, user_id), None)
+            try:
+                os.remove(self.path_for(kind, user_id))
+            except OSError:
+                pass
+
+        def purge(self):
+            """Xoá các entry hết TTL cùng file trên đĩa, trả về số entry đã bỏ"""
+            with self.lock:
+                now = time.time()
+                expired = [k for k, (_, ts) in list(self.index.cache.items()) if now - ts >= self.index.ttl]
+                for kind, user_id in expired:
+                    self.drop(kind, user_id)
+            return len(expired)
+
+        def get(self, kind, user_id, key):
+            with self.lock:
+                entry = self.index.get((kind, user_id))
+                if entry and entry['key'] == key and os.path.exists(entry['path']):
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+                # Hết hạn hoặc lệch key: file cũ không dùng lại được nữa
+                self.drop(kind, user_id)
+            return None
+
+        def put(self, kind, user_id, key, body, stats):
+            """Lưu nội dung body (ReportStream không BOM) ra file cache của (kind, user).
+            File là CSV thường nên không gọi cho báo cáo có mật khẩu."""
+            self.purge()
+            path = self.path_for(kind, user_id)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                body.text.flush()
+                body.raw.seek(0)
+                with open(tmp_path, 'wb') as dest:
+                    shutil.copyfileobj(body.raw, dest, REPORT_COPY_CHUNK)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"⚠️ Không lưu được cache báo cáo {kind}/{user_id}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return
+            with self.lock:
+                index = self.index.cache
+                if (kind, user_id) not in index and len(index) >= self.index.max_size:
+                    # Tự đẩy entry cũ nhất ra để xoá luôn file của nó
+                    self.drop(*min(index, key=lambda k: index[k][1]))
+                self.index.set((kind, user_id), {'key': key, 'path': path, 'stats': dict(stats)})
+
+        def get_stats(self):
+            with self.lock:
+                total = self.hits + self.misses
+                return {
+                    'size': len(self.index.cache),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / total * 100, 2) if total > 0 else 0
+                }
+
+    report_cache = ReportCache(REPORT_CACHE_DIR)
+
+    # ==================== REPORT JOB QUEUE ====================
+    # Tạo báo cáo (đọc SQLite + ghi CSV + nén AES) chạy trên thread pool riêng.
+    # Handler chỉ xếp job rồi trả về, file được gửi khi job xong nên các chat khác không phải chờ.
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))
+    REPORT_PER_USER_LIMIT = int(os.environ.get('REPORT_PER_USER_LIMIT', 1))
+    REPORT_BUSY_TEXT = "⏳ Bạn đang có báo cáo đang được tạo, vui lòng đợi xong rồi thử lại."
+
+    _report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+    _report_lock = threading.Lock()
+    _report_user_jobs = {}   # user_id -> số job đang chờ/chạy
+    _report_waiting = []     # job chưa được worker nhận, theo thứ tự vào hàng
+
+    def report_queue_stats():
+        with _report_lock:
+            return {
+                'workers': REPORT_WORKERS,
+                'jobs': sum(_report_user_jobs.values()),
+                'waiting': len(_report_waiting),
+            }
+
+    def start_report_job(context, user_id, progress_msg, build, deliver, on_error=None):
+        """Xếp job tạo báo cáo vào pool nền, trả về ngay.
+        build(): chạy trong worker thread, trả về kết quả (dict của ReportStream.finish hoặc None)
+        deliver(result): coroutine gửi file trên event loop
+        on_error(e): coroutine báo lỗi cho user
+        False nếu user đã đủ REPORT_PER_USER_LIMIT job.
+        Governor đang từ chối lệnh nặng thì báo ngay trên progress_msg, không xếp job."""
+        if memory_governor.rejecting_heavy():
+            memory_governor.rejected += 1
+            context.application.create_task(progress_msg.edit_text(MEMORY_BUSY_TEXT))
+            return True
+        with _report_lock:
+            if _report_user_jobs.get(user_id, 0) >= REPORT_PER_USER_LIMIT:
+                return False
+            _report_user_jobs[user_id] = _report_user_jobs.get(user_id, 0) + 1
+            job = {'user_id': user_id, 'started': False}
+            _report_waiting.append(job)
+
+        def work():
+            memory_governor.wait_reports()   # Bậc pause: job chờ ở hàng đợi tới khi bộ nhớ hạ
+            with _report_lock:
+                job['started'] = True
+                if job in _report_waiting:
+                    _report_waiting.remove(job)
+            return build()
+
+        async def show_queue_position():
+            # Chỉ hiện vị trí khi phải chờ worker rảnh
+            await asyncio.sleep(1)
+            last = None
+            while not job['started']:
+                with _report_lock:
+                    position = _report_waiting.index(job) + 1 if job in _report_waiting else 0
+                text = f"⏳ Đang xếp hàng tạo báo cáo... (vị trí {position})"
+                if position and text != last:
+                    try:
+                        await progress_msg.edit_text(text)
+                    except Exception:
+                        pass
+                    last = text
+                await asyncio.sleep(2)
+            if last:
+                try:
+                    await progress_msg.edit_text("🔄 Đang tạo báo cáo...")
+                except Exception:
+                    pass
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            notifier = asyncio.create_task(show_queue_position())
+            result = None
+            started_at = time.time()
+            try:
+                result = await loop.run_in_executor(_report_executor, with_trace_context(work))
+                notifier.cancel()
+                await deliver(result)
+                logger.info(f"📄 Report job user {user_id} xong sau {time.time() - started_at:.1f}s")
+            except Exception as e:
+                logger.error(f"❌ Report job user {user_id}: {e}", exc_info=True)
+                if on_error:
+                    try:
+                        await on_error(e)
+                    except Exception:
+                        pass
+            finally:
+                notifier.cancel()
+                if isinstance(result, dict) and result.get('content'):
+                    result['content'].close()
+                with _report_lock:
+                    if job in _report_waiting:
+                        _report_waiting.remove(job)
+                    remaining = _report_user_jobs.get(user_id, 1) - 1
+                    if remaining > 0:
+                        _report_user_jobs[user_id] = remaining
+                    else:
+                        _report_user_jobs.pop(user_id, None)
+
+        context.application.create_task(run())
+        return True
+
     def generate_detailed_portfolio_csv(user_id):
         """
         Tạo file CSV chi tiết cho portfolio đầu tư
+        Trả về {'content', 'filename', 'stats'} (xem ReportStream.finish)
         """
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        stream = ReportStream(f"portfolio_detail_{user_id}_{timestamp}.csv")
         try:
-            import csv
-            import io
             from datetime import datetime
-            
-            # Tạo buffer để chứa CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
+
+            writer = stream.writer
+
             # =========================================
             # 1. THÔNG TIN TỔNG QUAN
             # =========================================
@@ -4949,11 +6980,11 @@ try:
             writer.writerow(['User ID:', user_id])
             writer.writerow([])
             
-            # Lấy dữ liệu
-            transactions = get_transaction_detail(user_id)
-            if not transactions:
+            # Lấy dữ liệu - đọc dần từ cursor
+            transactions = peek_rows(iter_buy_rows(user_id))
+            if transactions is None:
                 writer.writerow(['KHÔNG CÓ DỮ LIỆU'])
-                return output.getvalue()
+                return stream.finish()
             
             # =========================================
             # 2. DANH SÁCH GIAO DỊCH CHI TIẾT
@@ -4969,13 +7000,17 @@ try:
             
             total_invest = 0
             total_current = 0
+            tx_count = 0
             all_coins = {}
+            monthly_data = {}
+            prices = get_report_prices(user_id)
+            now = get_vn_time()
             
             for tx in transactions:
                 tx_id, symbol, amount, buy_price, buy_date, total_cost = tx
                 
-                # Lấy giá hiện tại
-                price_data = get_price(symbol)
+                # Giá hiện tại (đã prefetch)
+                price_data = prices.get(symbol)
                 current_price = price_data['p'] if price_data else buy_price
                 current_value = amount * current_price
                 profit = current_value - total_cost
@@ -4984,7 +7019,7 @@ try:
                 # Tính thời gian nắm giữ
                 try:
                     buy_datetime = datetime.strptime(buy_date, "%Y-%m-%d %H:%M:%S")
-                    hold_days = (get_vn_time() - buy_datetime).days
+                    hold_days = (now - buy_datetime).days
                 except:
                     hold_days = 0
                 
@@ -5014,7 +7049,16 @@ try:
                 all_coins[symbol]['current'] += current_value
                 all_coins[symbol]['profit'] += profit
                 all_coins[symbol]['transactions'] += 1
+                
+                # Vốn theo tháng (gộp luôn trong 1 lượt đọc)
+                month = buy_date[:7]  # YYYY-MM
+                if month not in monthly_data:
+                    monthly_data[month] = {'invest': 0, 'transactions': 0}
+                monthly_data[month]['invest'] += total_cost
+                monthly_data[month]['transactions'] += 1
+                tx_count += 1
             
+            stream.stats['transactions'] = tx_count
             writer.writerow([])
             
             # =========================================
@@ -5031,7 +7075,7 @@ try:
             writer.writerow(['Tổng lợi nhuận:', f"${total_profit:,.2f}"])
             writer.writerow(['Tỷ suất lợi nhuận:', f"{total_profit_pct:+.2f}%"])
             writer.writerow(['Số loại coin:', len(all_coins)])
-            writer.writerow(['Tổng số giao dịch:', len(transactions)])
+            writer.writerow(['Tổng số giao dịch:', tx_count])
             writer.writerow([])
             
             # =========================================
@@ -5126,16 +7170,6 @@ try:
             writer.writerow(['='*80])
             
             # Phân tích theo tháng
-            monthly_data = {}
-            for tx in transactions:
-                tx_id, symbol, amount, buy_price, buy_date, total_cost = tx
-                month = buy_date[:7]  # YYYY-MM
-                
-                if month not in monthly_data:
-                    monthly_data[month] = {'invest': 0, 'transactions': 0}
-                monthly_data[month]['invest'] += total_cost
-                monthly_data[month]['transactions'] += 1
-            
             writer.writerow(['Vốn đầu tư theo tháng:'])
             writer.writerow(['Tháng', 'Số tiền đầu tư', 'Số giao dịch'])
             for month in sorted(monthly_data.keys()):
@@ -5233,9 +7267,10 @@ try:
             writer.writerow(['KẾT THÚC BÁO CÁO'])
             writer.writerow(['='*80])
             
-            return output.getvalue()
+            return stream.finish()
             
         except Exception as e:
+            stream.close()
             logger.error(f"❌ Lỗi tạo CSV chi tiết: {e}")
             import traceback
             traceback.print_exc()
@@ -5245,14 +7280,14 @@ try:
         """
         Tạo file CSV chi tiết cho quản lý thu chi
         Bao gồm: thu nhập, chi tiêu, phân tích danh mục, cân đối
+        Trả về {'content', 'filename', 'stats'} (xem ReportStream.finish)
         """
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        stream = ReportStream(f"expense_detail_{user_id}_{timestamp}.csv")
         try:
-            import csv
-            import io
             from datetime import datetime
             
-            output = io.StringIO()
-            writer = csv.writer(output)
+            writer = stream.writer
             
             # =========================================
             # 1. THÔNG TIN TỔNG QUAN
@@ -5264,13 +7299,13 @@ try:
             writer.writerow(['User ID:', user_id])
             writer.writerow([])
             
-            # Lấy dữ liệu
-            incomes = get_recent_incomes(user_id, 5000)  # Lấy tối đa 5000 giao dịch
-            expenses = get_recent_expenses(user_id, 5000)
+            # Lấy dữ liệu - đọc dần từ cursor, không giới hạn số dòng
+            incomes = peek_rows(iter_income_rows(user_id))
+            expenses = peek_rows(iter_expense_rows(user_id))
             
-            if not incomes and not expenses:
+            if incomes is None and expenses is None:
                 writer.writerow(['KHÔNG CÓ DỮ LIỆU'])
-                return output.getvalue()
+                return stream.finish()
             
             # =========================================
             # 2. DANH SÁCH THU NHẬP
@@ -5279,14 +7314,17 @@ try:
             writer.writerow(['DANH SÁCH THU NHẬP'])
             writer.writerow(['='*80])
             
-            if incomes:
+            total_income = {}
+            income_by_month = {}
+            income_count = 0
+            
+            if incomes is not None:
                 writer.writerow(['ID', 'Ngày', 'Nguồn', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                total_income = {}
-                income_by_month = {}
                 income_by_source = {}
                 
                 for inc in incomes:
                     inc_id, amount, source, note, date, currency = inc
+                    income_count += 1
                     writer.writerow([inc_id, date, source, f"{amount:,.0f}", currency, note or ''])
                     
                     # Tổng theo loại tiền
@@ -5331,14 +7369,18 @@ try:
             writer.writerow(['DANH SÁCH CHI TIÊU'])
             writer.writerow(['='*80])
             
-            if expenses:
+            total_expense = {}
+            expense_by_month = {}
+            category_stats = {}
+            expense_count = 0
+            
+            if expenses is not None:
                 writer.writerow(['ID', 'Ngày', 'Danh mục', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                total_expense = {}
-                expense_by_month = {}
-                category_stats = {}
+                budgets = get_category_budgets(user_id)
                 
                 for exp in expenses:
                     exp_id, cat_name, amount, note, date, currency = exp
+                    expense_count += 1
                     writer.writerow([exp_id, date, cat_name, f"{amount:,.0f}", currency, note or ''])
                     
                     # Tổng theo loại tiền
@@ -5357,19 +7399,12 @@ try:
                     # Thống kê theo danh mục
                     key = f"{cat_name}_{currency}"
                     if key not in category_stats:
-                        # Lấy budget từ database
-                        conn = sqlite3.connect(DB_PATH)
-                        c = conn.cursor()
-                        c.execute('''SELECT budget FROM expense_categories WHERE name = ? AND user_id = ?''', (cat_name, user_id))
-                        budget = c.fetchone()
-                        conn.close()
-                        
                         category_stats[key] = {
                             'category': cat_name,
                             'currency': currency,
                             'total': 0,
                             'count': 0,
-                            'budget': budget[0] if budget else 0
+                            'budget': budgets.get(cat_name, 0)
                         }
                     category_stats[key]['total'] += amount
                     category_stats[key]['count'] += 1
@@ -5383,6 +7418,9 @@ try:
             
             writer.writerow([])
             
+            stream.stats['incomes'] = income_count
+            stream.stats['expenses'] = expense_count
+            
             # =========================================
             # 4. PHÂN TÍCH CHI TIÊU THEO DANH MỤC
             # =========================================
@@ -5523,15 +7561,15 @@ try:
             total_income_all = sum(total_income.values())
             total_expense_all = sum(total_expense.values())
             
-            writer.writerow(['Tổng số khoản thu:', len(incomes)])
-            writer.writerow(['Tổng số khoản chi:', len(expenses)])
+            writer.writerow(['Tổng số khoản thu:', income_count])
+            writer.writerow(['Tổng số khoản chi:', expense_count])
             writer.writerow(['Tổng thu (quy đổi VND):', f"{total_income_all:,.0f} VND"])
             writer.writerow(['Tổng chi (quy đổi VND):', f"{total_expense_all:,.0f} VND"])
             writer.writerow(['Tổng cân đối:', f"{total_income_all - total_expense_all:,.0f} VND"])
             
             # Trung bình chi tiêu
-            if expenses:
-                avg_expense = total_expense_all / len(expenses)
+            if expense_count:
+                avg_expense = total_expense_all / expense_count
                 writer.writerow(['Trung bình mỗi khoản chi:', f"{avg_expense:,.0f} VND"])
             
             # Tỷ lệ chi theo danh mục
@@ -5618,9 +7656,10 @@ try:
             writer.writerow(['KẾT THÚC BÁO CÁO'])
             writer.writerow(['='*80])
             
-            return output.getvalue()
+            return stream.finish()
             
         except Exception as e:
+            stream.close()
             logger.error(f"❌ Lỗi tạo detailed expense CSV: {e}")
             import traceback
             traceback.print_exc()
@@ -5630,15 +7669,15 @@ try:
         """
         Tạo báo cáo MASTER cho quản lý chi tiêu
         Bao gồm TẤT CẢ thông tin và được mã hóa
+        Trả về {'content', 'filename', 'stats'} (xem ReportStream.finish)
         """
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        stream = ReportStream(f"expense_master_{user_id}_{timestamp}.csv")
+        body = None
         try:
-            import csv
-            import io
             from datetime import datetime
             
-            # Tạo buffer cho CSV
-            csv_buffer = io.StringIO()
-            writer = csv.writer(csv_buffer)
+            writer = stream.writer
             
             # =========================================
             # 1. THÔNG TIN TỔNG QUAN
@@ -5652,18 +7691,24 @@ try:
             writer.writerow(['Mã hóa:', 'AES-256' if password else 'Không mã hóa'])
             writer.writerow([])
             
-            # Lấy dữ liệu
-            incomes = get_recent_incomes(user_id, 5000)  # Lấy nhiều nhất
-            expenses = get_recent_expenses(user_id, 5000)
+            # Phần thân dùng lại từ cache nếu dữ liệu thu chi chưa đổi
+            cache_key = (get_data_version(user_id),)
+            cached = report_cache.get('expense_master', user_id, cache_key)
+            if cached:
+                stream.append_file(cached['path'])
+                stream.stats.update(cached['stats'])
+                return stream.finish(password)
+            
+            # Lấy dữ liệu - đọc dần từ cursor, không giới hạn số dòng
+            incomes = peek_rows(iter_income_rows(user_id))
+            expenses = peek_rows(iter_expense_rows(user_id))
             
-            if not incomes and not expenses:
+            if incomes is None and expenses is None:
                 writer.writerow(['KHÔNG CÓ DỮ LIỆU'])
-                csv_content = csv_buffer.getvalue()
-                
-                # Nếu có password, tạo ZIP
-                if password and HAS_PYZIPPER:
-                    return create_encrypted_zip(csv_content, f"expense_empty_{user_id}.csv", password)
-                return csv_content
+                return stream.finish(password)
+            
+            body = ReportStream(None, encoding='utf-8')
+            writer = body.writer
             
             # =========================================
             # 2. DANH SÁCH THU NHẬP
@@ -5672,13 +7717,16 @@ try:
             writer.writerow(['DANH SÁCH THU NHẬP'])
             writer.writerow(['='*80])
             
-            if incomes:
+            total_income = {}
+            income_by_month = {}
+            income_count = 0
+            
+            if incomes is not None:
                 writer.writerow(['ID', 'Ngày', 'Nguồn', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                total_income = {}
-                income_by_month = {}
                 
                 for inc in incomes:
                     inc_id, amount, source, note, date, currency = inc
+                    income_count += 1
                     writer.writerow([inc_id, date, source, f"{amount:,.0f}", currency, note or ''])
                     
                     # Tổng theo loại tiền
@@ -5710,14 +7758,18 @@ try:
             writer.writerow(['DANH SÁCH CHI TIÊU'])
             writer.writerow(['='*80])
             
-            if expenses:
+            total_expense = {}
+            expense_by_month = {}
+            category_stats = {}
+            expense_count = 0
+            
+            if expenses is not None:
                 writer.writerow(['ID', 'Ngày', 'Danh mục', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                total_expense = {}
-                expense_by_month = {}
-                category_stats = {}
+                budgets = get_category_budgets(user_id)
                 
                 for exp in expenses:
                     exp_id, cat_name, amount, note, date, currency = exp
+                    expense_count += 1
                     writer.writerow([exp_id, date, cat_name, f"{amount:,.0f}", currency, note or ''])
                     
                     # Tổng theo loại tiền
@@ -5736,19 +7788,12 @@ try:
                     # Thống kê theo danh mục
                     key = f"{cat_name}_{currency}"
                     if key not in category_stats:
-                        # Lấy budget từ database
-                        conn = sqlite3.connect(DB_PATH)
-                        c = conn.cursor()
-                        c.execute('''SELECT budget FROM expense_categories WHERE name = ? AND user_id = ?''', (cat_name, user_id))
-                        budget = c.fetchone()
-                        conn.close()
-                        
                         category_stats[key] = {
                             'category': cat_name,
                             'currency': currency,
                             'total': 0,
                             'count': 0,
-                            'budget': budget[0] if budget else 0
+                            'budget': budgets.get(cat_name, 0)
                         }
                     category_stats[key]['total'] += amount
                     category_stats[key]['count'] += 1
@@ -5762,6 +7807,9 @@ try:
             
             writer.writerow([])
             
+            stream.stats['incomes'] = income_count
+            stream.stats['expenses'] = expense_count
+            
             # =========================================
             # 4. PHÂN TÍCH THEO DANH MỤC
             # =========================================
@@ -5875,8 +7923,8 @@ try:
             total_income_all = sum(total_income.values())
             total_expense_all = sum(total_expense.values())
             
-            writer.writerow(['Tổng số khoản thu:', len(incomes)])
-            writer.writerow(['Tổng số khoản chi:', len(expenses)])
+            writer.writerow(['Tổng số khoản thu:', income_count])
+            writer.writerow(['Tổng số khoản chi:', expense_count])
             writer.writerow(['Tổng thu (quy đổi VND):', f"{total_income_all:,.0f} VND"])
             writer.writerow(['Tổng chi (quy đổi VND):', f"{total_expense_all:,.0f} VND"])
             writer.writerow(['Tổng cân đối:', f"{total_income_all - total_expense_all:,.0f} VND"])
@@ -5961,16 +8009,19 @@ try:
             writer.writerow(['KẾT THÚC BÁO CÁO'])
             writer.writerow(['='*80])
             
-            # Lấy nội dung CSV
-            csv_content = csv_buffer.getvalue()
-            
-            # Nếu có password, tạo ZIP mã hóa
-            if password and HAS_PYZIPPER:
-                return create_encrypted_zip(csv_content, f"expense_master_{user_id}.csv", password)
+            # Lưu phần thân vào cache rồi nối sau header (báo cáo có mật khẩu không để lại bản CSV thường trên đĩa)
+            if not password:
+                report_cache.put('expense_master', user_id, cache_key, body, stream.stats)
+            stream.append(body)
+            body.close()
             
-            return csv_content
+            # Có password -> nén ZIP mã hóa ngay từ file tạm
+            return stream.finish(password)
             
         except Exception as e:
+            stream.close()
+            if body:
+                body.close()
             logger.error(f"❌ Lỗi tạo expense master report: {e}")
             import traceback
             traceback.print_exc()
@@ -5984,15 +8035,15 @@ try:
         - Phân tích lợi nhuận đã thực hiện
         - Dự báo
         - Khuyến nghị
+        Trả về {'content', 'filename', 'stats'} (xem ReportStream.finish)
         """
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        stream = ReportStream(f"master_report_{user_id}_{timestamp}.csv")
+        body = None
         try:
-            import csv
-            import io  # <-- THÊM DÒNG NÀY
             from datetime import datetime
             
-            # Tạo buffer cho CSV
-            csv_buffer = io.StringIO()
-            writer = csv.writer(csv_buffer)
+            writer = stream.writer
             
             # =========================================
             # 1. THÔNG TIN TỔNG QUAN
@@ -6009,21 +8060,26 @@ try:
             # =========================================
             # 2. LẤY DỮ LIỆU THỰC TẾ
             # =========================================
-            # Lấy giao dịch mua
-            buy_transactions = get_transaction_detail(user_id)
-            
-            # Lấy lịch sử bán từ bảng sell_history
-            sell_transactions = get_sell_history(user_id, 5000)  # Lấy tối đa 5000 giao dịch bán
-            
-            # Lấy portfolio hiện tại
-            portfolio_data = get_portfolio(user_id)
-            
-            if not buy_transactions and not sell_transactions and not portfolio_data:
+            # Phần thân dùng lại từ cache nếu dữ liệu, giá và ngày chưa đổi
+            now = get_vn_time()
+            prices = get_report_prices(user_id)
+            cache_key = (get_data_version(user_id), price_snapshot(prices), now.strftime('%Y-%m-%d'))
+            cached = report_cache.get('master', user_id, cache_key)
+            if cached:
+                stream.append_file(cached['path'])
+                stream.stats.update(cached['stats'])
+                return stream.finish(password)
+            
+            # Giao dịch mua (portfolio) và lịch sử bán - đọc dần từ cursor
+            buy_transactions = peek_rows(iter_buy_rows(user_id))
+            sell_transactions = peek_rows(iter_sell_rows(user_id))
+            
+            if buy_transactions is None and sell_transactions is None:
                 writer.writerow(['KHÔNG CÓ DỮ LIỆU'])
-                csv_content = csv_buffer.getvalue()
-                if password and HAS_PYZIPPER:
-                    return create_encrypted_zip(csv_content, f"report_empty_{user_id}.csv", password)
-                return csv_content
+                return stream.finish(password)
+            
+            body = ReportStream(None, encoding='utf-8')
+            writer = body.writer
             
             # =========================================
             # 3. DANH SÁCH GIAO DỊCH MUA (ĐANG NẮM GIỮ)
@@ -6037,15 +8093,30 @@ try:
                 'Giá trị hiện tại (USD)', 'Lợi nhuận (USD)', 'Lợi nhuận (%)', 'Thời gian nắm giữ (ngày)'
             ])
             
-            total_invest = 0  # Tổng vốn đang nắm giữ
-            total_current = 0  # Tổng giá trị hiện tại
-            all_coins = {}  # Dict tổng hợp theo coin
+            # Tổng hợp theo coin (vốn, giá trị, LN chưa chốt/đã chốt) tính 1 lượt bằng PortfolioAnalytics
+            book = PortfolioAnalytics.load(user_id, prices, with_realized=True)
+            all_coins = {
+                pos['symbol']: {
+                    'amount': pos['amount'],
+                    'invest': pos['cost'],
+                    'current': pos['value'],
+                    'unrealized_profit': pos['profit'],
+                    'realized_profit': pos['realized'],
+                    'buy_count': pos['lots'],
+                    'sell_count': pos['sell_count']
+                }
+                for pos in book.positions(held_only=False)
+            }
+            total_invest = book.totals['invest']  # Tổng vốn đang nắm giữ
+            total_current = book.totals['value']  # Tổng giá trị hiện tại
+            buy_count = 0
             
-            for tx in buy_transactions:
+            for tx in buy_transactions or ():
                 tx_id, symbol, amount, buy_price, buy_date, total_cost = tx
+                buy_count += 1
                 
-                # Lấy giá hiện tại
-                price_data = get_price(symbol)
+                # Giá hiện tại (đã prefetch)
+                price_data = prices.get(symbol)
                 current_price = price_data['p'] if price_data else buy_price
                 current_value = amount * current_price
                 profit = current_value - total_cost
@@ -6054,7 +8125,7 @@ try:
                 # Tính thời gian nắm giữ
                 try:
                     buy_datetime = datetime.strptime(buy_date, "%Y-%m-%d %H:%M:%S")
-                    hold_days = (get_vn_time() - buy_datetime).days
+                    hold_days = (now - buy_datetime).days
                 except:
                     hold_days = 0
                 
@@ -6064,33 +8135,6 @@ try:
                     f"${current_value:,.2f}", f"${profit:,.2f}", f"{profit_pct:+.2f}%",
                     hold_days
                 ])
-                
-                total_invest += total_cost
-                total_current += current_value
-                
-                # Tổng hợp theo coin
-                if symbol not in all_coins:
-                    all_coins[symbol] = {
-                        'amount': 0,
-                        'invest': 0,
-                        'current': 0,
-                        'unrealized_profit': 0,
-                        'realized_profit': 0,
-                        'buy_count': 0,
-                        'sell_count': 0,
-                        'buy_transactions': []
-                    }
-                all_coins[symbol]['amount'] += amount
-                all_coins[symbol]['invest'] += total_cost
-                all_coins[symbol]['current'] += current_value
-                all_coins[symbol]['unrealized_profit'] += profit
-                all_coins[symbol]['buy_count'] += 1
-                all_coins[symbol]['buy_transactions'].append({
-                    'id': tx_id,
-                    'amount': amount,
-                    'price': buy_price,
-                    'date': buy_date
-                })
             
             writer.writerow([])
             
@@ -6106,14 +8150,16 @@ try:
                 'Tỷ suất (%)', 'Ngày bán'
             ])
             
-            total_realized_profit = 0
-            total_sold_value = 0
-            total_sold_cost = 0
+            total_realized_profit = book.totals['realized']
+            total_sold_value = book.totals['sold_value']
+            total_sold_cost = book.totals['sold_cost']
+            sell_count = 0
             
-            if sell_transactions:
+            if sell_transactions is not None:
                 for sell in sell_transactions:
                     # sell = (id, symbol, amount, sell_price, buy_price, profit, profit_pct, sell_date, created_at)
                     sell_id, symbol, amount, sell_price, buy_price, profit, profit_pct, sell_date, created_at = sell
+                    sell_count += 1
                     
                     total_sold = amount * sell_price
                     total_cost = amount * buy_price
@@ -6123,30 +8169,11 @@ try:
                         f"${total_sold:,.2f}", f"${total_cost:,.2f}", f"${profit:,.2f}", 
                         f"{profit_pct:+.2f}%", sell_date
                     ])
-                    
-                    total_sold_value += total_sold
-                    total_sold_cost += total_cost
-                    total_realized_profit += profit
-                    
-                    # Cập nhật thông tin coin
-                    if symbol in all_coins:
-                        all_coins[symbol]['realized_profit'] += profit
-                        all_coins[symbol]['sell_count'] += 1
-                    else:
-                        # Coin đã bán hết, không còn trong portfolio
-                        all_coins[symbol] = {
-                            'amount': 0,
-                            'invest': 0,
-                            'current': 0,
-                            'unrealized_profit': 0,
-                            'realized_profit': profit,
-                            'buy_count': 0,
-                            'sell_count': 1,
-                            'buy_transactions': []
-                        }
             else:
                 writer.writerow(['CHƯA CÓ GIAO DỊCH BÁN NÀO'])
             
+            stream.stats['buys'] = buy_count
+            stream.stats['sells'] = sell_count
             writer.writerow([])
             
             # =========================================
@@ -6184,8 +8211,8 @@ try:
             writer.writerow([])
             
             writer.writerow(['THỐNG KÊ GIAO DỊCH:'])
-            writer.writerow([f'   • Tổng số giao dịch mua: {len(buy_transactions)}'])
-            writer.writerow([f'   • Tổng số giao dịch bán: {len(sell_transactions) if sell_transactions else 0}'])
+            writer.writerow([f'   • Tổng số giao dịch mua: {buy_count}'])
+            writer.writerow([f'   • Tổng số giao dịch bán: {sell_count}'])
             writer.writerow([f'   • Số loại coin đã giao dịch: {len(all_coins)}'])
             writer.writerow([f'   • Số loại coin đang nắm giữ: {len([c for c in all_coins.values() if c["amount"] > 0])}'])
             writer.writerow([])
@@ -6223,28 +8250,22 @@ try:
             # =========================================
             # 7. CHI TIẾT LỢI NHUẬN ĐÃ CHỐT THEO COIN
             # =========================================
-            if sell_transactions:
+            if sell_count:
                 writer.writerow(['='*80])
                 writer.writerow(['CHI TIẾT LỢI NHUẬN ĐÃ CHỐT THEO TỪNG COIN'])
                 writer.writerow(['='*80])
                 
                 # Lấy danh sách coin có lợi nhuận đã chốt
-                coins_with_realized = [(s, d) for s, d in all_coins.items() if d['realized_profit'] != 0]
+                coins_with_realized = {s for s, d in all_coins.items() if d['realized_profit'] != 0}
                 
                 if coins_with_realized:
-                    for symbol, data in coins_with_realized:
+                    # Chi tiết bán của mọi coin trong 1 query, gom theo symbol
+                    for symbol, coin_sells in iter_sell_rows_by_coin(user_id):
+                        if symbol not in coins_with_realized:
+                            continue
+                        data = all_coins[symbol]
                         writer.writerow([f'📌 {symbol}: Tổng lợi nhuận đã chốt = ${data["realized_profit"]:,.2f}'])
                         
-                        # Lấy chi tiết các giao dịch bán của coin này
-                        conn = sqlite3.connect(DB_PATH)
-                        c = conn.cursor()
-                        c.execute('''SELECT id, amount, sell_price, buy_price, profit, profit_percent, sell_date 
-                                    FROM sell_history 
-                                    WHERE user_id = ? AND symbol = ? 
-                                    ORDER BY sell_date DESC''', (user_id, symbol))
-                        coin_sells = c.fetchall()
-                        conn.close()
-                        
                         if coin_sells:
                             writer.writerow(['   ID', 'Số lượng', 'Giá bán', 'Giá vốn', 'Lợi nhuận', 'Tỷ suất', 'Ngày bán'])
                             for sell in coin_sells:
@@ -6321,6 +8342,45 @@ try:
             
             writer.writerow([])
             
+            # =========================================
+            # 8b. DIỄN BIẾN GIÁ (LỊCH SỬ GIÁ LOCAL)
+            # =========================================
+            writer.writerow(['='*80])
+            writer.writerow(['DIỄN BIẾN GIÁ & GIÁ TRỊ DANH MỤC (LỊCH SỬ GIÁ LOCAL)'])
+            writer.writerow(['='*80])
+            
+            held_symbols = [symbol for symbol, data in all_coins.items() if data['amount'] > 0]
+            history = price_history.closes(held_symbols, '1d', time.time() - 31 * 86400)
+            if any(history.values()):
+                writer.writerow(['Mã coin', 'Giá gần nhất', '24h', '7 ngày', '30 ngày', 'Số nến ngày'])
+                for symbol in held_symbols:
+                    series = history[symbol]
+                    if not series:
+                        continue
+                    changes = [price_change(series, days * 86400) for days in (1, 7, 30)]
+                    writer.writerow([symbol, f"${series[-1][1]:,.2f}"]
+                                    + [f"{pct:+.2f}%" if pct is not None else 'N/A' for pct in changes]
+                                    + [len(series)])
+                
+                values = portfolio_value_series(user_id, 30)
+                if len(values) >= 2:
+                    drawdown, peak_at, trough_at = max_drawdown(values)
+                    writer.writerow([])
+                    writer.writerow(['Ngày', 'Giá trị danh mục (USD)'])
+                    for bucket, value in values:
+                        writer.writerow([datetime.utcfromtimestamp(bucket + VN_OFFSET).strftime('%Y-%m-%d'), f"${value:,.2f}"])
+                    writer.writerow([])
+                    if peak_at is not None:
+                        writer.writerow([f'   • Sụt giảm lớn nhất (30 ngày): {drawdown:.2f}% '
+                                         f'({datetime.utcfromtimestamp(peak_at + VN_OFFSET):%d/%m} → '
+                                         f'{datetime.utcfromtimestamp(trough_at + VN_OFFSET):%d/%m})'])
+                    else:
+                        writer.writerow(['   • Sụt giảm lớn nhất (30 ngày): 0.00%'])
+            else:
+                writer.writerow(['Chưa đủ lịch sử giá - bot sẽ tự tích lũy dần mỗi lần lấy giá'])
+            
+            writer.writerow([])
+            
             # =========================================
             # 9. DỰ BÁO LỢI NHUẬN
             # =========================================
@@ -6426,44 +8486,359 @@ try:
             writer.writerow(['KẾT THÚC BÁO CÁO'])
             writer.writerow(['='*80])
             
-            # Lấy nội dung CSV
-            csv_content = csv_buffer.getvalue()
-            
-            # Nếu có password, tạo ZIP mã hóa
-            if password and HAS_PYZIPPER:
-                return create_encrypted_zip(csv_content, f"master_report_{user_id}.csv", password)
+            # Lưu phần thân vào cache rồi nối sau header (báo cáo có mật khẩu không để lại bản CSV thường trên đĩa)
+            if not password:
+                report_cache.put('master', user_id, cache_key, body, stream.stats)
+            stream.append(body)
+            body.close()
             
-            return csv_content
+            # Có password -> nén ZIP mã hóa ngay từ file tạm
+            return stream.finish(password)
             
         except Exception as e:
+            stream.close()
+            if body:
+                body.close()
             logger.error(f"❌ Lỗi tạo master report: {e}")
             import traceback
             traceback.print_exc()
             return None
     
-    def create_encrypted_zip(csv_content, filename, password):
-        """Tạo ZIP AES-256 từ nội dung CSV"""
-        try:
-            import pyzipper
-            import io
-            
-            zip_buffer = io.BytesIO()
-            timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-            zip_filename = f"master_report_{timestamp}.zip"
-            
-            with pyzipper.AESZipFile(
-                zip_buffer, 'w',
-                compression=pyzipper.ZIP_DEFLATED,
-                encryption=pyzipper.WZ_AES
-            ) as zip_file:
-                zip_file.setpassword(password.encode('utf-8'))
-                zip_file.writestr(filename, csv_content.encode('utf-8-sig'))
-            
-            zip_buffer.seek(0)
-            return {'content': zip_buffer, 'filename': zip_filename}
-        except Exception as e:
-            logger.error(f"❌ Lỗi tạo ZIP: {e}")
+    # ==================== CHARTS ====================
+    # Vẽ biểu đồ PNG phía server (matplotlib, tùy chọn) trên thread pool riêng:
+    # - pie: tỷ trọng danh mục, pnl: lãi/lỗ chưa chốt theo coin, expense: thu/chi theo tháng
+    # Cache theo nội dung: spec (dữ liệu đã tổng hợp + data version) -> sha256 -> file PNG,
+    # sau lần gửi đầu lưu file_id Telegram nên lần xem lại chỉ là 1 send_photo bằng file_id
+    CHART_DIR = os.path.join(EXPORT_DIR, 'charts')
+    shutil.rmtree(CHART_DIR, ignore_errors=True)  # index file_id nằm trong RAM, PNG cũ vô dụng sau restart
+    os.makedirs(CHART_DIR, exist_ok=True)
+    CHART_WORKERS = int(os.environ.get('CHART_WORKERS', 1))
+    CHART_STYLE = 1          # Tăng khi đổi cách vẽ -> mọi digest cũ tự hết hiệu lực
+    CHART_TOP_COINS = 8      # Pie gộp phần còn lại vào "Khác"
+    CHART_MONTHS = 6
+    CHART_KINDS = {
+        'pie': 'Tỷ trọng danh mục',
+        'pnl': 'Lãi/lỗ theo coin',
+        'expense': 'Thu chi theo tháng',
+    }
+
+    _chart_executor = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix='chart')
+
+    class ChartCache:
+        """digest -> {'path', 'file_id'} - PNG trên đĩa + file_id Telegram sau lần gửi đầu"""
+        def __init__(self, directory, max_entries=300, ttl=24 * 3600):
+            self.directory = directory
+            self.index = AdvancedCache('charts', max_size=max_entries, ttl=ttl)
+            self.lock = threading.Lock()
+            self.renders = 0
+            self.hits = 0
+
+        def path(self, digest):
+            return os.path.join(self.directory, f"{digest}.png")
+
+        def get(self, digest):
+            with self.lock:
+                entry = self.index.get(digest)
+                if entry and (entry.get('file_id') or os.path.exists(entry['path'])):
+                    self.hits += 1
+                    return entry
+            return None
+
+        def put(self, digest, png):
+            path = self.path(digest)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.renders += 1
+                entry = {'path': path, 'file_id': None}
+                self.index.set(digest, entry)
+                return entry
+
+        def set_file_id(self, digest, file_id):
+            with self.lock:
+                entry = self.index.get(digest)
+                if entry:
+                    entry['file_id'] = file_id
+
+        def get_stats(self):
+            with self.lock:
+                return {'size': len(self.index.cache), 'renders': self.renders, 'hits': self.hits}
+
+    chart_cache = ChartCache(CHART_DIR)
+
+    def chart_digest(spec):
+        """Địa chỉ nội dung của biểu đồ - cùng dữ liệu + cùng style thì cùng digest"""
+        payload = json.dumps([CHART_STYLE, spec], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def portfolio_chart_spec(user_id, kind):
+        """Spec cho pie / pnl từ PortfolioAnalytics (đọc positions, giá lấy từ cache)"""
+        book = PortfolioAnalytics.load(user_id)
+        positions = sorted(book.positions(), key=lambda p: p['value'], reverse=True)
+        if not positions:
+            return None
+        spec = {'kind': kind, 'version': get_data_version(user_id)}
+        if kind == 'pie':
+            top = positions[:CHART_TOP_COINS]
+            rest = sum(p['value'] for p in positions[CHART_TOP_COINS:])
+            spec['labels'] = [p['symbol'] for p in top] + (['Khác'] if rest > 0 else [])
+            spec['values'] = [round(p['value'], 2) for p in top] + ([round(rest, 2)] if rest > 0 else [])
+            spec['total'] = round(book.totals['value'], 2)
+        else:
+            ranked = sorted(positions, key=lambda p: p['profit'], reverse=True)
+            spec['labels'] = [p['symbol'] for p in ranked]
+            spec['values'] = [round(p['profit'], 2) for p in ranked]
+            spec['total'] = round(book.totals['profit'], 2)
+        return spec
+
+    def expense_chart_spec(user_id, currency=None, months=CHART_MONTHS):
+        """Spec thu/chi theo tháng (1 loại tiền - mặc định loại có nhiều khoản chi nhất)"""
+        now = get_vn_time()
+        year, month = divmod(now.year * 12 + now.month - 1 - (months - 1), 12)
+        start = f"{year:04d}-{month + 1:02d}"
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            if not currency:
+                c.execute('''SELECT currency FROM (
+                                 SELECT currency FROM expenses WHERE user_id = ?
+                                 UNION ALL SELECT currency FROM incomes WHERE user_id = ?)
+                             GROUP BY currency ORDER BY COUNT(*) DESC LIMIT 1''', (user_id, user_id))
+                row = c.fetchone()
+                if not row:
+                    return None
+                currency = row[0] or 'VND'
+            c.execute('''SELECT substr(expense_date, 1, 7) AS month, SUM(amount) FROM expenses
+                         WHERE user_id = ? AND currency = ? AND substr(expense_date, 1, 7) >= ?
+                         GROUP BY month''', (user_id, currency, start))
+            expense = dict(c.fetchall())
+            c.execute('''SELECT substr(income_date, 1, 7) AS month, SUM(amount) FROM incomes
+                         WHERE user_id = ? AND currency = ? AND substr(income_date, 1, 7) >= ?
+                         GROUP BY month''', (user_id, currency, start))
+            income = dict(c.fetchall())
+        finally:
+            conn.close()
+        labels = sorted(set(expense) | set(income))
+        if not labels:
+            return None
+        return {
+            'kind': 'expense',
+            'version': get_data_version(user_id),
+            'currency': currency,
+            'labels': labels,
+            'income': [round(income.get(m, 0), 2) for m in labels],
+            'expense': [round(expense.get(m, 0), 2) for m in labels],
+        }
+
+    def render_chart(spec):
+        """Vẽ spec thành PNG (bytes) - dùng Figure trực tiếp, không đụng state toàn cục của pyplot"""
+        fig = Figure(figsize=(7, 5), dpi=110)
+        ax = fig.add_subplot(111)
+        kind = spec['kind']
+        if kind == 'pie':
+            ax.pie(spec['values'], labels=spec['labels'], autopct='%1.1f%%', startangle=90, counterclock=False)
+            ax.set_title(f"{CHART_KINDS['pie']} - ${spec['total']:,.2f}")
+            ax.axis('equal')
+        elif kind == 'pnl':
+            colors = ['#2e7d32' if v >= 0 else '#c62828' for v in spec['values']]
+            ax.barh(spec['labels'][::-1], spec['values'][::-1], color=colors[::-1])
+            ax.axvline(0, color='#555555', linewidth=0.8)
+            ax.set_title(f"{CHART_KINDS['pnl']} - tổng ${spec['total']:,.2f}")
+            ax.set_xlabel('USD')
+        else:
+            x = range(len(spec['labels']))
+            ax.bar([i - 0.2 for i in x], spec['income'], width=0.4, label='Thu', color='#2e7d32')
+            ax.bar([i + 0.2 for i in x], spec['expense'], width=0.4, label='Chi', color='#c62828')
+            ax.set_xticks(list(x))
+            ax.set_xticklabels(spec['labels'])
+            ax.set_title(f"{CHART_KINDS['expense']} ({spec['currency']})")
+            ax.legend()
+        if kind != 'pie':
+            ax.grid(axis='y' if kind == 'expense' else 'x', alpha=0.3)
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+        return buf.getvalue()
+
+    def prepare_chart(kind, user_id, currency=None):
+        """Chạy trong _chart_executor: tổng hợp spec -> digest -> PNG (vẽ mới nếu chưa có). None nếu không có dữ liệu"""
+        spec = expense_chart_spec(user_id, currency) if kind == 'expense' else portfolio_chart_spec(user_id, kind)
+        if not spec:
             return None
+        digest = chart_digest(spec)
+        entry = chart_cache.get(digest)
+        if not entry:
+            entry = chart_cache.put(digest, render_chart(spec))
+        return digest, dict(entry)
+
+    @heavy_command
+    @auto_update_user
+    @require_permission('view')
+    async def chart_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/chart [pie|pnl|expense] [loại tiền] - biểu đồ danh mục / thu chi"""
+        if not HAS_MATPLOTLIB:
+            await update.message.reply_text("❌ Biểu đồ chưa bật (server thiếu matplotlib)")
+            return
+        
+        uid = ctx.bot_data.get('effective_user_id', update.effective_user.id)
+        kind = ctx.args[0].lower() if ctx.args else 'pie'
+        if kind not in CHART_KINDS:
+            kinds = "\n".join(f"• `/chart {k}` - {v}" for k, v in CHART_KINDS.items())
+            await update.message.reply_text(f"🖼 *BIỂU ĐỒ*\n━━━━━━━━━━━━━━━━\n\n{kinds}", parse_mode=ParseMode.MARKDOWN)
+            return
+        currency = ctx.args[1].upper() if kind == 'expense' and len(ctx.args) > 1 else None
+        
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(_chart_executor, with_trace_context(prepare_chart, kind, uid, currency))
+        except Exception as e:
+            logger.error(f"❌ Lỗi vẽ biểu đồ {kind} cho {uid}: {e}")
+            await update.message.reply_text("❌ Không vẽ được biểu đồ, vui lòng thử lại sau!")
+            return
+        if not result:
+            await update.message.reply_text("📭 Chưa có dữ liệu để vẽ biểu đồ!")
+            return
+        
+        digest, entry = result
+        caption = f"🖼 {CHART_KINDS[kind]}\n🕐 {format_vn_time()}"
+        if entry['file_id']:
+            await update.message.reply_photo(photo=entry['file_id'], caption=caption)
+            return
+        with open(entry['path'], 'rb') as f:
+            sent = await update.message.reply_photo(photo=f, caption=caption)
+        if sent.photo:
+            chart_cache.set_file_id(digest, sent.photo[-1].file_id)
+
+    # ==================== COLUMNAR EXPORT ====================
+    # Dữ liệu thô có kiểu (Parquet / Arrow IPC), mỗi bảng 1 file trong ZIP - cho phân tích hàng loạt.
+    # Ngày tháng xuất dạng timestamp (giờ VN, không timezone) qua strftime('%s') của SQLite.
+    COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+    COLUMNAR_TABLES = [
+        ('buys',
+         '''SELECT id, symbol, amount, buy_price, total_cost, CAST(strftime('%s', buy_date) AS INTEGER)
+            FROM portfolio WHERE user_id = ? ORDER BY buy_date''',
+         [('id', 'int64'), ('symbol', 'string'), ('amount', 'float64'), ('buy_price', 'float64'),
+          ('total_cost', 'float64'), ('buy_date', 'timestamp')]),
+        ('sells',
+         '''SELECT id, symbol, amount, sell_price, buy_price, profit, profit_percent,
+                   CAST(strftime('%s', sell_date) AS INTEGER)
+            FROM sell_history WHERE user_id = ? ORDER BY sell_date, id''',
+         [('id', 'int64'), ('symbol', 'string'), ('amount', 'float64'), ('sell_price', 'float64'),
+          ('buy_price', 'float64'), ('profit', 'float64'), ('profit_percent', 'float64'),
+          ('sell_date', 'timestamp')]),
+        ('incomes',
+         '''SELECT id, amount, currency, source, note, CAST(strftime('%s', income_date) AS INTEGER)
+            FROM incomes WHERE user_id = ? ORDER BY income_date, id''',
+         [('id', 'int64'), ('amount', 'float64'), ('currency', 'string'), ('source', 'string'),
+          ('note', 'string'), ('income_date', 'timestamp')]),
+        ('expenses',
+         '''SELECT e.id, e.amount, e.currency, ec.name, e.note, CAST(strftime('%s', e.expense_date) AS INTEGER)
+            FROM expenses e LEFT JOIN expense_categories ec ON e.category_id = ec.id
+            WHERE e.user_id = ? ORDER BY e.expense_date, e.id''',
+         [('id', 'int64'), ('amount', 'float64'), ('currency', 'string'), ('category', 'string'),
+          ('note', 'string'), ('expense_date', 'timestamp')]),
+    ]
+
+    COLUMNAR_COINS_QUERY = '''SELECT s.symbol,
+               COALESCE(b.amount, 0), COALESCE(b.cost, 0), COALESCE(b.lots, 0),
+               COALESCE(r.realized, 0), COALESCE(r.sells, 0)
+        FROM (SELECT symbol FROM portfolio WHERE user_id = ?
+              UNION SELECT symbol FROM sell_history WHERE user_id = ?) s
+        LEFT JOIN (SELECT symbol, SUM(amount) AS amount, SUM(total_cost) AS cost, COUNT(*) AS lots
+                   FROM portfolio WHERE user_id = ? GROUP BY symbol) b ON b.symbol = s.symbol
+        LEFT JOIN (SELECT symbol, SUM(profit) AS realized, COUNT(*) AS sells
+                   FROM sell_history WHERE user_id = ? GROUP BY symbol) r ON r.symbol = s.symbol
+        ORDER BY s.symbol'''
+
+    COLUMNAR_COINS_COLUMNS = [
+        ('symbol', 'string'), ('amount', 'float64'), ('cost_basis', 'float64'), ('lots', 'int64'),
+        ('realized_profit', 'float64'), ('sell_count', 'int64'), ('price', 'float64'),
+        ('value', 'float64'), ('unrealized_profit', 'float64'),
+    ]
+
+    def iter_row_batches(query, params=(), batch_size=REPORT_FETCH_BATCH):
+        """Như iter_rows nhưng trả từng lô (list) để dựng record batch"""
+        conn = db_connect(DB_PATH)
+        try:
+            c = conn.cursor()
+            c.execute(query, params)
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+    def iter_coin_aggregate_batches(user_id):
+        """Tổng hợp theo coin (SQL GROUP BY) + giá hiện tại -> giá trị, lãi/lỗ chưa chốt"""
+        prices = get_report_prices(user_id)
+        for rows in iter_row_batches(COLUMNAR_COINS_QUERY, (user_id,) * 4):
+            batch = []
+            for symbol, amount, cost, lots, realized, sells in rows:
+                price_data = prices.get(symbol)
+                price = price_data['p'] if price_data else None
+                value = amount * price if price is not None else None
+                unrealized = value - cost if value is not None else None
+                batch.append((symbol, amount, cost, lots, realized, sells, price, value, unrealized))
+            yield batch
+
+    def _columnar_schema(columns):
+        types = {'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(), 'timestamp': pa.timestamp('s')}
+        return pa.schema([(name, types[kind]) for name, kind in columns])
+
+    def write_columnar_table(sink, fmt, columns, batches):
+        """Ghi từng lô vào Parquet/Arrow - bộ nhớ chỉ giữ 1 lô. Trả về số dòng."""
+        schema = _columnar_schema(columns)
+        if fmt == 'parquet':
+            writer = pq.ParquetWriter(sink, schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(sink, schema)
+        row_count = 0
+        try:
+            for rows in batches:
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                row_count += len(rows)
+        finally:
+            writer.close()
+        return row_count
+
+    def generate_columnar_export(user_id, fmt='parquet', password=None):
+        """
+        Xuất buys / sells / incomes / expenses / coins thành file cột có kiểu trong 1 ZIP
+        Trả về {'content', 'filename', 'stats'} như ReportStream.finish
+        """
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        ext = COLUMNAR_FORMATS[fmt]
+        tables = [(name, columns, iter_row_batches(query, (user_id,))) for name, query, columns in COLUMNAR_TABLES]
+        tables.append(('coins', COLUMNAR_COINS_COLUMNS, iter_coin_aggregate_batches(user_id)))
+
+        zip_raw = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX, mode='w+b', dir=EXPORT_DIR)
+        stats = {}
+        try:
+            # Parquet/Arrow đã nén sẵn -> ZIP chỉ đóng gói (STORED), có password thì thêm AES
+            if password and HAS_PYZIPPER:
+                archive = pyzipper.AESZipFile(zip_raw, 'w', compression=pyzipper.ZIP_STORED, encryption=pyzipper.WZ_AES)
+                archive.setpassword(password.encode('utf-8'))
+            else:
+                archive = zipfile.ZipFile(zip_raw, 'w', compression=zipfile.ZIP_STORED)
+            with archive:
+                for name, columns, batches in tables:
+                    with tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX, mode='w+b', dir=EXPORT_DIR) as table_file:
+                        stats[name] = write_columnar_table(table_file, fmt, columns, batches)
+                        table_file.seek(0)
+                        with archive.open(f"{name}{ext}", 'w') as dest:
+                            shutil.copyfileobj(table_file, dest, REPORT_COPY_CHUNK)
+        except Exception:
+            zip_raw.close()
+            raise
+
+        zip_raw.seek(0)
+        return {'content': zip_raw, 'filename': f"data_{fmt}_{user_id}_{timestamp}.zip", 'stats': stats}
 
     @auto_update_user
     async def view_portfolio_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -6499,13 +8874,13 @@ try:
             await update.message.reply_text(f"❌ Không tìm thấy user {target}")
             return
         
-        portfolio_data = get_portfolio(target_user_id)
+        book = PortfolioAnalytics.load(target_user_id)
         
-        if not portfolio_data:
+        if not book.held:
             await update.message.reply_text(f"📭 Danh mục của {target} trống!")
             return
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_user_id,))
         user_info = c.fetchone()
@@ -6513,44 +8888,8 @@ try:
         
         display_name = user_info[0] if user_info and user_info[0] else f"User {target_user_id}"
         
-        symbols = list(set([row[0] for row in portfolio_data]))
-        prices = get_prices_batch(symbols)
-        
-        summary = {}
-        total_invest = 0
-        total_value = 0
-        
-        for row in portfolio_data:
-            symbol, amount, price, date, cost = row
-            if symbol not in summary:
-                summary[symbol] = {'amount': 0, 'cost': 0}
-            summary[symbol]['amount'] += amount
-            summary[symbol]['cost'] += cost
-            total_invest += cost
-        
         msg = f"📊 *DANH MỤC CỦA {display_name}*\n━━━━━━━━━━━━\n\n"
-        
-        for symbol, data in summary.items():
-            price_data = prices.get(symbol)
-            if price_data:
-                current = data['amount'] * price_data['p']
-                profit = current - data['cost']
-                profit_percent = (profit / data['cost']) * 100 if data['cost'] > 0 else 0
-                total_value += current
-                
-                msg += f"*{symbol}*\n"
-                msg += f"📊 SL: `{data['amount']:.4f}`\n"
-                msg += f"💰 TB: `{fmt_price(data['cost']/data['amount'])}`\n"
-                msg += f"💎 TT: `{fmt_price(current)}`\n"
-                msg += f"{'✅' if profit>=0 else '❌'} LN: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n"
-        
-        total_profit = total_value - total_invest
-        total_profit_percent = (total_profit / total_invest) * 100 if total_invest > 0 else 0
-        
-        msg += "━━━━━━━━━━━━\n"
-        msg += f"💵 Vốn: `{fmt_price(total_invest)}`\n"
-        msg += f"💰 GT: `{fmt_price(total_value)}`\n"
-        msg += f"{'✅' if total_profit>=0 else '❌'} Tổng LN: `{fmt_price(total_profit)}` ({total_profit_percent:+.2f}%)\n\n"
+        msg += render_portfolio_body(book, "━━━━━━━━━━━━")
         msg += f"🕐 {format_vn_time()}"
         
         await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
@@ -6578,7 +8917,7 @@ try:
                 user = admin.user
                 status = "👑 Admin" if admin.status in ['administrator', 'creator'] else "👤 Member"
                 
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT last_seen FROM users WHERE user_id = ?", (user.id,))
                 db_user = c.fetchone()
@@ -6622,7 +8961,7 @@ try:
         try:
             admins = await ctx.bot.get_chat_administrators(chat_id)
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             granted_count = 0
@@ -6680,9 +9019,15 @@ try:
         except Exception:
             pass
 
-        for new_member in update.message.new_chat_members:
-            await update_user_info_async(new_member)
+        members = list(update.message.new_chat_members)
+        update_users_batch(members)
 
+        # Resolve cross-ban / fban / mute / captcha cho cả lô trong 1 lượt
+        human_ids = [m.id for m in members if not m.is_bot]
+        join_state = mod_resolve_join_batch(chat_id, human_ids) if human_ids else None
+        admin_status = None
+
+        for new_member in members:
             # === BOT ĐƯỢC THÊM VÀO NHÓM MỚI ===
             if new_member.id == bot_id:
                 chat = update.effective_chat
@@ -6711,7 +9056,8 @@ try:
                 continue
 
             # === MULTI-GROUP: Tự động kick nếu bị cross-ban ===
-            if mg_is_cross_banned(chat_id, new_member.id):
+            is_cross_banned = new_member.id in join_state['cross_banned']
+            if is_cross_banned:
                 try:
                     await ctx.bot.ban_chat_member(chat_id=chat_id, user_id=new_member.id)
                     await update.message.reply_text(
@@ -6724,28 +9070,19 @@ try:
                     logger.error(f"❌ Không kick được {new_member.id}: {e}")
 
             # === MODERATION: Federation ban check ===
-            if await mod_check_fed_ban(ctx, chat_id, new_member.id):
+            fban_reason = join_state['fed_banned'].get(new_member.id)
+            if fban_reason is not None and await mod_enforce_fed_ban(ctx, chat_id, new_member.id, fban_reason):
                 continue
 
             # === KIỂM TRA USER CÓ ĐANG BỊ MUTE KHÔNG (re-apply khi rejoin) ===
-            try:
-                conn_m = sqlite3.connect(DB_PATH)
-                c_m = conn_m.cursor()
-                # Lấy action cuối cùng liên quan mute/unmute của user
-                c_m.execute('''SELECT action FROM mod_logs
-                               WHERE group_id=? AND target_user=?
-                               AND action IN ('mute','auto_mute','auto_mute_flood','unmute')
-                               ORDER BY created_at DESC LIMIT 1''',
-                             (chat_id, new_member.id))
-                last_action = c_m.fetchone()
-                conn_m.close()
-
-                # Nếu action cuối là mute (chưa được unmute) → re-apply
-                if last_action and last_action[0] in ('mute', 'auto_mute', 'auto_mute_flood'):
+            if new_member.id in join_state['muted']:
+                try:
                     from telegram import ChatPermissions
+                    expires_at = join_state['muted'][new_member.id]
                     await ctx.bot.restrict_chat_member(
                         chat_id=chat_id, user_id=new_member.id,
-                        permissions=ChatPermissions(can_send_messages=False))
+                        permissions=ChatPermissions(can_send_messages=False),
+                        until_date=datetime.utcfromtimestamp(expires_at) if expires_at else None)
                     logger.info(f"🔇 Re-applied mute cho {new_member.id} khi rejoin {chat_id}")
                     try:
                         msg = await update.message.reply_text(
@@ -6754,38 +9091,39 @@ try:
                         asyncio.create_task(auto_delete_message(ctx, chat_id, msg.message_id, 10))
                     except Exception:
                         pass
-            except Exception as e:
-                logger.error(f"❌ Re-apply mute error: {e}")
+                except Exception as e:
+                    logger.error(f"❌ Re-apply mute error: {e}")
 
             # === MODERATION: CAPTCHA + Welcome ===
-            await mod_on_new_member(update, ctx, new_member)
+            await mod_on_new_member(update, ctx, new_member,
+                                    captcha_cfg=join_state['captcha'], cross_banned=is_cross_banned)
 
             try:
-                admins = await ctx.bot.get_chat_administrators(chat_id)
-                for admin in admins:
-                    if admin.user.id == new_member.id:
-                        conn = sqlite3.connect(DB_PATH)
-                        c = conn.cursor()
-                        
-                        c.execute("SELECT * FROM permissions WHERE group_id = ? AND user_id = ?", (chat_id, new_member.id))
-                        exists = c.fetchone()
-                        
-                        if not exists:
-                            permissions = {'view': 1, 'edit': 0, 'delete': 0, 'manage': 0}
-                            
-                            if admin.status == 'creator':
-                                permissions = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 1}
-                            
-                            c.execute('''INSERT INTO permissions (group_id, user_id, granted_by, can_view_all, can_edit_all, can_delete_all, can_manage_perms, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                                      (chat_id, new_member.id, new_member.id,
-                                       permissions['view'], permissions['edit'], permissions['delete'], permissions['manage'],
-                                       get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
-                            conn.commit()
-                            
-                            logger.info(f"✅ Auto-granted permissions for new admin @{new_member.username} in {chat_id}")
-                        
-                        conn.close()
-                        break
+                if admin_status is None:
+                    admins = await mod_get_chat_admins(ctx, chat_id)
+                    admin_status = {admin.user.id: admin.status for admin in admins}
+                if new_member.id in admin_status:
+                    conn = db_connect(DB_PATH)
+                    c = conn.cursor()
+
+                    c.execute("SELECT * FROM permissions WHERE group_id = ? AND user_id = ?", (chat_id, new_member.id))
+                    exists = c.fetchone()
+
+                    if not exists:
+                        permissions = {'view': 1, 'edit': 0, 'delete': 0, 'manage': 0}
+
+                        if admin_status[new_member.id] == 'creator':
+                            permissions = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 1}
+
+                        c.execute('''INSERT INTO permissions (group_id, user_id, granted_by, can_view_all, can_edit_all, can_delete_all, can_manage_perms, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                  (chat_id, new_member.id, new_member.id,
+                                   permissions['view'], permissions['edit'], permissions['delete'], permissions['manage'],
+                                   get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
+                        conn.commit()
+
+                        logger.info(f"✅ Auto-granted permissions for new admin @{new_member.username} in {chat_id}")
+
+                    conn.close()
             except Exception as e:
                 logger.error(f"❌ Lỗi xử lý new member: {e}")
 
@@ -6806,7 +9144,7 @@ try:
             target_id = update.message.reply_to_message.from_user.id
             target_name = f"@{update.message.reply_to_message.from_user.username or target_id}"
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         
         c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
@@ -6845,7 +9183,7 @@ try:
         try:
             admins = await ctx.bot.get_chat_administrators(chat_id)
             
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             synced = 0
@@ -6877,7 +9215,7 @@ try:
         chat_id = update.effective_chat.id
         
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             
             c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='permissions'")
@@ -6965,7 +9303,7 @@ try:
         
         owner_id = get_group_owner(chat_id)
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (owner_id,))
         owner_info = c.fetchone()
@@ -7093,7 +9431,7 @@ try:
         """Lấy danh sách admin từ bảng permissions (KHÔNG phải group_admins)"""
         conn = None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             # Đọc từ bảng permissions - đây là bảng đang được dùng để cấp quyền
             c.execute('''
@@ -7118,7 +9456,7 @@ try:
     def grant_admin_permission(group_id, admin_id, granted_by, permissions):
         """Cấp quyền admin trong group - ĐỒNG BỘ cả 2 bảng"""
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             created_at = get_vn_time().strftime("%Y-%m-%d %H:%M:%S")
             
@@ -7173,7 +9511,7 @@ try:
         
     def revoke_admin_permission(group_id, admin_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("DELETE FROM group_admins WHERE group_id = ? AND admin_id = ?", (group_id, admin_id))
             conn.commit()
@@ -7190,7 +9528,7 @@ try:
 
     def check_admin_permission(group_id, admin_id, permission='view'):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT can_view, can_edit, can_delete, can_manage FROM group_admins WHERE group_id = ? AND admin_id = ?''', (group_id, admin_id))
             result = c.fetchone()
@@ -7423,7 +9761,7 @@ try:
         
         msg = await update.message.reply_text("🔄 Đang tính toán cân đối...")
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (owner_id,))
         user_info = c.fetchone()
@@ -7438,6 +9776,8 @@ try:
             return
         
         balance_msg = format_balance_message(balance_data, user_name)
+        if HAS_MATPLOTLIB:
+            balance_msg += "\n🖼 Biểu đồ theo tháng: /chart expense"
         
         keyboard = [
             [InlineKeyboardButton("📅 Hôm nay", callback_data="balance_day"),
@@ -7471,50 +9811,14 @@ try:
             target_user_id = current_user
             target_name = "của bạn"
         
-        portfolio_data = get_portfolio(target_user_id)
+        book = PortfolioAnalytics.load(target_user_id)
         
-        if not portfolio_data:
+        if not book.held:
             await query.edit_message_text(f"📭 Danh mục {target_name} trống!\n\n🕐 {format_vn_time()}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]))
             return
         
-        symbols = list(set([row[0] for row in portfolio_data]))
-        prices = get_prices_batch(symbols)
-        
-        summary = {}
-        total_invest = 0
-        total_value = 0
-        
-        for row in portfolio_data:
-            symbol, amount, price, date, cost = row
-            if symbol not in summary:
-                summary[symbol] = {'amount': 0, 'cost': 0}
-            summary[symbol]['amount'] += amount
-            summary[symbol]['cost'] += cost
-            total_invest += cost
-        
         msg = f"📊 *DANH MỤC {target_name}*\n━━━━━━━━━━━━━━━━\n\n"
-        
-        for symbol, data in summary.items():
-            price_data = prices.get(symbol)
-            if price_data:
-                current = data['amount'] * price_data['p']
-                profit = current - data['cost']
-                profit_percent = (profit / data['cost']) * 100 if data['cost'] > 0 else 0
-                total_value += current
-                
-                msg += f"*{symbol}*\n"
-                msg += f"📊 SL: `{data['amount']:.4f}`\n"
-                msg += f"💰 TB: `{fmt_price(data['cost']/data['amount'])}`\n"
-                msg += f"💎 TT: `{fmt_price(current)}`\n"
-                msg += f"{'✅' if profit>=0 else '❌'} LN: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n"
-        
-        total_profit = total_value - total_invest
-        total_profit_percent = (total_profit / total_invest) * 100 if total_invest > 0 else 0
-        
-        msg += "━━━━━━━━━━━━━━━━\n"
-        msg += f"💵 Vốn: `{fmt_price(total_invest)}`\n"
-        msg += f"💰 GT: `{fmt_price(total_value)}`\n"
-        msg += f"{'✅' if total_profit>=0 else '❌'} Tổng LN: `{fmt_price(total_profit)}` ({total_profit_percent:+.2f}%)\n\n"
+        msg += render_portfolio_body(book, "━━━━━━━━━━━━━━━━")
         msg += f"🕐 {format_vn_time()}"
         
         keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
@@ -7530,7 +9834,7 @@ try:
             await update.message.reply_text("❌ Lệnh này chỉ dùng trong nhóm!")
             return
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         
         c.execute("SELECT COUNT(*) FROM permissions WHERE group_id = ?", (chat_id,))
@@ -7568,7 +9872,7 @@ try:
             admins = get_all_admins(chat_id)
             if not admins:
                 # Thử lấy từ bảng cũ nếu không có
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute('''SELECT COUNT(*) FROM group_admins WHERE group_id = ?''', (chat_id,))
                 old_count = c.fetchone()[0]
@@ -7855,7 +10159,7 @@ try:
             
             # Thêm thông tin chủ sở hữu nếu đang ở group
             if chat_type != 'private' and target_user_id != current_user_id:
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_user_id,))
                 owner_info = c.fetchone()
@@ -7892,7 +10196,7 @@ try:
             
             # Thêm thông tin chủ sở hữu nếu đang ở group
             if chat_type != 'private' and target_user_id != current_user_id:
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_user_id,))
                 owner_info = c.fetchone()
@@ -8036,7 +10340,7 @@ try:
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
         
-        logger.info(f"📨 Tin nhắn từ user {user_id} Group ID: {chat_id} trong {chat_type}: '{text}'")
+        log_message.debug("📨 Tin nhắn từ user %s chat %s (%s), %s ký tự", user_id, chat_id, chat_type, len(text or ''))
         
         # TRONG GROUP: Moderation chạy TRƯỚC check quyền
         # (flood/filter/custom cmd áp dụng cho tất cả mọi người)
@@ -8045,7 +10349,7 @@ try:
                 return
             # Sau đó mới check quyền cho các tính năng bot
             if not check_permission(chat_id, user_id, 'view'):
-                logger.info(f"⛔ User {user_id} không có quyền trong group, bỏ qua")
+                log_message.debug("⛔ User %s không có quyền trong group, bỏ qua", user_id)
                 return
         
         # Xử lý tính toán nếu có
@@ -8069,7 +10373,7 @@ try:
         
         # Xử lý menu chính - SO SÁNH CHÍNH XÁC
         if text == "💰 ĐẦU TƯ COIN":
-            logger.info(f"💰 User {user_id} chọn menu ĐẦU TƯ COIN")
+            log_message.debug("💰 User %s chọn menu ĐẦU TƯ COIN", user_id)
             await update.message.reply_text(
                 f"💰 *MENU ĐẦU TƯ COIN*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}", 
                 parse_mode=ParseMode.MARKDOWN, 
@@ -8078,7 +10382,7 @@ try:
             return
             
         if text == "💵 QUẢN LÝ CHI TIÊU":
-            logger.info(f"💰 User {user_id} chọn menu QUẢN LÝ CHI TIÊU")
+            log_message.debug("💰 User %s chọn menu QUẢN LÝ CHI TIÊU", user_id)
             await update.message.reply_text(
                 f"💰 *QUẢN LÝ CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}", 
                 parse_mode=ParseMode.MARKDOWN, 
@@ -8087,7 +10391,7 @@ try:
             return
 
         if text == "⚙️ CÀI ĐẶT":
-            logger.info(f"⚙️ User {user_id} chọn menu CÀI ĐẶT")
+            log_message.debug("⚙️ User %s chọn menu CÀI ĐẶT", user_id)
             
             # Kiểm tra quyền: chỉ admin mới vào được cài đặt
             if chat_type in ['group', 'supergroup']:
@@ -8122,10 +10426,31 @@ try:
         
         await query.edit_message_text("🔄 Đang tạo file CSV...")
         
-        try:
-            if query.data == "export_csv":
-                transactions = get_transaction_detail(user_id)
-                if not transactions:
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
+        
+        if query.data == "export_csv":
+            back_menu = "back_to_invest"
+            
+            def build():
+                stream = ReportStream(f"portfolio_{user_id}_{timestamp}.csv")
+                try:
+                    writer = stream.writer
+                    writer.writerow(['ID', 'Mã coin', 'Số lượng', 'Giá mua (USD)', 'Ngày mua', 'Tổng vốn (USD)'])
+                    tx_count = 0
+                    for tx in iter_buy_rows(user_id):
+                        writer.writerow([tx[0], tx[1], tx[2], tx[3], tx[4], tx[5]])
+                        tx_count += 1
+                    stream.stats['transactions'] = tx_count
+                except Exception:
+                    stream.close()
+                    raise
+                if not tx_count:
+                    stream.close()
+                    return None
+                return stream.finish()
+            
+            async def deliver(result):
+                if not result:
                     await query.edit_message_text(
                         "📭 Không có dữ liệu portfolio để xuất!", 
                         parse_mode=None,
@@ -8133,98 +10458,80 @@ try:
                     )
                     return
                 
-                timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-                filename = f"portfolio_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(EXPORT_DIR, filename)
-                
-                logger.info(f"📝 Đang tạo file CSV: {filepath}")
-                
-                with open(filepath, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow(['ID', 'Mã coin', 'Số lượng', 'Giá mua (USD)', 'Ngày mua', 'Tổng vốn (USD)'])
-                    for tx in transactions:
-                        writer.writerow([tx[0], tx[1], tx[2], tx[3], tx[4], tx[5]])
-                
-                if os.path.exists(filepath):
-                    file_size = os.path.getsize(filepath)
-                    logger.info(f"✅ File đã tạo: {filepath}, kích thước: {file_size} bytes")
-                    
-                    with open(filepath, 'rb') as f:
-                        await query.message.reply_document(document=f, filename=filename, caption=f"📊 *BÁO CÁO DANH MỤC ĐẦU TƯ*\n━━━━━━━━━━━━━━━━\n\n✅ Xuất thành công {len(transactions)} giao dịch!\n📁 File: `{filename}`\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
-                    
-                    os.remove(filepath)
-                    logger.info(f"🗑 Đã xóa file tạm: {filepath}")
-                else:
-                    logger.error(f"❌ Không tìm thấy file sau khi tạo: {filepath}")
-                    await query.edit_message_text("❌ Lỗi: Không thể tạo file CSV!")
-                    return
+                filename = result['filename']
+                await query.message.reply_document(document=result['content'], filename=filename, caption=f"📊 *BÁO CÁO DANH MỤC ĐẦU TƯ*\n━━━━━━━━━━━━━━━━\n\n✅ Xuất thành công {result['stats']['transactions']} giao dịch!\n📁 File: `{filename}`\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
+                logger.info(f"✅ Đã gửi CSV portfolio cho user {user_id}: {filename}")
                 
                 await query.edit_message_text(f"💰 *MENU ĐẦU TƯ COIN*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN, reply_markup=get_invest_menu_keyboard(user_id, query.message.chat.id))
-                
-            elif query.data == "expense_export":
-                expenses = get_recent_expenses(user_id, 1000)
-                incomes = get_recent_incomes(user_id, 1000)
-                
-                if not expenses and not incomes:
-                    await query.edit_message_text(
-                        "📭 Không có dữ liệu chi tiêu để xuất!", 
-                        parse_mode=None,
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]])
-                    )
-                    return
-                
-                timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-                filename = f"expense_report_{user_id}_{timestamp}.csv"
-                filepath = os.path.join(EXPORT_DIR, filename)
-                
-                logger.info(f"📝 Đang tạo file CSV: {filepath}")
-                
-                with open(filepath, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                    writer = csv.writer(csvfile)
+            
+        elif query.data == "expense_export":
+            back_menu = "back_to_expense"
+            
+            def build():
+                stream = ReportStream(f"expense_report_{user_id}_{timestamp}.csv")
+                try:
+                    writer = stream.writer
                     
                     writer.writerow(['=== THU NHẬP ==='])
                     writer.writerow(['ID', 'Ngày', 'Nguồn', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                    for inc in incomes:
+                    income_count = 0
+                    for inc in iter_income_rows(user_id):
                         writer.writerow([inc[0], inc[4], inc[2], inc[1], inc[5], inc[3]])
+                        income_count += 1
                     
                     writer.writerow([])
                     
                     writer.writerow(['=== CHI TIÊU ==='])
                     writer.writerow(['ID', 'Ngày', 'Danh mục', 'Số tiền', 'Loại tiền', 'Ghi chú'])
-                    for exp in expenses:
+                    expense_count = 0
+                    for exp in iter_expense_rows(user_id):
                         writer.writerow([exp[0], exp[4], exp[1], exp[2], exp[5], exp[3]])
-                
-                if os.path.exists(filepath):
-                    file_size = os.path.getsize(filepath)
-                    logger.info(f"✅ File đã tạo: {filepath}, kích thước: {file_size} bytes")
+                        expense_count += 1
                     
-                    with open(filepath, 'rb') as f:
-                        await query.message.reply_document(document=f, filename=filename, caption=f"📊 *BÁO CÁO THU CHI*\n━━━━━━━━━━━━━━━━\n\n✅ Xuất thành công!\n• Thu nhập: {len(incomes)} giao dịch\n• Chi tiêu: {len(expenses)} giao dịch\n📁 File: `{filename}`\n\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
-                    
-                    os.remove(filepath)
-                    logger.info(f"🗑 Đã xóa file tạm: {filepath}")
-                else:
-                    logger.error(f"❌ Không tìm thấy file sau khi tạo: {filepath}")
-                    await query.edit_message_text("❌ Lỗi: Không thể tạo file CSV!")
+                    stream.stats['incomes'] = income_count
+                    stream.stats['expenses'] = expense_count
+                except Exception:
+                    stream.close()
+                    raise
+                if not income_count and not expense_count:
+                    stream.close()
+                    return None
+                return stream.finish()
+            
+            async def deliver(result):
+                if not result:
+                    await query.edit_message_text(
+                        "📭 Không có dữ liệu chi tiêu để xuất!", 
+                        parse_mode=None,
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]])
+                    )
                     return
                 
+                filename = result['filename']
+                stats = result['stats']
+                await query.message.reply_document(document=result['content'], filename=filename, caption=f"📊 *BÁO CÁO THU CHI*\n━━━━━━━━━━━━━━━━\n\n✅ Xuất thành công!\n• Thu nhập: {stats['incomes']} giao dịch\n• Chi tiêu: {stats['expenses']} giao dịch\n📁 File: `{filename}`\n\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
+                logger.info(f"✅ Đã gửi CSV thu chi cho user {user_id}: {filename}")
+                
                 await query.edit_message_text(f"💰 *QUẢN LÝ CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN, reply_markup=get_expense_menu_keyboard(user_id, query.message.chat.id, query.message.chat.type))
-        except Exception as e:
-            logger.error(f"❌ Lỗi export CSV: {e}", exc_info=True)
+        else:
+            return
+        
+        async def on_error(e):
             await query.edit_message_text(
                 f"❌ Lỗi khi xuất CSV: {str(e)[:200]}", 
                 parse_mode=None,
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_main")]])
             )
-            
-            try:
-                if 'filepath' in locals() and os.path.exists(filepath):
-                    os.remove(filepath)
-                    logger.info(f"🗑 Đã dọn dẹp file lỗi: {filepath}")
-            except:
-                pass
-
-    @auto_update_user
+        
+        if not start_report_job(ctx, user_id, query.message, build, deliver, on_error=on_error):
+            await query.edit_message_text(
+                REPORT_BUSY_TEXT,
+                parse_mode=None,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Về menu", callback_data=back_menu)]])
+            )
+
+    @heavy_command
+    @auto_update_user
     @require_permission('view')
     async def export_secure_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         """Xuất CSV có mật khẩu: /export_secure [password] [thời gian xóa]"""
@@ -8285,12 +10592,38 @@ try:
             asyncio.create_task(auto_delete_message(ctx, update.effective_chat.id, warning_msg.message_id, 5))
         
         msg = await update.message.reply_text("🔄 Đang tạo file bảo mật...")
+        timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
         
-        try:
-            # Lấy dữ liệu portfolio
-            transactions = get_transaction_detail(user_id)
+        def build():
+            # Ghi CSV từng dòng từ cursor vào file tạm
+            stream = ReportStream(f"portfolio_{user_id}_{timestamp}.csv")
+            tx_count = 0
+            try:
+                stream.writer.writerow(['ID', 'Mã coin', 'Số lượng', 'Giá mua (USD)', 'Ngày mua', 'Tổng vốn (USD)'])
+                for tx in iter_buy_rows(user_id):
+                    stream.writer.writerow([
+                        tx[0],  # ID
+                        tx[1],  # Symbol
+                        f"{tx[2]:.8f}",  # Amount
+                        f"${tx[3]:,.2f}",  # Buy price
+                        tx[4],  # Buy date
+                        f"${tx[5]:,.2f}"  # Total cost
+                    ])
+                    tx_count += 1
+                stream.stats['transactions'] = tx_count
+            except Exception:
+                stream.close()
+                raise
             
-            if not transactions:
+            if not tx_count:
+                stream.close()
+                return None
+            
+            # Nén ZIP có mật khẩu theo từng khối
+            return stream.finish(password)
+        
+        async def deliver(result):
+            if not result:
                 await msg.edit_text(
                     "📭 Không có dữ liệu để xuất!",
                     reply_markup=InlineKeyboardMarkup([[
@@ -8299,48 +10632,8 @@ try:
                 )
                 return
             
-            # Tạo nội dung CSV
-            import csv
-            import io
-            
-            csv_buffer = io.StringIO()
-            writer = csv.writer(csv_buffer)
-            
-            # Ghi header
-            writer.writerow(['ID', 'Mã coin', 'Số lượng', 'Giá mua (USD)', 'Ngày mua', 'Tổng vốn (USD)'])
-            
-            # Ghi dữ liệu
-            for tx in transactions:
-                writer.writerow([
-                    tx[0],  # ID
-                    tx[1],  # Symbol
-                    f"{tx[2]:.8f}",  # Amount
-                    f"${tx[3]:,.2f}",  # Buy price
-                    tx[4],  # Buy date
-                    f"${tx[5]:,.2f}"  # Total cost
-                ])
-            
-            # Tạo tên file
-            timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-            csv_filename = f"portfolio_{user_id}_{timestamp}.csv"
-            zip_filename = f"portfolio_{user_id}_{timestamp}.zip"
-            
-            # Tạo ZIP có mật khẩu
-            zip_buffer = io.BytesIO()
-            
-            with pyzipper.AESZipFile(
-                zip_buffer, 
-                'w', 
-                compression=pyzipper.ZIP_DEFLATED, 
-                encryption=pyzipper.WZ_AES
-            ) as zip_file:
-                # Đặt mật khẩu
-                zip_file.setpassword(password.encode('utf-8'))
-                # Thêm file CSV vào ZIP
-                zip_file.writestr(csv_filename, csv_buffer.getvalue().encode('utf-8-sig'))
-            
-            # Chuẩn bị gửi file
-            zip_buffer.seek(0)
+            zip_filename = result['filename']
+            tx_count = result['stats']['transactions']
             
             # Tạo caption với cảnh báo xóa
             time_display = "KHÔNG tự động xóa" if delete_seconds == 0 else f"{delete_seconds} giây"
@@ -8348,7 +10641,7 @@ try:
             caption = (
                 f"🔐 *FILE ĐÃ MÃ HÓA*\n"
                 f"━━━━━━━━━━━━━━━━\n\n"
-                f"✅ *Số giao dịch:* {len(transactions)}\n"
+                f"✅ *Số giao dịch:* {tx_count}\n"
                 f"📁 *Tên file:* `{zip_filename}`\n"
                 f"🔑 *Mật khẩu:* `{password}`\n\n"
                 f"📊 *Cách mở file:*\n"
@@ -8364,7 +10657,7 @@ try:
             
             # Gửi file
             sent_message = await update.message.reply_document(
-                document=zip_buffer,
+                document=result['content'],
                 filename=zip_filename,
                 caption=caption,
                 parse_mode=ParseMode.MARKDOWN
@@ -8385,10 +10678,9 @@ try:
                 asyncio.create_task(auto_delete_message(ctx, update.effective_chat.id, sent_message.message_id, delete_seconds))
             
             # Log thành công
-            logger.info(f"✅ Exported secure ZIP for user {user_id} with {len(transactions)} transactions, auto-delete after {delete_seconds}s")
-            
-        except Exception as e:
-            logger.error(f"❌ Lỗi export secure: {e}", exc_info=True)
+            logger.info(f"✅ Exported secure ZIP for user {user_id} with {tx_count} transactions, auto-delete after {delete_seconds}s")
+        
+        async def on_error(e):
             await msg.edit_text(
                 f"❌ *LỖI KHI XUẤT FILE*\n\n"
                 f"Lỗi: `{str(e)[:200]}`\n\n"
@@ -8398,7 +10690,11 @@ try:
                     InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")
                 ]])
             )
+        
+        if not start_report_job(ctx, user_id, msg, build, deliver, on_error=on_error):
+            await msg.edit_text(REPORT_BUSY_TEXT)
 
+    @heavy_command
     @auto_update_user
     @require_permission('view')
     async def export_master_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -8420,25 +10716,23 @@ try:
         password = ctx.args[0]
         msg = await update.message.reply_text("🔄 Đang tạo báo cáo MASTER...")
         
-        try:
-            # Tạo báo cáo master
-            result = generate_master_report(user_id, password if password != '0' else None)
-            
+        def build():
+            return generate_master_report(user_id, password if password != '0' else None)
+        
+        async def deliver(result):
             if not result:
                 await msg.edit_text("❌ Không thể tạo báo cáo!")
                 return
             
-            timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-            
             # Nếu có password và password != '0' -> gửi ZIP
-            if password != '0' and HAS_PYZIPPER and isinstance(result, dict):
+            if password != '0' and HAS_PYZIPPER:
                 # Gửi file ZIP
                 sent_message = await update.message.reply_document(
                     document=result['content'],
                     filename=result['filename'],
                     caption=f"🔐 *BÁO CÁO MASTER ĐÃ MÃ HÓA*\n"
                             f"━━━━━━━━━━━━━━━━\n\n"
-                            f"✅ *Số giao dịch:* {len(get_transaction_detail(user_id))}\n"
+                            f"✅ *Số giao dịch:* {result['stats'].get('buys', 0)}\n"
                             f"🔑 *Mật khẩu:* `{password}`\n"
                             f"📁 *File:* `{result['filename']}`\n\n"
                             f"📊 *Nội dung:*\n"
@@ -8463,14 +10757,13 @@ try:
             
             else:
                 # Gửi CSV thường
-                filename = f"master_report_{user_id}_{timestamp}.csv"
                 await update.message.reply_document(
-                    document=io.BytesIO(result.encode('utf-8-sig')),
-                    filename=filename,
+                    document=result['content'],
+                    filename=result['filename'],
                     caption=f"📊 *BÁO CÁO MASTER*\n"
                             f"━━━━━━━━━━━━━━━━\n\n"
-                            f"✅ *Số giao dịch:* {len(get_transaction_detail(user_id))}\n"
-                            f"📁 *File:* `{filename}`\n\n"
+                            f"✅ *Số giao dịch:* {result['stats'].get('buys', 0)}\n"
+                            f"📁 *File:* `{result['filename']}`\n\n"
                             f"📊 *Nội dung:*\n"
                             f"• Phân tích lợi nhuận chi tiết\n"
                             f"• Dự báo kịch bản thị trường\n"
@@ -8481,16 +10774,20 @@ try:
             
             await msg.delete()
             logger.info(f"✅ User {user_id} đã xuất báo cáo master thành công")
-            
-        except Exception as e:
-            logger.error(f"❌ Lỗi export master: {e}", exc_info=True)
+        
+        async def on_error(e):
             await msg.edit_text(
                 f"❌ *LỖI KHI XUẤT BÁO CÁO*\n\n"
                 f"Lỗi: `{str(e)[:200]}`\n\n"
                 f"Vui lòng thử lại sau.",
                 parse_mode=ParseMode.MARKDOWN
             )
+        
+        # Tạo báo cáo trên pool nền, gửi file khi xong
+        if not start_report_job(ctx, user_id, msg, build, deliver, on_error=on_error):
+            await msg.edit_text(REPORT_BUSY_TEXT)
 
+    @heavy_command
     @auto_update_user
     @require_permission('view')
     async def export_expense_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -8520,26 +10817,24 @@ try:
         password = ctx.args[0]
         msg = await update.message.reply_text("🔄 Đang tạo báo cáo chi tiêu MASTER...")
         
-        try:
-            # Tạo báo cáo master
-            result = generate_expense_master_report(user_id, password if password != '0' else None)
-            
+        def build():
+            return generate_expense_master_report(user_id, password if password != '0' else None)
+        
+        async def deliver(result):
             if not result:
                 await msg.edit_text("❌ Không thể tạo báo cáo!")
                 return
             
-            timestamp = get_vn_time().strftime('%Y%m%d_%H%M%S')
-            
             # Nếu có password và password != '0' -> gửi ZIP
-            if password != '0' and HAS_PYZIPPER and isinstance(result, dict):
+            if password != '0' and HAS_PYZIPPER:
                 # Gửi file ZIP
                 sent_message = await update.message.reply_document(
                     document=result['content'],
                     filename=result['filename'],
                     caption=f"🔐 *BÁO CÁO CHI TIÊU MASTER ĐÃ MÃ HÓA*\n"
                             f"━━━━━━━━━━━━━━━━\n\n"
-                            f"✅ *Số khoản thu:* {len(get_recent_incomes(user_id, 5000))}\n"
-                            f"✅ *Số khoản chi:* {len(get_recent_expenses(user_id, 5000))}\n"
+                            f"✅ *Số khoản thu:* {result['stats'].get('incomes', 0)}\n"
+                            f"✅ *Số khoản chi:* {result['stats'].get('expenses', 0)}\n"
                             f"🔑 *Mật khẩu:* `{password}`\n"
                             f"📁 *File:* `{result['filename']}`\n\n"
                             f"📊 *Nội dung:*\n"
@@ -8565,15 +10860,14 @@ try:
             
             else:
                 # Gửi CSV thường
-                filename = f"expense_master_{user_id}_{timestamp}.csv"
                 await update.message.reply_document(
-                    document=io.BytesIO(result.encode('utf-8-sig')),
-                    filename=filename,
+                    document=result['content'],
+                    filename=result['filename'],
                     caption=f"📊 *BÁO CÁO CHI TIÊU MASTER*\n"
                             f"━━━━━━━━━━━━━━━━\n\n"
-                            f"✅ *Số khoản thu:* {len(get_recent_incomes(user_id, 5000))}\n"
-                            f"✅ *Số khoản chi:* {len(get_recent_expenses(user_id, 5000))}\n"
-                            f"📁 *File:* `{filename}`\n\n"
+                            f"✅ *Số khoản thu:* {result['stats'].get('incomes', 0)}\n"
+                            f"✅ *Số khoản chi:* {result['stats'].get('expenses', 0)}\n"
+                            f"📁 *File:* `{result['filename']}`\n\n"
                             f"📊 *Nội dung:*\n"
                             f"• Phân tích thu chi chi tiết\n"
                             f"• Thống kê theo danh mục\n"
@@ -8585,1766 +10879,1947 @@ try:
             
             await msg.delete()
             logger.info(f"✅ User {user_id} đã xuất báo cáo chi tiêu master thành công")
-            
-        except Exception as e:
-            logger.error(f"❌ Lỗi export expense master: {e}", exc_info=True)
+        
+        async def on_error(e):
             await msg.edit_text(
                 f"❌ *LỖI KHI XUẤT BÁO CÁO*\n\n"
                 f"Lỗi: `{str(e)[:200]}`\n\n"
                 f"Vui lòng thử lại sau.",
                 parse_mode=ParseMode.MARKDOWN
             )
+        
+        # Tạo báo cáo trên pool nền, gửi file khi xong
+        if not start_report_job(ctx, user_id, msg, build, deliver, on_error=on_error):
+            await msg.edit_text(REPORT_BUSY_TEXT)
 
-    async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    @heavy_command
+    @auto_update_user
+    @require_permission('view')
+    async def export_data_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """Xuất dữ liệu thô dạng cột: /export_data [parquet|arrow] [password]"""
+        user_id = ctx.bot_data.get('effective_user_id', update.effective_user.id)
+        
+        if not HAS_PYARROW:
+            await update.message.reply_text(
+                "❌ *TÍNH NĂNG CHƯA SẴN SÀNG*\n\n"
+                "Thư viện pyarrow chưa được cài đặt.\n"
+                "Vui lòng dùng `/export` để xuất báo cáo CSV.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        fmt = ctx.args[0].lower() if ctx.args else 'parquet'
+        if fmt not in COLUMNAR_FORMATS:
+            await update.message.reply_text(
+                "📦 *XUẤT DỮ LIỆU PHÂN TÍCH*\n\n"
+                "Dùng lệnh: `/export_data [parquet|arrow] [mật khẩu]`\n\n"
+                "• `/export_data` - Parquet, không mã hóa\n"
+                "• `/export_data arrow` - Arrow IPC\n"
+                "• `/export_data parquet 123456` - ZIP có mật khẩu\n\n"
+                "*File ZIP gồm:* buys, sells, incomes, expenses, coins\n\n"
+                f"🕐 {format_vn_time_short()}",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        password = ctx.args[1] if len(ctx.args) > 1 else None
+        msg = await update.message.reply_text("🔄 Đang xuất dữ liệu...")
+        
+        def build():
+            return generate_columnar_export(user_id, fmt, password)
+        
+        async def deliver(result):
+            stats = result['stats']
+            sent_message = await update.message.reply_document(
+                document=result['content'],
+                filename=result['filename'],
+                caption=f"📦 *DỮ LIỆU PHÂN TÍCH ({fmt.upper()})*\n"
+                        f"━━━━━━━━━━━━━━━━\n\n"
+                        f"• Mua: {stats['buys']} | Bán: {stats['sells']}\n"
+                        f"• Thu: {stats['incomes']} | Chi: {stats['expenses']}\n"
+                        f"• Coin: {stats['coins']}\n"
+                        + (f"🔑 *Mật khẩu:* `{password}`\n" if password else "")
+                        + f"\n🕐 {format_vn_time()}",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            await msg.delete()
+            
+            if password:
+                # Xóa tin nhắn lệnh gốc (chứa mật khẩu) và file sau 30s
+                try:
+                    await update.message.delete()
+                except Exception as e:
+                    logger.warning(f"⚠️ Không thể xóa tin nhắn lệnh gốc: {e}")
+                asyncio.create_task(auto_delete_message(ctx, update.effective_chat.id, sent_message.message_id, 30))
+            
+            logger.info(f"✅ User {user_id} đã xuất dữ liệu {fmt}: {stats}")
+        
+        async def on_error(e):
+            await msg.edit_text(f"❌ Lỗi khi xuất dữ liệu: {str(e)[:200]}")
+        
+        if not start_report_job(ctx, user_id, msg, build, deliver, on_error=on_error):
+            await msg.edit_text(REPORT_BUSY_TEXT)
+
+    # ==================== CALLBACK ROUTER ====================
+    # callback_data -> handler tra theo bảng thay cho chuỗi if/elif: khớp chính
+    # xác bằng dict, không có thì lấy prefix dài nhất trên trie theo ký tự. Chi
+    # phí tra cứu O(len(data)) dù có bao nhiêu route, và prefix dài luôn thắng
+    # prefix ngắn (edit_sell_ > edit_, del_sell_ > del_) không phụ thuộc thứ tự khai báo.
+    CALLBACK_INVALID_ID = "❌ ID không hợp lệ!"
+
+    class CallbackRoute:
+        __slots__ = ('key', 'handler', 'is_prefix', 'parse', 'permission', 'with_context', 'invalid')
+
+        def __init__(self, key, handler, is_prefix=False, parse=None, permission='view',
+                     with_context=True, invalid=CALLBACK_INVALID_ID):
+            self.key = key
+            self.handler = handler
+            self.is_prefix = is_prefix
+            self.parse = parse              # None (str) | int | tuple kiểu cho từng phần cách bởi '_'
+            self.permission = permission    # quyền cần có trong group (check_permission), None = bỏ qua
+            self.with_context = with_context  # False: handler(update, ctx) tự xử lý quyền/target
+            self.invalid = invalid          # thông báo khi payload sai kiểu
+
+        def parse_payload(self, payload):
+            if self.parse is None:
+                return payload
+            if isinstance(self.parse, tuple):
+                parts = payload.split('_', len(self.parse) - 1)
+                if len(parts) != len(self.parse):
+                    raise ValueError(payload)
+                return tuple(kind(part) for kind, part in zip(self.parse, parts))
+            return self.parse(payload)
+
+    class CallbackRequest:
+        """Thông tin đã xác định sẵn cho 1 callback: ai bấm, ở chat nào, thao tác trên dữ liệu của ai"""
+        __slots__ = ('query', 'data', 'payload', 'current_user_id', 'chat_id', 'chat_type',
+                     'target_user_id', 'owner_id', 'is_admin', 'is_owner_user')
+
+        def __init__(self, query, **fields):
+            self.query = query
+            self.data = query.data or ''
+            self.payload = None
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    class CallbackRouter:
+        def __init__(self):
+            self.exact_routes = {}
+            self.trie = {}      # ký tự -> node con; node[None] = route kết thúc tại đây
+
+        def add(self, key, handler, prefix=False, **meta):
+            route = CallbackRoute(key, handler, prefix, **meta)
+            if prefix:
+                node = self.trie
+                for ch in key:
+                    node = node.setdefault(ch, {})
+                node[None] = route
+            else:
+                self.exact_routes[key] = route
+            return route
+
+        def exact(self, key, **meta):
+            def decorator(func):
+                self.add(key, func, False, **meta)
+                return func
+            return decorator
+
+        def prefix(self, key, **meta):
+            def decorator(func):
+                self.add(key, func, True, **meta)
+                return func
+            return decorator
+
+        def resolve(self, data):
+            """-> (route, payload chưa parse) hoặc (None, None)"""
+            route = self.exact_routes.get(data)
+            if route is not None:
+                return route, ''
+            node, best, end = self.trie, None, 0
+            for i, ch in enumerate(data):
+                node = node.get(ch)
+                if node is None:
+                    break
+                if None in node:
+                    best, end = node[None], i + 1
+            if best is None:
+                return None, None
+            return best, data[end:]
+
+    callback_router = CallbackRouter()
+
+    # Upsert user trước mỗi callback: bỏ qua nếu vừa ghi cùng username/tên
+    _user_touch_cache = AdvancedCache('user_touch', max_size=1000, ttl=300)
+
+    async def touch_user_info(user):
+        fingerprint = (user.username, user.first_name, user.last_name)
+        if _user_touch_cache.get(user.id) == fingerprint:
+            return True
+        ok = await update_user_info_async(user)
+        if ok:
+            _user_touch_cache.set(user.id, fingerprint)
+        return ok
+
+    async def resolve_callback_request(update, ctx, permission):
+        """Xác định target user theo loại chat + kiểm tra quyền group. None = đã từ chối"""
         query = update.callback_query
-        await query.answer()
+        current_user_id = query.from_user.id
+        chat_id = query.message.chat.id
+        chat_type = query.message.chat.type
         
-        # Log chi tiết
-        logger.info("=" * 50)
-        logger.info(f"🔔 CALLBACK NHẬN ĐƯỢC: {query.data}")
-        logger.info(f"   • User: {query.from_user.id} (@{query.from_user.username})")
-        logger.info(f"   • Chat: {query.message.chat.id}")
-        logger.info(f"   • Message ID: {query.message.message_id}")
-        logger.info("=" * 50)
+        if chat_type == 'private':
+            return CallbackRequest(
+                query, current_user_id=current_user_id, chat_id=chat_id, chat_type=chat_type,
+                target_user_id=current_user_id, owner_id=current_user_id,
+                is_admin=False, is_owner_user=False
+            )
         
-        if query.from_user:
-            await update_user_info_async(query.from_user)
+        # GROUP CHAT: Lấy thông tin từ context
+        owner_id = ctx.bot_data['group_owner_id'] if 'group_owner_id' in ctx.bot_data else get_group_owner(chat_id)
+        is_admin = ctx.bot_data.get('is_admin', False)
+        is_owner_user = (current_user_id == owner_id)
         
-        data = query.data
+        if permission and not check_permission(chat_id, current_user_id, permission):
+            logger.warning(f"⛔ User {current_user_id} không có quyền {permission} trong group")
+            await safe_edit_message(query, "❌ Bạn không có quyền sử dụng bot trong nhóm này!")
+            return None
+        
+        # Admin/owner thao tác trên dữ liệu của owner, user thường tự thao tác
+        target_user_id = owner_id if (is_admin or is_owner_user) else current_user_id
+        log_callback.debug("👥 Group callback: user %s -> target %s (admin=%s, owner=%s)", current_user_id, target_user_id, is_admin, is_owner_user)
+        
+        return CallbackRequest(
+            query, current_user_id=current_user_id, chat_id=chat_id, chat_type=chat_type,
+            target_user_id=target_user_id, owner_id=owner_id,
+            is_admin=is_admin, is_owner_user=is_owner_user
+        )
 
-        # === MULTI-GROUP CALLBACK ROUTING ===
-        if data.startswith("mg_"):
-            await handle_mg_callback(update, ctx)
-            return
+    # ===========================================
+    # NHÓM 1: XỬ LÝ XÓA DANH MỤC
+    # ===========================================
+    @callback_router.prefix("confirm_del_cat_", parse=int, invalid="❌ ID danh mục không hợp lệ!")
+    async def cb_confirm_del_cat(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        category_id = cb.payload
+        logger.info(f"📂 Xác nhận xóa danh mục ID: {category_id}")
 
-        # === MODERATION CALLBACK ROUTING ===
-        if data.startswith("mod_"):
-            await handle_mod_callback(update, ctx)
-            return
+        await query.edit_message_text("🔄 Đang xóa danh mục...", parse_mode=None)
         
         try:
-            # Lấy thông tin cơ bản
-            current_user_id = query.from_user.id
-            chat_id = query.message.chat.id
-            chat_type = query.message.chat.type
+            success, result, deleted_count = delete_category(category_id, owner_id)
             
-            # ===== QUAN TRỌNG: XÁC ĐỊNH TARGET USER DỰA TRÊN CHAT TYPE =====
-            if chat_type == 'private':
-                target_user_id = current_user_id
-                is_admin = False
-                is_owner_user = False
-                owner_id = current_user_id
-                logger.info(f"💬 PRIVATE CALLBACK: xử lý cho user {target_user_id}")
+            if success:
+                safe_result = escape_markdown(str(result))
+                msg = (f"✅ *ĐÃ XÓA DANH MỤC*\n"
+                       f"━━━━━━━━━━━━━━━━\n\n"
+                       f"📋 Đã xóa danh mục: *{safe_result}*\n"
+                       f"💰 Đã xóa *{deleted_count}* khoản chi\n\n"
+                       f"🕐 {format_vn_time()}")
             else:
-                # GROUP CHAT: Lấy thông tin từ context
-                owner_id = ctx.bot_data.get('group_owner_id', get_group_owner(chat_id))
-                is_admin = ctx.bot_data.get('is_admin', False)
-                is_owner_user = (current_user_id == owner_id)
-                
-                # Log chi tiết
-                logger.info(f"👥 GROUP CALLBACK - Chi tiết:")
-                logger.info(f"   • current_user: {current_user_id}")
-                logger.info(f"   • owner_id từ context: {owner_id}")
-                logger.info(f"   • is_admin: {is_admin}")
-                logger.info(f"   • is_owner_user: {is_owner_user}")
-                
-                # Kiểm tra quyền trong group
-                if not check_permission(chat_id, current_user_id, 'view'):
-                    logger.warning(f"⛔ User {current_user_id} không có quyền view trong group")
-                    await safe_edit_message(query, "❌ Bạn không có quyền sử dụng bot trong nhóm này!")
-                    return
-                
-                # Xác định target_user_id
-                if is_admin or is_owner_user:
-                    target_user_id = owner_id
-                    logger.info(f"👑 Admin/owner thao tác: target = owner {target_user_id}")
-                else:
-                    target_user_id = current_user_id
-                    logger.info(f"👤 User thường tự thao tác: target = self {target_user_id}")
+                safe_result = escape_markdown(str(result))
+                msg = (f"❌ *LỖI*\n"
+                       f"━━━━━━━━━━━━━━━━\n\n"
+                       f"{safe_result}\n\n"
+                       f"🕐 {format_vn_time()}")
             
-            logger.info(f"🎯 Target user: {target_user_id}, IsAdmin: {is_admin}, IsOwner: {is_owner_user}")
+            safe_msg = escape_markdown(msg)
+            keyboard = [[
+                InlineKeyboardButton("📋 Xem danh mục", callback_data="expense_categories"),
+                InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")
+            ]]
             
-            # ===========================================
-            # NHÓM 1: XỬ LÝ XÓA DANH MỤC (ƯU TIÊN CAO NHẤT)
-            # ===========================================
+            await safe_edit_message(query, safe_msg, reply_markup=InlineKeyboardMarkup(keyboard))
             
-            if data.startswith("confirm_del_cat_"):
-                cat_id = data.replace("confirm_del_cat_", "")
-                logger.info(f"📂 Xác nhận xóa danh mục ID: {cat_id}")
-                
-                try:
-                    category_id = int(cat_id)
-                except ValueError:
-                    await safe_edit_message(query, "❌ ID danh mục không hợp lệ!")
-                    return
-                
-                await query.edit_message_text("🔄 Đang xóa danh mục...", parse_mode=None)
-                
-                try:
-                    success, result, deleted_count = delete_category(category_id, owner_id)
-                    
-                    if success:
-                        safe_result = escape_markdown(str(result))
-                        msg = (f"✅ *ĐÃ XÓA DANH MỤC*\n"
-                               f"━━━━━━━━━━━━━━━━\n\n"
-                               f"📋 Đã xóa danh mục: *{safe_result}*\n"
-                               f"💰 Đã xóa *{deleted_count}* khoản chi\n\n"
-                               f"🕐 {format_vn_time()}")
-                    else:
-                        safe_result = escape_markdown(str(result))
-                        msg = (f"❌ *LỖI*\n"
-                               f"━━━━━━━━━━━━━━━━\n\n"
-                               f"{safe_result}\n\n"
-                               f"🕐 {format_vn_time()}")
-                    
-                    safe_msg = escape_markdown(msg)
-                    keyboard = [[
-                        InlineKeyboardButton("📋 Xem danh mục", callback_data="expense_categories"),
-                        InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")
-                    ]]
-                    
-                    await safe_edit_message(query, safe_msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    
-                except Exception as e:
-                    logger.error(f"❌ Lỗi xóa danh mục: {e}")
-                    await query.edit_message_text(f"❌ Lỗi: {str(e)[:100]}", parse_mode=None)
-                
+        except Exception as e:
+            logger.error(f"❌ Lỗi xóa danh mục: {e}")
+            await query.edit_message_text(f"❌ Lỗi: {str(e)[:100]}", parse_mode=None)
+        
+        return
+
+    @callback_router.prefix("del_cat_", parse=int, invalid="❌ ID danh mục không hợp lệ!")
+    async def cb_del_cat(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        category_id = cb.payload
+        logger.info(f"📂 Xóa danh mục ID: {category_id}")
+
+        categories = get_expense_categories(owner_id)
+        category_name = "Không xác định"
+        for cat in categories:
+            if cat[0] == category_id:
+                category_name = cat[1]
+                break
+        
+        safe_category_name = escape_markdown(category_name)
+        
+        keyboard = [[
+            InlineKeyboardButton("✅ Xác nhận xóa", callback_data=f"confirm_del_cat_{category_id}"),
+            InlineKeyboardButton("❌ Hủy", callback_data="expense_categories")
+        ]]
+        
+        msg = (f"⚠️ *CẢNH BÁO: XÓA DANH MỤC*\n━━━━━━━━━━━━━━━━\n\n"
+               f"📋 Danh mục: *{safe_category_name}* (ID: {category_id})\n\n"
+               f"❗️ Hành động này sẽ xóa:\n"
+               f"• Danh mục *{safe_category_name}*\n"
+               f"• Tất cả chi tiêu trong danh mục này\n\n"
+               f"❌ *Không thể khôi phục!*\n\n"
+               f"Bạn có chắc chắn muốn xóa?")
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NHÓM 2: XỬ LÝ XÓA GIAO DỊCH COIN (ƯU TIÊN CAO)
+    # ===========================================
+
+    # ===========================================
+    # XỬ LÝ XÓA GIAO DỊCH MUA (COIN)
+    # ===========================================
+    @callback_router.prefix("confirm_del_", parse=int)
+    async def cb_confirm_del(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        
+        tx_id = cb.payload
+        logger.info(f"💰 Xác nhận xóa giao dịch mua: {tx_id}")
+        
+        # Kiểm tra giao dịch
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''SELECT user_id, symbol, amount FROM portfolio WHERE id = ?''', (tx_id,))
+        result = c.fetchone()
+        
+        if not result:
+            conn.close()
+            await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
+            return
+        
+        tx_owner_id, symbol, amount = result
+        
+        # Kiểm tra quyền xóa
+        can_delete = False
+        if tx_owner_id == target_user_id:
+            can_delete = True
+        elif is_admin and chat_type != 'private':
+            can_delete = True
+        
+        if not can_delete:
+            conn.close()
+            await safe_edit_message(query, "❌ Bạn không có quyền xóa giao dịch này!")
+            return
+        
+        # Thực hiện xóa
+        c.execute('''DELETE FROM portfolio WHERE id = ?''', (tx_id,))
+        conn.commit()
+        conn.close()
+        
+        msg = (f"✅ *ĐÃ XÓA GIAO DỊCH MUA #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
+               f"• Coin: {symbol}\n"
+               f"• Số lượng: {amount:.4f}\n\n"
+               f"🕐 {format_vn_time()}")
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về danh sách", callback_data="edit_transactions")]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # XỬ LÝ XÓA LỊCH SỬ BÁN (SELL)
+    # ===========================================
+    @callback_router.prefix("confirm_del_sell_", parse=int)
+    async def cb_confirm_del_sell(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        target_user_id = cb.target_user_id
+        
+        sell_id = cb.payload
+        logger.info(f"💰 Xác nhận xóa lệnh bán: {sell_id}")
+        
+        if delete_sell_history(sell_id, target_user_id):
+            await safe_edit_message(
+                query, 
+                f"✅ *Đã xóa lệnh bán #{sell_id}*",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("📋 Xem lịch sử bán", callback_data="show_sells"),
+                    InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")
+                ]])
+            )
+        else:
+            await safe_edit_message(query, f"❌ Không thể xóa lệnh bán #{sell_id}")
+        return
+
+    # ===========================================
+    # NHÓM 3: CÁC CALLBACK CHÍNH XÁC (MENU CHÍNH)
+    # ===========================================
+    @callback_router.exact("edit_transactions")
+    async def cb_edit_transactions(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        current_user_id = cb.current_user_id
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        is_owner_user = cb.is_owner_user
+        owner_id = cb.owner_id
+        
+        logger.info("📋 Hiển thị danh sách sửa/xóa giao dịch")
+        
+        # QUAN TRỌNG: Kiểm tra chat type
+        chat_type = query.message.chat.type
+        
+        # Nếu là private chat, chỉ quản lý dữ liệu của chính mình
+        if chat_type == 'private':
+            target_user_id = current_user_id
+            logger.info(f"💬 Private chat: quản lý giao dịch cá nhân {target_user_id}")
+        else:
+            # Trong group, chỉ cho phép chủ sở hữu hoặc admin
+            if not is_owner_user and not is_admin:
+                await safe_edit_message(query, "❌ Bạn không có quyền quản lý giao dịch!")
                 return
+            target_user_id = owner_id
+        
+        transactions = get_transaction_detail(target_user_id)
+        
+        if not transactions:
+            msg = f"📭 Không có giao dịch!\n\n🕐 {format_vn_time()}"
+            keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        
+        msg = "✏️ *CHỌN GIAO DỊCH*\n━━━━━━━━━━━━━━━━\n\n"
+        keyboard = []
+        row = []
+        
+        for tx in transactions:
+            tx_id, symbol, amount, price, date, total = tx
+            short_date = date.split()[0] if date else "N/A"
+            amount_str = f"{amount:.4f}".rstrip('0').rstrip('.') if '.' in f"{amount:.4f}" else f"{amount:.4f}"
             
-            if data.startswith("del_cat_"):
-                cat_id = data.replace("del_cat_", "")
-                logger.info(f"📂 Xóa danh mục ID: {cat_id}")
-                
-                try:
-                    category_id = int(cat_id)
-                except ValueError:
-                    await safe_edit_message(query, "❌ ID danh mục không hợp lệ!")
-                    return
-                
-                categories = get_expense_categories(owner_id)
-                category_name = "Không xác định"
-                for cat in categories:
-                    if cat[0] == category_id:
-                        category_name = cat[1]
-                        break
-                
-                safe_category_name = escape_markdown(category_name)
-                
-                keyboard = [[
-                    InlineKeyboardButton("✅ Xác nhận xóa", callback_data=f"confirm_del_cat_{category_id}"),
-                    InlineKeyboardButton("❌ Hủy", callback_data="expense_categories")
-                ]]
-                
-                msg = (f"⚠️ *CẢNH BÁO: XÓA DANH MỤC*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"📋 Danh mục: *{safe_category_name}* (ID: {category_id})\n\n"
-                       f"❗️ Hành động này sẽ xóa:\n"
-                       f"• Danh mục *{safe_category_name}*\n"
-                       f"• Tất cả chi tiêu trong danh mục này\n\n"
-                       f"❌ *Không thể khôi phục!*\n\n"
-                       f"Bạn có chắc chắn muốn xóa?")
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            msg += f"• #{tx_id}: {symbol} {amount_str} @ {fmt_price(price)} ({short_date})\n"
             
-            # ===========================================
-            # NHÓM 2: XỬ LÝ XÓA GIAO DỊCH COIN (ƯU TIÊN CAO)
-            # ===========================================
+            row.append(InlineKeyboardButton(f"#{tx_id}", callback_data=f"edit_{tx_id}"))
             
-            # ===========================================
-            # XỬ LÝ XÓA GIAO DỊCH MUA (COIN)
-            # ===========================================
-            if data.startswith("confirm_del_") and not data.startswith("confirm_del_sell_") and not data.startswith("confirm_del_cat_"):
-                tx_id_str = data.replace("confirm_del_", "")
-                logger.info(f"💰 Xác nhận xóa giao dịch mua: {tx_id_str}")
-                
-                if tx_id_str.isdigit():
-                    tx_id = int(tx_id_str)
-                    
-                    # Kiểm tra giao dịch
-                    conn = sqlite3.connect(DB_PATH)
-                    c = conn.cursor()
-                    c.execute('''SELECT user_id, symbol, amount FROM portfolio WHERE id = ?''', (tx_id,))
-                    result = c.fetchone()
-                    
-                    if not result:
-                        conn.close()
-                        await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
-                        return
-                    
-                    tx_owner_id, symbol, amount = result
-                    
-                    # Kiểm tra quyền xóa
-                    can_delete = False
-                    if tx_owner_id == target_user_id:
-                        can_delete = True
-                    elif is_admin and chat_type != 'private':
-                        can_delete = True
-                    
-                    if not can_delete:
-                        conn.close()
-                        await safe_edit_message(query, "❌ Bạn không có quyền xóa giao dịch này!")
-                        return
-                    
-                    # Thực hiện xóa
-                    c.execute('''DELETE FROM portfolio WHERE id = ?''', (tx_id,))
-                    conn.commit()
-                    conn.close()
-                    
-                    msg = (f"✅ *ĐÃ XÓA GIAO DỊCH MUA #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
-                           f"• Coin: {symbol}\n"
-                           f"• Số lượng: {amount:.4f}\n\n"
-                           f"🕐 {format_vn_time()}")
-                    
-                    keyboard = [[InlineKeyboardButton("🔙 Về danh sách", callback_data="edit_transactions")]]
-                    
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                else:
-                    await safe_edit_message(query, "❌ ID không hợp lệ!")
-                    return
+            if len(row) == 4:
+                keyboard.append(row)
+                row = []
+        
+        if row:
+            keyboard.append(row)
+        
+        # Thay vì "Xem user khác", quay về menu chính
+        keyboard.append([InlineKeyboardButton("🔙 Về menu đầu tư", callback_data="back_to_invest")])
+        
+        msg += f"\n🕐 {format_vn_time_short()}"
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-            # ===========================================
-            # XỬ LÝ XÓA LỊCH SỬ BÁN (SELL)
-            # ===========================================
-            if data.startswith("confirm_del_sell_"):
-                sell_id = int(data.replace("confirm_del_sell_", ""))
-                logger.info(f"💰 Xác nhận xóa lệnh bán: {sell_id}")
-                
-                if delete_sell_history(sell_id, target_user_id):
-                    await safe_edit_message(
-                        query, 
-                        f"✅ *Đã xóa lệnh bán #{sell_id}*",
-                        reply_markup=InlineKeyboardMarkup([[
-                            InlineKeyboardButton("📋 Xem lịch sử bán", callback_data="show_sells"),
-                            InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")
-                        ]])
-                    )
-                else:
-                    await safe_edit_message(query, f"❌ Không thể xóa lệnh bán #{sell_id}")
-                return
+    @callback_router.exact("back_to_main")
+    async def cb_back_to_main(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = f"💰 *MENU CHÍNH*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
+        await safe_edit_message(query, msg, reply_markup=None)
+        await query.message.reply_text("👇 Chọn chức năng:", reply_markup=get_main_keyboard())
+        return
 
-            # ===========================================
-            # XỬ LÝ XÓA DANH MỤC CHI TIÊU
-            # ===========================================
-            if data.startswith("confirm_del_cat_"):
-                cat_id = data.replace("confirm_del_cat_", "")
-                logger.info(f"📂 Xác nhận xóa danh mục ID: {cat_id}")
-                
-                try:
-                    category_id = int(cat_id)
-                except ValueError:
-                    await safe_edit_message(query, "❌ ID danh mục không hợp lệ!")
-                    return
-                
-                await query.edit_message_text("🔄 Đang xóa danh mục...", parse_mode=None)
-                
-                try:
-                    success, result, deleted_count = delete_category(category_id, owner_id)
-                    
-                    if success:
-                        safe_result = escape_markdown(str(result))
-                        msg = (f"✅ *ĐÃ XÓA DANH MỤC*\n"
-                               f"━━━━━━━━━━━━━━━━\n\n"
-                               f"📋 Đã xóa danh mục: *{safe_result}*\n"
-                               f"💰 Đã xóa *{deleted_count}* khoản chi\n\n"
-                               f"🕐 {format_vn_time()}")
-                    else:
-                        safe_result = escape_markdown(str(result))
-                        msg = (f"❌ *LỖI*\n"
-                               f"━━━━━━━━━━━━━━━━\n\n"
-                               f"{safe_result}\n\n"
-                               f"🕐 {format_vn_time()}")
-                    
-                    safe_msg = escape_markdown(msg)
-                    keyboard = [[
-                        InlineKeyboardButton("📋 Xem danh mục", callback_data="expense_categories"),
-                        InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")
-                    ]]
-                    
-                    await safe_edit_message(query, safe_msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    
-                except Exception as e:
-                    logger.error(f"❌ Lỗi xóa danh mục: {e}")
-                    await query.edit_message_text(f"❌ Lỗi: {str(e)[:100]}", parse_mode=None)
-                
-                return
-            
-            # ===========================================
-            # NHÓM 3: CÁC CALLBACK CHÍNH XÁC (MENU CHÍNH)
-            # ===========================================
-            
-            if data == "edit_transactions":
-                logger.info("📋 Hiển thị danh sách sửa/xóa giao dịch")
-                
-                # QUAN TRỌNG: Kiểm tra chat type
-                chat_type = query.message.chat.type
-                
-                # Nếu là private chat, chỉ quản lý dữ liệu của chính mình
-                if chat_type == 'private':
-                    target_user_id = current_user_id
-                    logger.info(f"💬 Private chat: quản lý giao dịch cá nhân {target_user_id}")
-                else:
-                    # Trong group, chỉ cho phép chủ sở hữu hoặc admin
-                    if not is_owner_user and not is_admin:
-                        await safe_edit_message(query, "❌ Bạn không có quyền quản lý giao dịch!")
-                        return
-                    target_user_id = owner_id
-                
-                transactions = get_transaction_detail(target_user_id)
-                
-                if not transactions:
-                    msg = f"📭 Không có giao dịch!\n\n🕐 {format_vn_time()}"
-                    keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                
-                msg = "✏️ *CHỌN GIAO DỊCH*\n━━━━━━━━━━━━━━━━\n\n"
-                keyboard = []
-                row = []
-                
-                for tx in transactions:
-                    tx_id, symbol, amount, price, date, total = tx
-                    short_date = date.split()[0] if date else "N/A"
-                    amount_str = f"{amount:.4f}".rstrip('0').rstrip('.') if '.' in f"{amount:.4f}" else f"{amount:.4f}"
-                    
-                    msg += f"• #{tx_id}: {symbol} {amount_str} @ {fmt_price(price)} ({short_date})\n"
-                    
-                    row.append(InlineKeyboardButton(f"#{tx_id}", callback_data=f"edit_{tx_id}"))
-                    
-                    if len(row) == 4:
-                        keyboard.append(row)
-                        row = []
-                
-                if row:
-                    keyboard.append(row)
-                
-                # Thay vì "Xem user khác", quay về menu chính
-                keyboard.append([InlineKeyboardButton("🔙 Về menu đầu tư", callback_data="back_to_invest")])
-                
-                msg += f"\n🕐 {format_vn_time_short()}"
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            if data == "back_to_main":
-                msg = f"💰 *MENU CHÍNH*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
-                await safe_edit_message(query, msg, reply_markup=None)
-                await query.message.reply_text("👇 Chọn chức năng:", reply_markup=get_main_keyboard())
-                return
-            
-            if data == "back_to_invest":
-                uid = query.from_user.id
-                gid = query.message.chat.id
-                msg = f"💰 *MENU ĐẦU TƯ COIN*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
-                await safe_edit_message(query, msg, reply_markup=get_invest_menu_keyboard(uid, gid, chat_type))
-                return
+    @callback_router.exact("back_to_invest")
+    async def cb_back_to_invest(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_type = cb.chat_type
+        
+        uid = query.from_user.id
+        gid = query.message.chat.id
+        msg = f"💰 *MENU ĐẦU TƯ COIN*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
+        await safe_edit_message(query, msg, reply_markup=get_invest_menu_keyboard(uid, gid, chat_type))
+        return
+
+    @callback_router.exact("back_to_expense")
+    async def cb_back_to_expense(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_type = cb.chat_type
+
+        uid = query.from_user.id
+        gid = query.message.chat.id
+        msg = f"💰 *QUẢN LÝ CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
+        await safe_edit_message(query, msg, reply_markup=get_expense_menu_keyboard(uid, gid, chat_type))
+        return
+
+    @callback_router.exact("refresh_usdt")
+    async def cb_refresh_usdt(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        rate_data = get_usdt_vnd_rate()
+        text = ("💱 *TỶ GIÁ USDT/VND*\n━━━━━━━━━━━━━━━━\n\n"
+                f"🇺🇸 *1 USDT* = `{fmt_vnd(rate_data['vnd'])}`\n"
+                f"🇻🇳 *1,000,000 VND* = `{1000000/rate_data['vnd']:.4f} USDT`\n\n"
+                f"⏱ *Cập nhật:* `{rate_data['update_time']}`\n"
+                f"📊 *Nguồn:* `{rate_data['source']}`\n\n"
+                f"🕐 {format_vn_time()}")
+        keyboard = [[InlineKeyboardButton("🔄 Làm mới", callback_data="refresh_usdt")],
+                    [InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NÚT XUẤT MASTER DUY NHẤT - THÊM VÀO ĐÂY
+    # ===========================================
+    @callback_router.exact("export_master")
+    async def cb_export_master(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        await safe_edit_message(
+            query,
+            "🔐 *XUẤT BÁO CÁO MASTER*\n\n"
+            "Dùng lệnh: `/export [mật khẩu]`\n\n"
+            "• `/export 123456` - File ZIP có mật khẩu (tự xóa sau 30s)\n"
+            "• `/export 0` - File CSV không mã hóa\n\n"
+            f"🕐 {format_vn_time_short()}",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Về menu đầu tư", callback_data="back_to_invest")
+            ]])
+        )
+        return
+
+    # ===========================================
+    # NHÓM 4: XỬ LÝ XEM PORTFOLIO - CHỈ XEM CỦA CHỦ SỞ HỮU
+    # ===========================================
+    @callback_router.exact("show_portfolio")
+    async def cb_show_portfolio(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        current_user_id = cb.current_user_id
+        chat_id = cb.chat_id
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        owner_id = cb.owner_id
+        
+        logger.info("📊 Hiển thị portfolio")
+        
+        # Xác định user_id cần xem
+        chat_type = query.message.chat.type
+        current_user_id = query.from_user.id
+        
+        if chat_type == 'private':
+            target_user_id = current_user_id
+            logger.info(f"💬 Private: xem portfolio cá nhân {target_user_id}")
+        else:
+            # Trong group, chỉ cho xem portfolio của chủ sở hữu nếu có quyền
+            owner_id = ctx.bot_data.get('group_owner_id', get_group_owner(chat_id))
+            is_admin = ctx.bot_data.get('is_admin', False)
+            is_owner = (current_user_id == owner_id)
             
-            if data == "back_to_expense":
-                msg = f"💰 *QUẢN LÝ CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n🕐 {format_vn_time()}"
-                await safe_edit_message(query, msg, reply_markup=get_expense_menu_keyboard(uid, gid, chat_type))
+            if not check_permission(chat_id, current_user_id, 'view'):
+                await safe_edit_message(query, "❌ Bạn không có quyền xem portfolio!")
                 return
             
-            if data == "refresh_usdt":
-                rate_data = get_usdt_vnd_rate()
-                text = ("💱 *TỶ GIÁ USDT/VND*\n━━━━━━━━━━━━━━━━\n\n"
-                        f"🇺🇸 *1 USDT* = `{fmt_vnd(rate_data['vnd'])}`\n"
-                        f"🇻🇳 *1,000,000 VND* = `{1000000/rate_data['vnd']:.4f} USDT`\n\n"
-                        f"⏱ *Cập nhật:* `{rate_data['update_time']}`\n"
-                        f"📊 *Nguồn:* `{rate_data['source']}`\n\n"
-                        f"🕐 {format_vn_time()}")
-                keyboard = [[InlineKeyboardButton("🔄 Làm mới", callback_data="refresh_usdt")],
-                            [InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            if is_admin or is_owner:
+                target_user_id = owner_id
+                logger.info(f"👥 Group: admin xem portfolio của owner {target_user_id}")
+            else:
+                target_user_id = current_user_id
+                logger.info(f"👥 Group: user xem portfolio cá nhân {target_user_id}")
+        
+        # Tổng hợp danh mục (PortfolioAnalytics lấy giá 1 lần)
+        book = PortfolioAnalytics.load(target_user_id)
+        
+        if not book.held:
+            msg = f"📭 Danh mục trống!\n\n🕐 {format_vn_time()}"
+            keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        
+        # Lấy tên hiển thị
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_user_id,))
+        user_info = c.fetchone()
+        conn.close()
+        
+        display_name = user_info[0] if user_info and user_info[0] else (user_info[1] if user_info else f"User {target_user_id}")
+        safe_display_name = escape_markdown(display_name)
+        
+        msg = f"📊 *DANH MỤC CỦA {safe_display_name}*\n━━━━━━━━━━━━━━━━\n\n"
+        msg += render_portfolio_body(book, "━━━━━━━━━━━━━━━━")
+        
+        msg += f"🕐 {format_vn_time()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-            # ===========================================
-            # NÚT XUẤT MASTER DUY NHẤT - THÊM VÀO ĐÂY
-            # ===========================================
-            if data == "export_master":
-                await safe_edit_message(
-                    query,
-                    "🔐 *XUẤT BÁO CÁO MASTER*\n\n"
-                    "Dùng lệnh: `/export [mật khẩu]`\n\n"
-                    "• `/export 123456` - File ZIP có mật khẩu (tự xóa sau 30s)\n"
-                    "• `/export 0` - File CSV không mã hóa\n\n"
-                    f"🕐 {format_vn_time_short()}",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Về menu đầu tư", callback_data="back_to_invest")
-                    ]])
-                )
+    # ===========================================
+    # NHÓM 5: XỬ LÝ XEM LỢI NHUẬN - CHỈ XEM CỦA CHỦ SỞ HỮU
+    # ===========================================
+    @callback_router.exact("show_profit")
+    async def cb_show_profit(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        current_user_id = cb.current_user_id
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        is_owner_user = cb.is_owner_user
+        owner_id = cb.owner_id
+        
+        logger.info("📈 Hiển thị lợi nhuận")
+        
+        # QUAN TRỌNG: Kiểm tra chat type
+        chat_type = query.message.chat.type
+        
+        # Nếu là private chat, chỉ xem dữ liệu của chính mình
+        if chat_type == 'private':
+            target_user_id = current_user_id
+            logger.info(f"💬 Private chat: xem lợi nhuận cá nhân {target_user_id}")
+        else:
+            # Trong group, admin mới được xem dữ liệu chủ sở hữu
+            if not is_owner_user and not is_admin:
+                await safe_edit_message(query, "❌ Bạn không có quyền xem lợi nhuận!")
                 return
-                
-            # ===========================================
-            # NHÓM 4: XỬ LÝ XEM PORTFOLIO - CHỈ XEM CỦA CHỦ SỞ HỮU
-            # ===========================================
+            target_user_id = owner_id
+        
+        transactions = get_transaction_detail(target_user_id)
+        
+        if not transactions:
+            msg = f"📭 Danh mục trống!\n\n🕐 {format_vn_time()}"
+            keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        
+        msg = f"📈 *CHI TIẾT LỢI NHUẬN*\n━━━━━━━━━━━━━━━━\n\n"
+        total_invest = 0
+        total_value = 0
+        
+        for tx in transactions:
+            tx_id, symbol, amount, price, date, cost = tx
+            price_data = get_price(symbol)
             
-            if data == "show_portfolio":
-                logger.info("📊 Hiển thị portfolio")
-                
-                # Xác định user_id cần xem
-                chat_type = query.message.chat.type
-                current_user_id = query.from_user.id
-                
-                if chat_type == 'private':
-                    target_user_id = current_user_id
-                    logger.info(f"💬 Private: xem portfolio cá nhân {target_user_id}")
-                else:
-                    # Trong group, chỉ cho xem portfolio của chủ sở hữu nếu có quyền
-                    owner_id = ctx.bot_data.get('group_owner_id', get_group_owner(chat_id))
-                    is_admin = ctx.bot_data.get('is_admin', False)
-                    is_owner = (current_user_id == owner_id)
-                    
-                    if not check_permission(chat_id, current_user_id, 'view'):
-                        await safe_edit_message(query, "❌ Bạn không có quyền xem portfolio!")
-                        return
-                    
-                    if is_admin or is_owner:
-                        target_user_id = owner_id
-                        logger.info(f"👥 Group: admin xem portfolio của owner {target_user_id}")
-                    else:
-                        target_user_id = current_user_id
-                        logger.info(f"👥 Group: user xem portfolio cá nhân {target_user_id}")
-                
-                # Lấy dữ liệu portfolio
-                portfolio_data = get_portfolio(target_user_id)
-                
-                if not portfolio_data:
-                    msg = f"📭 Danh mục trống!\n\n🕐 {format_vn_time()}"
-                    keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                
-                # Lấy tất cả symbols để fetch giá
-                symbols = list(set([row[0] for row in portfolio_data]))
-                prices = get_prices_batch(symbols)
-                
-                # Tính toán tổng hợp theo từng coin
-                summary = {}
-                total_invest = 0
-                total_value = 0
-                
-                for row in portfolio_data:
-                    symbol, amount, price, date, cost = row
-                    if symbol not in summary:
-                        summary[symbol] = {'amount': 0, 'cost': 0}
-                    summary[symbol]['amount'] += amount
-                    summary[symbol]['cost'] += cost
-                    total_invest += cost
-                
-                # Lấy tên hiển thị
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (target_user_id,))
-                user_info = c.fetchone()
-                conn.close()
-                
-                display_name = user_info[0] if user_info and user_info[0] else (user_info[1] if user_info else f"User {target_user_id}")
-                safe_display_name = escape_markdown(display_name)
-                
-                msg = f"📊 *DANH MỤC CỦA {safe_display_name}*\n━━━━━━━━━━━━━━━━\n\n"
-                
-                for symbol, data in summary.items():
-                    price_data = prices.get(symbol)
-                    if price_data:
-                        current = data['amount'] * price_data['p']
-                        profit = current - data['cost']
-                        profit_percent = (profit / data['cost']) * 100 if data['cost'] > 0 else 0
-                        total_value += current
-                        
-                        msg += f"*{symbol}*\n"
-                        msg += f"📊 SL: `{data['amount']:.4f}`\n"
-                        msg += f"💰 TB: `{fmt_price(data['cost']/data['amount'])}`\n"
-                        msg += f"💎 TT: `{fmt_price(current)}`\n"
-                        msg += f"{'✅' if profit>=0 else '❌'} LN: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n"
-                
-                total_profit = total_value - total_invest
-                total_profit_percent = (total_profit / total_invest) * 100 if total_invest > 0 else 0
-                
-                msg += "━━━━━━━━━━━━━━━━\n"
-                msg += f"💵 Vốn: `{fmt_price(total_invest)}`\n"
-                msg += f"💰 GT: `{fmt_price(total_value)}`\n"
-                msg += f"{'✅' if total_profit>=0 else '❌'} Tổng LN: `{fmt_price(total_profit)}` ({total_profit_percent:+.2f}%)\n\n"
-                msg += f"🕐 {format_vn_time()}"
+            if price_data:
+                current = amount * price_data['p']
+                profit = current - cost
+                profit_percent = (profit / cost) * 100 if cost > 0 else 0
                 
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+                total_invest += cost
+                total_value += current
                 
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+                short_date = date.split()[0]
+                msg += f"*#{tx_id}: {symbol}*\n"
+                msg += f"📅 {short_date}\n"
+                msg += f"📊 SL: `{amount:.4f}`\n"
+                msg += f"💰 Mua: `{fmt_price(price)}`\n"
+                msg += f"💎 TT: `{fmt_price(current)}`\n"
+                msg += f"{'✅' if profit>=0 else '❌'} LN: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n"
+        
+        total_profit = total_value - total_invest
+        total_profit_percent = (total_profit / total_invest) * 100 if total_invest > 0 else 0
+        
+        msg += "━━━━━━━━━━━━━━━━\n"
+        msg += f"💵 Vốn: `{fmt_price(total_invest)}`\n"
+        msg += f"💰 GT: `{fmt_price(total_value)}`\n"
+        msg += f"{'✅' if total_profit>=0 else '❌'} Tổng LN: `{fmt_price(total_profit)}` ({total_profit_percent:+.2f}%)\n\n"
+        msg += f"🕐 {format_vn_time()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NHÓM 6: XỬ LÝ XEM THỐNG KÊ - CHỈ XEM CỦA CHỦ SỞ HỮU
+    # ===========================================
+    @callback_router.exact("show_stats")
+    async def cb_show_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        current_user_id = cb.current_user_id
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        is_owner_user = cb.is_owner_user
+        owner_id = cb.owner_id
+        
+        logger.info("📊 Hiển thị thống kê")
+        
+        # QUAN TRỌNG: Kiểm tra chat type
+        chat_type = query.message.chat.type
+        
+        # Nếu là private chat, chỉ xem dữ liệu của chính mình
+        if chat_type == 'private':
+            target_user_id = current_user_id
+            logger.info(f"💬 Private chat: xem thống kê cá nhân {target_user_id}")
+        else:
+            # Trong group, admin mới được xem dữ liệu chủ sở hữu
+            if not is_owner_user and not is_admin:
+                await safe_edit_message(query, "❌ Bạn không có quyền xem thống kê!")
                 return
+            target_user_id = owner_id
+        
+        stats = get_portfolio_stats(target_user_id)
+        
+        if not stats:
+            msg = f"📭 Danh mục trống!"
+            keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        
+        msg = (f"📊 *THỐNG KÊ DANH MỤC*\n━━━━━━━━━━━━━━━━\n\n"
+               f"*TỔNG QUAN*\n"
+               f"• Vốn: `{fmt_price(stats['total_invest'])}`\n"
+               f"• Giá trị: `{fmt_price(stats['total_value'])}`\n"
+               f"• Lợi nhuận: `{fmt_price(stats['total_profit'])}`\n"
+               f"• Tỷ suất: `{stats['total_profit_percent']:+.2f}%`\n\n"
+               f"*📈 TOP COIN LỜI NHẤT*\n")
+        
+        count = 0
+        for symbol, profit, profit_pct, value, cost in stats['coin_profits']:
+            if profit > 0:
+                count += 1
+                msg += f"{count}. *{symbol}*: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n"
+            if count >= 3:
+                break
+        
+        if count == 0:
+            msg += "Không có coin lời\n"
+        
+        msg += f"\n*📉 TOP COIN LỖ NHẤT*\n"
+        count = 0
+        for symbol, profit, profit_pct, value, cost in reversed(stats['coin_profits']):
+            if profit < 0:
+                count += 1
+                msg += f"{count}. *{symbol}*: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n"
+            if count >= 3:
+                break
+        
+        if count == 0:
+            msg += "Không có coin lỗ\n"
+        
+        msg += f"\n🕐 {format_vn_time()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NHÓM 7: XỬ LÝ XEM GIÁ COIN
+    # ===========================================
+    @callback_router.prefix("price_")
+    async def cb_price(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        symbol = cb.payload
+        d = get_price(symbol)
+        
+        if d:
+            if symbol == 'USDT':
+                rate_data = get_usdt_vnd_rate()
+                msg = f"*{d['n']}* #{d['r']}\n💰 USD: `{fmt_price(d['p'])}`\n🇻🇳 VND: `{fmt_vnd(rate_data['vnd'])}`\n📦 Volume: `{fmt_vol(d['v'])}`\n💎 Market Cap: `{fmt_vol(d['m'])}`\n📈 24h: {fmt_percent(d['c'])}"
+            else:
+                msg = f"*{d['n']}* #{d['r']}\n💰 Giá: `{fmt_price(d['p'])}`\n📦 Volume: `{fmt_vol(d['v'])}`\n💎 Market Cap: `{fmt_vol(d['m'])}`\n📈 24h: {fmt_percent(d['c'])}"
+            msg += f"\n\n🕐 {format_vn_time_short()}"
+        else:
+            msg = f"❌ *{symbol}*: Không có dữ liệu\n\n🕐 {format_vn_time_short()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NHÓM 8: XỬ LÝ SỬA GIAO DỊCH
+    # ===========================================
+    @callback_router.prefix("edit_form_", parse=int)
+    async def cb_edit_form(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        logger.info(f"📝 Form sửa giao dịch: {cb.data}")
+        tx_id = cb.payload
+
+        # Lấy thông tin giao dịch
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''SELECT symbol, amount, buy_price FROM portfolio WHERE id = ?''', (tx_id,))
+        tx = c.fetchone()
+        conn.close()
+        
+        if not tx:
+            await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
+            return
+        
+        symbol, current_amount, current_price = tx
+        
+        msg = (f"✏️ *SỬA GIAO DỊCH #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
+               f"*{symbol}*\n"
+               f"📊 SL hiện tại: `{current_amount:.4f}`\n"
+               f"💰 Giá hiện tại: `{fmt_price(current_price)}`\n\n"
+               f"*Nhập lệnh:*\n"
+               f"`/edit {tx_id} [số lượng mới] [giá mới]`\n\n"
+               f"*Ví dụ:*\n"
+               f"`/edit {tx_id} 0.5 45000`\n\n"
+               f"🕐 {format_vn_time_short()}")
+        
+        keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data=f"edit_{tx_id}")]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("edit_", parse=int)
+    async def cb_edit(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        owner_id = cb.owner_id
+        
+        logger.info(f"✏️ Sửa giao dịch: {cb.data}")
+        tx_id = cb.payload
+
+        # Lấy chi tiết giao dịch
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''SELECT id, symbol, amount, buy_price, buy_date, total_cost, user_id 
+                    FROM portfolio WHERE id = ?''', (tx_id,))
+        tx = c.fetchone()
+        conn.close()
+        
+        if not tx:
+            await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
+            return
+        
+        tx_id, symbol, amount, price, date, total, tx_owner_id = tx
+        
+        # Kiểm tra quyền xem/sửa - chỉ cho phép chủ sở hữu hoặc admin
+        if tx_owner_id != target_user_id and not is_admin:
+            await safe_edit_message(query, "❌ Bạn không có quyền xem giao dịch này!")
+            return
+        
+        # Lấy giá hiện tại
+        price_data = get_price(symbol)
+        current_price = price_data['p'] if price_data else 0
+        profit = (current_price - price) * amount if current_price else 0
+        profit_percent = ((current_price - price) / price) * 100 if price and current_price else 0
+        
+        # Tạo message
+        msg = (f"📝 *GIAO DỊCH #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
+               f"*{symbol}*\n"
+               f"📅 Ngày mua: {date}\n"
+               f"📊 Số lượng: `{amount:.4f}`\n"
+               f"💰 Giá mua: `{fmt_price(price)}`\n"
+               f"💵 Tổng vốn: `{fmt_price(total)}`\n"
+               f"📈 Giá hiện tại: `{fmt_price(current_price)}`\n"
+               f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n")
+        
+        # Thêm nút sửa/xóa nếu có quyền
+        keyboard = []
+        if tx_owner_id == owner_id or is_admin:
+            keyboard.append([
+                InlineKeyboardButton("✏️ Sửa", callback_data=f"edit_form_{tx_id}"),
+                InlineKeyboardButton("🗑 Xóa", callback_data=f"del_{tx_id}")
+            ])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Về danh sách", callback_data="edit_transactions")])
+        
+        msg += f"🕐 {format_vn_time()}"
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("del_", parse=int)
+    async def cb_del(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_type = cb.chat_type
+        target_user_id = cb.target_user_id
+        is_admin = cb.is_admin
+        
+        logger.info(f"🗑 Xóa giao dịch: {cb.data}")
+        tx_id = cb.payload
+
+        # Kiểm tra giao dịch có tồn tại không
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''SELECT user_id, symbol, amount FROM portfolio WHERE id = ?''', (tx_id,))
+        result = c.fetchone()
+        conn.close()
+        
+        if not result:
+            await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
+            return
+        
+        tx_owner_id, symbol, amount = result
+        
+        # Kiểm tra quyền xóa - chỉ cho phép chủ sở hữu hoặc admin
+        can_delete = False
+        can_delete = False
+        if tx_owner_id == target_user_id:
+            can_delete = True
+        elif is_admin and chat_type != 'private':  # Trong group mới được admin xóa
+            can_delete = True
+        
+        if not can_delete:
+            await safe_edit_message(query, "❌ Bạn không có quyền xóa giao dịch này!")
+            return
+        
+        # Hỏi xác nhận
+        msg = (f"⚠️ *XÁC NHẬN XÓA*\n━━━━━━━━━━━━━━━━\n\n"
+               f"• Giao dịch: #{tx_id}\n"
+               f"• Coin: {symbol}\n"
+               f"• Số lượng: {amount:.4f}\n\n"
+               f"Bạn có chắc chắn muốn xóa?")
+        
+        keyboard = [[
+            InlineKeyboardButton("✅ Có", callback_data=f"confirm_del_{tx_id}"),
+            InlineKeyboardButton("❌ Không", callback_data=f"edit_{tx_id}")
+        ]]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    # ===========================================
+    # NHÓM 9: XỬ LÝ MENU CHI TIÊU
+    # ===========================================
+    @callback_router.exact("show_alerts")
+    async def cb_show_alerts(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        uid = query.from_user.id
+        alerts = get_user_alerts(uid)
+        
+        if not alerts:
+            msg = f"📭 Bạn chưa có cảnh báo nào!\n\n🕐 {format_vn_time()}"
+            await safe_edit_message(query, msg)
+            return
+        
+        msg = "🔔 *CẢNH BÁO GIÁ*\n━━━━━━━━━━━━━━━━\n\n"
+        for alert in alerts:
+            alert_id, symbol, target, condition, created = alert
+            created_date = created.split()[0]
+            price_data = get_price(symbol)
+            current_price = price_data['p'] if price_data else 0
+            status = "🟢" if (condition == 'above' and current_price < target) or (condition == 'below' and current_price > target) else "🔴"
+            msg += f"{status} *#{alert_id}*: {symbol} {condition} `{fmt_price(target)}`\n"
+            msg += f"   Giá hiện: `{fmt_price(current_price)}` (tạo {created_date})\n\n"
+        
+        msg += f"🕐 {format_vn_time()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("show_top10")
+    async def cb_show_top10(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        await query.edit_message_text("🔄 Đang tải...")
+        
+        try:
+            res = cmc_get('/cryptocurrency/listings/latest', params={'limit': 10, 'convert': 'USD'})
             
-            # ===========================================
-            # NHÓM 5: XỬ LÝ XEM LỢI NHUẬN - CHỈ XEM CỦA CHỦ SỞ HỮU
-            # ===========================================
-            
-            if data == "show_profit":
-                logger.info("📈 Hiển thị lợi nhuận")
-                
-                # QUAN TRỌNG: Kiểm tra chat type
-                chat_type = query.message.chat.type
-                
-                # Nếu là private chat, chỉ xem dữ liệu của chính mình
-                if chat_type == 'private':
-                    target_user_id = current_user_id
-                    logger.info(f"💬 Private chat: xem lợi nhuận cá nhân {target_user_id}")
-                else:
-                    # Trong group, admin mới được xem dữ liệu chủ sở hữu
-                    if not is_owner_user and not is_admin:
-                        await safe_edit_message(query, "❌ Bạn không có quyền xem lợi nhuận!")
-                        return
-                    target_user_id = owner_id
-                
-                transactions = get_transaction_detail(target_user_id)
-                
-                if not transactions:
-                    msg = f"📭 Danh mục trống!\n\n🕐 {format_vn_time()}"
-                    keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                
-                # Lấy tên hiển thị
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (owner_id,))
-                user_info = c.fetchone()
-                conn.close()
-                
-                display_name = user_info[0] if user_info and user_info[0] else (user_info[1] if user_info else f"User {owner_id}")
-                safe_display_name = escape_markdown(display_name)
-                
-                msg = f"📈 *CHI TIẾT LỢI NHUẬN*\n━━━━━━━━━━━━━━━━\n\n"
-                total_invest = 0
-                total_value = 0
+            if res.status_code == 200:
+                data = res.json()['data']
+                msg = "📊 *TOP 10 COIN*\n━━━━━━━━━━━━\n\n"
                 
-                for tx in transactions:
-                    tx_id, symbol, amount, price, date, cost = tx
-                    price_data = get_price(symbol)
+                for i, coin in enumerate(data, 1):
+                    quote = coin['quote']['USD']
+                    change = quote['percent_change_24h']
+                    emoji = "📈" if change > 0 else "📉" if change < 0 else "➡️"
                     
-                    if price_data:
-                        current = amount * price_data['p']
-                        profit = current - cost
-                        profit_percent = (profit / cost) * 100 if cost > 0 else 0
-                        
-                        total_invest += cost
-                        total_value += current
-                        
-                        short_date = date.split()[0]
-                        msg += f"*#{tx_id}: {symbol}*\n"
-                        msg += f"📅 {short_date}\n"
-                        msg += f"📊 SL: `{amount:.4f}`\n"
-                        msg += f"💰 Mua: `{fmt_price(price)}`\n"
-                        msg += f"💎 TT: `{fmt_price(current)}`\n"
-                        msg += f"{'✅' if profit>=0 else '❌'} LN: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n"
-                
-                total_profit = total_value - total_invest
-                total_profit_percent = (total_profit / total_invest) * 100 if total_invest > 0 else 0
-                
-                msg += "━━━━━━━━━━━━━━━━\n"
-                msg += f"💵 Vốn: `{fmt_price(total_invest)}`\n"
-                msg += f"💰 GT: `{fmt_price(total_value)}`\n"
-                msg += f"{'✅' if total_profit>=0 else '❌'} Tổng LN: `{fmt_price(total_profit)}` ({total_profit_percent:+.2f}%)\n\n"
-                msg += f"🕐 {format_vn_time()}"
+                    msg += f"{i}. *{coin['symbol']}* - {coin['name']}\n"
+                    msg += f"   💰 `{fmt_price(quote['price'])}` {emoji} `{change:+.2f}%`\n"
                 
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            # ===========================================
-            # NHÓM 6: XỬ LÝ XEM THỐNG KÊ - CHỈ XEM CỦA CHỦ SỞ HỮU
-            # ===========================================
-            
-            if data == "show_stats":
-                logger.info("📊 Hiển thị thống kê")
-                
-                # QUAN TRỌNG: Kiểm tra chat type
-                chat_type = query.message.chat.type
-                
-                # Nếu là private chat, chỉ xem dữ liệu của chính mình
-                if chat_type == 'private':
-                    target_user_id = current_user_id
-                    logger.info(f"💬 Private chat: xem thống kê cá nhân {target_user_id}")
-                else:
-                    # Trong group, admin mới được xem dữ liệu chủ sở hữu
-                    if not is_owner_user and not is_admin:
-                        await safe_edit_message(query, "❌ Bạn không có quyền xem thống kê!")
-                        return
-                    target_user_id = owner_id
-                
-                stats = get_portfolio_stats(target_user_id)
-                
-                if not stats:
-                    msg = f"📭 Danh mục trống!"
-                    keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                
-                # Lấy tên hiển thị
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("SELECT username, first_name FROM users WHERE user_id = ?", (owner_id,))
-                user_info = c.fetchone()
-                conn.close()
-                
-                display_name = user_info[0] if user_info and user_info[0] else (user_info[1] if user_info else f"User {owner_id}")
-                safe_display_name = escape_markdown(display_name)
-                
-                msg = (f"📊 *THỐNG KÊ DANH MỤC*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"*TỔNG QUAN*\n"
-                       f"• Vốn: `{fmt_price(stats['total_invest'])}`\n"
-                       f"• Giá trị: `{fmt_price(stats['total_value'])}`\n"
-                       f"• Lợi nhuận: `{fmt_price(stats['total_profit'])}`\n"
-                       f"• Tỷ suất: `{stats['total_profit_percent']:+.2f}%`\n\n"
-                       f"*📈 TOP COIN LỜI NHẤT*\n")
-                
-                count = 0
-                for symbol, profit, profit_pct, value, cost in stats['coin_profits']:
-                    if profit > 0:
-                        count += 1
-                        msg += f"{count}. *{symbol}*: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n"
-                    if count >= 3:
-                        break
-                
-                if count == 0:
-                    msg += "Không có coin lời\n"
-                
-                msg += f"\n*📉 TOP COIN LỖ NHẤT*\n"
-                count = 0
-                for symbol, profit, profit_pct, value, cost in reversed(stats['coin_profits']):
-                    if profit < 0:
-                        count += 1
-                        msg += f"{count}. *{symbol}*: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n"
-                    if count >= 3:
-                        break
-                
-                if count == 0:
-                    msg += "Không có coin lỗ\n"
-                
-                msg += f"\n🕐 {format_vn_time()}"
-                
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            # ===========================================
-            # NHÓM 7: XỬ LÝ XEM GIÁ COIN
-            # ===========================================
-            
-            if data.startswith("price_"):
-                symbol = data.replace("price_", "")
-                d = get_price(symbol)
-                
-                if d:
-                    if symbol == 'USDT':
-                        rate_data = get_usdt_vnd_rate()
-                        msg = f"*{d['n']}* #{d['r']}\n💰 USD: `{fmt_price(d['p'])}`\n🇻🇳 VND: `{fmt_vnd(rate_data['vnd'])}`\n📦 Volume: `{fmt_vol(d['v'])}`\n💎 Market Cap: `{fmt_vol(d['m'])}`\n📈 24h: {fmt_percent(d['c'])}"
-                    else:
-                        msg = f"*{d['n']}* #{d['r']}\n💰 Giá: `{fmt_price(d['p'])}`\n📦 Volume: `{fmt_vol(d['v'])}`\n💎 Market Cap: `{fmt_vol(d['m'])}`\n📈 24h: {fmt_percent(d['c'])}"
-                    msg += f"\n\n🕐 {format_vn_time_short()}"
-                else:
-                    msg = f"❌ *{symbol}*: Không có dữ liệu\n\n🕐 {format_vn_time_short()}"
-                
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            # ===========================================
-            # NHÓM 8: XỬ LÝ SỬA GIAO DỊCH
-            # ===========================================
-            
-            if data.startswith("edit_form_"):
-                logger.info(f"📝 Form sửa giao dịch: {data}")
-                tx_id_str = data.replace("edit_form_", "")
-                
-                if not tx_id_str.isdigit():
-                    await safe_edit_message(query, "❌ ID không hợp lệ!")
-                    return
-                
-                tx_id = int(tx_id_str)
-                
-                # Lấy thông tin giao dịch
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute('''SELECT symbol, amount, buy_price FROM portfolio WHERE id = ?''', (tx_id,))
-                tx = c.fetchone()
-                conn.close()
-                
-                if not tx:
-                    await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
-                    return
-                
-                symbol, current_amount, current_price = tx
-                
-                msg = (f"✏️ *SỬA GIAO DỊCH #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"*{symbol}*\n"
-                       f"📊 SL hiện tại: `{current_amount:.4f}`\n"
-                       f"💰 Giá hiện tại: `{fmt_price(current_price)}`\n\n"
-                       f"*Nhập lệnh:*\n"
-                       f"`/edit {tx_id} [số lượng mới] [giá mới]`\n\n"
-                       f"*Ví dụ:*\n"
-                       f"`/edit {tx_id} 0.5 45000`\n\n"
-                       f"🕐 {format_vn_time_short()}")
-                
-                keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data=f"edit_{tx_id}")]]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-                
-            if data.startswith("edit_"):
-                logger.info(f"✏️ Sửa giao dịch: {data}")
-                
-                # QUAN TRỌNG: Kiểm tra nếu là "edit_transactions" thì đã xử lý ở trên
-                if data == "edit_transactions":
-                    return
-                
-                tx_id_str = data.replace("edit_", "")
-                
-                if not tx_id_str.isdigit():
-                    logger.error(f"❌ edit_ callback với ID không hợp lệ: {tx_id_str}")
-                    await safe_edit_message(query, "❌ ID không hợp lệ!")
-                    return
-                
-                tx_id = int(tx_id_str)
-                
-                # Lấy chi tiết giao dịch
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute('''SELECT id, symbol, amount, buy_price, buy_date, total_cost, user_id 
-                            FROM portfolio WHERE id = ?''', (tx_id,))
-                tx = c.fetchone()
-                conn.close()
-                
-                if not tx:
-                    await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
-                    return
-                
-                tx_id, symbol, amount, price, date, total, tx_owner_id = tx
-                
-                # Kiểm tra quyền xem/sửa - chỉ cho phép chủ sở hữu hoặc admin
-                if tx_owner_id != target_user_id and not is_admin:
-                    await safe_edit_message(query, "❌ Bạn không có quyền xem giao dịch này!")
-                    return
-                
-                # Lấy giá hiện tại
-                price_data = get_price(symbol)
-                current_price = price_data['p'] if price_data else 0
-                profit = (current_price - price) * amount if current_price else 0
-                profit_percent = ((current_price - price) / price) * 100 if price and current_price else 0
-                
-                # Tạo message
-                msg = (f"📝 *GIAO DỊCH #{tx_id}*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"*{symbol}*\n"
-                       f"📅 Ngày mua: {date}\n"
-                       f"📊 Số lượng: `{amount:.4f}`\n"
-                       f"💰 Giá mua: `{fmt_price(price)}`\n"
-                       f"💵 Tổng vốn: `{fmt_price(total)}`\n"
-                       f"📈 Giá hiện tại: `{fmt_price(current_price)}`\n"
-                       f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_percent:+.2f}%)\n\n")
-                
-                # Thêm nút sửa/xóa nếu có quyền
-                keyboard = []
-                if tx_owner_id == owner_id or is_admin:
-                    keyboard.append([
-                        InlineKeyboardButton("✏️ Sửa", callback_data=f"edit_form_{tx_id}"),
-                        InlineKeyboardButton("🗑 Xóa", callback_data=f"del_{tx_id}")
-                    ])
-                
-                keyboard.append([InlineKeyboardButton("🔙 Về danh sách", callback_data="edit_transactions")])
-                
-                msg += f"🕐 {format_vn_time()}"
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-   
-            if data.startswith("del_"):
-                logger.info(f"🗑 Xóa giao dịch: {data}")
-                tx_id_str = data.replace("del_", "")
-                
-                # Kiểm tra nếu là xóa danh mục (cat_) - đã xử lý ở nhóm 1
-                if tx_id_str.startswith("cat_"):
-                    return
-                
-                if not tx_id_str.isdigit():
-                    await safe_edit_message(query, "❌ ID không hợp lệ!")
-                    return
-                
-                tx_id = int(tx_id_str)
-                
-                # Kiểm tra giao dịch có tồn tại không
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute('''SELECT user_id, symbol, amount FROM portfolio WHERE id = ?''', (tx_id,))
-                result = c.fetchone()
-                conn.close()
-                
-                if not result:
-                    await safe_edit_message(query, f"❌ Không tìm thấy giao dịch #{tx_id}")
-                    return
-                
-                tx_owner_id, symbol, amount = result
-                
-                # Kiểm tra quyền xóa - chỉ cho phép chủ sở hữu hoặc admin
-                can_delete = False
-                can_delete = False
-                if tx_owner_id == target_user_id:
-                    can_delete = True
-                elif is_admin and chat_type != 'private':  # Trong group mới được admin xóa
-                    can_delete = True
-                
-                if not can_delete:
-                    await safe_edit_message(query, "❌ Bạn không có quyền xóa giao dịch này!")
-                    return
-                
-                # Hỏi xác nhận
-                msg = (f"⚠️ *XÁC NHẬN XÓA*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"• Giao dịch: #{tx_id}\n"
-                       f"• Coin: {symbol}\n"
-                       f"• Số lượng: {amount:.4f}\n\n"
-                       f"Bạn có chắc chắn muốn xóa?")
-                
-                keyboard = [[
-                    InlineKeyboardButton("✅ Có", callback_data=f"confirm_del_{tx_id}"),
-                    InlineKeyboardButton("❌ Không", callback_data=f"edit_{tx_id}")
-                ]]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            # ===========================================
-            # NHÓM 9: XỬ LÝ MENU CHI TIÊU
-            # ===========================================
+                msg += f"\n🕐 {format_vn_time_short()}"
+            else:
+                msg = "❌ Không thể lấy dữ liệu"
+        except Exception as e:
+            msg = "❌ Lỗi kết nối"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("show_buy")
+    async def cb_show_buy(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = ("➕ *MUA COIN*\n\nDùng lệnh: `/buy [coin] [sl] [giá]`\n\n"
+               "*Ví dụ:*\n• `/buy btc 0.5 40000`\n\n"
+               f"🕐 {format_vn_time_short()}")
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("show_sell")
+    async def cb_show_sell(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = ("➖ *BÁN COIN*\n\nDùng lệnh: `/sell [coin] [sl]`\n\n"
+               "*Ví dụ:*\n• `/sell btc 0.2`\n\n"
+               f"🕐 {format_vn_time_short()}")
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("admin_panel")
+    async def cb_admin_panel(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = ("👑 *ADMIN PANEL*\n━━━━━━━━━━━━━━━━\n\n"
+               "• `/perm list` - Danh sách admin\n"
+               "• `/perm grant @user view` - Cấp quyền xem\n"
+               "• `/perm grant @user edit` - Cấp quyền sửa\n"
+               "• `/perm grant @user delete` - Cấp quyền xóa\n"
+               "• `/perm grant @user manage` - Cấp quyền QL\n"
+               "• `/perm revoke @user` - Thu hồi quyền\n\n"
+               f"🕐 {format_vn_time()}")
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("expense_income_menu")
+    async def cb_expense_income_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = ("💰 *MENU THU NHẬP*\n\n"
+               "• `tn [số tiền]` - Thêm thu nhập\n"
+               "• `tn 100 USD Lương` - Thêm 100 USD\n\n"
+               f"🕐 {format_vn_time_short()}")
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("expense_expense_menu")
+    async def cb_expense_expense_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = ("💸 *MENU CHI TIÊU*\n\n"
+               "• `ct [mã] [số tiền]` - Thêm chi tiêu\n"
+               "• `ct 1 50000 VND Ăn trưa` - Ví dụ\n\n"
+               f"🕐 {format_vn_time_short()}")
+        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("expense_categories")
+    async def cb_expense_categories(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        categories = get_expense_categories(owner_id)
+        
+        if not categories:
+            msg = (f"📋 Chưa có danh mục nào!\n"
+                   f"Tạo: `dm [tên] [budget]`\n\n"
+                   f"🕐 {format_vn_time_short()}")
+            keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+        
+        msg = "📋 *DANH MỤC CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n"
+        keyboard = []
+        row = []
+        
+        for cat in categories:
+            cat_id, name, budget, created = cat
+            safe_name = escape_markdown(name)
+            msg += f"• *{cat_id}.* {safe_name} - {format_currency_simple(budget, 'VND')}\n"
             
-            if data == "show_alerts":
-                uid = query.from_user.id
-                alerts = get_user_alerts(uid)
-                
-                if not alerts:
-                    msg = f"📭 Bạn chưa có cảnh báo nào!\n\n🕐 {format_vn_time()}"
-                    await safe_edit_message(query, msg)
-                    return
-                
-                msg = "🔔 *CẢNH BÁO GIÁ*\n━━━━━━━━━━━━━━━━\n\n"
-                for alert in alerts:
-                    alert_id, symbol, target, condition, created = alert
-                    created_date = created.split()[0]
-                    price_data = get_price(symbol)
-                    current_price = price_data['p'] if price_data else 0
-                    status = "🟢" if (condition == 'above' and current_price < target) or (condition == 'below' and current_price > target) else "🔴"
-                    msg += f"{status} *#{alert_id}*: {symbol} {condition} `{fmt_price(target)}`\n"
-                    msg += f"   Giá hiện: `{fmt_price(current_price)}` (tạo {created_date})\n\n"
-                
-                msg += f"🕐 {format_vn_time()}"
-                
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            row.append(InlineKeyboardButton(f"🗑 {cat_id}", callback_data=f"del_cat_{cat_id}"))
+            if len(row) == 4:
+                keyboard.append(row)
+                row = []
+        
+        if row:
+            keyboard.append(row)
+        
+        keyboard.append([InlineKeyboardButton("➕ Thêm danh mục", callback_data="expense_expense_menu"),
+                         InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")])
+        
+        msg += f"\n🕐 {format_vn_time_short()}"
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("expense_today")
+    async def cb_expense_today(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        try:
+            incomes_data = get_income_by_period(owner_id, 'day')
+            expenses_data = get_expenses_by_period(owner_id, 'day')
+            
+            msg = f"📅 *THU CHI HÔM NAY ({get_vn_time().strftime('%d/%m/%Y')})*\n━━━━━━━━━━━━━━━━\n\n"
             
-            if data == "show_top10":
-                await query.edit_message_text("🔄 Đang tải...")
+            if incomes_data['transactions']:
+                msg += "*💰 THU NHẬP:*\n"
+                for inc in incomes_data['transactions']:
+                    id, amount, source, note, currency, date = inc
+                    safe_source = escape_markdown(source)
+                    safe_note = escape_markdown(note) if note else ""
+                    
+                    msg += f"• #{id}: {format_currency_simple(amount, currency)} - {safe_source}\n"
+                    if safe_note:
+                        msg += f"  📝 {safe_note}\n"
                 
-                try:
-                    headers = {'X-CMC_PRO_API_KEY': CMC_API_KEY}
-                    res = requests.get(f"{CMC_API_URL}/cryptocurrency/listings/latest", headers=headers, params={'limit': 10, 'convert': 'USD'}, timeout=10)
+                msg += f"\n📊 *Tổng thu:*\n"
+                for currency, total in incomes_data['summary'].items():
+                    msg += f"  {format_currency_simple(total, currency)}\n"
+                msg += "\n"
+            else:
+                msg += "📭 Không có thu nhập hôm nay.\n\n"
+            
+            if expenses_data['transactions']:
+                msg += "*💸 CHI TIÊU:*\n"
+                for exp in expenses_data['transactions']:
+                    id, cat_name, amount, note, currency, date, budget = exp
+                    safe_cat = escape_markdown(cat_name)
+                    safe_note = escape_markdown(note) if note else ""
                     
-                    if res.status_code == 200:
-                        data = res.json()['data']
-                        msg = "📊 *TOP 10 COIN*\n━━━━━━━━━━━━\n\n"
-                        
-                        for i, coin in enumerate(data, 1):
-                            quote = coin['quote']['USD']
-                            change = quote['percent_change_24h']
-                            emoji = "📈" if change > 0 else "📉" if change < 0 else "➡️"
-                            
-                            msg += f"{i}. *{coin['symbol']}* - {coin['name']}\n"
-                            msg += f"   💰 `{fmt_price(quote['price'])}` {emoji} `{change:+.2f}%`\n"
-                        
-                        msg += f"\n🕐 {format_vn_time_short()}"
-                    else:
-                        msg = "❌ Không thể lấy dữ liệu"
-                except Exception as e:
-                    msg = "❌ Lỗi kết nối"
+                    msg += f"• #{id}: {format_currency_simple(amount, currency)} - {safe_cat}\n"
+                    if safe_note:
+                        msg += f"  📝 {safe_note}\n"
                 
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+                msg += f"\n📊 *Tổng chi:*\n"
+                for currency, total in expenses_data['summary'].items():
+                    msg += f"  {format_currency_simple(total, currency)}\n"
+            else:
+                msg += "📭 Không có chi tiêu hôm nay."
             
-            if data == "show_buy":
-                msg = ("➕ *MUA COIN*\n\nDùng lệnh: `/buy [coin] [sl] [giá]`\n\n"
-                       "*Ví dụ:*\n• `/buy btc 0.5 40000`\n\n"
-                       f"🕐 {format_vn_time_short()}")
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            msg += f"\n\n🕐 {format_vn_time()}"
             
-            if data == "show_sell":
-                msg = ("➖ *BÁN COIN*\n\nDùng lệnh: `/sell [coin] [sl]`\n\n"
-                       "*Ví dụ:*\n• `/sell btc 0.2`\n\n"
-                       f"🕐 {format_vn_time_short()}")
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
+            if len(msg) > 4000:
+                await query.edit_message_text("📊 *Báo cáo quá dài, đang chia nhỏ...*")
+                chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
+                for i, chunk in enumerate(chunks, 1):
+                    await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
+            else:
+                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
                 await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+                
+        except Exception as e:
+            logger.error(f"Lỗi expense_today: {e}", exc_info=True)
+            await safe_edit_message(query, "❌ Có lỗi xảy ra khi xem hôm nay!")
+        return
+
+    @callback_router.exact("expense_month")
+    async def cb_expense_month(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        try:
+            incomes_data = get_income_by_period(owner_id, 'month')
+            expenses_data = get_expenses_by_period(owner_id, 'month')
             
-            if data == "admin_panel":
-                uid = query.from_user.id
-                group_id = query.message.chat.id
-                
-                msg = ("👑 *ADMIN PANEL*\n━━━━━━━━━━━━━━━━\n\n"
-                       "• `/perm list` - Danh sách admin\n"
-                       "• `/perm grant @user view` - Cấp quyền xem\n"
-                       "• `/perm grant @user edit` - Cấp quyền sửa\n"
-                       "• `/perm grant @user delete` - Cấp quyền xóa\n"
-                       "• `/perm grant @user manage` - Cấp quyền QL\n"
-                       "• `/perm revoke @user` - Thu hồi quyền\n\n"
-                       f"🕐 {format_vn_time()}")
+            msg = f"📅 *THU CHI THÁNG {get_vn_time().strftime('%m/%Y')}*\n━━━━━━━━━━━━━━━━\n\n"
+            
+            if incomes_data['transactions']:
+                msg += "*💰 THU NHẬP:*\n"
+                for inc in incomes_data['transactions'][:10]:
+                    id, amount, source, note, currency, date = inc
+                    safe_source = escape_markdown(source)
+                    safe_note = escape_markdown(note) if note else ""
+                    
+                    msg += f"• #{id} {date}: {format_currency_simple(amount, currency)} - {safe_source}\n"
+                    if safe_note:
+                        msg += f"  📝 {safe_note}\n"
                 
-                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+                msg += f"\n📊 *Tổng thu:*\n"
+                for currency, total in incomes_data['summary'].items():
+                    msg += f"  {format_currency_simple(total, currency)}\n"
+                msg += f"  *Tổng số:* {incomes_data['total_count']} giao dịch\n\n"
+            else:
+                msg += "📭 Không có thu nhập.\n\n"
+            
+            if expenses_data['transactions']:
+                msg += "*💸 CHI TIÊU:*\n"
+                for exp in expenses_data['transactions'][:10]:
+                    id, cat_name, amount, note, currency, date, budget = exp
+                    safe_cat = escape_markdown(cat_name)
+                    safe_note = escape_markdown(note) if note else ""
+                    
+                    msg += f"• #{id} {date}: {format_currency_simple(amount, currency)} - {safe_cat}\n"
+                    if safe_note:
+                        msg += f"  📝 {safe_note}\n"
+                
+                msg += f"\n📊 *Tổng chi:*\n"
+                for currency, total in expenses_data['summary'].items():
+                    msg += f"  {format_currency_simple(total, currency)}\n"
+            else:
+                msg += "📭 Không có chi tiêu."
+            
+            msg += f"\n\n🕐 {format_vn_time()}"
             
-            if data == "expense_income_menu":
-                msg = ("💰 *MENU THU NHẬP*\n\n"
-                       "• `tn [số tiền]` - Thêm thu nhập\n"
-                       "• `tn 100 USD Lương` - Thêm 100 USD\n\n"
-                       f"🕐 {format_vn_time_short()}")
+            if len(msg) > 4000:
+                await query.edit_message_text("📊 *Báo cáo quá dài, đang chia nhỏ...*")
+                chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
+                for i, chunk in enumerate(chunks, 1):
+                    await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
+            else:
                 keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
                 await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+                
+        except Exception as e:
+            logger.error(f"Lỗi expense_month: {e}", exc_info=True)
+            await safe_edit_message(query, "❌ Có lỗi xảy ra!")
+        return
+
+    @callback_router.exact("expense_recent")
+    async def cb_expense_recent(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        try:
+            recent_incomes = get_recent_incomes(owner_id, 20)
+            recent_expenses = get_recent_expenses(owner_id, 20)
             
-            if data == "expense_expense_menu":
-                msg = ("💸 *MENU CHI TIÊU*\n\n"
-                       "• `ct [mã] [số tiền]` - Thêm chi tiêu\n"
-                       "• `ct 1 50000 VND Ăn trưa` - Ví dụ\n\n"
-                       f"🕐 {format_vn_time_short()}")
+            if not recent_incomes and not recent_expenses:
+                msg = f"📭 Chưa có giao dịch nào!\n\n🕐 {format_vn_time_short()}"
                 keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
                 await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
                 return
             
-            if data == "expense_categories":
-                categories = get_expense_categories(owner_id)
-                
-                if not categories:
-                    msg = (f"📋 Chưa có danh mục nào!\n"
-                           f"Tạo: `dm [tên] [budget]`\n\n"
-                           f"🕐 {format_vn_time_short()}")
-                    keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                
-                msg = "📋 *DANH MỤC CHI TIÊU*\n━━━━━━━━━━━━━━━━\n\n"
-                keyboard = []
-                row = []
-                
-                for cat in categories:
-                    cat_id, name, budget, created = cat
-                    safe_name = escape_markdown(name)
-                    msg += f"• *{cat_id}.* {safe_name} - {format_currency_simple(budget, 'VND')}\n"
-                    
-                    row.append(InlineKeyboardButton(f"🗑 {cat_id}", callback_data=f"del_cat_{cat_id}"))
-                    if len(row) == 4:
-                        keyboard.append(row)
-                        row = []
-                
-                if row:
-                    keyboard.append(row)
-                
-                keyboard.append([InlineKeyboardButton("➕ Thêm danh mục", callback_data="expense_expense_menu"),
-                                 InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")])
-                
-                msg += f"\n🕐 {format_vn_time_short()}"
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            msg = f"🔄 *20 GIAO DỊCH GẦN ĐÂY*\n━━━━━━━━━━━━━━━━\n\n"
             
-            if data == "expense_today":
-                try:
-                    incomes_data = get_income_by_period(owner_id, 'day')
-                    expenses_data = get_expenses_by_period(owner_id, 'day')
-                    
-                    msg = f"📅 *THU CHI HÔM NAY ({get_vn_time().strftime('%d/%m/%Y')})*\n━━━━━━━━━━━━━━━━\n\n"
-                    
-                    if incomes_data['transactions']:
-                        msg += "*💰 THU NHẬP:*\n"
-                        for inc in incomes_data['transactions']:
-                            id, amount, source, note, currency, date = inc
-                            safe_source = escape_markdown(source)
-                            safe_note = escape_markdown(note) if note else ""
-                            
-                            msg += f"• #{id}: {format_currency_simple(amount, currency)} - {safe_source}\n"
-                            if safe_note:
-                                msg += f"  📝 {safe_note}\n"
-                        
-                        msg += f"\n📊 *Tổng thu:*\n"
-                        for currency, total in incomes_data['summary'].items():
-                            msg += f"  {format_currency_simple(total, currency)}\n"
-                        msg += "\n"
-                    else:
-                        msg += "📭 Không có thu nhập hôm nay.\n\n"
-                    
-                    if expenses_data['transactions']:
-                        msg += "*💸 CHI TIÊU:*\n"
-                        for exp in expenses_data['transactions']:
-                            id, cat_name, amount, note, currency, date, budget = exp
-                            safe_cat = escape_markdown(cat_name)
-                            safe_note = escape_markdown(note) if note else ""
-                            
-                            msg += f"• #{id}: {format_currency_simple(amount, currency)} - {safe_cat}\n"
-                            if safe_note:
-                                msg += f"  📝 {safe_note}\n"
-                        
-                        msg += f"\n📊 *Tổng chi:*\n"
-                        for currency, total in expenses_data['summary'].items():
-                            msg += f"  {format_currency_simple(total, currency)}\n"
-                    else:
-                        msg += "📭 Không có chi tiêu hôm nay."
-                    
-                    msg += f"\n\n🕐 {format_vn_time()}"
-                    
-                    if len(msg) > 4000:
-                        await query.edit_message_text("📊 *Báo cáo quá dài, đang chia nhỏ...*")
-                        chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
-                        for i, chunk in enumerate(chunks, 1):
-                            await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
-                    else:
-                        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
-                        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                        
-                except Exception as e:
-                    logger.error(f"Lỗi expense_today: {e}", exc_info=True)
-                    await safe_edit_message(query, "❌ Có lỗi xảy ra khi xem hôm nay!")
-                return
+            all_transactions = []
             
-            if data == "expense_month":
-                try:
-                    incomes_data = get_income_by_period(owner_id, 'month')
-                    expenses_data = get_expenses_by_period(owner_id, 'month')
-                    
-                    msg = f"📅 *THU CHI THÁNG {get_vn_time().strftime('%m/%Y')}*\n━━━━━━━━━━━━━━━━\n\n"
-                    
-                    if incomes_data['transactions']:
-                        msg += "*💰 THU NHẬP:*\n"
-                        for inc in incomes_data['transactions'][:10]:
-                            id, amount, source, note, currency, date = inc
-                            safe_source = escape_markdown(source)
-                            safe_note = escape_markdown(note) if note else ""
-                            
-                            msg += f"• #{id} {date}: {format_currency_simple(amount, currency)} - {safe_source}\n"
-                            if safe_note:
-                                msg += f"  📝 {safe_note}\n"
-                        
-                        msg += f"\n📊 *Tổng thu:*\n"
-                        for currency, total in incomes_data['summary'].items():
-                            msg += f"  {format_currency_simple(total, currency)}\n"
-                        msg += f"  *Tổng số:* {incomes_data['total_count']} giao dịch\n\n"
-                    else:
-                        msg += "📭 Không có thu nhập.\n\n"
-                    
-                    if expenses_data['transactions']:
-                        msg += "*💸 CHI TIÊU:*\n"
-                        for exp in expenses_data['transactions'][:10]:
-                            id, cat_name, amount, note, currency, date, budget = exp
-                            safe_cat = escape_markdown(cat_name)
-                            safe_note = escape_markdown(note) if note else ""
-                            
-                            msg += f"• #{id} {date}: {format_currency_simple(amount, currency)} - {safe_cat}\n"
-                            if safe_note:
-                                msg += f"  📝 {safe_note}\n"
-                        
-                        msg += f"\n📊 *Tổng chi:*\n"
-                        for currency, total in expenses_data['summary'].items():
-                            msg += f"  {format_currency_simple(total, currency)}\n"
-                    else:
-                        msg += "📭 Không có chi tiêu."
-                    
-                    msg += f"\n\n🕐 {format_vn_time()}"
-                    
-                    if len(msg) > 4000:
-                        await query.edit_message_text("📊 *Báo cáo quá dài, đang chia nhỏ...*")
-                        chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
-                        for i, chunk in enumerate(chunks, 1):
-                            await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
-                    else:
-                        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
-                        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                        
-                except Exception as e:
-                    logger.error(f"Lỗi expense_month: {e}", exc_info=True)
-                    await safe_edit_message(query, "❌ Có lỗi xảy ra!")
-                return
+            for inc in recent_incomes:
+                id, amount, source, note, date, currency = inc
+                safe_source = escape_markdown(source)
+                safe_note = escape_markdown(note) if note else ""
+                desc = f"{format_currency_simple(amount, currency)} - {safe_source}"
+                all_transactions.append(('💰', id, date, desc, safe_note))
             
-            if data == "expense_recent":
-                try:
-                    recent_incomes = get_recent_incomes(owner_id, 20)
-                    recent_expenses = get_recent_expenses(owner_id, 20)
-                    
-                    if not recent_incomes and not recent_expenses:
-                        msg = f"📭 Chưa có giao dịch nào!\n\n🕐 {format_vn_time_short()}"
-                        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
-                        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                        return
-                    
-                    msg = f"🔄 *20 GIAO DỊCH GẦN ĐÂY*\n━━━━━━━━━━━━━━━━\n\n"
-                    
-                    all_transactions = []
-                    
-                    for inc in recent_incomes:
-                        id, amount, source, note, date, currency = inc
-                        safe_source = escape_markdown(source)
-                        safe_note = escape_markdown(note) if note else ""
-                        desc = f"{format_currency_simple(amount, currency)} - {safe_source}"
-                        all_transactions.append(('💰', id, date, desc, safe_note))
-                    
-                    for exp in recent_expenses:
-                        id, cat_name, amount, note, date, currency = exp
-                        safe_cat = escape_markdown(cat_name)
-                        safe_note = escape_markdown(note) if note else ""
-                        desc = f"{format_currency_simple(amount, currency)} - {safe_cat}"
-                        all_transactions.append(('💸', id, date, desc, safe_note))
-                    
-                    all_transactions.sort(key=lambda x: x[2], reverse=True)
-                    
-                    for emoji, id, date, desc, note in all_transactions[:20]:
-                        msg += f"{emoji} #{id} {date}: {desc}\n"
-                        if note:
-                            msg += f"   📝 {note}\n"
-                    
-                    msg += f"\n🕐 {format_vn_time_short()}"
-                    
-                    if len(msg) > 4000:
-                        await query.edit_message_text("📊 *Danh sách quá dài, đang chia nhỏ...*")
-                        chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
-                        for i, chunk in enumerate(chunks, 1):
-                            await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
-                    else:
-                        keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
-                        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                        
-                except Exception as e:
-                    logger.error(f"Lỗi expense_recent: {e}", exc_info=True)
-                    await safe_edit_message(query, "❌ Có lỗi xảy ra!")
-                return
+            for exp in recent_expenses:
+                id, cat_name, amount, note, date, currency = exp
+                safe_cat = escape_markdown(cat_name)
+                safe_note = escape_markdown(note) if note else ""
+                desc = f"{format_currency_simple(amount, currency)} - {safe_cat}"
+                all_transactions.append(('💸', id, date, desc, safe_note))
             
-            if data == "export_csv" or data == "expense_export":
-                await export_csv_handler(update, ctx)
-                return
-    
-            if data.startswith("balance_"):
-                period = data.replace("balance_", "")
-                
-                balance_data = get_balance_summary(owner_id, period)
-                
-                if not balance_data:
-                    msg = "❌ Không thể tính cân đối!"
-                    await safe_edit_message(query, msg)
-                    return
-                
-                balance_msg = format_balance_message(balance_data, "")
-                
-                keyboard = [
-                    [InlineKeyboardButton("📅 Hôm nay", callback_data="balance_day"),
-                     InlineKeyboardButton("📅 Tháng này", callback_data="balance_month")],
-                    [InlineKeyboardButton("📅 Năm nay", callback_data="balance_year"),
-                     InlineKeyboardButton("📊 Tất cả", callback_data="balance_all")],
-                    [InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]
-                ]
-                
-                await safe_edit_message(query, balance_msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-
-            elif data == "export_secure":
-                await query.edit_message_text(
-                    "🔐 *XUẤT CSV CÓ MẬT KHẨU*\n\n"
-                    "Dùng lệnh: `/export_secure [mật khẩu]`\n\n"
-                    "*Ví dụ:*\n"
-                    "• `/export_secure 123456`\n"
-                    "• `/export_secure mysecretpass`\n\n"
-                    "*Tính năng:*\n"
-                    "• Mã hóa AES-256\n"
-                    "• File ZIP có mật khẩu\n"
-                    "• An toàn hơn CSV thường\n\n"
-                    f"🕐 {format_vn_time_short()}",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")
-                    ]])
-                )
-                return
-            # ===========================================
-            # XỬ LÝ XUẤT BÁO CÁO CHI TIÊU
-            # ===========================================
-            if data == "export_expense_menu":
-                await safe_edit_message(
-                    query,
-                    "🔐 *XUẤT BÁO CÁO CHI TIÊU MASTER*\n\n"
-                    "Dùng lệnh: `/export_expense [mật khẩu]`\n\n"
-                    "*Ví dụ:*\n"
-                    "• `/export_expense 123456` - File ZIP có mật khẩu (tự xóa sau 30s)\n"
-                    "• `/export_expense 0` - File CSV không mã hóa\n\n"
-                    "*Báo cáo bao gồm TẤT CẢ:*\n"
-                    "📊 Danh sách thu nhập chi tiết\n"
-                    "📊 Danh sách chi tiêu chi tiết\n"
-                    "📋 Phân tích theo danh mục\n"
-                    "⚖️ Cân đối theo loại tiền\n"
-                    "📅 Phân tích theo tháng\n"
-                    "💡 Đánh giá budget & khuyến nghị\n\n"
-                    f"🕐 {format_vn_time_short()}",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Về menu chi tiêu", callback_data="back_to_expense")
-                    ]])
-                )
-                return
-
-            # ===========================================
-            # NHÓM 11: MENU CÀI ĐẶT - QUẢN LÝ PHÂN QUYỀN
-            # ===========================================
+            all_transactions.sort(key=lambda x: x[2], reverse=True)
             
-            elif data == "settings_members":
-                await query.edit_message_text("🔄 Đang tải danh sách thành viên...")
-                
-                try:
-                    # Lấy danh sách thành viên từ Telegram
-                    admins = await ctx.bot.get_chat_administrators(chat_id)
-                    
-                    # Tạo message và keyboard
-                    msg_lines = ["👥 *DANH SÁCH THÀNH VIÊN*", "━━━━━━━━━━━━━━━━\n"]
-                    keyboard = []
-                    row = []
-                    
-                    human_count = 0
-                    bot_count = 0
-                    
-                    for admin in admins:
-                        user = admin.user
-                        
-                        # Lấy quyền hiện tại từ DB (nếu là người)
-                        perm = None
-                        if not user.is_bot:
-                            conn = sqlite3.connect(DB_PATH)
-                            c = conn.cursor()
-                            c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
-                                        FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, user.id))
-                            perm = c.fetchone()
-                            conn.close()
-                        
-                        # Xác định icon và tên hiển thị
-                        if user.is_bot:
-                            icon = "🤖"  # Bot
-                            bot_count += 1
-                        elif admin.status == 'creator':
-                            icon = "👑"  # Chủ sở hữu
-                            human_count += 1
-                        elif perm:
-                            icon = "🔰"  # Đã được cấp quyền
-                            human_count += 1
-                        else:
-                            icon = "👤"  # Thành viên thường
-                            human_count += 1
-                        
-                        display_name = f"@{user.username}" if user.username else user.first_name or "No name"
-                        msg_lines.append(f"{icon} {display_name} (`{user.id}`)")
-                        
-                        # Chỉ thêm nút quản lý nếu KHÔNG phải bot và user hiện tại có quyền manage
-                        if not user.is_bot and check_permission(chat_id, query.from_user.id, 'manage'):
-                            btn_text = f"⚙️ {user.first_name[:10] if user.first_name else 'User'}"
-                            if user.first_name and len(user.first_name) > 10:
-                                btn_text = f"⚙️ {user.first_name[:8]}..."
-                            
-                            row.append(InlineKeyboardButton(btn_text, callback_data=f"perm_user_{user.id}"))
-                            
-                            if len(row) == 2:
-                                keyboard.append(row)
-                                row = []
-                    
-                    # Thêm hàng cuối cùng nếu còn
-                    if row:
-                        keyboard.append(row)
-                    
-                    # Thêm thống kê
-                    msg_lines.append("")
-                    msg_lines.append(f"📊 *Tổng số:* {len(admins)} thành viên")
-                    msg_lines.append(f"   • 👤 Người: {human_count}")
-                    msg_lines.append(f"   • 🤖 Bot: {bot_count}")
-                    
-                    # Nút quay lại
-                    keyboard.append([InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")])
-                    
-                    msg = "\n".join(msg_lines) + f"\n\n🕐 {format_vn_time_short()}"
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                    return
-                    
-                except Exception as e:
-                    logger.error(f"❌ Lỗi settings_members: {e}")
-                    await safe_edit_message(query, "❌ Không thể tải danh sách thành viên!")
-                    return
+            for emoji, id, date, desc, note in all_transactions[:20]:
+                msg += f"{emoji} #{id} {date}: {desc}\n"
+                if note:
+                    msg += f"   📝 {note}\n"
             
-            elif data == "settings_permissions":
-                msg = (
-                    "🔐 *HƯỚNG DẪN PHÂN QUYỀN*\n"
-                    "━━━━━━━━━━━━━━━━\n\n"
-                    "👁 *XEM*\n"
-                    "• Xem giá coin, portfolio, lợi nhuận\n\n"
-                    "✏️ *SỬA*\n"
-                    "• Thêm/sửa giao dịch (bao gồm quyền XEM)\n\n"
-                    "🗑 *XOÁ*\n"
-                    "• Xóa giao dịch (bao gồm quyền XEM)\n\n"
-                    "🔐 *QUẢN LÝ*\n"
-                    "• Cấp/thu hồi quyền cho người khác\n"
-                    "• Bao gồm TẤT CẢ quyền trên\n\n"
-                    "⚡ *Cách thực hiện:*\n"
-                    "1️⃣ Chọn *QUẢN LÝ THÀNH VIÊN*\n"
-                    "2️⃣ Chọn người cần cấp quyền\n"
-                    "3️⃣ Tick vào các quyền muốn cấp\n"
-                    "4️⃣ Nhấn *LƯU THAY ĐỔI*"
-                )
-                
-                keyboard = [
-                    [InlineKeyboardButton("👥 QUẢN LÝ THÀNH VIÊN", callback_data="settings_members")],
-                    [InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]
-                ]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            msg += f"\n🕐 {format_vn_time_short()}"
             
-            elif data == "settings_list":
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute('''
-                    SELECT p.user_id, p.can_view_all, p.can_edit_all, p.can_delete_all, p.can_manage_perms,
-                           u.username, u.first_name 
-                    FROM permissions p 
-                    LEFT JOIN users u ON p.user_id = u.user_id 
-                    WHERE p.group_id = ?
-                    ORDER BY p.created_at
-                ''', (chat_id,))
-                permissions = c.fetchall()
-                conn.close()
-                
-                if not permissions:
-                    msg = "📋 *DANH SÁCH QUYỀN*\n━━━━━━━━━━━━━━━━\n\nChưa có ai được cấp quyền đặc biệt."
-                else:
-                    msg_lines = ["📋 *DANH SÁCH QUYỀN HIỆN TẠI*", "━━━━━━━━━━━━━━━━\n"]
-                    
-                    for p in permissions:
-                        user_id, view, edit, delete, manage, username, first_name = p
-                        name = f"@{username}" if username else first_name or f"User {user_id}"
-                        
-                        perms = []
-                        if view: perms.append("👁")
-                        if edit: perms.append("✏️")
-                        if delete: perms.append("🗑")
-                        if manage: perms.append("🔐")
-                        
-                        perms_display = ' '.join(perms) if perms else '❌'
-                        msg_lines.append(f"• {name}: {perms_display}")
-                    
-                    msg = "\n".join(msg_lines)
-                
-                msg += f"\n\n🕐 {format_vn_time_short()}"
-                
-                keyboard = [[InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]]
+            if len(msg) > 4000:
+                await query.edit_message_text("📊 *Danh sách quá dài, đang chia nhỏ...*")
+                chunks = [msg[i:i+3500] for i in range(0, len(msg), 3500)]
+                for i, chunk in enumerate(chunks, 1):
+                    await query.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
+            else:
+                keyboard = [[InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]]
                 await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            
-            elif data == "settings_sync":
-                await query.edit_message_text("🔄 Đang đồng bộ danh sách admin từ Telegram...")
-                
-                try:
-                    admins = await ctx.bot.get_chat_administrators(chat_id)
-                    synced = 0
-                    updated = 0
-                    
-                    for admin in admins:
-                        if admin.user and not admin.user.is_bot:
-                            await update_user_info_async(admin.user)
-                            
-                            conn = sqlite3.connect(DB_PATH)
-                            c = conn.cursor()
-                            c.execute('''SELECT id FROM permissions WHERE group_id = ? AND user_id = ?''', 
-                                     (chat_id, admin.user.id))
-                            exists = c.fetchone()
-                            
-                            if not exists:
-                                # Tự động cấp quyền cho admin Telegram
-                                perms = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 0}
-                                if admin.status == 'creator':
-                                    perms = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 1}
-                                
-                                c.execute('''
-                                    INSERT INTO permissions 
-                                    (group_id, user_id, granted_by, is_approved, role, 
-                                     can_view_all, can_edit_all, can_delete_all, can_manage_perms,
-                                     created_at, approved_at) 
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                ''', (chat_id, admin.user.id, chat_id, 1, 'staff',
-                                      perms['view'], perms['edit'], perms['delete'], perms['manage'],
-                                      get_vn_time().strftime("%Y-%m-%d %H:%M:%S"),
-                                      get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
-                                synced += 1
-                            else:
-                                updated += 1
-                            
-                            conn.commit()
-                            conn.close()
-                    
-                    msg = (
-                        f"✅ *ĐỒNG BỘ THÀNH CÔNG*\n"
-                        f"━━━━━━━━━━━━━━━━\n\n"
-                        f"📊 *Kết quả:*\n"
-                        f"• Tổng số admin: {len(admins)}\n"
-                        f"• Đã cấp quyền mới: {synced}\n"
-                        f"• Đã cập nhật: {updated}\n\n"
-                        f"🕐 {format_vn_time()}"
-                    )
-                except Exception as e:
-                    logger.error(f"❌ Lỗi đồng bộ: {e}")
-                    msg = f"❌ Lỗi: {str(e)[:100]}"
                 
-                keyboard = [[InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+        except Exception as e:
+            logger.error(f"Lỗi expense_recent: {e}", exc_info=True)
+            await safe_edit_message(query, "❌ Có lỗi xảy ra!")
+        return
 
-            elif data.startswith("lang_"):
-                lang = data.replace("lang_", "")
-                user_id = query.from_user.id
-                current_lang = get_lang(user_id)
-                
-                # Lưu ngôn ngữ mới
-                if lang == 'vi':
-                    LANGUAGE[user_id] = 'VI'
-                    success_msg = "✅ Đã chuyển sang Tiếng Việt!"
-                elif lang == 'zh':
-                    LANGUAGE[user_id] = 'ZH'
-                    success_msg = "✅ 已切换到中文！"
-                else:
-                    await safe_edit_message(query, "❌ Ngôn ngữ không hợp lệ!")
-                    return
-                
-                # QUAN TRỌNG: Chỉ cập nhật message hiện tại, không tạo mới
-                # Hiển thị thông báo thành công và nút quay lại
-                keyboard = [[InlineKeyboardButton("🔙 Quay lại cài đặt", callback_data="back_to_settings")]]
-                await safe_edit_message(query, success_msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                
-                # Không gửi message mới, chỉ cập nhật message cũ
-                return
-                
-            elif data == "lang_menu":
-                user_id = query.from_user.id
-                current_lang = get_lang(user_id)
-                
-                # Xác định ngôn ngữ hiện tại để hiển thị
-                if current_lang == 'VI':
-                    current_display = "🇻🇳 Tiếng Việt"
-                else:
-                    current_display = "🇨🇳 中文"
-                
-                keyboard = [
-                    [InlineKeyboardButton("🇻🇳 Tiếng Việt", callback_data="lang_vi")],
-                    [InlineKeyboardButton("🇨🇳 中文", callback_data="lang_zh")],
-                    [InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_settings")]
-                ]
-                
-                msg = (f"🌐 *CHỌN NGÔN NGỮ*\n"
-                       f"━━━━━━━━━━━━━━━━\n\n"
-                       f"Ngôn ngữ hiện tại: {current_display}\n\n"
-                       f"Vui lòng chọn ngôn ngữ mới:")
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+    @callback_router.exact("export_csv")
+    @callback_router.exact("expense_export")
+    async def cb_export_csv(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        await export_csv_handler(update, ctx)
+        return
+
+    @callback_router.prefix("balance_")
+    async def cb_balance(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        owner_id = cb.owner_id
+        
+        period = cb.payload
+        
+        balance_data = get_balance_summary(owner_id, period)
+        
+        if not balance_data:
+            msg = "❌ Không thể tính cân đối!"
+            await safe_edit_message(query, msg)
+            return
+        
+        balance_msg = format_balance_message(balance_data, "")
+        
+        keyboard = [
+            [InlineKeyboardButton("📅 Hôm nay", callback_data="balance_day"),
+             InlineKeyboardButton("📅 Tháng này", callback_data="balance_month")],
+            [InlineKeyboardButton("📅 Năm nay", callback_data="balance_year"),
+             InlineKeyboardButton("📊 Tất cả", callback_data="balance_all")],
+            [InlineKeyboardButton("🔙 Về menu", callback_data="back_to_expense")]
+        ]
         
-            elif data == "back_to_settings":
-                lang = get_lang(query.from_user.id)
-                
-                if lang == 'ZH':
-                    keyboard = [
-                        [InlineKeyboardButton("👥 成员管理", callback_data="settings_members")],
-                        [InlineKeyboardButton("🔐 权限说明", callback_data="settings_permissions")],
-                        [InlineKeyboardButton("📋 权限列表", callback_data="settings_list")],
-                        [InlineKeyboardButton("🔄 同步管理员", callback_data="settings_sync")],
-                        [InlineKeyboardButton("🌐 语言", callback_data="lang_menu")],
-                        [InlineKeyboardButton("🔙 主菜单", callback_data="back_to_main")]
-                    ]
-                    msg = ("⚙️ *群组设置*\n"
-                           "━━━━━━━━━━━━━━━━\n\n"
-                           "请选择管理功能:\n\n"
-                           f"🕐 {format_vn_time()}")
-                else:
-                    keyboard = [
-                        [InlineKeyboardButton("👥 QUẢN LÝ THÀNH VIÊN", callback_data="settings_members")],
-                        [InlineKeyboardButton("🔐 HƯỚNG DẪN QUYỀN", callback_data="settings_permissions")],
-                        [InlineKeyboardButton("📋 DANH SÁCH QUYỀN", callback_data="settings_list")],
-                        [InlineKeyboardButton("🔄 ĐỒNG BỘ ADMIN", callback_data="settings_sync")],
-                        [InlineKeyboardButton("🌐 NGÔN NGỮ", callback_data="lang_menu")],
-                        [InlineKeyboardButton("🔙 VỀ MENU CHÍNH", callback_data="back_to_main")]
-                    ]
-                    msg = ("⚙️ *CÀI ĐẶT NHÓM*\n"
-                           "━━━━━━━━━━━━━━━━\n\n"
-                           "Chọn chức năng quản lý:\n\n"
-                           f"🕐 {format_vn_time()}")
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+        await safe_edit_message(query, balance_msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("export_secure")
+    async def cb_export_secure(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        await query.edit_message_text(
+            "🔐 *XUẤT CSV CÓ MẬT KHẨU*\n\n"
+            "Dùng lệnh: `/export_secure [mật khẩu]`\n\n"
+            "*Ví dụ:*\n"
+            "• `/export_secure 123456`\n"
+            "• `/export_secure mysecretpass`\n\n"
+            "*Tính năng:*\n"
+            "• Mã hóa AES-256\n"
+            "• File ZIP có mật khẩu\n"
+            "• An toàn hơn CSV thường\n\n"
+            f"🕐 {format_vn_time_short()}",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Về menu", callback_data="back_to_invest")
+            ]])
+        )
+        return
+
+    # ===========================================
+    # XỬ LÝ XUẤT BÁO CÁO CHI TIÊU
+    # ===========================================
+    @callback_router.exact("export_expense_menu")
+    async def cb_export_expense_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        await safe_edit_message(
+            query,
+            "🔐 *XUẤT BÁO CÁO CHI TIÊU MASTER*\n\n"
+            "Dùng lệnh: `/export_expense [mật khẩu]`\n\n"
+            "*Ví dụ:*\n"
+            "• `/export_expense 123456` - File ZIP có mật khẩu (tự xóa sau 30s)\n"
+            "• `/export_expense 0` - File CSV không mã hóa\n\n"
+            "*Báo cáo bao gồm TẤT CẢ:*\n"
+            "📊 Danh sách thu nhập chi tiết\n"
+            "📊 Danh sách chi tiêu chi tiết\n"
+            "📋 Phân tích theo danh mục\n"
+            "⚖️ Cân đối theo loại tiền\n"
+            "📅 Phân tích theo tháng\n"
+            "💡 Đánh giá budget & khuyến nghị\n\n"
+            f"🕐 {format_vn_time_short()}",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Về menu chi tiêu", callback_data="back_to_expense")
+            ]])
+        )
+        return
+
+    # ===========================================
+    # NHÓM 11: MENU CÀI ĐẶT - QUẢN LÝ PHÂN QUYỀN
+    # ===========================================
+    @callback_router.exact("settings_members")
+    async def cb_settings_members(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        await query.edit_message_text("🔄 Đang tải danh sách thành viên...")
+        
+        try:
+            # Lấy danh sách thành viên từ Telegram
+            admins = await ctx.bot.get_chat_administrators(chat_id)
             
-            elif data.startswith("perm_user_"):
-                target_id = int(data.replace("perm_user_", ""))
-                
-                # Không cho tự quản lý
-                if target_id == query.from_user.id:
-                    await safe_edit_message(query, "❌ Bạn không thể tự phân quyền cho chính mình!")
-                    return
-                
-                # Lấy thông tin user
-                try:
-                    chat = await ctx.bot.get_chat(target_id)
-                    name = f"@{chat.username}" if chat.username else chat.first_name
-                except:
-                    name = f"User {target_id}"
-                
-                # Lấy quyền hiện tại
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
-                            FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
-                current = c.fetchone()
-                conn.close()
-                
-                view = current[0] if current else 0
-                edit = current[1] if current else 0
-                delete = current[2] if current else 0
-                manage = current[3] if current else 0
-                
-                # Lưu tạm vào bot_data
-                ctx.bot_data[f"temp_perm_{target_id}"] = (view, edit, delete, manage)
-                
-                # Hiển thị giao diện phân quyền
-                msg = (
-                    f"🔐 *PHÂN QUYỀN CHO {name}*\n"
-                    f"━━━━━━━━━━━━━━━━\n\n"
-                    f"User ID: `{target_id}`\n\n"
-                    f"*Quyền hiện tại:*\n"
-                    f"{'✅' if view else '⬜'} 👁 XEM\n"
-                    f"{'✅' if edit else '⬜'} ✏️ SỬA\n"
-                    f"{'✅' if delete else '⬜'} 🗑 XÓA\n"
-                    f"{'✅' if manage else '⬜'} 🔐 QUẢN LÝ\n\n"
-                    f"*Chọn để thay đổi:*"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton(f"{'✅' if view else '⬜'} 👁", callback_data=f"perm_toggle_{target_id}_view"),
-                        InlineKeyboardButton(f"{'✅' if edit else '⬜'} ✏️", callback_data=f"perm_toggle_{target_id}_edit"),
-                        InlineKeyboardButton(f"{'✅' if delete else '⬜'} 🗑", callback_data=f"perm_toggle_{target_id}_delete"),
-                        InlineKeyboardButton(f"{'✅' if manage else '⬜'} 🔐", callback_data=f"perm_toggle_{target_id}_manage")
-                    ],
-                    [
-                        InlineKeyboardButton("👑 FULL", callback_data=f"perm_set_{target_id}_full"),
-                        InlineKeyboardButton("❌ XÓA HẾT", callback_data=f"perm_set_{target_id}_none")
-                    ],
-                    [InlineKeyboardButton("💾 LƯU", callback_data=f"perm_save_{target_id}")],
-                    [InlineKeyboardButton("🔙 Quay lại", callback_data="settings_members")]
-                ]
-                
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+            # Tạo message và keyboard
+            msg_lines = ["👥 *DANH SÁCH THÀNH VIÊN*", "━━━━━━━━━━━━━━━━\n"]
+            keyboard = []
+            row = []
             
-            elif data.startswith("perm_toggle_"):
-                parts = data.split("_")
-                target_id = int(parts[2])
-                perm_type = parts[3]
-                
-                # Lấy quyền tạm thời
-                key = f"temp_perm_{target_id}"
-                temp = ctx.bot_data.get(key)
+            human_count = 0
+            bot_count = 0
+            
+            for admin in admins:
+                user = admin.user
                 
-                if temp:
-                    view, edit, delete, manage = temp
-                else:
-                    # Fallback: lấy từ DB
-                    conn = sqlite3.connect(DB_PATH)
+                # Lấy quyền hiện tại từ DB (nếu là người)
+                perm = None
+                if not user.is_bot:
+                    conn = db_connect(DB_PATH)
                     c = conn.cursor()
                     c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
-                                FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
-                    current = c.fetchone()
+                                FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, user.id))
+                    perm = c.fetchone()
                     conn.close()
-                    view = current[0] if current else 0
-                    edit = current[1] if current else 0
-                    delete = current[2] if current else 0
-                    manage = current[3] if current else 0
-                
-                # Toggle
-                if perm_type == 'view':
-                    view = 1 - view
-                elif perm_type == 'edit':
-                    edit = 1 - edit
-                elif perm_type == 'delete':
-                    delete = 1 - delete
-                elif perm_type == 'manage':
-                    manage = 1 - manage
-                
-                # Lưu lại
-                ctx.bot_data[key] = (view, edit, delete, manage)
-                
-                # Cập nhật message
-                await update_perm_message(query, ctx, target_id, view, edit, delete, manage)
-                return
-            
-            elif data.startswith("perm_set_"):
-                parts = data.split("_")
-                target_id = int(parts[2])
-                preset = parts[3]
-                
-                if preset == 'full':
-                    view = edit = delete = manage = 1
-                elif preset == 'none':
-                    view = edit = delete = manage = 0
-                
-                ctx.bot_data[f"temp_perm_{target_id}"] = (view, edit, delete, manage)
-                await update_perm_message(query, ctx, target_id, view, edit, delete, manage)
-                return
-            
-            elif data.startswith("perm_save_"):
-                target_id = int(data.replace("perm_save_", ""))
-                key = f"temp_perm_{target_id}"
-                temp = ctx.bot_data.get(key)
-                
-                if not temp:
-                    await safe_edit_message(query, "ℹ️ Không có thay đổi nào để lưu!")
-                    return
                 
-                view, edit, delete, manage = temp
+                # Xác định icon và tên hiển thị
+                if user.is_bot:
+                    icon = "🤖"  # Bot
+                    bot_count += 1
+                elif admin.status == 'creator':
+                    icon = "👑"  # Chủ sở hữu
+                    human_count += 1
+                elif perm:
+                    icon = "🔰"  # Đã được cấp quyền
+                    human_count += 1
+                else:
+                    icon = "👤"  # Thành viên thường
+                    human_count += 1
                 
-                # Lưu vào database
-                permissions = {'view': view, 'edit': edit, 'delete': delete, 'manage': manage}
+                display_name = f"@{user.username}" if user.username else user.first_name or "No name"
+                msg_lines.append(f"{icon} {display_name} (`{user.id}`)")
                 
-                if grant_permission(chat_id, target_id, query.from_user.id, permissions):
-                    # Xóa temp
-                    if key in ctx.bot_data:
-                        del ctx.bot_data[key]
+                # Chỉ thêm nút quản lý nếu KHÔNG phải bot và user hiện tại có quyền manage
+                if not user.is_bot and check_permission(chat_id, query.from_user.id, 'manage'):
+                    btn_text = f"⚙️ {user.first_name[:10] if user.first_name else 'User'}"
+                    if user.first_name and len(user.first_name) > 10:
+                        btn_text = f"⚙️ {user.first_name[:8]}..."
                     
-                    # Lấy tên user
-                    try:
-                        chat = await ctx.bot.get_chat(target_id)
-                        name = f"@{chat.username}" if chat.username else chat.first_name
-                    except:
-                        name = f"User {target_id}"
+                    row.append(InlineKeyboardButton(btn_text, callback_data=f"perm_user_{user.id}"))
                     
-                    # Tạo message thông báo
-                    perms = []
-                    if view: perms.append("👁 Xem")
-                    if edit: perms.append("✏️ Sửa")
-                    if delete: perms.append("🗑 Xóa")
-                    if manage: perms.append("🔐 Quản lý")
+                    if len(row) == 2:
+                        keyboard.append(row)
+                        row = []
+            
+            # Thêm hàng cuối cùng nếu còn
+            if row:
+                keyboard.append(row)
+            
+            # Thêm thống kê
+            msg_lines.append("")
+            msg_lines.append(f"📊 *Tổng số:* {len(admins)} thành viên")
+            msg_lines.append(f"   • 👤 Người: {human_count}")
+            msg_lines.append(f"   • 🤖 Bot: {bot_count}")
+            
+            # Nút quay lại
+            keyboard.append([InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")])
+            
+            msg = "\n".join(msg_lines) + f"\n\n🕐 {format_vn_time_short()}"
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+            
+        except Exception as e:
+            logger.error(f"❌ Lỗi settings_members: {e}")
+            await safe_edit_message(query, "❌ Không thể tải danh sách thành viên!")
+            return
+
+    @callback_router.exact("settings_permissions")
+    async def cb_settings_permissions(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        msg = (
+            "🔐 *HƯỚNG DẪN PHÂN QUYỀN*\n"
+            "━━━━━━━━━━━━━━━━\n\n"
+            "👁 *XEM*\n"
+            "• Xem giá coin, portfolio, lợi nhuận\n\n"
+            "✏️ *SỬA*\n"
+            "• Thêm/sửa giao dịch (bao gồm quyền XEM)\n\n"
+            "🗑 *XOÁ*\n"
+            "• Xóa giao dịch (bao gồm quyền XEM)\n\n"
+            "🔐 *QUẢN LÝ*\n"
+            "• Cấp/thu hồi quyền cho người khác\n"
+            "• Bao gồm TẤT CẢ quyền trên\n\n"
+            "⚡ *Cách thực hiện:*\n"
+            "1️⃣ Chọn *QUẢN LÝ THÀNH VIÊN*\n"
+            "2️⃣ Chọn người cần cấp quyền\n"
+            "3️⃣ Tick vào các quyền muốn cấp\n"
+            "4️⃣ Nhấn *LƯU THAY ĐỔI*"
+        )
+        
+        keyboard = [
+            [InlineKeyboardButton("👥 QUẢN LÝ THÀNH VIÊN", callback_data="settings_members")],
+            [InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]
+        ]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("settings_list")
+    async def cb_settings_list(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''
+            SELECT p.user_id, p.can_view_all, p.can_edit_all, p.can_delete_all, p.can_manage_perms,
+                   u.username, u.first_name 
+            FROM permissions p 
+            LEFT JOIN users u ON p.user_id = u.user_id 
+            WHERE p.group_id = ?
+            ORDER BY p.created_at
+        ''', (chat_id,))
+        permissions = c.fetchall()
+        conn.close()
+        
+        if not permissions:
+            msg = "📋 *DANH SÁCH QUYỀN*\n━━━━━━━━━━━━━━━━\n\nChưa có ai được cấp quyền đặc biệt."
+        else:
+            msg_lines = ["📋 *DANH SÁCH QUYỀN HIỆN TẠI*", "━━━━━━━━━━━━━━━━\n"]
+            
+            for p in permissions:
+                user_id, view, edit, delete, manage, username, first_name = p
+                name = f"@{username}" if username else first_name or f"User {user_id}"
+                
+                perms = []
+                if view: perms.append("👁")
+                if edit: perms.append("✏️")
+                if delete: perms.append("🗑")
+                if manage: perms.append("🔐")
+                
+                perms_display = ' '.join(perms) if perms else '❌'
+                msg_lines.append(f"• {name}: {perms_display}")
+            
+            msg = "\n".join(msg_lines)
+        
+        msg += f"\n\n🕐 {format_vn_time_short()}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("settings_sync")
+    async def cb_settings_sync(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        await query.edit_message_text("🔄 Đang đồng bộ danh sách admin từ Telegram...")
+        
+        try:
+            admins = await ctx.bot.get_chat_administrators(chat_id)
+            synced = 0
+            updated = 0
+            
+            for admin in admins:
+                if admin.user and not admin.user.is_bot:
+                    await update_user_info_async(admin.user)
                     
-                    msg = (
-                        f"✅ *ĐÃ LƯU QUYỀN CHO {name}*\n"
-                        f"━━━━━━━━━━━━━━━━\n\n"
-                        f"Quyền được cấp: {', '.join(perms) if perms else '❌ Không có'}\n\n"
-                        f"🕐 {format_vn_time()}"
-                    )
+                    conn = db_connect(DB_PATH)
+                    c = conn.cursor()
+                    c.execute('''SELECT id FROM permissions WHERE group_id = ? AND user_id = ?''', 
+                             (chat_id, admin.user.id))
+                    exists = c.fetchone()
                     
-                    keyboard = [[InlineKeyboardButton("🔙 Quay lại danh sách", callback_data="settings_members")]]
-                    await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+                    if not exists:
+                        # Tự động cấp quyền cho admin Telegram
+                        perms = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 0}
+                        if admin.status == 'creator':
+                            perms = {'view': 1, 'edit': 1, 'delete': 1, 'manage': 1}
+                        
+                        c.execute('''
+                            INSERT INTO permissions 
+                            (group_id, user_id, granted_by, is_approved, role, 
+                             can_view_all, can_edit_all, can_delete_all, can_manage_perms,
+                             created_at, approved_at) 
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (chat_id, admin.user.id, chat_id, 1, 'staff',
+                              perms['view'], perms['edit'], perms['delete'], perms['manage'],
+                              get_vn_time().strftime("%Y-%m-%d %H:%M:%S"),
+                              get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
+                        synced += 1
+                    else:
+                        updated += 1
                     
-                    # Thông báo cho user được cấp quyền
-                    try:
-                        await ctx.bot.send_message(
-                            target_id,
-                            f"🔔 *THÔNG BÁO QUYỀN TRONG NHÓM*\n\n"
-                            f"Bạn đã được cấp quyền trong nhóm:\n"
-                            f"• {query.message.chat.title}\n"
-                            f"• Quyền: {', '.join(perms) if perms else '❌ Không có'}\n\n"
-                            f"🕐 {format_vn_time()}",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    except:
-                        pass
-                else:
-                    await safe_edit_message(query, "❌ Lỗi khi lưu quyền!")
-                
-                return
+                    conn.commit()
+                    conn.close()
+            
+            msg = (
+                f"✅ *ĐỒNG BỘ THÀNH CÔNG*\n"
+                f"━━━━━━━━━━━━━━━━\n\n"
+                f"📊 *Kết quả:*\n"
+                f"• Tổng số admin: {len(admins)}\n"
+                f"• Đã cấp quyền mới: {synced}\n"
+                f"• Đã cập nhật: {updated}\n\n"
+                f"🕐 {format_vn_time()}"
+            )
+        except Exception as e:
+            logger.error(f"❌ Lỗi đồng bộ: {e}")
+            msg = f"❌ Lỗi: {str(e)[:100]}"
+        
+        keyboard = [[InlineKeyboardButton("🔙 Về cài đặt", callback_data="back_to_settings")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("lang_")
+    async def cb_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        lang = cb.payload
+        user_id = query.from_user.id
+        
+        # Lưu ngôn ngữ mới
+        if lang == 'vi':
+            LANGUAGE[user_id] = 'VI'
+            success_msg = "✅ Đã chuyển sang Tiếng Việt!"
+        elif lang == 'zh':
+            LANGUAGE[user_id] = 'ZH'
+            success_msg = "✅ 已切换到中文！"
+        else:
+            await safe_edit_message(query, "❌ Ngôn ngữ không hợp lệ!")
+            return
+        
+        # QUAN TRỌNG: Chỉ cập nhật message hiện tại, không tạo mới
+        # Hiển thị thông báo thành công và nút quay lại
+        keyboard = [[InlineKeyboardButton("🔙 Quay lại cài đặt", callback_data="back_to_settings")]]
+        await safe_edit_message(query, success_msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        
+        # Không gửi message mới, chỉ cập nhật message cũ
+        return
+
+    @callback_router.exact("lang_menu")
+    async def cb_lang_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        user_id = query.from_user.id
+        current_lang = get_lang(user_id)
+        
+        # Xác định ngôn ngữ hiện tại để hiển thị
+        if current_lang == 'VI':
+            current_display = "🇻🇳 Tiếng Việt"
+        else:
+            current_display = "🇨🇳 中文"
+        
+        keyboard = [
+            [InlineKeyboardButton("🇻🇳 Tiếng Việt", callback_data="lang_vi")],
+            [InlineKeyboardButton("🇨🇳 中文", callback_data="lang_zh")],
+            [InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_settings")]
+        ]
+        
+        msg = (f"🌐 *CHỌN NGÔN NGỮ*\n"
+               f"━━━━━━━━━━━━━━━━\n\n"
+               f"Ngôn ngữ hiện tại: {current_display}\n\n"
+               f"Vui lòng chọn ngôn ngữ mới:")
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.exact("back_to_settings")
+    async def cb_back_to_settings(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        lang = get_lang(query.from_user.id)
+        
+        if lang == 'ZH':
+            keyboard = [
+                [InlineKeyboardButton("👥 成员管理", callback_data="settings_members")],
+                [InlineKeyboardButton("🔐 权限说明", callback_data="settings_permissions")],
+                [InlineKeyboardButton("📋 权限列表", callback_data="settings_list")],
+                [InlineKeyboardButton("🔄 同步管理员", callback_data="settings_sync")],
+                [InlineKeyboardButton("🌐 语言", callback_data="lang_menu")],
+                [InlineKeyboardButton("🔙 主菜单", callback_data="back_to_main")]
+            ]
+            msg = ("⚙️ *群组设置*\n"
+                   "━━━━━━━━━━━━━━━━\n\n"
+                   "请选择管理功能:\n\n"
+                   f"🕐 {format_vn_time()}")
+        else:
+            keyboard = [
+                [InlineKeyboardButton("👥 QUẢN LÝ THÀNH VIÊN", callback_data="settings_members")],
+                [InlineKeyboardButton("🔐 HƯỚNG DẪN QUYỀN", callback_data="settings_permissions")],
+                [InlineKeyboardButton("📋 DANH SÁCH QUYỀN", callback_data="settings_list")],
+                [InlineKeyboardButton("🔄 ĐỒNG BỘ ADMIN", callback_data="settings_sync")],
+                [InlineKeyboardButton("🌐 NGÔN NGỮ", callback_data="lang_menu")],
+                [InlineKeyboardButton("🔙 VỀ MENU CHÍNH", callback_data="back_to_main")]
+            ]
+            msg = ("⚙️ *CÀI ĐẶT NHÓM*\n"
+                   "━━━━━━━━━━━━━━━━\n\n"
+                   "Chọn chức năng quản lý:\n\n"
+                   f"🕐 {format_vn_time()}")
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("perm_user_", parse=int)
+    async def cb_perm_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        target_id = cb.payload
+        
+        # Không cho tự quản lý
+        if target_id == query.from_user.id:
+            await safe_edit_message(query, "❌ Bạn không thể tự phân quyền cho chính mình!")
+            return
+        
+        # Lấy thông tin user
+        try:
+            chat = await ctx.bot.get_chat(target_id)
+            name = f"@{chat.username}" if chat.username else chat.first_name
+        except:
+            name = f"User {target_id}"
+        
+        # Lấy quyền hiện tại
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
+                    FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
+        current = c.fetchone()
+        conn.close()
+        
+        view = current[0] if current else 0
+        edit = current[1] if current else 0
+        delete = current[2] if current else 0
+        manage = current[3] if current else 0
+        
+        # Lưu tạm vào bot_data
+        ctx.bot_data[f"temp_perm_{target_id}"] = (view, edit, delete, manage)
+        
+        # Hiển thị giao diện phân quyền
+        msg = (
+            f"🔐 *PHÂN QUYỀN CHO {name}*\n"
+            f"━━━━━━━━━━━━━━━━\n\n"
+            f"User ID: `{target_id}`\n\n"
+            f"*Quyền hiện tại:*\n"
+            f"{'✅' if view else '⬜'} 👁 XEM\n"
+            f"{'✅' if edit else '⬜'} ✏️ SỬA\n"
+            f"{'✅' if delete else '⬜'} 🗑 XÓA\n"
+            f"{'✅' if manage else '⬜'} 🔐 QUẢN LÝ\n\n"
+            f"*Chọn để thay đổi:*"
+        )
+        
+        keyboard = [
+            [
+                InlineKeyboardButton(f"{'✅' if view else '⬜'} 👁", callback_data=f"perm_toggle_{target_id}_view"),
+                InlineKeyboardButton(f"{'✅' if edit else '⬜'} ✏️", callback_data=f"perm_toggle_{target_id}_edit"),
+                InlineKeyboardButton(f"{'✅' if delete else '⬜'} 🗑", callback_data=f"perm_toggle_{target_id}_delete"),
+                InlineKeyboardButton(f"{'✅' if manage else '⬜'} 🔐", callback_data=f"perm_toggle_{target_id}_manage")
+            ],
+            [
+                InlineKeyboardButton("👑 FULL", callback_data=f"perm_set_{target_id}_full"),
+                InlineKeyboardButton("❌ XÓA HẾT", callback_data=f"perm_set_{target_id}_none")
+            ],
+            [InlineKeyboardButton("💾 LƯU", callback_data=f"perm_save_{target_id}")],
+            [InlineKeyboardButton("🔙 Quay lại", callback_data="settings_members")]
+        ]
+        
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("perm_toggle_", parse=(int, str))
+    async def cb_perm_toggle(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        target_id, perm_type = cb.payload
+
+        # Lấy quyền tạm thời
+        key = f"temp_perm_{target_id}"
+        temp = ctx.bot_data.get(key)
+        
+        if temp:
+            view, edit, delete, manage = temp
+        else:
+            # Fallback: lấy từ DB
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            c.execute('''SELECT can_view_all, can_edit_all, can_delete_all, can_manage_perms 
+                        FROM permissions WHERE group_id = ? AND user_id = ?''', (chat_id, target_id))
+            current = c.fetchone()
+            conn.close()
+            view = current[0] if current else 0
+            edit = current[1] if current else 0
+            delete = current[2] if current else 0
+            manage = current[3] if current else 0
+        
+        # Toggle
+        if perm_type == 'view':
+            view = 1 - view
+        elif perm_type == 'edit':
+            edit = 1 - edit
+        elif perm_type == 'delete':
+            delete = 1 - delete
+        elif perm_type == 'manage':
+            manage = 1 - manage
+        
+        # Lưu lại
+        ctx.bot_data[key] = (view, edit, delete, manage)
+        
+        # Cập nhật message
+        await update_perm_message(query, ctx, target_id, view, edit, delete, manage)
+        return
+
+    @callback_router.prefix("perm_set_", parse=(int, str))
+    async def cb_perm_set(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        target_id, preset = cb.payload
+
+        if preset == 'full':
+            view = edit = delete = manage = 1
+        elif preset == 'none':
+            view = edit = delete = manage = 0
+        
+        ctx.bot_data[f"temp_perm_{target_id}"] = (view, edit, delete, manage)
+        await update_perm_message(query, ctx, target_id, view, edit, delete, manage)
+        return
+
+    @callback_router.prefix("perm_save_", parse=int)
+    async def cb_perm_save(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        chat_id = cb.chat_id
+        
+        target_id = cb.payload
+        key = f"temp_perm_{target_id}"
+        temp = ctx.bot_data.get(key)
+        
+        if not temp:
+            await safe_edit_message(query, "ℹ️ Không có thay đổi nào để lưu!")
+            return
+        
+        view, edit, delete, manage = temp
+        
+        # Lưu vào database
+        permissions = {'view': view, 'edit': edit, 'delete': delete, 'manage': manage}
+        
+        if grant_permission(chat_id, target_id, query.from_user.id, permissions):
+            # Xóa temp
+            if key in ctx.bot_data:
+                del ctx.bot_data[key]
+            
+            # Lấy tên user
+            try:
+                chat = await ctx.bot.get_chat(target_id)
+                name = f"@{chat.username}" if chat.username else chat.first_name
+            except:
+                name = f"User {target_id}"
+            
+            # Tạo message thông báo
+            perms = []
+            if view: perms.append("👁 Xem")
+            if edit: perms.append("✏️ Sửa")
+            if delete: perms.append("🗑 Xóa")
+            if manage: perms.append("🔐 Quản lý")
+            
+            msg = (
+                f"✅ *ĐÃ LƯU QUYỀN CHO {name}*\n"
+                f"━━━━━━━━━━━━━━━━\n\n"
+                f"Quyền được cấp: {', '.join(perms) if perms else '❌ Không có'}\n\n"
+                f"🕐 {format_vn_time()}"
+            )
+            
+            keyboard = [[InlineKeyboardButton("🔙 Quay lại danh sách", callback_data="settings_members")]]
+            await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            
+            # Thông báo cho user được cấp quyền
+            try:
+                await ctx.bot.send_message(
+                    target_id,
+                    f"🔔 *THÔNG BÁO QUYỀN TRONG NHÓM*\n\n"
+                    f"Bạn đã được cấp quyền trong nhóm:\n"
+                    f"• {query.message.chat.title}\n"
+                    f"• Quyền: {', '.join(perms) if perms else '❌ Không có'}\n\n"
+                    f"🕐 {format_vn_time()}",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            except:
+                pass
+        else:
+            await safe_edit_message(query, "❌ Lỗi khi lưu quyền!")
+        
+        return
+
+    # ===========================================
+    # XỬ LÝ CALLBACK LIÊN QUAN ĐẾN SELL HISTORY
+    # ===========================================
+    @callback_router.prefix("sell_detail_", parse=int)
+    async def cb_sell_detail(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        target_user_id = cb.target_user_id
+        
+        sell_id = cb.payload
+        sell = get_sell_detail(sell_id, target_user_id)
+        
+        if not sell:
+            await safe_edit_message(query, f"❌ Không tìm thấy lệnh bán #{sell_id}")
+            return
+        
+        id, user, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_pct, sell_date, created = sell
+        
+        msg = (f"📝 *LỆNH BÁN #{sell_id}*\n━━━━━━━━━━━━━━━━\n\n"
+               f"*{symbol}*\n"
+               f"📅 Ngày bán: {sell_date}\n"
+               f"📊 Số lượng: `{amount:.4f}`\n"
+               f"💰 Giá bán: `{fmt_price(sell_price)}`\n"
+               f"💵 Giá vốn: `{fmt_price(buy_price)}`\n"
+               f"💎 Giá trị bán: `{fmt_price(total_sold)}`\n"
+               f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n\n"
+               f"🕐 {format_vn_time()}")
+        
+        keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    @callback_router.prefix("del_sell_", parse=int)
+    async def cb_del_sell(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        sell_id = cb.payload
+        
+        keyboard = [[
+            InlineKeyboardButton("✅ Xác nhận", callback_data=f"confirm_del_sell_{sell_id}"),
+            InlineKeyboardButton("❌ Hủy", callback_data="cancel_del_sell")
+        ]]
+        
+        await safe_edit_message(query, f"⚠️ *Xác nhận xóa lệnh bán #{sell_id}?*", 
+                               reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-            # ===========================================
-            # XỬ LÝ CALLBACK LIÊN QUAN ĐẾN SELL HISTORY
-            # ===========================================
-            
-            if data.startswith("sell_detail_"):
-                sell_id = int(data.replace("sell_detail_", ""))
-                sell = get_sell_detail(sell_id, target_user_id)
-                
-                if not sell:
-                    await safe_edit_message(query, f"❌ Không tìm thấy lệnh bán #{sell_id}")
-                    return
-                
-                id, user, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_pct, sell_date, created = sell
-                
-                msg = (f"📝 *LỆNH BÁN #{sell_id}*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"*{symbol}*\n"
-                       f"📅 Ngày bán: {sell_date}\n"
-                       f"📊 Số lượng: `{amount:.4f}`\n"
-                       f"💰 Giá bán: `{fmt_price(sell_price)}`\n"
-                       f"💵 Giá vốn: `{fmt_price(buy_price)}`\n"
-                       f"💎 Giá trị bán: `{fmt_price(total_sold)}`\n"
-                       f"{'✅' if profit>=0 else '❌'} Lợi nhuận: `{fmt_price(profit)}` ({profit_pct:+.2f}%)\n\n"
-                       f"🕐 {format_vn_time()}")
-                
-                keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+    @callback_router.exact("cancel_del_sell")
+    async def cb_cancel_del_sell(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        
+        await safe_edit_message(query, "❌ Đã hủy xóa.")
+        return
 
-            if data.startswith("del_sell_"):
-                sell_id = int(data.replace("del_sell_", ""))
-                
-                keyboard = [[
-                    InlineKeyboardButton("✅ Xác nhận", callback_data=f"confirm_del_sell_{sell_id}"),
-                    InlineKeyboardButton("❌ Hủy", callback_data="cancel_del_sell")
-                ]]
-                
-                await safe_edit_message(query, f"⚠️ *Xác nhận xóa lệnh bán #{sell_id}?*", 
-                                       reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+    @callback_router.prefix("edit_sell_", parse=int)
+    async def cb_edit_sell(update: Update, ctx: ContextTypes.DEFAULT_TYPE, cb):
+        query = cb.query
+        target_user_id = cb.target_user_id
+        
+        sell_id = cb.payload
+        sell = get_sell_detail(sell_id, target_user_id)
+        
+        if not sell:
+            await safe_edit_message(query, f"❌ Không tìm thấy lệnh bán #{sell_id}")
+            return
+        
+        id, user, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_pct, sell_date, created = sell
+        
+        msg = (f"✏️ *SỬA LỆNH BÁN #{sell_id}*\n━━━━━━━━━━━━━━━━\n\n"
+               f"*{symbol}*\n"
+               f"📊 SL hiện tại: `{amount:.4f}`\n"
+               f"💰 Giá hiện tại: `{fmt_price(sell_price)}`\n\n"
+               f"*Nhập lệnh:*\n"
+               f"`/editsell {sell_id} [số lượng mới] [giá mới]`\n\n"
+               f"*Ví dụ:*\n"
+               f"`/editsell {sell_id} 0.3 50000`\n\n"
+               f"🕐 {format_vn_time_short()}")
+        
+        keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_invest")]]
+        await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-            if data.startswith("confirm_del_sell_"):
-                sell_id = int(data.replace("confirm_del_sell_", ""))
-                
-                if delete_sell_history(sell_id, target_user_id):
-                    await safe_edit_message(query, f"✅ *Đã xóa lệnh bán #{sell_id}*")
-                else:
-                    await safe_edit_message(query, f"❌ Không thể xóa lệnh bán #{sell_id}")
+    async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        
+        data = query.data or ''
+        log_callback.debug("🔔 Callback %s từ user %s", data, query.from_user.id)
+        
+        if query.from_user:
+            await touch_user_info(query.from_user)
+        
+        route, payload = callback_router.resolve(data)
+        
+        # mg_/mod_: module riêng tự kiểm tra quyền
+        if route is not None and not route.with_context:
+            await route.handler(update, ctx)
+            return
+        
+        try:
+            cb = await resolve_callback_request(update, ctx, route.permission if route else 'view')
+            if cb is None:
                 return
-
-            if data == "cancel_del_sell":
-                await safe_edit_message(query, "❌ Đã hủy xóa.")
+            
+            if route is None:
+                logger.warning(f"⚠️ Callback không xác định: {data}")
+                await safe_edit_message(query, "❌ Chức năng chưa được hỗ trợ!")
                 return
-
-            if data.startswith("edit_sell_"):
-                sell_id = int(data.replace("edit_sell_", ""))
-                sell = get_sell_detail(sell_id, target_user_id)
-                
-                if not sell:
-                    await safe_edit_message(query, f"❌ Không tìm thấy lệnh bán #{sell_id}")
-                    return
-                
-                id, user, symbol, amount, sell_price, buy_price, total_sold, total_cost, profit, profit_pct, sell_date, created = sell
-                
-                msg = (f"✏️ *SỬA LỆNH BÁN #{sell_id}*\n━━━━━━━━━━━━━━━━\n\n"
-                       f"*{symbol}*\n"
-                       f"📊 SL hiện tại: `{amount:.4f}`\n"
-                       f"💰 Giá hiện tại: `{fmt_price(sell_price)}`\n\n"
-                       f"*Nhập lệnh:*\n"
-                       f"`/editsell {sell_id} [số lượng mới] [giá mới]`\n\n"
-                       f"*Ví dụ:*\n"
-                       f"`/editsell {sell_id} 0.3 50000`\n\n"
-                       f"🕐 {format_vn_time_short()}")
-                
-                keyboard = [[InlineKeyboardButton("🔙 Quay lại", callback_data="back_to_invest")]]
-                await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
+            
+            try:
+                cb.payload = route.parse_payload(payload)
+            except ValueError:
+                await safe_edit_message(query, route.invalid)
                 return
-                
-            # ===========================================
-            # XỬ LÝ CALLBACK KHÔNG XÁC ĐỊNH
-            # ===========================================
             
-            logger.warning(f"⚠️ Callback không xác định: {data}")
-            await safe_edit_message(query, "❌ Chức năng chưa được hỗ trợ!")
+            await route.handler(update, ctx, cb)
             
         except Exception as e:
             logger.error(f"❌ LỖI CALLBACK: {e}", exc_info=True)
@@ -10367,7 +12842,8 @@ try:
         query = update.callback_query
         await query.answer()
         
-        if query.data == "cancel_sell":
+        if query.data.startswith("cancel_sell"):
+            _pending_sells.cache.pop(query.data[len("cancel_sell_"):], None)
             await query.edit_message_text(
                 "❌ Đã hủy lệnh bán.", 
                 reply_markup=InlineKeyboardMarkup([[
@@ -10377,20 +12853,14 @@ try:
             return
         
         if query.data.startswith("confirm_sell_"):
-            # Parse dữ liệu
-            parts = query.data.replace("confirm_sell_", "").split("_")
-            
-            if len(parts) < 3:
-                await query.edit_message_text("❌ Dữ liệu không hợp lệ!")
-                return
-                
-            symbol = parts[0]
-            try:
-                sell_amount = float(parts[1])
-                sell_price = float(parts[2])
-            except ValueError:
-                await query.edit_message_text("❌ Số liệu không hợp lệ!")
+            # Lấy lệnh bán đang chờ theo token (pop để bấm 2 lần không bán 2 lần)
+            token = query.data[len("confirm_sell_"):]
+            pending = _pending_sells.get(token)
+            _pending_sells.cache.pop(token, None)
+            if not pending:
+                await query.edit_message_text("⏰ Lệnh bán đã hết hạn, vui lòng dùng /sell lại!")
                 return
+            symbol, sell_amount, sell_price, method = pending
             
             current_user_id = query.from_user.id
             chat_type = query.message.chat.type
@@ -10404,18 +12874,6 @@ try:
                 is_admin = check_permission(chat_id, current_user_id, 'edit')
                 target_user_id = owner_id if is_admin else current_user_id
             
-            # Lấy portfolio
-            portfolio_data = get_portfolio(target_user_id)
-            portfolio = []
-            for row in portfolio_data:
-                portfolio.append({
-                    'symbol': row[0], 
-                    'amount': row[1], 
-                    'buy_price': row[2], 
-                    'buy_date': row[3], 
-                    'total_cost': row[4]
-                })
-            
             # Lấy giá hiện tại
             price_data = get_price(symbol)
             current_price = price_data['p'] if price_data else 0
@@ -10426,21 +12884,229 @@ try:
             await execute_sell(
                 update, ctx, target_user_id, symbol, 
                 sell_amount, sell_price, current_price, 
-                portfolio, current_user_id
+                current_user_id, method
             )
                     
+    # ==================== UPDATE SCHEDULER ====================
+    # Update của các chat khác nhau chạy song song (tối đa UPDATE_CONCURRENCY),
+    # update trong cùng 1 chat vẫn chạy đúng thứ tự đến. Update chờ khóa chat
+    # không giữ slot worker, nên 1 chat spam không chặn các chat còn lại.
+    UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 8))
+    UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', 256))
+
+    def update_order_key(update):
+        """Khóa tuần tự: theo chat, không có chat thì theo user, None = không cần thứ tự"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+        return None
+
+    class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+        """Song song giữa các chat, tuần tự trong từng chat.
+
+        Semaphore của lớp cha (max_pending) giới hạn số update đã nhận chưa xong;
+        self._workers giới hạn số update thực sự đang chạy handler.
+        """
+
+        def __init__(self, workers=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING):
+            workers = max(1, int(workers))
+            super().__init__(max(workers, int(max_pending)))
+            self.workers = workers
+            self._workers = asyncio.Semaphore(workers)
+            self._chains = {}           # key -> [asyncio.Lock, số update đang giữ/chờ]
+            self.pending = 0
+            self.running = 0
+            self.max_running = 0
+            self.processed = 0
+
+        async def do_process_update(self, update, coroutine):
+            self.pending += 1
+            try:
+                key = update_order_key(update)
+                if key is None:
+                    await self._run(coroutine)
+                    return
+                
+                chain = self._chains.get(key)
+                if chain is None:
+                    chain = self._chains[key] = [asyncio.Lock(), 0]
+                chain[1] += 1
+                try:
+                    # asyncio.Lock đánh thức theo FIFO -> giữ thứ tự trong chat
+                    async with chain[0]:
+                        await self._run(coroutine)
+                finally:
+                    chain[1] -= 1
+                    if chain[1] == 0:
+                        del self._chains[key]
+            finally:
+                self.pending -= 1
+
+        async def _run(self, coroutine):
+            async with self._workers:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def get_stats(self):
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_concurrent_updates,
+                'pending': self.pending,
+                'running': self.running,
+                'max_running': self.max_running,
+                'chats': len(self._chains),
+                'processed': self.processed
+            }
+
+    def build_application(token=None, concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING):
+        """Application.builder() + scheduler theo chat; concurrency=1 giữ kiểu tuần tự mặc định"""
+        builder = (Application.builder().token(token or TELEGRAM_TOKEN)
+                   .request(MeteredHTTPXRequest(connection_pool_size=256))
+                   .get_updates_request(MeteredHTTPXRequest(connection_pool_size=1)))
+        if concurrency > 1:
+            builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(concurrency, max_pending))
+        return builder.build()
+
+    def pending_updates():
+        """Update đang chờ xử lý = còn trong update_queue + đã nhận nhưng chưa xong"""
+        if not app:
+            return 0
+        processor = app.update_processor
+        return app.update_queue.qsize() + getattr(processor, 'pending', 0)
+
+    metrics.gauge('bot_updates_running', 'Updates currently inside a handler',
+                  lambda: getattr(app.update_processor, 'running', 0) if app else 0)
+
+    async def simulate_update_load(processor, updates=500, chats=20, work_ms=20, seed=42):
+        """Bơm update giả qua processor như Application làm (1 task / update)
+        rồi kiểm tra thứ tự xử lý trong từng chat. Không gọi Telegram."""
+        import random
+        from telegram import Message, Chat
+        rng = random.Random(seed)
+        now = datetime.now()
+        seen = {}
+        work_total = 0.0
+        
+        async def handler(chat_id, seq, delay):
+            seen.setdefault(chat_id, []).append(seq)
+            await asyncio.sleep(delay)
+        
+        tasks = []
+        counters = {}
+        start = time.perf_counter()
+        for i in range(updates):
+            chat_id = -1000 - rng.randrange(chats)
+            seq = counters[chat_id] = counters.get(chat_id, 0) + 1
+            delay = work_ms / 1000 * rng.uniform(0.5, 1.5)
+            work_total += delay
+            message = Message(message_id=i, date=now, chat=Chat(id=chat_id, type='group'), text='load')
+            update = Update(update_id=i, message=message)
+            tasks.append(asyncio.create_task(processor.process_update(update, handler(chat_id, seq, delay))))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        
+        violations = sum(
+            1 for order in seen.values()
+            for a, b in zip(order, order[1:]) if b != a + 1
+        )
+        return {
+            'updates': updates,
+            'chats': len(seen),
+            'elapsed_ms': elapsed * 1000,
+            'sequential_ms': work_total * 1000,
+            'speedup': work_total / elapsed if elapsed else 0,
+            'throughput': updates / elapsed if elapsed else 0,
+            'max_running': getattr(processor, 'max_running', 1),
+            'violations': violations
+        }
+
+    @heavy_command
+    async def loadtest_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        """/loadtest [số update] [số chat] [ms/update] - Owner đo scheduler bằng tải giả lập"""
+        if not is_owner(update.effective_user.id):
+            await update.message.reply_text("❌ Chỉ Owner mới có quyền sử dụng lệnh này!")
+            return
+        
+        try:
+            updates = int(ctx.args[0]) if ctx.args else 500
+            chats = int(ctx.args[1]) if len(ctx.args) > 1 else 20
+            work_ms = float(ctx.args[2]) if len(ctx.args) > 2 else 20
+        except ValueError:
+            await update.message.reply_text("❌ /loadtest [số update] [số chat] [ms/update]")
+            return
+        updates = max(1, min(updates, 20000))
+        chats = max(1, min(chats, updates))
+        work_ms = max(0.0, min(work_ms, 500.0))
+        
+        msg = await update.message.reply_text("⏱ Đang chạy tải giả lập...")
+        processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+        result = await simulate_update_load(processor, updates, chats, work_ms)
+        
+        await msg.edit_text(
+            f"⏱ *LOAD TEST SCHEDULER*\n━━━━━━━━━━━━━━━━\n\n"
+            f"• Tải: `{result['updates']}` update / `{result['chats']}` chat / `{work_ms:g} ms`\n"
+            f"• Worker: `{processor.workers}` (đỉnh `{result['max_running']}`)\n"
+            f"• Thời gian: `{result['elapsed_ms']:.0f} ms` (tuần tự ~`{result['sequential_ms']:.0f} ms`)\n"
+            f"• Tăng tốc: `x{result['speedup']:.1f}` | `{result['throughput']:.0f}` update/s\n"
+            f"• Sai thứ tự trong chat: `{result['violations']}`\n\n"
+            f"🕐 {format_vn_time()}",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
     # ==================== WEBHOOK SETUP ====================
+    # Webhook chạy ngay trên event loop của Application (asyncio.start_server):
+    # kiểm tra secret token, đẩy Update vào app.update_queue để PTB tự xử lý,
+    # không còn thread WSGI + run_coroutine_threadsafe cho mỗi update.
+    WEBHOOK_PATH = '/webhook'
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()[:48]
+    WEBHOOK_MAX_QUEUE = int(os.getenv('WEBHOOK_MAX_QUEUE', 200))
+    WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
+    WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', 15))
+    WEBHOOK_RETRY_AFTER = 2
+    WEBHOOK_MAX_HEADERS = 100
+
+    HTTP_REASONS = {
+        200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+        405: 'Method Not Allowed', 413: 'Payload Too Large',
+        500: 'Internal Server Error', 503: 'Service Unavailable'
+    }
+
+    webhook_stats = {'received': 0, 'enqueued': 0, 'rejected_secret': 0, 'rejected_busy': 0, 'bad_request': 0}
+
+    def update_queue_depth():
+        try:
+            return pending_updates()
+        except Exception:
+            return 0
+
     async def setup_webhook():
         try:
             if not render_config.render_url:
                 logger.warning("⚠️ Không có RENDER_EXTERNAL_URL, dùng polling")
                 return False
             
-            webhook_url = f"{render_config.render_url}/webhook"
+            webhook_url = f"{render_config.render_url}{WEBHOOK_PATH}"
             
             await app.bot.delete_webhook(drop_pending_updates=True)
             
-            await app.bot.set_webhook(url=webhook_url, allowed_updates=['message', 'callback_query'], drop_pending_updates=True, max_connections=render_config.get_worker_count())
+            await app.bot.set_webhook(
+                url=webhook_url, allowed_updates=['message', 'callback_query'],
+                drop_pending_updates=True, max_connections=render_config.get_worker_count(),
+                secret_token=WEBHOOK_SECRET
+            )
             
             webhook_info = await app.bot.get_webhook_info()
             logger.info(f"✅ Webhook set: {webhook_url}")
@@ -10451,43 +13117,76 @@ try:
             logger.error(f"❌ Lỗi setup webhook: {e}")
             return False
 
-    @webhook_app.route('/webhook', methods=['POST'])
-    def webhook():
-        try:
-            update = Update.de_json(request.get_json(force=True), app.bot)
-            asyncio.run_coroutine_threadsafe(app.process_update(update), app.loop)
-            return 'OK', 200
-        except Exception as e:
-            logger.error(f"❌ Webhook error: {e}")
-            return 'Error', 500
-
-    @webhook_app.route('/health', methods=['GET'])
-    def health():
-        try:
-            import psutil
-            process = psutil.Process()
-            memory_mb = process.memory_info().rss / 1024 / 1024
-            
-            db_exists = os.path.exists(DB_PATH)
-            db_size = os.path.getsize(DB_PATH) / 1024 if db_exists else 0
-            
-            status = {
-                'status': 'healthy',
-                'time': format_vn_time(),
-                'uptime': time.time() - render_config.start_time,
-                'memory_mb': round(memory_mb, 2),
-                'db_size_kb': round(db_size, 2),
-                'cache_stats': {
-                    'price': price_cache.get_stats(),
-                    'usdt': usdt_cache.get_stats()
-                }
-            }
-            return json.dumps(status), 200, {'Content-Type': 'application/json'}
-        except Exception as e:
-            return json.dumps({'status': 'error', 'message': str(e)}), 500
+    # ----- Nội dung /health, /metrics, / (dùng chung cho cả 2 chế độ) -----
+    def health_status():
+        process = psutil.Process()
+        memory_mb = process.memory_info().rss / 1024 / 1024
+        db_size = os.path.getsize(DB_PATH) / 1024 if os.path.exists(DB_PATH) else 0
+        
+        return {
+            'status': 'healthy' if lifecycle.phase == 'running' else lifecycle.phase,
+            'time': format_vn_time(),
+            'memory_mb': round(memory_mb, 2),
+            'cpu_percent': process.cpu_percent(),
+            'db_size_kb': round(db_size, 2),
+            'cache_stats': {
+                'price': price_cache.get_stats(),
+                'usdt': usdt_cache.get_stats()
+            },
+            'webhook': dict(webhook_stats, queue_depth=update_queue_depth()),
+            'updates': app.update_processor.get_stats() if app and hasattr(app.update_processor, 'get_stats') else {},
+            'lifecycle': lifecycle.get_stats(),
+            'memory': memory_governor.get_stats(),
+            'startup': startup_planner.get_stats(),
+            'maintenance': maintenance_state,
+            'uptime': time.time() - render_config.start_time
+        }
 
-    @webhook_app.route('/', methods=['GET'])
-    def home():
+    def metrics_text():
+        process = psutil.Process()
+        memory_mb = process.memory_info().rss / 1024 / 1024
+        cpu_percent = process.cpu_percent()
+        db_size = os.path.getsize(DB_PATH) / 1024 if os.path.exists(DB_PATH) else 0
+        
+        return f"""# HELP bot_memory Memory usage in MB
+# TYPE bot_memory gauge
+bot_memory {memory_mb}
+
+# HELP bot_cpu CPU usage percent
+# TYPE bot_cpu gauge
+bot_cpu {cpu_percent}
+
+# HELP bot_db_size Database size in KB
+# TYPE bot_db_size gauge
+bot_db_size {db_size}
+
+# HELP bot_uptime Uptime in seconds
+# TYPE bot_uptime counter
+bot_uptime {time.time() - render_config.start_time}
+
+# HELP bot_cache_hits Cache hit rate
+# TYPE bot_cache_hits gauge
+bot_cache_hits_price {price_cache.get_stats()['hit_rate']}
+bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
+
+# HELP bot_update_queue_depth Updates waiting in the Application queue
+# TYPE bot_update_queue_depth gauge
+bot_update_queue_depth {update_queue_depth()}
+
+# HELP bot_webhook_requests Webhook requests by result
+# TYPE bot_webhook_requests counter
+bot_webhook_requests{{result="enqueued"}} {webhook_stats['enqueued']}
+bot_webhook_requests{{result="rejected_secret"}} {webhook_stats['rejected_secret']}
+bot_webhook_requests{{result="rejected_busy"}} {webhook_stats['rejected_busy']}
+bot_webhook_requests{{result="bad_request"}} {webhook_stats['bad_request']}
+
+# HELP bot_log_dropped_total Log records dropped because the log queue was full
+# TYPE bot_log_dropped_total counter
+bot_log_dropped_total {log_queue_handler.dropped}
+
+""" + metrics.render()
+
+    def home_html():
         return f"""
         <html>
             <head><title>Crypto Bot</title></head>
@@ -10496,16 +13195,142 @@ try:
                 <p>Status: <span style="color: green;">Running</span></p>
                 <p>Time: {format_vn_time()}</p>
                 <p>Uptime: {time.time() - render_config.start_time:.0f} seconds</p>
-                <p><a href="/health">Health Check</a></p>
+                <p>
+                    <a href="/health">Health Check (JSON)</a> | 
+                    <a href="/metrics">Metrics (Prometheus)</a>
+                </p>
             </body>
         </html>
         """
 
-    def run_webhook_server():
+    # ----- HTTP server asyncio (webhook mode) -----
+    async def handle_webhook_update(headers, body):
+        """Nhận 1 update từ Telegram. Trả về (status, body, extra_headers)."""
+        webhook_stats['received'] += 1
+        
+        token = headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode('latin-1'), WEBHOOK_SECRET.encode()):
+            webhook_stats['rejected_secret'] += 1
+            return 403, 'Forbidden', None
+        
+        # Backpressure: hàng đợi đầy hoặc đang drain/restart thì trả 503, Telegram sẽ tự gửi lại sau
+        if not lifecycle.accepting() or update_queue_depth() >= WEBHOOK_MAX_QUEUE:
+            webhook_stats['rejected_busy'] += 1
+            return 503, 'Busy', {'Retry-After': str(WEBHOOK_RETRY_AFTER)}
+        
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception as e:
+            webhook_stats['bad_request'] += 1
+            logger.warning(f"⚠️ Webhook payload lỗi: {e}")
+            return 400, 'Bad Request', None
+        
+        await app.update_queue.put(update)
+        webhook_stats['enqueued'] += 1
+        return 200, 'OK', None
+
+    async def route_http(method, path, headers, body):
+        """Trả về (status, body, content_type, extra_headers)"""
+        if path == WEBHOOK_PATH:
+            if method != 'POST':
+                return 405, 'Method Not Allowed', 'text/plain', {'Allow': 'POST'}
+            status, payload, extra = await handle_webhook_update(headers, body)
+            return status, payload, 'text/plain', extra
+        
+        if method not in ('GET', 'HEAD'):
+            return 405, 'Method Not Allowed', 'text/plain', {'Allow': 'GET'}
+        
+        try:
+            if path == '/health':
+                return 200, json.dumps(health_status(), indent=2), 'application/json', None
+            if path == '/metrics':
+                return 200, metrics_text(), 'text/plain; version=0.0.4', None
+            if path == '/':
+                return 200, home_html(), 'text/html; charset=utf-8', None
+        except Exception as e:
+            logger.error(f"❌ HTTP {path} error: {e}")
+            return 500, json.dumps({'status': 'error', 'message': str(e)}), 'application/json', None
+        
+        return 404, 'Not Found', 'text/plain', None
+
+    async def write_http_response(writer, status, body, content_type='text/plain', headers=None, keep_alive=True, head_only=False):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"
+        ]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def serve_http_connection(reader, writer):
+        """1 kết nối keep-alive: Telegram giữ tối đa max_connections kết nối song song"""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), WEBHOOK_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await write_http_response(writer, 400, 'Bad Request', keep_alive=False)
+                    break
+                method, target, version = parts
+                
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), WEBHOOK_READ_TIMEOUT)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    if len(headers) >= WEBHOOK_MAX_HEADERS:
+                        raise ValueError("too many headers")
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    await write_http_response(writer, 400, 'Bad Request', keep_alive=False)
+                    break
+                if length < 0 or length > WEBHOOK_MAX_BODY:
+                    await write_http_response(writer, 413, 'Payload Too Large', keep_alive=False)
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_READ_TIMEOUT) if length else b''
+                
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                path = target.split('?', 1)[0]
+                
+                status, payload, content_type, extra = await route_http(method, path, headers, body)
+                await write_http_response(writer, status, payload, content_type, extra, keep_alive, head_only=(method == 'HEAD'))
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            logger.error(f"❌ Webhook server error: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def start_webhook_server():
         port = int(os.environ.get('PORT', 10000))
-        logger.info(f"🌐 Starting webhook server on port {port}")
-        webhook_app.run(host='0.0.0.0', port=port, threaded=True)
+        server = await asyncio.start_server(serve_http_connection, host='0.0.0.0', port=port)
+        logger.info(f"🌐 Webhook server on port {port} (same loop as Application)")
+        return server
 
+    # ----- Health server cho polling mode -----
     class EnhancedHealthHandler(BaseHTTPRequestHandler):
         def do_GET(self):
             if self.path == '/health':
@@ -10514,27 +13339,7 @@ try:
                 self.end_headers()
                 
                 try:
-                    import psutil
-                    process = psutil.Process()
-                    memory_mb = process.memory_info().rss / 1024 / 1024
-                    cpu_percent = process.cpu_percent()
-                    
-                    db_size = os.path.getsize(DB_PATH) / 1024 if os.path.exists(DB_PATH) else 0
-                    
-                    status = {
-                        'status': 'healthy',
-                        'time': format_vn_time(),
-                        'memory_mb': round(memory_mb, 2),
-                        'cpu_percent': cpu_percent,
-                        'db_size_kb': round(db_size, 2),
-                        'cache_stats': {
-                            'price': price_cache.get_stats(),
-                            'usdt': usdt_cache.get_stats()
-                        },
-                        'uptime': time.time() - render_config.start_time
-                    }
-                    
-                    self.wfile.write(json.dumps(status, indent=2).encode())
+                    self.wfile.write(json.dumps(health_status(), indent=2).encode())
                 except:
                     self.wfile.write(b'{"status": "healthy"}')
             
@@ -10544,34 +13349,7 @@ try:
                 self.end_headers()
                 
                 try:
-                    import psutil
-                    process = psutil.Process()
-                    memory_mb = process.memory_info().rss / 1024 / 1024
-                    cpu_percent = process.cpu_percent()
-                    db_size = os.path.getsize(DB_PATH) / 1024 if os.path.exists(DB_PATH) else 0
-                    
-                    metrics = f"""# HELP bot_memory Memory usage in MB
-# TYPE bot_memory gauge
-bot_memory {memory_mb}
-
-# HELP bot_cpu CPU usage percent
-# TYPE bot_cpu gauge
-bot_cpu {cpu_percent}
-
-# HELP bot_db_size Database size in KB
-# TYPE bot_db_size gauge
-bot_db_size {db_size}
-
-# HELP bot_uptime Uptime in seconds
-# TYPE bot_uptime counter
-bot_uptime {time.time() - render_config.start_time}
-
-# HELP bot_cache_hits Cache hit rate
-# TYPE bot_cache_hits gauge
-bot_cache_hits_price {price_cache.get_stats()['hit_rate']}
-bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
-"""
-                    self.wfile.write(metrics.encode())
+                    self.wfile.write(metrics_text().encode())
                 except:
                     self.wfile.write(b'# No metrics available')
             
@@ -10579,35 +13357,323 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 self.send_response(200)
                 self.send_header('Content-type', 'text/html')
                 self.end_headers()
-                html = f"""
-                <html>
-                    <head><title>Crypto Bot</title></head>
-                    <body>
-                        <h1>🚀 Crypto & Expense Manager Bot</h1>
-                        <p>Status: <span style="color: green;">Running</span></p>
-                        <p>Time: {format_vn_time()}</p>
-                        <p>Uptime: {time.time() - render_config.start_time:.0f} seconds</p>
-                        <p>
-                            <a href="/health">Health Check (JSON)</a> | 
-                            <a href="/metrics">Metrics (Prometheus)</a>
-                        </p>
-                    </body>
-                </html>
-                """
-                self.wfile.write(html.encode())
+                self.wfile.write(home_html().encode())
         
         def log_message(self, format, *args):
             return
 
-    def run_health_server():
-        try:
-            port = int(os.environ.get('PORT', 10000))
-            server = HTTPServer(('0.0.0.0', port), EnhancedHealthHandler)
-            logger.info(f"✅ Health server on port {port}")
-            server.serve_forever()
-        except Exception as e:
-            logger.error(f"❌ Health server error: {e}")
-            time.sleep(10)
+    def run_health_server():
+        try:
+            port = int(os.environ.get('PORT', 10000))
+            server = HTTPServer(('0.0.0.0', port), EnhancedHealthHandler)
+            logger.info(f"✅ Health server on port {port}")
+            server.serve_forever()
+        except Exception as e:
+            logger.error(f"❌ Health server error: {e}")
+            time.sleep(10)
+
+    # ==================== VÒNG ĐỜI & KHỞI ĐỘNG LẠI ====================
+    # Mọi yêu cầu dừng (memory quá ngưỡng, lỗi nặng, SIGTERM) đi qua lifecycle.request_stop().
+    # Session hiện tại ngừng nhận update, xử lý nốt hàng đợi, huỷ timer CAPTCHA (pending vẫn
+    # nằm trong DB), flush buffer + lưu trạng thái rồi dựng Application mới ngay trong process.
+    # Quá RESTART_BUDGET lần trong RESTART_WINDOW giây thì thoát hẳn (exit 1) để Render khởi động lại.
+    RESTART_BUDGET = int(os.environ.get('RESTART_BUDGET', 5))
+    RESTART_WINDOW = int(os.environ.get('RESTART_WINDOW', 3600))
+    RESTART_BACKOFF_MAX = int(os.environ.get('RESTART_BACKOFF_MAX', 60))
+    DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', 20))
+    LIFECYCLE_FILE = os.path.join(DATA_DIR, 'lifecycle.json')
+
+    class Lifecycle:
+        """Phase của process, lý do dừng, ngân sách restart; trạng thái bền lưu ở lifecycle.json"""
+
+        def __init__(self, path):
+            self.path = path
+            self.lock = threading.Lock()
+            self.loop = None
+            self.stop_event = None
+            self.stop_reason = None
+            self.restart = True
+            self.phase = 'starting'     # starting | running | draining | restarting | stopped
+            self.transport = None       # 'webhook' | 'polling', chốt ở session đầu
+            self.session = 0
+            self.session_started = None
+            self.last_drain = None
+            self.state = {'restarts': [], 'history': []}
+            self.load()
+
+        def load(self):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self.state.update(json.load(f))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"⚠️ Không đọc được {self.path}: {e}")
+
+        def save(self):
+            tmp = self.path + '.tmp'
+            try:
+                with self.lock:
+                    data = json.dumps(self.state, ensure_ascii=False)
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except Exception as e:
+                logger.error(f"❌ Lỗi lưu lifecycle: {e}")
+
+        def update_state(self, **values):
+            with self.lock:
+                self.state.update(values)
+            self.save()
+
+        def bind(self, loop):
+            """Gắn vào event loop của supervisor; yêu cầu dừng đến trước đó vẫn được giữ"""
+            self.loop = loop
+            self.stop_event = asyncio.Event()
+            if self.stop_reason:
+                self.stop_event.set()
+
+        def request_stop(self, reason, restart=True):
+            """Gọi được từ mọi thread. Yêu cầu đầu tiên thắng, trừ khi yêu cầu sau là dừng hẳn"""
+            with self.lock:
+                if self.stop_reason and (restart or not self.restart):
+                    return False
+                self.stop_reason, self.restart = reason, restart
+            logger.warning(f"🔁 Yêu cầu dừng: {reason} (restart={restart})")
+            if self.loop and self.stop_event:
+                try:
+                    in_loop = asyncio.get_running_loop() is self.loop
+                except RuntimeError:
+                    in_loop = False
+                if in_loop:
+                    self.stop_event.set()
+                else:
+                    self.loop.call_soon_threadsafe(self.stop_event.set)
+            return True
+
+        def accepting(self):
+            return self.phase == 'running'
+
+        async def wait_stop(self, timeout):
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+        def begin_session(self):
+            with self.lock:
+                self.session += 1
+                self.session_started = time.time()
+                self.stop_reason, self.restart = None, True
+                self.last_drain = None
+            self.stop_event.clear()
+
+        def recent_restarts(self):
+            cutoff = time.time() - RESTART_WINDOW
+            return [t for t in self.state['restarts'] if t >= cutoff]
+
+        def consume_budget(self, reason):
+            """Ghi nhận 1 lần restart; False nếu đã hết ngân sách trong cửa sổ"""
+            with self.lock:
+                recent = self.recent_restarts()
+                allowed = len(recent) < RESTART_BUDGET
+                if allowed:
+                    recent.append(time.time())
+                self.state['restarts'] = recent
+                self.state['history'] = (self.state['history'] + [{
+                    'time': format_vn_time(), 'session': self.session, 'reason': reason,
+                    'allowed': allowed, 'drain': self.last_drain}])[-20:]
+            self.save()
+            return allowed
+
+        def get_stats(self):
+            return {
+                'phase': self.phase,
+                'transport': self.transport,
+                'session': self.session,
+                'session_uptime': round(time.time() - self.session_started, 1) if self.session_started else 0,
+                'restarts_in_window': len(self.recent_restarts()),
+                'restart_budget': RESTART_BUDGET,
+                'restart_window_sec': RESTART_WINDOW,
+                'stop_reason': self.stop_reason,
+                'last_drain': self.last_drain,
+                'history': self.state['history'][-5:],
+            }
+
+    lifecycle = Lifecycle(LIFECYCLE_FILE)
+    metrics.gauge('bot_restart_budget_remaining', 'In-process restarts left in the current window',
+                  lambda: RESTART_BUDGET - len(lifecycle.recent_restarts()))
+
+    def release_memory():
+        """Xả cache + flood tracker trong RAM (dữ liệu gốc vẫn ở DB/API), trả về số object gc thu hồi"""
+        for cache in (price_cache, usdt_cache, _user_touch_cache, _feature_cache,
+                      _chat_admins_cache, _master_of_cache):
+            cache.clear()
+        username_cache.clear()
+        _flood_tracker.clear()
+        return gc.collect()
+
+    def flush_runtime_state(free_memory=False):
+        """Ghi nốt buffer xuống DB/đĩa trước khi bỏ Application cũ"""
+        price_history.flush()
+        if free_memory:
+            release_memory()
+        for handler in log_listener.handlers:
+            handler.flush()
+        lifecycle.save()
+
+    async def cancel_update_tasks(timeout=5):
+        """Huỷ các task PTB đang xử lý update của app (khi drain quá hạn), trả về số task đã huỷ"""
+        prefix = f"Application:{app.bot.id}:"
+        tasks = [task for task in asyncio.all_tasks()
+                 if task.get_name().startswith(prefix) and task is not asyncio.current_task() and not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        return len(tasks)
+
+    async def drain_session():
+        """Ngừng nhận update, xử lý nốt hàng đợi trong DRAIN_TIMEOUT, flush trạng thái"""
+        lifecycle.phase = 'draining'
+        started = time.perf_counter()
+        pending = pending_updates()
+        if app.updater.running:
+            await app.updater.stop()
+        timers = cancel_captcha_timers()    # app.stop() sẽ chờ các task này nếu không huỷ
+        timed_out = False
+        cancelled = 0
+        if app.running:
+            try:
+                await asyncio.wait_for(app.stop(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.warning(f"⚠️ Drain quá {DRAIN_TIMEOUT:g}s, bỏ {pending_updates()} update còn lại")
+                # Handler còn treo thì huỷ hẳn, không để chạy tiếp trên Application đã shutdown
+                cancelled = await cancel_update_tasks()
+        flush_runtime_state(free_memory=(lifecycle.stop_reason or '').startswith('memory'))
+        lifecycle.last_drain = {'pending': pending, 'captcha_timers': timers, 'timed_out': timed_out,
+                                'cancelled': cancelled, 'seconds': round(time.perf_counter() - started, 2)}
+        logger.info(f"🧹 Drain xong: {lifecycle.last_drain}")
+
+    async def run_session(webhook_mode):
+        """1 vòng đời Application: start → nhận update → drain khi có yêu cầu dừng"""
+        first = lifecycle.transport is None
+        async with app:
+            await app.start()
+            # Lỗi ở bất kỳ bước nào sau start() vẫn phải stop updater/app trước khi shutdown
+            try:
+                restore_captcha_timers(app)
+                if first:
+                    lifecycle.transport = 'webhook' if webhook_mode and await setup_webhook() else 'polling'
+                    if webhook_mode and lifecycle.transport == 'polling':
+                        # Vẫn giữ server cho /health, nhận update bằng polling
+                        logger.warning("⚠️ Webhook lỗi, chuyển sang polling")
+                if lifecycle.transport == 'polling':
+                    # Session sau không bỏ update tồn: đó chính là update bị dừng giữa chừng
+                    await app.updater.start_polling(timeout=30, drop_pending_updates=first)
+                lifecycle.phase = 'running'
+                await lifecycle.stop_event.wait()   # memory_monitor (thread) lo việc lấy mẫu RSS
+            finally:
+                await drain_session()
+
+    async def run_supervised(webhook_mode):
+        """Giữ process sống qua các session, trả về exit code"""
+        global app
+        loop = asyncio.get_running_loop()
+        lifecycle.bind(loop)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, lifecycle.request_stop, sig.name, False)
+            except (NotImplementedError, RuntimeError):
+                pass
+        server = await start_webhook_server() if webhook_mode else None
+        exit_code = 0
+        try:
+            while True:
+                lifecycle.begin_session()
+                try:
+                    await run_session(webhook_mode)
+                except Exception as e:
+                    logger.error(f"❌ Session {lifecycle.session} lỗi: {e}", exc_info=True)
+                    lifecycle.request_stop(f"crash: {type(e).__name__}: {e}", restart=True)
+                if not lifecycle.restart:
+                    logger.info(f"👋 Dừng bot: {lifecycle.stop_reason}")
+                    break
+                if not lifecycle.consume_budget(lifecycle.stop_reason):
+                    logger.critical(f"💥 Hết ngân sách restart ({RESTART_BUDGET} lần/{RESTART_WINDOW}s), thoát")
+                    exit_code = 1
+                    break
+                lifecycle.phase = 'restarting'
+                backoff = min(RESTART_BACKOFF_MAX, 2 ** (len(lifecycle.recent_restarts()) - 1))
+                logger.warning(f"🔁 Restart session {lifecycle.session + 1} sau {backoff}s ({lifecycle.stop_reason})")
+                lifecycle.stop_event.clear()
+                if await lifecycle.wait_stop(backoff) and not lifecycle.restart:
+                    logger.info(f"👋 Dừng bot: {lifecycle.stop_reason}")
+                    break
+                app = create_application()
+        finally:
+            lifecycle.phase = 'stopped'
+            if server:
+                server.close()
+                await server.wait_closed()
+            lifecycle.save()
+        return exit_code
+
+    # ==================== FAN-OUT EXECUTOR ====================
+    # Chạy 1 lệnh Telegram (ban/unban/...) trên nhiều nhóm cùng lúc: giới hạn số
+    # lệnh song song, chờ đúng retry_after khi dính 429, retry lỗi mạng có backoff.
+
+    FANOUT_CONCURRENCY = int(os.environ.get('FANOUT_CONCURRENCY', 10))
+    FANOUT_MAX_RETRIES = 3
+
+    async def fanout_execute(chat_ids, action, concurrency=None, max_retries=FANOUT_MAX_RETRIES, progress=None):
+        """Gọi `await action(chat_id)` cho mọi chat, tối đa `concurrency` lệnh cùng lúc.
+        `progress(summary)` (nếu có) được gọi sau mỗi chat hoàn tất.
+
+        Returns: {'total': int, 'success': int, 'failed': {chat_id: lỗi}, 'retries': int}
+        """
+        targets = list(dict.fromkeys(chat_ids))
+        sem = asyncio.Semaphore(concurrency or FANOUT_CONCURRENCY)
+        summary = {'total': len(targets), 'success': 0, 'failed': {}, 'retries': 0}
+
+        async def run_one(chat_id):
+            async with sem:
+                await attempt_all(chat_id)
+            if progress:
+                progress(summary)
+
+        async def attempt_all(chat_id):
+            for attempt in range(max_retries + 1):
+                try:
+                    await action(chat_id)
+                    summary['success'] += 1
+                    return
+                except RetryAfter as e:
+                    # Flood control của Telegram → chờ đúng thời gian được yêu cầu
+                    delay, error = e.retry_after + 0.5, e
+                except BadRequest as e:
+                    # BadRequest kế thừa NetworkError nhưng là lỗi vĩnh viễn
+                    summary['failed'][chat_id] = str(e)
+                    return
+                except NetworkError as e:
+                    delay, error = 0.5 * 2 ** attempt, e
+                except Exception as e:
+                    # Forbidden (bot bị kick, đã rời nhóm...) → không retry
+                    summary['failed'][chat_id] = str(e)
+                    return
+                if attempt == max_retries:
+                    summary['failed'][chat_id] = str(error)
+                    return
+                summary['retries'] += 1
+                await asyncio.sleep(delay)
+
+        await asyncio.gather(*(run_one(cid) for cid in targets))
+        if summary['failed']:
+            logger.warning(f"⚠️ Fan-out: {summary['success']}/{summary['total']} OK, "
+                           f"{len(summary['failed'])} lỗi, {summary['retries']} retry")
+        return summary
 
     # ==================== MULTI-GROUP MANAGEMENT SYSTEM ====================
 
@@ -10654,19 +13720,20 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_set_master(group_id, group_name, set_by):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT OR REPLACE INTO master_groups (group_id, group_name, set_by, created_at)
                          VALUES (?, ?, ?, ?)''',
                       (group_id, group_name, set_by, get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
             conn.commit(); conn.close()
+            _master_of_cache.clear()
             return True
         except Exception as e:
             logger.error(f"❌ mg_set_master: {e}"); return False
 
     def mg_is_master(group_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT group_id FROM master_groups WHERE group_id = ?", (group_id,))
             r = c.fetchone(); conn.close(); return r is not None
@@ -10674,7 +13741,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_get_master_of_child(child_group_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT master_group_id FROM group_hierarchy WHERE child_group_id = ?", (child_group_id,))
             r = c.fetchone(); conn.close()
@@ -10683,7 +13750,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_add_child(master_id, child_id, child_name, level, added_by):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT OR REPLACE INTO group_hierarchy
                          (master_group_id, child_group_id, child_group_name, autonomy_level, added_by, created_at)
@@ -10691,6 +13758,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                       (master_id, child_id, child_name, level, added_by,
                        get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
             conn.commit(); conn.close()
+            _master_of_cache.clear()
             mg_apply_preset(child_id, level, added_by)
             return True
         except Exception as e:
@@ -10698,17 +13766,19 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_remove_child(master_id, child_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("DELETE FROM group_hierarchy WHERE master_group_id=? AND child_group_id=?",
                       (master_id, child_id))
-            conn.commit(); conn.close(); return True
+            conn.commit(); conn.close()
+            _master_of_cache.clear()
+            return True
         except Exception as e:
             logger.error(f"❌ mg_remove_child: {e}"); return False
 
     def mg_get_children(master_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT child_group_id, child_group_name, autonomy_level, created_at
                          FROM group_hierarchy WHERE master_group_id=? ORDER BY autonomy_level DESC''', (master_id,))
@@ -10717,35 +13787,58 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_set_feature(group_id, feature_key, is_enabled, set_by):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT OR REPLACE INTO group_features (group_id, feature_key, is_enabled, set_by, updated_at)
                          VALUES (?, ?, ?, ?, ?)''',
                       (group_id, feature_key, 1 if is_enabled else 0, set_by,
                        get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
-            conn.commit(); conn.close(); return True
+            conn.commit(); conn.close()
+            cached = _feature_cache.get(group_id)
+            if cached is not None:
+                cached[feature_key] = bool(is_enabled)
+            return True
         except Exception as e:
             logger.error(f"❌ mg_set_feature: {e}"); return False
 
+    # Cache feature theo nhóm: {group_id: {feature_key: bool}}
+    _feature_cache = AdvancedCache('features', max_size=500, ttl=300)
+
+    def _mg_load_features(group_ids):
+        """Nạp feature của các nhóm chưa có trong cache bằng 1 query"""
+        missing = [gid for gid in dict.fromkeys(group_ids) if _feature_cache.get(gid) is None]
+        if not missing:
+            return
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        loaded = {gid: {} for gid in missing}
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            c.execute(f"SELECT group_id, feature_key, is_enabled FROM group_features WHERE group_id IN ({','.join('?' * len(chunk))})",
+                      chunk)
+            for gid, key, enabled in c.fetchall():
+                loaded[gid][key] = bool(enabled)
+        conn.close()
+        for gid, features in loaded.items():
+            _feature_cache.set(gid, features)
+
     def mg_has_feature(group_id, feature_key):
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT is_enabled FROM group_features WHERE group_id=? AND feature_key=?",
-                      (group_id, feature_key))
-            r = c.fetchone(); conn.close()
-            return r is not None and r[0] == 1
-        except: return False
+        return mg_get_features(group_id).get(feature_key, False)
 
     def mg_get_features(group_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT feature_key, is_enabled FROM group_features WHERE group_id=?", (group_id,))
-            rows = c.fetchall(); conn.close()
-            return {row[0]: bool(row[1]) for row in rows}
+            _mg_load_features([group_id])
+            return dict(_feature_cache.get(group_id) or {})
         except: return {}
 
+    def mg_filter_feature(group_ids, feature_key):
+        """Lọc các nhóm đang bật feature, nạp cache cho cả danh sách trong 1 lượt"""
+        try:
+            _mg_load_features(group_ids)
+        except Exception as e:
+            logger.error(f"❌ mg_filter_feature: {e}"); return []
+        return [gid for gid in group_ids if (_feature_cache.get(gid) or {}).get(feature_key, False)]
+
     def mg_apply_preset(group_id, level, set_by):
         enabled = AUTONOMY_PRESETS.get(level, [])
         for key in FEATURE_CATALOG:
@@ -10754,7 +13847,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_cross_ban(master_id, banned_user_id, banned_by, reason=""):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT OR REPLACE INTO cross_bans
                          (master_group_id, banned_user_id, banned_by, reason, banned_at, is_active)
@@ -10767,7 +13860,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_cross_unban(master_id, banned_user_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("UPDATE cross_bans SET is_active=0 WHERE master_group_id=? AND banned_user_id=?",
                       (master_id, banned_user_id))
@@ -10782,7 +13875,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         if not master_id:
             return False
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT id FROM cross_bans WHERE master_group_id=? AND banned_user_id=? AND is_active=1''',
                       (master_id, user_id))
@@ -10791,55 +13884,144 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     def mg_get_ban_list(master_id):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''SELECT banned_user_id, banned_by, reason, banned_at FROM cross_bans
                          WHERE master_group_id=? AND is_active=1 ORDER BY banned_at DESC''', (master_id,))
             rows = c.fetchall(); conn.close(); return rows
         except: return []
 
-    async def mg_broadcast(context, master_id, message, sent_by, target_ids=None, photo_id=None, caption=None):
+    # ── Broadcast jobs ──────────────────────────────────────────────
+    # Telegram giới hạn ~30 tin/s toàn bot và ~20 tin/phút mỗi nhóm. Broadcast chạy
+    # nền, gửi song song nhưng mỗi tin phải lấy token từ bucket toàn cục trước.
+
+    BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))   # tin/giây, chừa biên dưới 30
+    BROADCAST_CHAT_INTERVAL = 3.0                                 # giây giữa 2 tin cùng 1 nhóm
+
+    class TokenBucket:
+        """Token bucket cho asyncio: acquire() chờ tới khi có token"""
+
+        def __init__(self, rate, capacity=None):
+            self.rate = rate
+            self.capacity = capacity or rate
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+            self.lock = asyncio.Lock()
+
+        async def acquire(self):
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    _send_bucket = TokenBucket(BROADCAST_RATE)
+    _chat_next_send = {}   # {chat_id: monotonic time được phép gửi tiếp}
+    _broadcast_jobs = {}   # {master_id: {'total', 'done', 'success', 'fail', 'started_at'}}
+
+    async def _rate_limited_send(chat_id, send):
+        """Chờ slot của nhóm + token toàn cục rồi mới gửi"""
+        now = time.monotonic()
+        slot = max(now, _chat_next_send.get(chat_id, 0))
+        _chat_next_send[chat_id] = slot + BROADCAST_CHAT_INTERVAL
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await _send_bucket.acquire()
+        return await send()
+
+    async def mg_broadcast(context, master_id, message, sent_by, target_ids=None, photo_id=None, caption=None,
+                           on_progress=None):
         """Gửi broadcast text hoặc ảnh+caption đến các nhóm con"""
         children = mg_get_children(master_id)
-        targets = [(cid, cname) for cid, cname, _, _ in children
-                   if (target_ids is None or cid in target_ids) and mg_has_feature(cid, "broadcast_recv")]
-        success = fail = 0
+        names = {cid: cname for cid, cname, _, _ in children
+                 if target_ids is None or cid in target_ids}
+        targets = mg_filter_feature(list(names), "broadcast_recv")
         header = "📢 *THÔNG BÁO TỪ NHÓM TỔNG*\n━━━━━━━━━━━━━━━━\n\n"
         footer = f"\n\n🕐 {format_vn_time()}"
-        for child_id, child_name in targets:
-            try:
-                if photo_id:
-                    # Gửi ảnh kèm caption
-                    cap = header + (caption or "") + footer
-                    await context.bot.send_photo(
-                        chat_id=child_id,
-                        photo=photo_id,
-                        caption=cap,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    full_msg = header + message + footer
-                    await context.bot.send_message(
-                        chat_id=child_id,
-                        text=full_msg,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                success += 1
-            except Exception as e:
-                fail += 1
-                logger.error(f"❌ Broadcast failed → {child_name}: {e}")
+
+        def send_to(child_id):
+            if photo_id:
+                # Gửi ảnh kèm caption
+                cap = header + (caption or "") + footer
+                return _rate_limited_send(child_id, lambda: context.bot.send_photo(
+                    chat_id=child_id, photo=photo_id, caption=cap, parse_mode=ParseMode.MARKDOWN))
+            full_msg = header + message + footer
+            return _rate_limited_send(child_id, lambda: context.bot.send_message(
+                chat_id=child_id, text=full_msg, parse_mode=ParseMode.MARKDOWN))
+
+        result = await fanout_execute(targets, send_to, concurrency=max(1, int(BROADCAST_RATE)),
+                                      progress=on_progress)
+        success, fail = result['success'], len(result['failed'])
+        for child_id, err in result['failed'].items():
+            logger.error(f"❌ Broadcast failed → {names.get(child_id, child_id)}: {err}")
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT INTO broadcasts (master_group_id, message, sent_by, target_groups, sent_at, success_count, fail_count)
                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (master_id, caption or message, sent_by, ",".join(str(t[0]) for t in targets),
+                      (master_id, caption or message, sent_by, ",".join(str(t) for t in targets),
                        get_vn_time().strftime("%Y-%m-%d %H:%M:%S"), success, fail))
             conn.commit(); conn.close()
         except Exception as e:
             logger.error(f"❌ Lưu broadcast history: {e}")
         return success, fail
 
+    def mg_start_broadcast_job(context, progress_msg, master_id, message, sent_by, target_ids=None,
+                               photo_id=None, caption=None):
+        """Chạy broadcast nền, cập nhật tiến độ vào progress_msg. False nếu master đang có job chạy."""
+        if master_id in _broadcast_jobs:
+            return False
+        job = {'total': 0, 'done': 0, 'success': 0, 'fail': 0, 'started_at': time.time()}
+        _broadcast_jobs[master_id] = job
+        preview = escape_markdown((caption or message or "")[:80])
+
+        def on_progress(summary):
+            job['total'] = summary['total']
+            job['success'] = summary['success']
+            job['fail'] = len(summary['failed'])
+            job['done'] = job['success'] + job['fail']
+
+        async def report_progress():
+            last = None
+            while True:
+                await asyncio.sleep(3)
+                text = (f"📤 *Đang gửi broadcast...*\n\n"
+                        f"📊 {job['done']}/{job['total']} nhóm\n"
+                        f"✅ {job['success']} | ❌ {job['fail']}")
+                if text != last:
+                    try:
+                        await progress_msg.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+                    except Exception:
+                        pass
+                    last = text
+
+        async def run():
+            reporter = asyncio.create_task(report_progress())
+            try:
+                success, fail = await mg_broadcast(context, master_id, message, sent_by, target_ids,
+                                                   photo_id=photo_id, caption=caption, on_progress=on_progress)
+                elapsed = time.time() - job['started_at']
+                reporter.cancel()
+                await progress_msg.edit_text(
+                    f"📢 *KẾT QUẢ BROADCAST*\n━━━━━━━━━━━━━━━━\n\n"
+                    f"✅ Thành công: *{success}* nhóm\n"
+                    f"❌ Thất bại: *{fail}* nhóm\n"
+                    f"⏱ Thời gian: {elapsed:.1f}s\n\n"
+                    f"📝 _{preview}_\n\n"
+                    f"🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
+            except Exception as e:
+                logger.error(f"❌ Broadcast job {master_id}: {e}")
+            finally:
+                reporter.cancel()
+                _broadcast_jobs.pop(master_id, None)
+
+        context.application.create_task(run())
+        return True
+
     # ── Commands ────────────────────────────────────────────────────
 
     async def mg_setmaster_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -11038,27 +14220,18 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         reason = " ".join(context.args[1:]) if len(context.args) > 1 else "Không có lý do"
         if mg_cross_ban(chat_id, target_id, user_id, reason):
             children = mg_get_children(chat_id)
-            kicked = 0
-            # Kick khỏi nhóm tổng
-            try:
-                await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
-                kicked += 1
-                logger.info(f"🚫 Kicked {target_id} from master {chat_id}")
-            except Exception as e:
-                logger.warning(f"⚠️ Không kick được {target_id} khỏi nhóm tổng: {e}")
-            # Kick khỏi tất cả nhóm con
-            for child_id, _, _, _ in children:
-                try:
-                    await context.bot.ban_chat_member(chat_id=child_id, user_id=target_id)
-                    kicked += 1
-                except Exception as e:
-                    logger.warning(f"⚠️ Không kick được {target_id} khỏi {child_id}: {e}")
-            total_groups = len(children) + 1  # +1 nhóm tổng
+            # Kick khỏi nhóm tổng + tất cả nhóm con song song
+            group_ids = [chat_id] + [child_id for child_id, _, _, _ in children]
+            result = await fanout_execute(
+                group_ids, lambda gid: context.bot.ban_chat_member(chat_id=gid, user_id=target_id))
+            logger.info(f"🚫 Crossban {target_id}: {result['success']}/{result['total']} nhóm")
+            fail_line = f"⚠️ Lỗi: *{len(result['failed'])}* nhóm\n" if result['failed'] else ""
             await update.message.reply_text(
                 f"🚫 *ĐÃ BAN XUYÊN NHÓM*\n━━━━━━━━━━━━━━━━\n\n"
                 f"👤 User ID: `{target_id}`\n"
                 f"📝 Lý do: {escape_markdown(reason)}\n"
-                f"👢 Kicked: *{kicked}*/{total_groups} nhóm (tổng + con)\n\n"
+                f"👢 Kicked: *{result['success']}*/{result['total']} nhóm (tổng + con)\n"
+                f"{fail_line}\n"
                 f"Gỡ ban: `/crossunban {target_id}`\n🕐 {format_vn_time()}",
                 parse_mode=ParseMode.MARKDOWN)
         else:
@@ -11081,17 +14254,13 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("❌ user_id phải là số!"); return
         if mg_cross_unban(chat_id, target_id):
             children = mg_get_children(chat_id)
-            unbanned = 0
-            for child_id, _, _, _ in children:
-                try:
-                    await context.bot.unban_chat_member(chat_id=child_id, user_id=target_id)
-                    unbanned += 1
-                except Exception as e:
-                    logger.warning(f"⚠️ Không unban được {target_id} khỏi {child_id}: {e}")
+            result = await fanout_execute(
+                [child_id for child_id, _, _, _ in children],
+                lambda gid: context.bot.unban_chat_member(chat_id=gid, user_id=target_id))
             await update.message.reply_text(
                 f"✅ *ĐÃ GỠ BAN XUYÊN NHÓM*\n━━━━━━━━━━━━━━━━\n\n"
                 f"👤 User ID: `{target_id}`\n"
-                f"🔓 Unban ở: *{unbanned}*/{len(children)} nhóm\n🕐 {format_vn_time()}",
+                f"🔓 Unban ở: *{result['success']}*/{result['total']} nhóm\n🕐 {format_vn_time()}",
                 parse_mode=ParseMode.MARKDOWN)
         else:
             await update.message.reply_text("❌ Lỗi gỡ ban!")
@@ -11196,9 +14365,9 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         selected = draft.get('targets', set())
 
         keyboard = []
+        recv_ids = set(mg_filter_feature([cid for cid, _, _, _ in children], "broadcast_recv"))
         for cid, cname, level, _ in children:
-            is_recv = mg_has_feature(cid, "broadcast_recv")
-            if not is_recv:
+            if cid not in recv_ids:
                 continue  # Bỏ qua nhóm không bật nhận broadcast
             icon = "✅" if cid in selected else "⬜"
             short_name = cname[:20] + "..." if len(cname) > 20 else cname
@@ -11216,7 +14385,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             return
 
         # Nút chọn tất cả / bỏ tất cả
-        all_ids = {cid for cid, _, _, _ in children if mg_has_feature(cid, "broadcast_recv")}
+        all_ids = recv_ids
         all_selected = all_ids == selected
         keyboard.append([
             InlineKeyboardButton(
@@ -11245,6 +14414,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         else:
             await message_or_query.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
 
+    @callback_router.prefix("mg_", with_context=False, permission=None)
     async def handle_mg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Xử lý tất cả callback mg_* của multi-group system"""
         query = update.callback_query
@@ -11303,7 +14473,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         elif data.startswith("mg_broadcast_panel_"):
             master_id = int(data[len("mg_broadcast_panel_"):])
             children = mg_get_children(master_id)
-            recv = sum(1 for cid, _, _, _ in children if mg_has_feature(cid, "broadcast_recv"))
+            recv = len(mg_filter_feature([cid for cid, _, _, _ in children], "broadcast_recv"))
             msg = (f"📢 *BROADCAST PANEL*\n━━━━━━━━━━━━━━━━\n\n"
                    f"Nhóm con: *{len(children)}*\n"
                    f"Có thể nhận: *{recv}*\n\n"
@@ -11369,7 +14539,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             master_id = draft['master_id']
             children = mg_get_children(master_id)
             if action == 'select':
-                draft['targets'] = {cid for cid, _, _, _ in children if mg_has_feature(cid, "broadcast_recv")}
+                draft['targets'] = set(mg_filter_feature([cid for cid, _, _, _ in children], "broadcast_recv"))
             else:
                 draft['targets'] = set()
             await _mg_send_broadcast_panel(query, draft_key, children, draft['msg'], edit=True)
@@ -11389,19 +14559,17 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             caption = draft.get('caption')
             # Nếu chưa chọn nhóm nào → gửi tất cả
             target_ids = draft['targets'] if draft['targets'] else None
+            if master_id in _broadcast_jobs:
+                await query.answer("⏳ Đang có broadcast chạy, vui lòng chờ!", show_alert=True); return
             children = mg_get_children(master_id)
-            target_count = len(target_ids) if target_ids else sum(
-                1 for cid, _, _, _ in children if mg_has_feature(cid, "broadcast_recv"))
+            target_count = len(target_ids) if target_ids else len(
+                mg_filter_feature([cid for cid, _, _, _ in children], "broadcast_recv"))
             type_icon = "🖼" if photo_id else "📝"
             await safe_edit_message(query, f"📤 *Đang gửi {type_icon} đến {target_count} nhóm...*")
-            success, fail = await mg_broadcast(context, master_id, message_text, user_id, target_ids, photo_id=photo_id, caption=caption)
+            # Gửi chạy nền, handler trả về ngay; kết quả được cập nhật vào chính tin nhắn này
+            mg_start_broadcast_job(context, query.message, master_id, message_text, user_id, target_ids,
+                                   photo_id=photo_id, caption=caption)
             _broadcast_drafts.pop(draft_key, None)
-            await safe_edit_message(query,
-                f"📢 *KẾT QUẢ BROADCAST*\n━━━━━━━━━━━━━━━━\n\n"
-                f"✅ Thành công: *{success}* nhóm\n"
-                f"❌ Thất bại: *{fail}* nhóm\n\n"
-                f"📝 _{escape_markdown(message_text[:80])}_\n\n"
-                f"🕐 {format_vn_time()}")
 
         elif data.startswith("mg_bc_cancel_"):
             import re as _re
@@ -11413,131 +14581,283 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     # ==================== MODERATION: DATABASE TABLES ====================
 
-    def mod_init_tables():
-        """Khởi tạo tất cả bảng cho hệ thống moderation"""
+    _MOD_DURATION_UNITS = {'s': 1, 'giây': 1, 'm': 60, 'phút': 60, 'h': 3600, 'giờ': 3600, 'd': 86400, 'ngày': 86400}
+
+    def mod_last_mutes(c):
+        """Mute mới nhất chưa bị unmute của từng (group, user):
+        (group_id, target_user, action_by, action, reason, extra, created_at)"""
+        c.execute('''SELECT l.group_id, l.target_user, l.action_by, l.action, l.reason, l.extra, l.created_at
+                     FROM mod_logs l
+                     WHERE l.action IN ('mute','auto_mute','auto_mute_flood')
+                     AND l.created_at = (SELECT MAX(created_at) FROM mod_logs
+                                         WHERE group_id=l.group_id AND target_user=l.target_user
+                                         AND action IN ('mute','auto_mute','auto_mute_flood','unmute'))''')
+        return c.fetchall()
+
+    def mod_log_mute_expiry(action, extra, created_at):
+        """(có seed không, expires_at epoch UTC | None = vĩnh viễn) cho 1 dòng mute trong mod_logs.
+        extra là thời lượng đã ghi ("30phút", "1h", "vĩnh viễn"); flood mute không ghi thời lượng thì bỏ qua."""
+        extra = (extra or '').strip().lower()
+        if extra in ('', 'vĩnh viễn'):
+            return action != 'auto_mute_flood', None
+        m = re.match(r'^(\d+)\s*(giây|phút|giờ|ngày|s|m|h|d)$', extra)
+        if not m:
+            return False, None
         try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-
-            # Cảnh cáo (Warns)
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_warns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER, user_id INTEGER,
-                reason TEXT, warned_by INTEGER,
-                created_at TEXT
-            )''')
-            # Cấu hình warn: max warn, action khi đạt max
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_warn_config (
-                group_id INTEGER PRIMARY KEY,
-                max_warns INTEGER DEFAULT 3,
-                action TEXT DEFAULT 'mute',
-                mute_duration INTEGER DEFAULT 3600
-            )''')
-            # Chào mừng tùy chỉnh
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_welcome (
-                group_id INTEGER PRIMARY KEY,
-                message TEXT,
-                enabled INTEGER DEFAULT 1,
-                set_by INTEGER, updated_at TEXT
-            )''')
-            # Nội quy nhóm
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_rules (
-                group_id INTEGER PRIMARY KEY,
-                rules TEXT,
-                set_by INTEGER, updated_at TEXT
-            )''')
-            # Lọc từ khóa
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_filters (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER, keyword TEXT,
-                action TEXT DEFAULT 'delete',
-                reply TEXT,
-                added_by INTEGER, created_at TEXT,
-                UNIQUE(group_id, keyword)
-            )''')
-            # Lệnh tùy chỉnh
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_commands (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER, command TEXT,
-                response TEXT,
-                added_by INTEGER, created_at TEXT,
-                UNIQUE(group_id, command)
-            )''')
-            # Anti-flood config
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_flood_config (
-                group_id INTEGER PRIMARY KEY,
-                enabled INTEGER DEFAULT 0,
-                max_msgs INTEGER DEFAULT 5,
-                interval_sec INTEGER DEFAULT 5,
-                action TEXT DEFAULT 'mute',
-                mute_duration INTEGER DEFAULT 300
-            )''')
-            # Anti-flood tracking (RAM only, không lưu DB)
-            # CAPTCHA config
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_captcha_config (
-                group_id INTEGER PRIMARY KEY,
-                enabled INTEGER DEFAULT 0,
-                captcha_type TEXT DEFAULT 'button',
-                timeout_sec INTEGER DEFAULT 60
-            )''')
-            # CAPTCHA pending
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_captcha_pending (
-                group_id INTEGER, user_id INTEGER,
-                answer TEXT, expires_at TEXT,
-                message_id INTEGER,
-                PRIMARY KEY (group_id, user_id)
-            )''')
-            # Admin logs
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER, action_by INTEGER,
-                target_user INTEGER, action TEXT,
-                reason TEXT, extra TEXT,
-                created_at TEXT
-            )''')
-            # Report
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER, reporter_id INTEGER,
-                target_user INTEGER, message_id INTEGER,
-                reason TEXT, status TEXT DEFAULT 'pending',
-                created_at TEXT
-            )''')
-            # Federation
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_federations (
-                fed_id TEXT PRIMARY KEY,
-                fed_name TEXT,
-                owner_id INTEGER,
-                created_at TEXT
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_fed_members (
-                fed_id TEXT, group_id INTEGER,
-                joined_at TEXT,
-                PRIMARY KEY (fed_id, group_id)
-            )''')
-            c.execute('''CREATE TABLE IF NOT EXISTS mod_fed_bans (
-                fed_id TEXT, user_id INTEGER,
-                reason TEXT, banned_by INTEGER,
-                banned_at TEXT,
-                PRIMARY KEY (fed_id, user_id)
-            )''')
-
-            conn.commit()
-            conn.close()
-            logger.info("✅ Moderation tables initialized")
-        except Exception as e:
-            logger.error(f"❌ mod_init_tables: {e}")
+            # created_at lưu theo giờ VN (UTC+7)
+            started = (datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S") - timedelta(hours=7)
+                       - datetime(1970, 1, 1)).total_seconds()
+        except (TypeError, ValueError):
+            return False, None
+        expires_at = started + int(m.group(1)) * _MOD_DURATION_UNITS[m.group(2)]
+        return expires_at > time.time(), expires_at
+
+    @schema_migration(2, 'moderation_tables')
+    def _migrate_moderation_tables(c):
+        """Tất cả bảng cho hệ thống moderation"""
+        # Cảnh cáo (Warns)
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_warns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER, user_id INTEGER,
+            reason TEXT, warned_by INTEGER,
+            created_at TEXT
+        )''')
+        # Cấu hình warn: max warn, action khi đạt max
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_warn_config (
+            group_id INTEGER PRIMARY KEY,
+            max_warns INTEGER DEFAULT 3,
+            action TEXT DEFAULT 'mute',
+            mute_duration INTEGER DEFAULT 3600
+        )''')
+        # Chào mừng tùy chỉnh
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_welcome (
+            group_id INTEGER PRIMARY KEY,
+            message TEXT,
+            enabled INTEGER DEFAULT 1,
+            set_by INTEGER, updated_at TEXT
+        )''')
+        # Nội quy nhóm
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_rules (
+            group_id INTEGER PRIMARY KEY,
+            rules TEXT,
+            set_by INTEGER, updated_at TEXT
+        )''')
+        # Lọc từ khóa
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_filters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER, keyword TEXT,
+            action TEXT DEFAULT 'delete',
+            reply TEXT,
+            added_by INTEGER, created_at TEXT,
+            UNIQUE(group_id, keyword)
+        )''')
+        # Lệnh tùy chỉnh
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER, command TEXT,
+            response TEXT,
+            added_by INTEGER, created_at TEXT,
+            UNIQUE(group_id, command)
+        )''')
+        # Anti-flood config
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_flood_config (
+            group_id INTEGER PRIMARY KEY,
+            enabled INTEGER DEFAULT 0,
+            max_msgs INTEGER DEFAULT 5,
+            interval_sec INTEGER DEFAULT 5,
+            action TEXT DEFAULT 'mute',
+            mute_duration INTEGER DEFAULT 300
+        )''')
+        # Anti-flood tracking (RAM only, không lưu DB)
+        # CAPTCHA config
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_captcha_config (
+            group_id INTEGER PRIMARY KEY,
+            enabled INTEGER DEFAULT 0,
+            captcha_type TEXT DEFAULT 'button',
+            timeout_sec INTEGER DEFAULT 60
+        )''')
+        # CAPTCHA pending
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_captcha_pending (
+            group_id INTEGER, user_id INTEGER,
+            answer TEXT, expires_at TEXT,
+            message_id INTEGER,
+            PRIMARY KEY (group_id, user_id)
+        )''')
+        # Admin logs
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER, action_by INTEGER,
+            target_user INTEGER, action TEXT,
+            reason TEXT, extra TEXT,
+            created_at TEXT
+        )''')
+        # Report
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER, reporter_id INTEGER,
+            target_user INTEGER, message_id INTEGER,
+            reason TEXT, status TEXT DEFAULT 'pending',
+            created_at TEXT
+        )''')
+        # Federation
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_federations (
+            fed_id TEXT PRIMARY KEY,
+            fed_name TEXT,
+            owner_id INTEGER,
+            created_at TEXT
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_fed_members (
+            fed_id TEXT, group_id INTEGER,
+            joined_at TEXT,
+            PRIMARY KEY (fed_id, group_id)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_fed_bans (
+            fed_id TEXT, user_id INTEGER,
+            reason TEXT, banned_by INTEGER,
+            banned_at TEXT,
+            PRIMARY KEY (fed_id, user_id)
+        )''')
+        # Mute/ban đang hiệu lực (expires_at: epoch UTC, NULL = vĩnh viễn)
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='mod_sanctions'")
+        sanctions_existed = c.fetchone() is not None
+        c.execute('''CREATE TABLE IF NOT EXISTS mod_sanctions (
+            group_id INTEGER, user_id INTEGER,
+            kind TEXT, reason TEXT,
+            set_by INTEGER, expires_at REAL,
+            created_at TEXT,
+            PRIMARY KEY (group_id, user_id, kind)
+        )''')
+        if not sanctions_existed:
+            # Lần đầu: lấy các mute chưa được gỡ từ mod_logs, hạn = created_at + thời lượng trong extra
+            seeded = 0
+            for row in mod_last_mutes(c):
+                seed, expires_at = mod_log_mute_expiry(row[3], row[5], row[6])
+                if seed:
+                    c.execute('''INSERT OR IGNORE INTO mod_sanctions (group_id, user_id, kind, reason, set_by, expires_at, created_at)
+                                 VALUES (?, ?, 'mute', ?, ?, ?, ?)''', (row[0], row[1], row[4], row[2], expires_at, row[6]))
+                    seeded += 1
+            logger.info(f"✅ Seeded {seeded} active mutes from mod_logs")
+
+    @schema_migration(11, 'mod_sanctions_expiry')
+    def _migrate_mod_sanctions_expiry(c):
+        """Sửa các mute đã seed từ mod_logs với expires_at NULL (bản seed cũ coi mọi mute là vĩnh viễn)"""
+        fixed = dropped = 0
+        for row in mod_last_mutes(c):
+            c.execute('''SELECT 1 FROM mod_sanctions WHERE group_id=? AND user_id=? AND kind='mute'
+                         AND expires_at IS NULL AND created_at=?''', (row[0], row[1], row[6]))
+            if not c.fetchone():
+                continue
+            seed, expires_at = mod_log_mute_expiry(row[3], row[5], row[6])
+            if not seed:
+                c.execute("DELETE FROM mod_sanctions WHERE group_id=? AND user_id=? AND kind='mute'", (row[0], row[1]))
+                dropped += 1
+            elif expires_at is not None:
+                c.execute("UPDATE mod_sanctions SET expires_at=? WHERE group_id=? AND user_id=? AND kind='mute'",
+                          (expires_at, row[0], row[1]))
+                fixed += 1
+        logger.info(f"✅ mod_sanctions: {fixed} mute có hạn, bỏ {dropped} mute đã hết hạn/không rõ hạn")
 
     # Flood tracking trong RAM
     _flood_tracker = {}       # {(group_id, user_id): [(timestamp, message_id)]}
+    _captcha_config_cache = {}  # {group_id: (enabled, captcha_type, timeout_sec, cached_at)}
     _flood_config_cache = {}  # {group_id: (enabled, max_msgs, interval_sec, action, mute_duration, cached_at)}
     _flood_warned = {}        # {(group_id, user_id): warned_at} — đã cảnh báo lần 1
 
+    # ==================== MODERATION: ACTIVE SANCTIONS ====================
+
+    class SanctionStore:
+        """Mute/ban đang hiệu lực, lưu DB + cache RAM.
+        Kiểm tra khi rejoin là 1 lần tra dict thay vì quét mod_logs."""
+
+        def __init__(self):
+            self.active = {}  # {(group_id, user_id, kind): expires_at | None}
+            self.lock = threading.Lock()
+            self.loaded = False
+
+        def load(self):
+            try:
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
+                c.execute("SELECT group_id, user_id, kind, expires_at FROM mod_sanctions WHERE expires_at IS NULL OR expires_at > ?",
+                          (time.time(),))
+                active = {(g, u, k): exp for g, u, k, exp in c.fetchall()}
+                conn.close()
+                with self.lock:
+                    self.active = active
+                    self.loaded = True
+                logger.info(f"✅ Loaded {len(active)} active sanctions")
+            except Exception as e:
+                logger.error(f"❌ Lỗi load sanctions: {e}")
+
+        def add(self, group_id, user_id, kind, duration_sec=None, reason="", set_by=0):
+            expires_at = time.time() + duration_sec if duration_sec else None
+            try:
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
+                c.execute('''INSERT OR REPLACE INTO mod_sanctions (group_id, user_id, kind, reason, set_by, expires_at, created_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          (group_id, user_id, kind, reason, set_by, expires_at,
+                           get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit(); conn.close()
+            except Exception as e:
+                logger.error(f"❌ Lỗi lưu sanction {kind} {user_id}@{group_id}: {e}")
+            with self.lock:
+                self.active[(group_id, user_id, kind)] = expires_at
+
+        def remove(self, group_id, user_id, kind):
+            try:
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
+                c.execute("DELETE FROM mod_sanctions WHERE group_id=? AND user_id=? AND kind=?", (group_id, user_id, kind))
+                conn.commit(); conn.close()
+            except Exception as e:
+                logger.error(f"❌ Lỗi xóa sanction {kind} {user_id}@{group_id}: {e}")
+            with self.lock:
+                self.active.pop((group_id, user_id, kind), None)
+
+        def is_active(self, group_id, user_id, kind='mute'):
+            if not self.loaded:
+                self.load()
+            key = (group_id, user_id, kind)
+            if key not in self.active:
+                return False
+            expires_at = self.active.get(key)
+            return expires_at is None or expires_at > time.time()
+
+        def reap(self):
+            """Xóa các sanction đã hết hạn khỏi DB và RAM"""
+            now = time.time()
+            try:
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
+                c.execute("DELETE FROM mod_sanctions WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+                removed = c.rowcount
+                conn.commit(); conn.close()
+            except Exception as e:
+                logger.error(f"❌ Lỗi reap sanctions: {e}")
+                return 0
+            with self.lock:
+                for key in [k for k, exp in self.active.items() if exp is not None and exp <= now]:
+                    del self.active[key]
+            if removed:
+                logger.info(f"🧹 Reaped {removed} expired sanctions")
+            return removed
+
+        def get_stats(self):
+            return {'active': len(self.active)}
+
+    sanctions = SanctionStore()
+
+    def sanction_reaper():
+        while True:
+            time.sleep(60)
+            sanctions.reap()
+
     # ==================== MODERATION: HELPERS ====================
 
     def mod_log(group_id, action_by, target_user, action, reason="", extra=""):
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute('''INSERT INTO mod_logs (group_id, action_by, target_user, action, reason, extra, created_at)
                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
@@ -11594,6 +14914,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         try:
             await context.bot.ban_chat_member(chat_id=target_chat_id, user_id=target_id)
             mod_log(target_chat_id, operator_id, target_id, "ban", reason)
+            sanctions.add(target_chat_id, target_id, 'ban', reason=reason, set_by=operator_id)
             suffix = f"\n📌 Nhóm: `{target_chat_id}`" if from_master else ""
             await update.message.reply_text(
                 f"🚫 *ĐÃ BAN*\n━━━━━━━━━━━━━━━━\n\n"
@@ -11622,6 +14943,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         try:
             await context.bot.unban_chat_member(chat_id=target_chat_id, user_id=target_id)
             mod_log(target_chat_id, operator_id, target_id, "unban")
+            sanctions.remove(target_chat_id, target_id, 'ban')
             suffix = f"\n📌 Nhóm: `{target_chat_id}`" if from_master else ""
             await update.message.reply_text(
                 f"✅ Đã gỡ ban `{target_id}`{suffix}\n🕐 {format_vn_time()}",
@@ -11699,6 +15021,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 permissions=ChatPermissions(can_send_messages=False),
                 until_date=until_date)
             mod_log(target_chat_id, operator_id, target_id, "mute", reason, duration_str)
+            sanctions.add(target_chat_id, target_id, 'mute', duration_sec, reason, operator_id)
             suffix = f"\n📌 Nhóm: `{target_chat_id}`" if from_master else ""
             await update.message.reply_text(
                 f"🔇 *ĐÃ TẮT TIẾNG*\n━━━━━━━━━━━━━━━━\n\n"
@@ -11732,6 +15055,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 chat_id=target_chat_id, user_id=target_id,
                 permissions=default_perms)
             mod_log(target_chat_id, operator_id, target_id, "unmute")
+            sanctions.remove(target_chat_id, target_id, 'mute')
             # Reset flood state để user bị track lại từ đầu
             _flood_tracker.pop((target_chat_id, target_id), None)
             _flood_warned.pop((target_chat_id, target_id), None)
@@ -11760,7 +15084,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
         reason = " ".join(a for a in args if a != str(target_id)) or "Không có lý do"
 
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT max_warns, action, mute_duration FROM mod_warn_config WHERE group_id=?", (target_chat_id,))
         cfg = c.fetchone() or (3, 'mute', 3600)
@@ -11787,6 +15111,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 if action == 'ban':
                     await context.bot.ban_chat_member(chat_id=target_chat_id, user_id=target_id)
                     mod_log(target_chat_id, operator_id, target_id, "auto_ban", f"Đạt {max_warns} warns")
+                    sanctions.add(target_chat_id, target_id, 'ban', reason=f"Đạt {max_warns} warns", set_by=operator_id)
                 elif action == 'kick':
                     await context.bot.ban_chat_member(chat_id=target_chat_id, user_id=target_id)
                     await context.bot.unban_chat_member(chat_id=target_chat_id, user_id=target_id)
@@ -11797,9 +15122,10 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                         chat_id=target_chat_id, user_id=target_id,
                         permissions=ChatPermissions(can_send_messages=False))
                     mod_log(target_chat_id, operator_id, target_id, "auto_mute", f"Đạt {max_warns} warns")
+                    sanctions.add(target_chat_id, target_id, 'mute', reason=f"Đạt {max_warns} warns", set_by=operator_id)
             except Exception as e:
                 msg += f"\n❌ Lỗi: {e}\n"
-            conn2 = sqlite3.connect(DB_PATH)
+            conn2 = db_connect(DB_PATH)
             c2 = conn2.cursor()
             c2.execute("DELETE FROM mod_warns WHERE group_id=? AND user_id=?", (target_chat_id, target_id))
             conn2.commit(); conn2.close()
@@ -11879,7 +15205,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         target_id, _ = await mod_get_target(update, context)
         if not target_id:
             await update.message.reply_text("❌ Reply vào tin nhắn người cần unwarn"); return
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''DELETE FROM mod_warns WHERE id = (
                      SELECT id FROM mod_warns WHERE group_id=? AND user_id=? ORDER BY created_at DESC LIMIT 1)''',
@@ -11902,7 +15228,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         target_id, _ = await mod_get_target(update, context)
         if not target_id:
             target_id = update.effective_user.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT max_warns FROM mod_warn_config WHERE group_id=?", (chat_id,))
         cfg = c.fetchone()
@@ -11943,7 +15269,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         except:
             await update.message.reply_text("❌ Sai cú pháp! `/setwarn [số] [ban/kick/mute] [giây]`",
                                              parse_mode=ParseMode.MARKDOWN); return
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_warn_config (group_id, max_warns, action, mute_duration)
                      VALUES (?, ?, ?, ?)''', (target_chat_id, max_w, action, mute_dur))
@@ -11962,13 +15288,11 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     # ==================== CAPTCHA ====================
 
-    async def mod_captcha_join(update: Update, context: ContextTypes.DEFAULT_TYPE, new_member):
+    async def mod_captcha_join(update: Update, context: ContextTypes.DEFAULT_TYPE, new_member, cfg=None):
         """Gửi CAPTCHA cho thành viên mới"""
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT enabled, captcha_type, timeout_sec FROM mod_captcha_config WHERE group_id=?", (chat_id,))
-        cfg = c.fetchone(); conn.close()
+        if cfg is None:
+            cfg = mod_get_captcha_config(chat_id)
         if not cfg or not cfg[0]:
             return  # CAPTCHA tắt
         captcha_type, timeout = cfg[1], cfg[2]
@@ -11996,15 +15320,13 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             except: pass
             # Lưu pending
             expires = (get_vn_time() + timedelta(seconds=timeout)).strftime("%Y-%m-%d %H:%M:%S")
-            conn2 = sqlite3.connect(DB_PATH)
+            conn2 = db_connect(DB_PATH)
             c2 = conn2.cursor()
             c2.execute('''INSERT OR REPLACE INTO mod_captcha_pending (group_id, user_id, answer, expires_at, message_id)
                           VALUES (?, ?, ?, ?, ?)''', (chat_id, new_member.id, "confirmed", expires, msg.message_id))
             conn2.commit(); conn2.close()
             # Schedule timeout kick
-            context.application.create_task(
-                _mod_captcha_timeout(context, chat_id, new_member.id, msg.message_id, timeout)
-            )
+            schedule_captcha_timeout(context.application, chat_id, new_member.id, msg.message_id, timeout)
         elif captcha_type == 'math':
             a, b = random.randint(1, 10), random.randint(1, 10)
             answer = str(a + b)
@@ -12032,19 +15354,52 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 )
             except: pass
             expires = (get_vn_time() + timedelta(seconds=timeout)).strftime("%Y-%m-%d %H:%M:%S")
-            conn2 = sqlite3.connect(DB_PATH)
+            conn2 = db_connect(DB_PATH)
             c2 = conn2.cursor()
             c2.execute('''INSERT OR REPLACE INTO mod_captcha_pending (group_id, user_id, answer, expires_at, message_id)
                           VALUES (?, ?, ?, ?, ?)''', (chat_id, new_member.id, answer, expires, msg.message_id))
             conn2.commit(); conn2.close()
-            context.application.create_task(
-                _mod_captcha_timeout(context, chat_id, new_member.id, msg.message_id, timeout)
-            )
+            schedule_captcha_timeout(context.application, chat_id, new_member.id, msg.message_id, timeout)
+
+    captcha_timer_tasks = set()
+
+    def schedule_captcha_timeout(application, chat_id, user_id, msg_id, timeout):
+        """Hẹn giờ kick; task được theo dõi để huỷ khi restart (pending vẫn nằm trong DB)"""
+        task = application.create_task(_mod_captcha_timeout(application, chat_id, user_id, msg_id, timeout))
+        captcha_timer_tasks.add(task)
+        task.add_done_callback(captcha_timer_tasks.discard)
+        return task
+
+    def cancel_captcha_timers():
+        count = len(captcha_timer_tasks)
+        for task in list(captcha_timer_tasks):
+            task.cancel()
+        return count
+
+    def restore_captcha_timers(application):
+        """Lên lịch lại các CAPTCHA còn chờ trong DB (sau restart hoặc crash)"""
+        try:
+            conn = db_connect(DB_PATH)
+            rows = conn.execute("SELECT group_id, user_id, message_id, expires_at FROM mod_captcha_pending").fetchall()
+            conn.close()
+        except Exception as e:
+            logger.error(f"❌ restore_captcha_timers: {e}")
+            return 0
+        now = get_vn_time()
+        for group_id, user_id, msg_id, expires_at in rows:
+            try:
+                remaining = (datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S") - now).total_seconds()
+            except (TypeError, ValueError):
+                remaining = 0
+            schedule_captcha_timeout(application, group_id, user_id, msg_id, max(0, remaining))
+        if rows:
+            logger.info(f"⏱ Khôi phục {len(rows)} CAPTCHA đang chờ")
+        return len(rows)
 
     async def _mod_captcha_timeout(context, chat_id, user_id, msg_id, timeout):
-        """Kick user nếu không xác nhận CAPTCHA trong timeout"""
+        """Kick user nếu không xác nhận CAPTCHA trong timeout (context chỉ cần .bot)"""
         await asyncio.sleep(timeout)
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT user_id FROM mod_captcha_pending WHERE group_id=? AND user_id=?", (chat_id, user_id))
         still_pending = c.fetchone(); conn.close()
@@ -12057,7 +15412,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                     text=f"⏱ User `{user_id}` đã bị kick do không xác nhận CAPTCHA.",
                     parse_mode=ParseMode.MARKDOWN)
             except: pass
-            conn2 = sqlite3.connect(DB_PATH)
+            conn2 = db_connect(DB_PATH)
             c2 = conn2.cursor()
             c2.execute("DELETE FROM mod_captcha_pending WHERE group_id=? AND user_id=?", (chat_id, user_id))
             conn2.commit(); conn2.close()
@@ -12075,11 +15430,12 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         ctype = context.args[1].lower() if len(context.args) > 1 else 'button'
         if ctype not in ['button', 'math']:
             ctype = 'button'
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_captcha_config (group_id, enabled, captcha_type)
                      VALUES (?, ?, ?)''', (chat_id, enabled, ctype))
         conn.commit(); conn.close()
+        _captcha_config_cache.pop(chat_id, None)
         status = "BẬT" if enabled else "TẮT"
         await update.message.reply_text(
             f"✅ CAPTCHA *{status}*" + (f" — Loại: *{ctype}*" if enabled else ""),
@@ -12099,7 +15455,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             enabled, max_msgs, interval_sec, action, mute_duration = cached[:5]
         else:
             try:
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT enabled, max_msgs, interval_sec, action, COALESCE(mute_duration, 300) FROM mod_flood_config WHERE group_id=?", (chat_id,))
                 cfg = c.fetchone()
@@ -12127,7 +15483,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         count = len(_flood_tracker[key])  # Số tin TRƯỚC khi thêm tin này
         _flood_tracker[key].append((now, msg_id))
 
-        logger.info(f"🌊 Flood check {user_id}@{chat_id}: {count+1}/{max_msgs} trong {interval_sec}s")
+        log_flood.debug("🌊 Flood check %s@%s: %s/%s trong %ss", user_id, chat_id, count + 1, max_msgs, interval_sec)
 
         # Hàm xóa tất cả tin trong cửa sổ thời gian
         async def delete_all_flood_msgs():
@@ -12164,7 +15520,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         await delete_all_flood_msgs()
         _flood_tracker[key] = []
         _flood_warned.pop(warn_key, None)
-        logger.info(f"🌊 FLOOD ACTION: {user_id} @ {chat_id} → {action} ({mute_duration}s)")
+        log_flood.info("🌊 FLOOD ACTION: %s @ %s → %s (%ss)", user_id, chat_id, action, mute_duration)
         try:
             await update.message.delete()
         except Exception:
@@ -12173,6 +15529,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             if action == 'ban':
                 await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
                 mod_log(chat_id, 0, user_id, "auto_ban_flood")
+                sanctions.add(chat_id, user_id, 'ban', reason="flood")
                 msg = await update.effective_chat.send_message(
                     f"🚫 [{update.effective_user.first_name}](tg://user?id={user_id}) bị *ban* do tiếp tục spam\\!",
                     parse_mode=ParseMode.MARKDOWN)
@@ -12193,6 +15550,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                     permissions=ChatPermissions(can_send_messages=False),
                     until_date=until)
                 mod_log(chat_id, 0, user_id, "auto_mute_flood")
+                sanctions.add(chat_id, user_id, 'mute', mute_duration, reason="flood")
                 if mute_duration < 60:
                     dur_text = f"{mute_duration} giây"
                 elif mute_duration < 3600:
@@ -12228,7 +15586,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         interval = int(context.args[2]) if len(context.args) > 2 else 5
         action = context.args[3].lower() if len(context.args) > 3 else 'mute'
         mute_dur = int(context.args[4]) if len(context.args) > 4 else 300
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_flood_config (group_id, enabled, max_msgs, interval_sec, action, mute_duration)
                      VALUES (?, ?, ?, ?, ?, ?)''', (chat_id, enabled, max_m, interval, action, mute_dur))
@@ -12263,7 +15621,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 "Ví dụ: `/setwelcome Chào {name}! Bạn là thành viên thứ {count} 🎉`",
                 parse_mode=ParseMode.MARKDOWN); return
         msg_text = " ".join(context.args)
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_welcome (group_id, message, enabled, set_by, updated_at)
                      VALUES (?, ?, 1, ?, ?)''',
@@ -12277,7 +15635,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         """/welcomeoff — Tắt chào mừng"""
         if not await mod_check_admin(update, 'welcome'): return
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("UPDATE mod_welcome SET enabled=0 WHERE group_id=?", (chat_id,))
         conn.commit(); conn.close()
@@ -12288,7 +15646,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
     async def mod_send_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE, member):
         """Gửi tin chào mừng, xóa tin cũ nếu có, tự xóa sau 30 giây"""
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT message, enabled FROM mod_welcome WHERE group_id=?", (chat_id,))
         row = c.fetchone(); conn.close()
@@ -12331,7 +15689,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("📖 Cách dùng: `/setrules [nội dung nội quy]`",
                                              parse_mode=ParseMode.MARKDOWN); return
         rules_text = " ".join(context.args)
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_rules (group_id, rules, set_by, updated_at)
                      VALUES (?, ?, ?, ?)''',
@@ -12342,7 +15700,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
     async def mod_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """/rules — Xem nội quy nhóm"""
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT rules FROM mod_rules WHERE group_id=?", (chat_id,))
         row = c.fetchone(); conn.close()
@@ -12373,7 +15731,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         else:
             reply_text = " ".join(context.args[1:]) if len(context.args) > 1 else ""
         action = "delete" if not reply_text else "reply"
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_filters (group_id, keyword, action, reply, added_by, created_at)
                      VALUES (?, ?, ?, ?, ?, ?)''',
@@ -12394,7 +15752,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("📖 Cách dùng: `/unfilter [từ khóa]`",
                                              parse_mode=ParseMode.MARKDOWN); return
         keyword = context.args[0].lower()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("DELETE FROM mod_filters WHERE group_id=? AND keyword=?", (chat_id, keyword))
         deleted = c.rowcount; conn.commit(); conn.close()
@@ -12411,7 +15769,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 if not mg_has_feature(chat_id, 'filter_kw'):
                     await update.message.reply_text("🚫 Tính năng *Lọc từ khóa* chưa được bật trong nhóm này.", parse_mode=ParseMode.MARKDOWN); return
             except Exception: pass
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT keyword, action, reply FROM mod_filters WHERE group_id=? ORDER BY keyword", (chat_id,))
         rows = c.fetchall(); conn.close()
@@ -12428,7 +15786,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             return False
         chat_id = update.effective_chat.id
         text = update.message.text.lower()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT keyword, action, reply FROM mod_filters WHERE group_id=?", (chat_id,))
         filters = c.fetchall(); conn.close()
@@ -12457,7 +15815,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                 parse_mode=ParseMode.MARKDOWN); return
         cmd = context.args[0].lower().replace('/', '')
         response = " ".join(context.args[1:])
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT OR REPLACE INTO mod_commands (group_id, command, response, added_by, created_at)
                      VALUES (?, ?, ?, ?, ?)''',
@@ -12475,7 +15833,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("📖 Cách dùng: `/delcmd [lệnh]`",
                                              parse_mode=ParseMode.MARKDOWN); return
         cmd = context.args[0].lower().replace('/', '')
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("DELETE FROM mod_commands WHERE group_id=? AND command=?", (chat_id, cmd))
         deleted = c.rowcount; conn.commit(); conn.close()
@@ -12487,7 +15845,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
     async def mod_cmds_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """/cmds — Xem danh sách lệnh tùy chỉnh"""
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT command, response FROM mod_commands WHERE group_id=? ORDER BY command", (chat_id,))
         rows = c.fetchall(); conn.close()
@@ -12507,7 +15865,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         if not text.startswith('/'):
             return False
         cmd = text.split()[0][1:].split('@')[0].lower()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT response FROM mod_commands WHERE group_id=? AND command=?", (chat_id, cmd))
         row = c.fetchone(); conn.close()
@@ -12565,7 +15923,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         if not await mod_check_admin(update, 'kick_mute'): return
         chat_id = update.effective_chat.id
         limit = int(context.args[0]) if context.args else 20
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''SELECT action_by, target_user, action, reason, created_at
                      FROM mod_logs WHERE group_id=? ORDER BY created_at DESC LIMIT ?''',
@@ -12603,7 +15961,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         target = update.message.reply_to_message.from_user
         target_msg_id = update.message.reply_to_message.message_id
         reason = " ".join(context.args) if context.args else "Không có lý do"
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT INTO mod_reports (group_id, reporter_id, target_user, message_id, reason, created_at)
                      VALUES (?, ?, ?, ?, ?, ?)''',
@@ -12637,6 +15995,69 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     # ==================== FEDERATION (LIÊN MINH) ====================
 
+    class FedBanIndex:
+        """Index liên minh trong RAM: group → feds và user → {fed: lý do}.
+        Kiểm tra fban khi join chỉ còn là phép giao 2 set, không chạm DB."""
+
+        def __init__(self):
+            self.group_feds = {}  # {group_id: set(fed_id)}
+            self.user_bans = {}   # {user_id: {fed_id: reason}}
+            self.loaded = False
+
+        def load(self):
+            try:
+                conn = db_connect(DB_PATH)
+                c = conn.cursor()
+                c.execute("SELECT fed_id, group_id FROM mod_fed_members")
+                group_feds = {}
+                for fed_id, group_id in c.fetchall():
+                    group_feds.setdefault(group_id, set()).add(fed_id)
+                c.execute("SELECT fed_id, user_id, reason FROM mod_fed_bans")
+                user_bans = {}
+                for fed_id, user_id, reason in c.fetchall():
+                    user_bans.setdefault(user_id, {})[fed_id] = reason
+                conn.close()
+                self.group_feds, self.user_bans = group_feds, user_bans
+                self.loaded = True
+                logger.info(f"✅ Loaded fed index: {len(group_feds)} groups, {len(user_bans)} banned users")
+            except Exception as e:
+                logger.error(f"❌ Lỗi load fed index: {e}")
+
+        def join(self, fed_id, group_id):
+            self.group_feds.setdefault(group_id, set()).add(fed_id)
+
+        def leave(self, group_id):
+            self.group_feds.pop(group_id, None)
+
+        def ban(self, fed_id, user_id, reason):
+            self.user_bans.setdefault(user_id, {})[fed_id] = reason
+
+        def unban(self, fed_id, user_id):
+            bans = self.user_bans.get(user_id)
+            if bans:
+                bans.pop(fed_id, None)
+                if not bans:
+                    del self.user_bans[user_id]
+
+        def check(self, group_id, user_id):
+            """Trả về lý do fban nếu user bị ban ở 1 liên minh mà nhóm tham gia, ngược lại None"""
+            if not self.loaded:
+                self.load()
+            bans = self.user_bans.get(user_id)
+            if not bans:
+                return None
+            feds = self.group_feds.get(group_id)
+            if not feds:
+                return None
+            for fed_id in feds & bans.keys():
+                return bans[fed_id]
+            return None
+
+        def get_stats(self):
+            return {'groups': len(self.group_feds), 'banned_users': len(self.user_bans)}
+
+    fed_index = FedBanIndex()
+
     async def mod_newfed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """/newfed [tên] — Tạo liên minh chống spam mới"""
         user_id = update.effective_user.id
@@ -12646,7 +16067,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         import uuid
         fed_name = " ".join(context.args)
         fed_id = str(uuid.uuid4())[:8].upper()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute('''INSERT INTO mod_federations (fed_id, fed_name, owner_id, created_at)
                      VALUES (?, ?, ?, ?)''',
@@ -12668,7 +16089,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("📖 Cách dùng: `/joinfed [fed_id]`",
                                              parse_mode=ParseMode.MARKDOWN); return
         fed_id = context.args[0].upper()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT fed_name FROM mod_federations WHERE fed_id=?", (fed_id,))
         fed = c.fetchone()
@@ -12680,6 +16101,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                      VALUES (?, ?, ?)''',
                   (fed_id, chat_id, get_vn_time().strftime("%Y-%m-%d %H:%M:%S")))
         conn.commit(); conn.close()
+        fed_index.join(fed_id, chat_id)
         await update.message.reply_text(
             f"✅ Đã tham gia liên minh *{fed[0]}* (`{fed_id}`)\n"
             f"User bị fban trong liên minh sẽ tự động bị ban tại nhóm này.",
@@ -12689,10 +16111,11 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         """/leavefed — Rời liên minh"""
         if not await mod_check_admin(update, 'kick_mute'): return
         chat_id = update.effective_chat.id
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("DELETE FROM mod_fed_members WHERE group_id=?", (chat_id,))
         conn.commit(); conn.close()
+        fed_index.leave(chat_id)
         await update.message.reply_text("✅ Đã rời khỏi liên minh.")
 
     async def mod_fban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -12708,7 +16131,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         except:
             await update.message.reply_text("❌ user_id phải là số!"); return
         # Kiểm tra quyền: phải là owner của fed
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT owner_id, fed_name FROM mod_federations WHERE fed_id=?", (fed_id,))
         fed = c.fetchone()
@@ -12726,18 +16149,16 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         # Lấy tất cả nhóm trong liên minh
         c.execute("SELECT group_id FROM mod_fed_members WHERE fed_id=?", (fed_id,))
         groups = c.fetchall(); conn.commit(); conn.close()
-        banned = 0
-        for (gid,) in groups:
-            try:
-                await context.bot.ban_chat_member(chat_id=gid, user_id=target_id)
-                banned += 1
-            except: pass
+        fed_index.ban(fed_id, target_id, reason)
+        result = await fanout_execute(
+            [gid for (gid,) in groups],
+            lambda gid: context.bot.ban_chat_member(chat_id=gid, user_id=target_id))
         await update.message.reply_text(
             f"🏛 *FBAN THỰC HIỆN*\n━━━━━━━━━━━━━━━━\n\n"
             f"👤 User: `{target_id}`\n"
             f"🏷 Liên minh: *{fed[1]}*\n"
             f"📝 Lý do: {reason}\n"
-            f"🚫 Banned ở: *{banned}*/{len(groups)} nhóm\n"
+            f"🚫 Banned ở: *{result['success']}*/{result['total']} nhóm\n"
             f"🕐 {format_vn_time()}", parse_mode=ParseMode.MARKDOWN)
 
     async def mod_funban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -12751,19 +16172,17 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             target_id = int(context.args[1])
         except:
             await update.message.reply_text("❌ user_id phải là số!"); return
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("DELETE FROM mod_fed_bans WHERE fed_id=? AND user_id=?", (fed_id, target_id))
         c.execute("SELECT group_id FROM mod_fed_members WHERE fed_id=?", (fed_id,))
         groups = c.fetchall(); conn.commit(); conn.close()
-        unbanned = 0
-        for (gid,) in groups:
-            try:
-                await context.bot.unban_chat_member(chat_id=gid, user_id=target_id)
-                unbanned += 1
-            except: pass
+        fed_index.unban(fed_id, target_id)
+        result = await fanout_execute(
+            [gid for (gid,) in groups],
+            lambda gid: context.bot.unban_chat_member(chat_id=gid, user_id=target_id))
         await update.message.reply_text(
-            f"✅ Đã gỡ fban `{target_id}` ở *{unbanned}* nhóm.",
+            f"✅ Đã gỡ fban `{target_id}` ở *{result['success']}* nhóm.",
             parse_mode=ParseMode.MARKDOWN)
 
     async def mod_fedinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -12772,7 +16191,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await update.message.reply_text("📖 Cách dùng: `/fedinfo [fed_id]`",
                                              parse_mode=ParseMode.MARKDOWN); return
         fed_id = context.args[0].upper()
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT fed_name, owner_id, created_at FROM mod_federations WHERE fed_id=?", (fed_id,))
         fed = c.fetchone()
@@ -12805,7 +16224,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         await _mod_send_main_menu(update.message, update.effective_chat.id)
 
     async def _mod_send_main_menu(msg_or_query, chat_id, edit=False):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT enabled, captcha_type FROM mod_captcha_config WHERE group_id=?", (chat_id,))
         cap = c.fetchone() or (0, 'button')
@@ -12855,7 +16274,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             await msg_or_query.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
 
     async def _mod_panel_captcha(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT enabled, captcha_type, timeout_sec FROM mod_captcha_config WHERE group_id=?", (chat_id,))
         cfg = c.fetchone() or (0, 'button', 60)
@@ -12872,7 +16291,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_flood(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT enabled, max_msgs, interval_sec, action, COALESCE(mute_duration, 300) FROM mod_flood_config WHERE group_id=?", (chat_id,))
         cfg = c.fetchone() or (0, 5, 5, 'mute', 300)
@@ -12909,7 +16328,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_warn(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT max_warns, action FROM mod_warn_config WHERE group_id=?", (chat_id,))
         cfg = c.fetchone() or (3, 'mute')
@@ -12929,7 +16348,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_welcome(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT message, enabled FROM mod_welcome WHERE group_id=?", (chat_id,))
         row = c.fetchone()
@@ -12945,7 +16364,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_rules(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT rules FROM mod_rules WHERE group_id=?", (chat_id,))
         row = c.fetchone()
@@ -12972,7 +16391,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_filters(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT id, keyword, action, reply FROM mod_filters WHERE group_id=? ORDER BY keyword LIMIT 20", (chat_id,))
         rows = c.fetchall()
@@ -12990,7 +16409,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_cmds(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT id, command, response FROM mod_commands WHERE group_id=? ORDER BY command LIMIT 20", (chat_id,))
         rows = c.fetchall()
@@ -13008,7 +16427,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_logs(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT action_by, target_user, action, reason, created_at FROM mod_logs WHERE group_id=? ORDER BY created_at DESC LIMIT 15", (chat_id,))
         rows = c.fetchall()
@@ -13028,7 +16447,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         await safe_edit_message(query, msg, reply_markup=InlineKeyboardMarkup(keyboard))
 
     async def _mod_panel_fed(query, chat_id):
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect(DB_PATH)
         c = conn.cursor()
         c.execute("SELECT f.fed_id, f.fed_name, (SELECT COUNT(*) FROM mod_fed_bans WHERE fed_id=f.fed_id) FROM mod_federations f JOIN mod_fed_members m ON f.fed_id=m.fed_id WHERE m.group_id=?", (chat_id,))
         fed = c.fetchone()
@@ -13047,6 +16466,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+    @callback_router.prefix("mod_", with_context=False, permission=None)
     async def handle_mod_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Xử lý callbacks của moderation system"""
         query = update.callback_query
@@ -13115,13 +16535,14 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         # ── CAPTCHA TOGGLE / TYPE ─────────────────────────────────────────
         if data.startswith("mod_cap_toggle_"):
             cid = int(data[len("mod_cap_toggle_"):])
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT enabled FROM mod_captcha_config WHERE group_id=?", (cid,))
             row = c.fetchone()
             new_val = 0 if (row and row[0]) else 1
             c.execute("INSERT OR REPLACE INTO mod_captcha_config (group_id, enabled, captcha_type, timeout_sec) VALUES (?, ?, COALESCE((SELECT captcha_type FROM mod_captcha_config WHERE group_id=?), 'button'), COALESCE((SELECT timeout_sec FROM mod_captcha_config WHERE group_id=?), 60))", (cid, new_val, cid, cid))
             conn.commit(); conn.close()
+            _captcha_config_cache.pop(cid, None)
             await _mod_panel_captcha(query, cid); return
 
         if data.startswith("mod_cap_type_"):
@@ -13129,16 +16550,17 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_cap_type_(-?\d+)_(button|math)", data)
             if m:
                 cid, ctype = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("INSERT OR REPLACE INTO mod_captcha_config (group_id, enabled, captcha_type, timeout_sec) VALUES (?, COALESCE((SELECT enabled FROM mod_captcha_config WHERE group_id=?),0), ?, COALESCE((SELECT timeout_sec FROM mod_captcha_config WHERE group_id=?),60))", (cid, cid, ctype, cid))
                 conn.commit(); conn.close()
+                _captcha_config_cache.pop(cid, None)
                 await _mod_panel_captcha(query, cid); return
 
         # ── FLOOD CONTROLS ───────────────────────────────────────────────
         if data.startswith("mod_flood_toggle_"):
             cid = int(data[len("mod_flood_toggle_"):])
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT enabled FROM mod_flood_config WHERE group_id=?", (cid,))
             row = c.fetchone()
@@ -13153,7 +16575,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_flood_max_(-?\d+)_(inc|dec)", data)
             if m:
                 cid, op = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT max_msgs FROM mod_flood_config WHERE group_id=?", (cid,))
                 row = c.fetchone()
@@ -13169,7 +16591,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_flood_int_(-?\d+)_(inc|dec)", data)
             if m:
                 cid, op = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT interval_sec FROM mod_flood_config WHERE group_id=?", (cid,))
                 row = c.fetchone()
@@ -13185,7 +16607,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_flood_act_(-?\d+)_(mute|kick|ban)", data)
             if m:
                 cid, action = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("INSERT OR REPLACE INTO mod_flood_config (group_id, enabled, max_msgs, interval_sec, action, mute_duration) VALUES (?, COALESCE((SELECT enabled FROM mod_flood_config WHERE group_id=?),0), COALESCE((SELECT max_msgs FROM mod_flood_config WHERE group_id=?),5), COALESCE((SELECT interval_sec FROM mod_flood_config WHERE group_id=?),5), ?, COALESCE((SELECT mute_duration FROM mod_flood_config WHERE group_id=?),300))", (cid, cid, cid, cid, action, cid))
                 conn.commit(); conn.close()
@@ -13197,7 +16619,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_flood_dur_(-?\d+)_(inc|dec)", data)
             if m:
                 cid, op = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT mute_duration FROM mod_flood_config WHERE group_id=?", (cid,))
                 row = c.fetchone()
@@ -13221,7 +16643,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_warn_max_(-?\d+)_(inc|dec)", data)
             if m:
                 cid, op = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("SELECT max_warns FROM mod_warn_config WHERE group_id=?", (cid,))
                 row = c.fetchone()
@@ -13236,7 +16658,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_warn_act_(-?\d+)_(mute|kick|ban)", data)
             if m:
                 cid, action = int(m.group(1)), m.group(2)
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("INSERT OR REPLACE INTO mod_warn_config (group_id, max_warns, action) VALUES (?, COALESCE((SELECT max_warns FROM mod_warn_config WHERE group_id=?),3), ?)", (cid, cid, action))
                 conn.commit(); conn.close()
@@ -13245,7 +16667,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         # ── WELCOME TOGGLE ───────────────────────────────────────────────
         if data.startswith("mod_welcome_toggle_"):
             cid = int(data[len("mod_welcome_toggle_"):])
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT enabled FROM mod_welcome WHERE group_id=?", (cid,))
             row = c.fetchone()
@@ -13263,7 +16685,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_filter_del_(-?\d+)_(\d+)", data)
             if m:
                 cid, fid = int(m.group(1)), int(m.group(2))
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("DELETE FROM mod_filters WHERE id=? AND group_id=?", (fid, cid))
                 conn.commit(); conn.close()
@@ -13275,7 +16697,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             m = _re.match(r"mod_cmd_del_(-?\d+)_(\d+)", data)
             if m:
                 cid, rid = int(m.group(1)), int(m.group(2))
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("DELETE FROM mod_commands WHERE id=? AND group_id=?", (rid, cid))
                 conn.commit(); conn.close()
@@ -13284,10 +16706,11 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         # ── FED LEAVE ────────────────────────────────────────────────────
         if data.startswith("mod_fed_leave_"):
             cid = int(data[len("mod_fed_leave_"):])
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("DELETE FROM mod_fed_members WHERE group_id=?", (cid,))
             conn.commit(); conn.close()
+            fed_index.leave(cid)
             await query.answer("✅ Đã rời liên minh!", show_alert=True)
             await _mod_panel_fed(query, cid); return
 
@@ -13321,7 +16744,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             if user_id != cap_user:
                 await query.answer("❌ CAPTCHA này không phải của bạn!", show_alert=True); return
             # Kiểm tra đáp án
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
             c.execute("SELECT answer, message_id FROM mod_captcha_pending WHERE group_id=? AND user_id=?",
                       (cap_chat, cap_user))
@@ -13333,13 +16756,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             if user_answer == correct_answer or correct_answer == "confirmed":
                 # Đúng → kiểm tra user có đang bị mute không trước khi restore
                 from telegram import ChatPermissions
-                # Lấy action cuối cùng của user trong nhóm này
-                c.execute('''SELECT action FROM mod_logs
-                             WHERE group_id=? AND target_user=?
-                             AND action IN ('mute','auto_mute','auto_mute_flood','unmute')
-                             ORDER BY created_at DESC LIMIT 1''', (cap_chat, cap_user))
-                last_mod = c.fetchone()
-                is_muted = last_mod and last_mod[0] in ('mute', 'auto_mute', 'auto_mute_flood')
+                is_muted = sanctions.is_active(cap_chat, cap_user, 'mute')
 
                 c.execute("DELETE FROM mod_captcha_pending WHERE group_id=? AND user_id=?", (cap_chat, cap_user))
                 conn.commit(); conn.close()
@@ -13392,7 +16809,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
             action = parts[2]  # ban/mute/ignore
             if action == "ignore":
                 report_id = int(parts[3])
-                conn = sqlite3.connect(DB_PATH)
+                conn = db_connect(DB_PATH)
                 c = conn.cursor()
                 c.execute("UPDATE mod_reports SET status='ignored' WHERE id=?", (report_id,))
                 conn.commit(); conn.close()
@@ -13404,6 +16821,7 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                     if action == "ban":
                         await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_id)
                         mod_log(chat_id, user_id, target_id, "ban", f"Từ báo cáo #{report_id}")
+                        sanctions.add(chat_id, target_id, 'ban', reason=f"Từ báo cáo #{report_id}", set_by=user_id)
                         await safe_edit_message(query, f"🚫 Đã ban user `{target_id}` (báo cáo #{report_id})")
                     elif action == "mute":
                         from telegram import ChatPermissions
@@ -13413,8 +16831,9 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
                             permissions=ChatPermissions(can_send_messages=False),
                             until_date=until)
                         mod_log(chat_id, user_id, target_id, "mute", f"Từ báo cáo #{report_id}", "1h")
+                        sanctions.add(chat_id, target_id, 'mute', 3600, f"Từ báo cáo #{report_id}", user_id)
                         await safe_edit_message(query, f"🔇 Đã mute 1h user `{target_id}` (báo cáo #{report_id})")
-                    conn2 = sqlite3.connect(DB_PATH)
+                    conn2 = db_connect(DB_PATH)
                     c2 = conn2.cursor()
                     c2.execute("UPDATE mod_reports SET status='resolved' WHERE id=?", (report_id,))
                     conn2.commit(); conn2.close()
@@ -13424,10 +16843,13 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
     # ==================== TÍCH HỢP VÀO new_chat_members & handle_message ====================
     # Các hàm này sẽ được gọi từ handler hiện có
 
-    async def mod_on_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE, member):
+    async def mod_on_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE, member,
+                                captcha_cfg=None, cross_banned=None):
         """Gọi khi có thành viên mới: chạy CAPTCHA và welcome"""
-        await mod_captcha_join(update, context, member)
-        if not mg_is_cross_banned(update.effective_chat.id, member.id):
+        await mod_captcha_join(update, context, member, cfg=captcha_cfg)
+        if cross_banned is None:
+            cross_banned = mg_is_cross_banned(update.effective_chat.id, member.id)
+        if not cross_banned:
             await mod_send_welcome(update, context, member)
 
     async def mod_on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
@@ -13463,31 +16885,233 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
 
     # ==================== FED CHECK KHI USER JOIN ====================
 
+    async def mod_enforce_fed_ban(context, chat_id, user_id, reason) -> bool:
+        """Ban user đã xác định nằm trong fban list, return True nếu ban thành công"""
+        try:
+            await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+            await context.bot.send_message(chat_id,
+                f"🚫 `{user_id}` bị tự động ban do nằm trong fban list (lý do: {reason})",
+                parse_mode=ParseMode.MARKDOWN)
+            return True
+        except Exception as e:
+            logger.error(f"❌ mod_enforce_fed_ban: {e}")
+        return False
+
     async def mod_check_fed_ban(context, chat_id, user_id) -> bool:
         """Kiểm tra user có bị fban không, return True nếu bị ban"""
+        reason = fed_index.check(chat_id, user_id)
+        if reason is None:
+            return False
+        return await mod_enforce_fed_ban(context, chat_id, user_id, reason)
+
+    # ==================== JOIN PIPELINE (RAID FAST PATH) ====================
+    # Khi bị raid, mỗi update join không được tốn hàng chục round-trip DB/API:
+    # cấu hình captcha, master group và danh sách admin được cache trong RAM,
+    # fban tra từ fed_index, mute từ sanctions, còn cross-ban của cả lô resolve trong 1 query.
+
+    _chat_admins_cache = AdvancedCache('chat_admins', max_size=200, ttl=300)
+    _master_of_cache = AdvancedCache('master_of', max_size=500, ttl=300)
+
+    async def mod_get_chat_admins(context, chat_id):
+        """get_chat_administrators có cache 5 phút"""
+        admins = _chat_admins_cache.get(chat_id)
+        if admins is None:
+            admins = await context.bot.get_chat_administrators(chat_id)
+            _chat_admins_cache.set(chat_id, admins)
+        return admins
+
+    def mod_get_captcha_config(chat_id):
+        """Lấy (enabled, captcha_type, timeout_sec) từ cache RAM (TTL 60s)"""
+        now = time.time()
+        cached = _captcha_config_cache.get(chat_id)
+        if cached and now - cached[3] < 60:
+            return cached[:3] if cached[0] is not None else None
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db_connect(DB_PATH)
             c = conn.cursor()
-            c.execute("SELECT fed_id FROM mod_fed_members WHERE group_id=?", (chat_id,))
-            feds = c.fetchall()
-            for (fed_id,) in feds:
-                c.execute("SELECT reason FROM mod_fed_bans WHERE fed_id=? AND user_id=?", (fed_id, user_id))
-                ban = c.fetchone()
-                if ban:
-                    conn.close()
-                    await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
-                    await context.bot.send_message(chat_id,
-                        f"🚫 `{user_id}` bị tự động ban do nằm trong fban list (lý do: {ban[0]})",
-                        parse_mode=ParseMode.MARKDOWN)
-                    return True
+            c.execute("SELECT enabled, captcha_type, timeout_sec FROM mod_captcha_config WHERE group_id=?", (chat_id,))
+            cfg = c.fetchone(); conn.close()
+        except Exception as e:
+            logger.error(f"❌ mod_get_captcha_config: {e}")
+            return None
+        _captcha_config_cache[chat_id] = (cfg or (None, None, None)) + (now,)
+        return cfg
+
+    def _mod_resolve_master(c, chat_id):
+        """master_id của nhóm (chính nó nếu là nhóm tổng), cache 5 phút; 0 = không có"""
+        master_id = _master_of_cache.get(chat_id)
+        if master_id is None:
+            c.execute("SELECT master_group_id FROM group_hierarchy WHERE child_group_id = ?", (chat_id,))
+            r = c.fetchone()
+            if not r:
+                c.execute("SELECT group_id FROM master_groups WHERE group_id = ?", (chat_id,))
+                r = c.fetchone()
+            master_id = r[0] if r else 0
+            _master_of_cache.set(chat_id, master_id)
+        return master_id
+
+    def mod_resolve_join_batch(chat_id, user_ids):
+        """Resolve cross-ban, fban, mute và captcha config cho cả lô user mới vào.
+
+        Returns: {'cross_banned': set, 'fed_banned': {user_id: reason},
+                  'muted': {user_id: expires_at | None}, 'captcha': cfg | None}
+        """
+        result = {'cross_banned': set(), 'fed_banned': {}, 'muted': {},
+                  'captcha': mod_get_captcha_config(chat_id)}
+        if not user_ids:
+            return result
+        for uid in user_ids:
+            reason = fed_index.check(chat_id, uid)
+            if reason is not None:
+                result['fed_banned'][uid] = reason
+            if sanctions.is_active(chat_id, uid, 'mute'):
+                result['muted'][uid] = sanctions.active.get((chat_id, uid, 'mute'))
+        try:
+            conn = db_connect(DB_PATH)
+            c = conn.cursor()
+            master_id = _mod_resolve_master(c, chat_id)
+            # SQLite giới hạn ~999 tham số → chia lô
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                if master_id:
+                    c.execute(f'''SELECT banned_user_id FROM cross_bans
+                                  WHERE master_group_id=? AND is_active=1 AND banned_user_id IN ({marks})''',
+                              (master_id, *chunk))
+                    result['cross_banned'].update(r[0] for r in c.fetchall())
             conn.close()
         except Exception as e:
-            logger.error(f"❌ mod_check_fed_ban: {e}")
-        return False
+            logger.error(f"❌ mod_resolve_join_batch: {e}")
+        return result
+
+    # ==================== SMART STARTUP ====================
+    # Đường găng trước khi nhận update chỉ gồm việc bắt buộc: thư mục, schema (chỉ chạy
+    # các bước migration còn thiếu, còn lại là 1 lần đọc PRAGMA user_version), nạp
+    # owner/co-owner/fed/sanction vào RAM rồi bật các thread nền. Thống kê COUNT(*), kiểm tra
+    # toàn vẹn, đồng bộ admin cũ và VACUUM chạy ở maintenance_worker sau khi bot đã sẵn sàng.
+    MAINTENANCE_DELAY = int(os.environ.get('MAINTENANCE_DELAY', 120))
+    MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 86400))
+
+    class StartupPlanner:
+        """Đo thời gian từng phase khởi động; phase lỗi được ghi lại và không chặn các phase sau"""
+
+        def __init__(self):
+            self.phases = []
+            self.started = time.perf_counter()
+            self.total_ms = None
+
+        @contextmanager
+        def phase(self, name):
+            started = time.perf_counter()
+            status = 'ok'
+            try:
+                yield
+            except Exception as e:
+                status = f"error: {e}"
+                logger.error(f"❌ Startup phase {name}: {e}", exc_info=True)
+            finally:
+                ms = round((time.perf_counter() - started) * 1000, 1)
+                self.phases.append({'name': name, 'ms': ms, 'status': status})
+                logger.info(f"⏱ Startup {name}: {ms:g}ms")
 
+        def finish(self):
+            self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+            summary = ' | '.join(f"{p['name']} {p['ms']:g}ms" for p in self.phases)
+            logger.info(f"⏱ Startup tổng {self.total_ms:g}ms: {summary}")
 
+        def get_stats(self):
+            return {'total_ms': self.total_ms, 'phases': self.phases}
+
+    startup_planner = StartupPlanner()
+    maintenance_state = {'runs': 0, 'last_run': None, 'db_stats': None, 'integrity': None, 'optimize': None}
+
+    def read_schema_version(path=None):
+        conn = db_connect(path or DB_PATH)
+        try:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+
+    def schema_targets():
+        """(file DB, danh sách migration, journal_mode) cho từng file SQLite của bot"""
+        return ((DB_PATH, SCHEMA_MIGRATIONS, None),
+                (PRICE_DB_PATH, PRICE_SCHEMA_MIGRATIONS, 'WAL'))   # Ghi liên tục -> WAL
+
+    def ensure_schema():
+        """Chạy các bước migration còn thiếu; schema đã mới nhất thì chỉ là 1 lần đọc user_version / file"""
+        applied = []
+        for path, migrations, journal_mode in schema_targets():
+            name = os.path.basename(path)
+            current = read_schema_version(path)
+            latest = latest_schema_version(migrations)
+            if current >= latest:
+                logger.info(f"✅ Schema {name} v{current} - bỏ qua migration")
+                continue
+            logger.info(f"🔄 Schema {name} v{current} → v{latest}: chạy migration...")
+            applied += run_migrations(path, migrations, journal_mode)
+        return applied
+
+    def collect_db_stats():
+        """Đếm bản ghi các bảng chính (trước đây chạy đồng bộ lúc khởi động)"""
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        stats = {}
+        for key, sql in (('users', "SELECT COUNT(*) FROM users"),
+                         ('group_owners', "SELECT COUNT(*) FROM group_owners"),
+                         ('staff', "SELECT COUNT(*) FROM permissions WHERE role = 'staff'"),
+                         ('old_admins', "SELECT COUNT(*) FROM group_admins"),
+                         ('portfolio', "SELECT COUNT(*) FROM portfolio"),
+                         ('incomes', "SELECT COUNT(*) FROM incomes"),
+                         ('expenses', "SELECT COUNT(*) FROM expenses")):
+            try:
+                stats[key] = c.execute(sql).fetchone()[0]
+            except sqlite3.Error:
+                stats[key] = None
+        conn.close()
+        logger.info(f"📊 DB stats: {stats}")
+        return stats
+
+    def check_db_integrity():
+        """PRAGMA quick_check + dò dữ liệu mồ côi (chỉ báo cáo, không tự xoá)"""
+        conn = db_connect(DB_PATH)
+        c = conn.cursor()
+        quick = [row[0] for row in c.execute("PRAGMA quick_check(20)").fetchall()]
+        orphan_expenses = c.execute('''SELECT COUNT(*) FROM expenses
+                                       WHERE category_id IS NOT NULL
+                                       AND category_id NOT IN (SELECT id FROM expense_categories)''').fetchone()[0]
+        conn.close()
+        result = {'quick_check': 'ok' if quick == ['ok'] else quick, 'orphan_expenses': orphan_expenses}
+        if quick != ['ok']:
+            logger.error(f"❌ DB quick_check: {quick}")
+        if orphan_expenses:
+            logger.warning(f"⚠️ Phát hiện {orphan_expenses} chi tiêu orphan (không có danh mục)")
+        return result
+
+    def run_maintenance():
+        """1 lượt bảo trì nền; mỗi job lỗi riêng không ảnh hưởng job khác"""
+        started = time.perf_counter()
+        try:
+            migrate_admin_data()   # Code cũ vẫn ghi group_admins - đồng bộ sang permissions
+        except Exception as e:
+            logger.error(f"❌ Lỗi migrate admin: {e}")
+        for key, job in (('db_stats', collect_db_stats), ('integrity', check_db_integrity),
+                         ('optimize', optimize_database), ('report_cache_purged', report_cache.purge)):
+            try:
+                maintenance_state[key] = job()
+            except Exception as e:
+                maintenance_state[key] = {'error': str(e)}
+                logger.error(f"❌ Maintenance {key}: {e}")
+        maintenance_state['runs'] += 1
+        maintenance_state['last_run'] = format_vn_time()
+        maintenance_state['seconds'] = round(time.perf_counter() - started, 2)
+        logger.info(f"🧰 Bảo trì DB xong sau {maintenance_state['seconds']}s")
+
+    def maintenance_worker():
+        time.sleep(MAINTENANCE_DELAY)
+        while True:
+            run_maintenance()
+            time.sleep(MAINTENANCE_INTERVAL)
 
-    # ==================== SMART STARTUP ====================
     def smart_startup():
         logger.info("🚀 SMART STARTUP")
         logger.info(f"📊 Render mode: {render_config.is_render}")
@@ -13495,390 +17119,209 @@ bot_cache_hits_usdt {usdt_cache.get_stats()['hit_rate']}
         logger.info(f"⚙️ CPU limit: {render_config.cpu_limit}")
         logger.info(f"🌐 Render URL: {render_config.render_url}")
 
-        EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
-        os.makedirs(EXPORT_DIR, exist_ok=True)
-        logger.info(f"📁 Export directory: {EXPORT_DIR}")
-        
-        test_file = os.path.join(EXPORT_DIR, 'test.txt')
-        try:
-            with open(test_file, 'w') as f:
-                f.write('test')
-            os.remove(test_file)
-            logger.info("✅ Export directory is writable")
-        except Exception as e:
-            logger.error(f"❌ Export directory not writable: {e}")
-        
-        if not init_database():
-            logger.error("❌ KHÔNG THỂ KHỞI TẠO DATABASE")
-            time.sleep(5)
-            
-        def fix_database_constraints():
-            """Sửa các ràng buộc trong database"""
-            conn = None
+        with startup_planner.phase('environment'):
+            EXPORT_DIR = os.path.join(DATA_DIR, 'exports')
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            test_file = os.path.join(EXPORT_DIR, 'test.txt')
             try:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                
-                # Bật khóa ngoại
-                c.execute("PRAGMA foreign_keys = ON")
-                logger.info("✅ Đã bật FOREIGN_KEY support")
-                
-                # Kiểm tra bảng expenses có cột category_id không
-                c.execute("PRAGMA table_info(expenses)")
-                columns = [col[1] for col in c.fetchall()]
-                
-                if 'category_id' in columns:
-                    logger.info("✅ Bảng expenses có cột category_id")
-                else:
-                    logger.warning("⚠️ Bảng expenses thiếu cột category_id - Đang thêm...")
-                    try:
-                        c.execute("ALTER TABLE expenses ADD COLUMN category_id INTEGER")
-                        logger.info("✅ Đã thêm cột category_id")
-                    except Exception as e:
-                        logger.error(f"❌ Không thể thêm cột category_id: {e}")
-                
-                # Kiểm tra ràng buộc khóa ngoại
-                c.execute("PRAGMA foreign_key_list(expenses)")
-                fk_list = c.fetchall()
-                
-                has_fk = False
-                for fk in fk_list:
-                    if len(fk) >= 5 and fk[3] == 'category_id' and fk[2] == 'expense_categories':
-                        has_fk = True
-                        logger.info(f"✅ Có ràng buộc khóa ngoại: {fk}")
-                        break
-                
-                if not has_fk:
-                    logger.warning("⚠️ Thiếu ràng buộc khóa ngoại giữa expenses và expense_categories")
-                    logger.warning("   Có thể gây lỗi khi xóa danh mục")
-                
-                # Xóa các chi tiêu có category_id không tồn tại
-                c.execute('''
-                    SELECT COUNT(*) FROM expenses 
-                    WHERE category_id IS NOT NULL 
-                    AND category_id NOT IN (SELECT id FROM expense_categories)
-                ''')
-                orphan_count = c.fetchone()[0]
-                
-                if orphan_count > 0:
-                    logger.warning(f"⚠️ Phát hiện {orphan_count} chi tiêu orphan (không có danh mục)")
-                    c.execute('''
-                        DELETE FROM expenses 
-                        WHERE category_id IS NOT NULL 
-                        AND category_id NOT IN (SELECT id FROM expense_categories)
-                    ''')
-                    deleted = c.rowcount
-                    logger.info(f"✅ Đã xóa {deleted} chi tiêu orphan")
-                
-                conn.commit()
-                
-                # Đếm số lượng để báo cáo
-                c.execute("SELECT COUNT(*) FROM expense_categories")
-                cat_count = c.fetchone()[0]
-                
-                c.execute("SELECT COUNT(*) FROM expenses")
-                exp_count = c.fetchone()[0]
-                
-                logger.info(f"📊 Thống kê: {cat_count} danh mục, {exp_count} chi tiêu")
-                logger.info("✅ Đã kiểm tra và sửa ràng buộc database")
-                
+                with open(test_file, 'w') as f:
+                    f.write('test')
+                os.remove(test_file)
             except Exception as e:
-                logger.error(f"❌ Lỗi sửa database: {e}")
-            finally:
-                if conn:
-                    conn.close()
-            
-        # ===== THÊM PHẦN KIỂM TRA TỔNG THỂ VÀO ĐÂY =====
-        logger.info("🔍 KIỂM TRA TỔNG THỂ HỆ THỐNG...")
-        
-        # 1. Migrate dữ liệu admin cũ
-        logger.info("🔄 Kiểm tra và migrate dữ liệu admin...")
-        try:
-            migrate_admin_data()
-        except Exception as e:
-            logger.error(f"❌ Lỗi migrate admin: {e}")
-        
-        # 2. Load group owners
-        logger.info("🔄 Loading group owners...")
-        load_group_owners()
-        
-        # 2b. Load co-owners
-        logger.info("🔄 Loading co-owners...")
-        load_co_owners()
-        
-        # 3. Kiểm tra dữ liệu trong database
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # Đếm số lượng staff trong permissions
-            c.execute("SELECT COUNT(*) FROM permissions WHERE role = 'staff'")
-            staff_count = c.fetchone()[0]
-            
-            # Đếm số lượng admin cũ (nếu bảng còn tồn tại)
-            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='group_admins'")
-            old_table_exists = c.fetchone()
-            
-            old_admin_count = 0
-            if old_table_exists:
-                c.execute("SELECT COUNT(*) FROM group_admins")
-                old_admin_count = c.fetchone()[0]
-            
-            # Đếm số lượng group owners
-            c.execute("SELECT COUNT(*) FROM group_owners")
-            group_owners_count = c.fetchone()[0]
-            
-            # Đếm tổng số user
-            c.execute("SELECT COUNT(*) FROM users")
-            users_count = c.fetchone()[0]
-            
-            # Đếm tổng số giao dịch
-            c.execute("SELECT COUNT(*) FROM portfolio")
-            portfolio_count = c.fetchone()[0]
-            
-            # Đếm tổng số thu chi
-            c.execute("SELECT COUNT(*) FROM incomes")
-            income_count = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM expenses")
-            expense_count = c.fetchone()[0]
-            
-            conn.close()
-            
-            # In báo cáo kiểm tra
-            logger.info("📊 *BÁO CÁO KIỂM TRA DATABASE*")
-            logger.info(f"   • Users: {users_count}")
-            logger.info(f"   • Group Owners: {group_owners_count}")
-            logger.info(f"   • Staff (permissions): {staff_count}")
-            if old_table_exists:
-                logger.info(f"   • Old admins (group_admins): {old_admin_count}")
-            logger.info(f"   • Portfolio transactions: {portfolio_count}")
-            logger.info(f"   • Income records: {income_count}")
-            logger.info(f"   • Expense records: {expense_count}")
-            
-            # Cảnh báo nếu còn dữ liệu cũ
-            if old_admin_count > 0:
-                logger.warning(f"⚠️ Vẫn còn {old_admin_count} admin trong bảng cũ group_admins!")
-                logger.warning("   Chạy migrate_admin_data() để chuyển sang bảng mới")
-            
-            # Kiểm tra consistency
-            if staff_count == 0 and old_admin_count > 0:
-                logger.warning("⚠️ Có admin cũ nhưng chưa có staff trong permissions!")
-                logger.warning("   Đang thử migrate lại...")
-                migrate_admin_data()  # Thử migrate lần nữa
-                
-        except Exception as e:
-            logger.error(f"❌ Lỗi kiểm tra database: {e}")
-        
-        # 4. Kiểm tra cache
-        logger.info("🔄 Kiểm tra cache system...")
-        logger.info(f"   • Price cache: {price_cache.get_stats()}")
-        logger.info(f"   • USDT cache: {usdt_cache.get_stats()}")
-        logger.info(f"   • Username cache: {len(username_cache.cache)} entries")
-        
-        # 5. Kiểm tra thư mục
-        logger.info("🔄 Kiểm tra thư mục...")
-        db_size = os.path.getsize(DB_PATH) / (1024 * 1024) if os.path.exists(DB_PATH) else 0
-        logger.info(f"   • Database size: {db_size:.2f} MB")
-        logger.info(f"   • Backup dir: {BACKUP_DIR} ({len(os.listdir(BACKUP_DIR)) if os.path.exists(BACKUP_DIR) else 0} files)")
-        logger.info(f"   • Export dir: {EXPORT_DIR} ({len(os.listdir(EXPORT_DIR)) if os.path.exists(EXPORT_DIR) else 0} files)")
-        
-        # 6. Kiểm tra Render Disk
-        if render_config.is_render:
-            logger.info("🔄 Kiểm tra Render Disk...")
-            if os.path.exists('/data'):
-                # Kiểm tra dung lượng
-                stat = os.statvfs('/data')
-                free_space = stat.f_frsize * stat.f_bavail / (1024 * 1024 * 1024)  # GB
-                total_space = stat.f_frsize * stat.f_blocks / (1024 * 1024 * 1024)  # GB
-                logger.info(f"   • Render Disk mounted at /data")
-                logger.info(f"   • Free space: {free_space:.2f} GB / {total_space:.2f} GB")
-                
-                # Kiểm tra database có trong disk không
-                if DB_PATH.startswith('/data'):
-                    logger.info(f"   ✅ Database is on Render Disk: {DB_PATH}")
+                logger.error(f"❌ Export directory not writable: {e}")
+            
+            if render_config.is_render:
+                if os.path.exists('/data'):
+                    stat = os.statvfs('/data')
+                    free_space = stat.f_frsize * stat.f_bavail / (1024 * 1024 * 1024)  # GB
+                    total_space = stat.f_frsize * stat.f_blocks / (1024 * 1024 * 1024)  # GB
+                    logger.info(f"💽 Render Disk /data: {free_space:.2f} GB / {total_space:.2f} GB trống")
+                    if not DB_PATH.startswith('/data'):
+                        logger.warning(f"⚠️ Database is NOT on Render Disk: {DB_PATH}")
                 else:
-                    logger.warning(f"⚠️ Database is NOT on Render Disk: {DB_PATH}")
-            else:
-                logger.warning("⚠️ Render Disk not mounted at /data")
+                    logger.warning("⚠️ Render Disk not mounted at /data")
         
-        # ===== KẾT THÚC PHẦN KIỂM TRA =====
-
-        # Các phần còn lại giữ nguyên
-        try:
-            migrate_database()
-        except Exception as e:
-            logger.error(f"❌ Lỗi migrate: {e}")
+        with startup_planner.phase('schema'):
+            ensure_schema()
         
-        optimize_database()
+        with startup_planner.phase('load_state'):
+            load_group_owners()
+            load_co_owners()
+            fed_index.load()
+            sanctions.load()
         
-        if render_config.is_render and render_config.render_url:
-            logger.info("🌐 Using webhook mode")
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(setup_webhook())
+        with startup_planner.phase('services'):
+            if render_config.is_render and render_config.render_url:
+                # Server webhook + setWebhook chạy trong run_supervised() trên loop của Application
+                logger.info("🌐 Using webhook mode")
+            else:
+                logger.info("🔄 Using polling mode")
+                threading.Thread(target=run_health_server, daemon=True).start()
             
-            threading.Thread(target=run_webhook_server, daemon=True).start()
-        else:
-            logger.info("🔄 Using polling mode")
-            threading.Thread(target=run_health_server, daemon=True).start()
-        
-        threading.Thread(target=memory_monitor, daemon=True).start()
-        threading.Thread(target=schedule_backup, daemon=True).start()
-        threading.Thread(target=check_alerts, daemon=True).start()
+            threading.Thread(target=memory_monitor, daemon=True).start()
+            threading.Thread(target=schedule_backup, daemon=True).start()
+            threading.Thread(target=check_alerts, daemon=True).start()
+            threading.Thread(target=price_history_worker, daemon=True).start()
+            threading.Thread(target=sanction_reaper, daemon=True).start()
+            threading.Thread(target=maintenance_worker, daemon=True).start()
         
+        startup_planner.finish()
         logger.info(f"🎉 BOT ĐÃ SẴN SÀNG! {format_vn_time()}")
 
     # ==================== MAIN ====================
+    def create_application():
+        """Dựng Application + đăng ký toàn bộ handler (gọi lại mỗi lần restart session)"""
+        application = build_application()
+        application.bot_data = {}
+
+        # Đăng ký handlers
+        application.add_handler(CommandHandler("start", start))
+        application.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("menu", menu_command))
+        application.add_handler(CommandHandler("usdt", usdt_command))
+        application.add_handler(CommandHandler("s", s_command))
+        application.add_handler(CommandHandler("buy", buy_command))
+        application.add_handler(CommandHandler("sell", sell_command))
+        application.add_handler(CommandHandler("edit", edit_command))
+        application.add_handler(CommandHandler("del", delete_tx_command))
+        application.add_handler(CommandHandler("delete", delete_tx_command))
+        application.add_handler(CommandHandler("xoa", delete_tx_command))
+        application.add_handler(CommandHandler("alert", alert_command))
+        application.add_handler(CommandHandler("alerts", alerts_command))
+        application.add_handler(CommandHandler("stats", stats_command))
+        application.add_handler(CommandHandler("perm", perm_command))
+        application.add_handler(CommandHandler("whoami", whoami_command))
+        application.add_handler(CommandHandler("permgrant", quick_grant_command))
+        application.add_handler(CommandHandler("getid", getid_command))
+        application.add_handler(CommandHandler("groupid", groupid_command))
+        application.add_handler(CommandHandler("syncusers", sync_users_command))
+        application.add_handler(CommandHandler("view", view_portfolio_command))
+        application.add_handler(CommandHandler("users", list_users_command))
+        application.add_handler(CommandHandler("syncadmins", sync_admins_command))
+        application.add_handler(CommandHandler("checkperm", check_perm_command))
+        application.add_handler(CommandHandler("syncdata", sync_data_command))
+        application.add_handler(CommandHandler("owner", owner_panel))
+        application.add_handler(CommandHandler("addcoowner", addcoowner_command))
+        application.add_handler(CommandHandler("removecoowner", removecoowner_command))
+        application.add_handler(CommandHandler("coowners", listcoowners_command))
+        application.add_handler(CommandHandler("movemaster", movemaster_command))
+        application.add_handler(CommandHandler("debugperm", debug_perm_command))
+        application.add_handler(CommandHandler("benchanalytics", bench_analytics_command))
+        application.add_handler(CommandHandler("positions", positions_command))
+        application.add_handler(CommandHandler("loadtest", loadtest_command))
+        application.add_handler(CommandHandler("profile", profile_command))
+        application.add_handler(CommandHandler("memory", memory_command))
+        application.add_handler(CommandHandler("setupgroup", setup_group_command))
+        application.add_handler(CommandHandler("groupinfo", group_info_command))
+        application.add_handler(CommandHandler("addadmin", add_group_admin))
+        application.add_handler(CommandHandler("hide", hide_keyboard))
+        application.add_handler(CommandHandler("balance", balance_command))
+        application.add_handler(CommandHandler("canhdoi", balance_command))
+        application.add_handler(CommandHandler("thuchi", balance_command))
+        application.add_handler(CommandHandler("addadmin", add_admin_command))
+        application.add_handler(CommandHandler("listadmin", list_admin_command))
+        application.add_handler(CommandHandler("removeadmin", remove_admin_command))
+        application.add_handler(CommandHandler("xoadm", delete_category_command))
+        application.add_handler(CommandHandler("xoacategory", delete_category_command))
+        application.add_handler(CommandHandler("xoadanhmuc", delete_category_command))
+        application.add_handler(CommandHandler("xoadanhmuc", delete_category_command))
+        application.add_handler(CommandHandler("delcat", delete_category_command))
+        application.add_handler(CommandHandler("editthu", edit_income_command))
+        application.add_handler(CommandHandler("editchi", edit_expense_command))
+        application.add_handler(CommandHandler("suathu", edit_income_command))
+        application.add_handler(CommandHandler("suachi", edit_expense_command))
+        application.add_handler(CommandHandler("grant", grant_command))
+        application.add_handler(CommandHandler("myperm", myperm_command))
+        application.add_handler(CommandHandler("export", export_master_command))
+        application.add_handler(CommandHandler("lang", lang_command))
+        application.add_handler(CommandHandler("export_secure", export_secure_command))
+        application.add_handler(CommandHandler("export_expense", export_expense_command))
+        application.add_handler(CommandHandler("export_data", export_data_command))
+        application.add_handler(CommandHandler("chart", chart_command))
+        application.add_handler(CommandHandler("sells", sells_command))
+        application.add_handler(CommandHandler("delsell", delete_sell_command))
+        application.add_handler(CommandHandler("editsell", edit_sell_command))
+        application.add_handler(CommandHandler("sells", sells_command))
+        application.add_handler(CommandHandler("addsell", addsell_command))
+        application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_members))
+        application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, left_chat_member))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        application.add_handler(CallbackQueryHandler(handle_sell_confirmation, pattern="^(confirm_sell_|cancel_sell)"))
+        application.add_handler(CallbackQueryHandler(handle_callback))
+
+        # === MULTI-GROUP SYSTEM HANDLERS ===
+        application.add_handler(CommandHandler("setmaster", mg_setmaster_command))
+        application.add_handler(CommandHandler("masterinfo", mg_masterinfo_command))
+
+        # ── MODERATION COMMANDS ──────────────────────────
+        application.add_handler(CommandHandler("mod", mod_menu_command))
+        application.add_handler(CommandHandler("ban", mod_ban_command))
+        application.add_handler(CommandHandler("unban", mod_unban_command))
+        application.add_handler(CommandHandler("kick", mod_kick_command))
+        application.add_handler(CommandHandler("mute", mod_mute_command))
+        application.add_handler(CommandHandler("unmute", mod_unmute_command))
+        application.add_handler(CommandHandler("warn", mod_warn_command))
+        application.add_handler(CommandHandler("unwarn", mod_unwarn_command))
+        application.add_handler(CommandHandler("warns", mod_warns_command))
+        application.add_handler(CommandHandler("setwarn", mod_setwarn_command))
+        application.add_handler(CommandHandler("setcaptcha", mod_setcaptcha_command))
+        application.add_handler(CommandHandler("setflood", mod_setflood_command))
+        application.add_handler(CommandHandler("setwelcome", mod_setwelcome_command))
+        application.add_handler(CommandHandler("welcomeoff", mod_welcome_off_command))
+        application.add_handler(CommandHandler("setrules", mod_setrules_command))
+        application.add_handler(CommandHandler("rules", mod_rules_command))
+        application.add_handler(CommandHandler("filter", mod_filter_command))
+        application.add_handler(CommandHandler("unfilter", mod_unfilter_command))
+        application.add_handler(CommandHandler("filters", mod_filters_list_command))
+        application.add_handler(CommandHandler("addcmd", mod_addcmd_command))
+        application.add_handler(CommandHandler("delcmd", mod_delcmd_command))
+        application.add_handler(CommandHandler("cmds", mod_cmds_list_command))
+        application.add_handler(CommandHandler("purge", mod_purge_command))
+        application.add_handler(CommandHandler("spurge", mod_spurge_command))
+        application.add_handler(CommandHandler("adminlogs", mod_logs_command))
+        application.add_handler(CommandHandler("report", mod_report_command))
+        application.add_handler(CommandHandler("newfed", mod_newfed_command))
+        application.add_handler(CommandHandler("joinfed", mod_joinfed_command))
+        application.add_handler(CommandHandler("leavefed", mod_leavefed_command))
+        application.add_handler(CommandHandler("fban", mod_fban_command))
+        application.add_handler(CommandHandler("funban", mod_funban_command))
+        application.add_handler(CommandHandler("fedinfo", mod_fedinfo_command))
+        # Callback handler cho moderation
+        application.add_handler(CallbackQueryHandler(handle_mod_callback, pattern="^mod_"))
+        application.add_handler(CommandHandler("addchild", mg_addchild_command))
+        application.add_handler(CommandHandler("removechild", mg_removechild_command))
+        application.add_handler(CommandHandler("features", mg_features_command))
+        application.add_handler(CommandHandler("crossban", mg_crossban_command))
+        application.add_handler(CommandHandler("crossunban", mg_crossunban_command))
+        application.add_handler(CommandHandler("banlist", mg_banlist_command))
+        application.add_handler(CommandHandler("broadcast", mg_broadcast_command))
+        instrument_handlers(application)
+        return application
+
     if __name__ == '__main__':
         try:
             logger.info("🚀 KHỞI ĐỘNG CRYPTO BOT - RENDER OPTIMIZED")
             logger.info(f"🕐 Thời gian: {format_vn_time()}")
             
-            # Tạo application
-            app = Application.builder().token(TELEGRAM_TOKEN).build()
-            app.bot_data = {}
-            logger.info("✅ Đã tạo Telegram Application")
-
-            # Đăng ký handlers
-            app.add_handler(CommandHandler("start", start))
-            app.add_handler(CommandHandler("help", help_command))
-            app.add_handler(CommandHandler("menu", menu_command))
-            app.add_handler(CommandHandler("usdt", usdt_command))
-            app.add_handler(CommandHandler("s", s_command))
-            app.add_handler(CommandHandler("buy", buy_command))
-            app.add_handler(CommandHandler("sell", sell_command))
-            app.add_handler(CommandHandler("edit", edit_command))
-            app.add_handler(CommandHandler("del", delete_tx_command))
-            app.add_handler(CommandHandler("delete", delete_tx_command))
-            app.add_handler(CommandHandler("xoa", delete_tx_command))
-            app.add_handler(CommandHandler("alert", alert_command))
-            app.add_handler(CommandHandler("alerts", alerts_command))
-            app.add_handler(CommandHandler("stats", stats_command))
-            app.add_handler(CommandHandler("perm", perm_command))
-            app.add_handler(CommandHandler("whoami", whoami_command))
-            app.add_handler(CommandHandler("permgrant", quick_grant_command))
-            app.add_handler(CommandHandler("getid", getid_command))
-            app.add_handler(CommandHandler("groupid", groupid_command))
-            app.add_handler(CommandHandler("syncusers", sync_users_command))
-            app.add_handler(CommandHandler("view", view_portfolio_command))
-            app.add_handler(CommandHandler("users", list_users_command))
-            app.add_handler(CommandHandler("syncadmins", sync_admins_command))
-            app.add_handler(CommandHandler("checkperm", check_perm_command))
-            app.add_handler(CommandHandler("syncdata", sync_data_command))
-            app.add_handler(CommandHandler("owner", owner_panel))
-            app.add_handler(CommandHandler("addcoowner", addcoowner_command))
-            app.add_handler(CommandHandler("removecoowner", removecoowner_command))
-            app.add_handler(CommandHandler("coowners", listcoowners_command))
-            app.add_handler(CommandHandler("movemaster", movemaster_command))
-            app.add_handler(CommandHandler("debugperm", debug_perm_command))
-            app.add_handler(CommandHandler("setupgroup", setup_group_command))
-            app.add_handler(CommandHandler("groupinfo", group_info_command))
-            app.add_handler(CommandHandler("addadmin", add_group_admin))
-            app.add_handler(CommandHandler("hide", hide_keyboard))
-            app.add_handler(CommandHandler("balance", balance_command))
-            app.add_handler(CommandHandler("canhdoi", balance_command))
-            app.add_handler(CommandHandler("thuchi", balance_command))
-            app.add_handler(CommandHandler("addadmin", add_admin_command))
-            app.add_handler(CommandHandler("listadmin", list_admin_command))
-            app.add_handler(CommandHandler("removeadmin", remove_admin_command))
-            app.add_handler(CommandHandler("xoadm", delete_category_command))
-            app.add_handler(CommandHandler("xoacategory", delete_category_command))
-            app.add_handler(CommandHandler("xoadanhmuc", delete_category_command))
-            app.add_handler(CommandHandler("xoadanhmuc", delete_category_command))
-            app.add_handler(CommandHandler("delcat", delete_category_command))
-            app.add_handler(CommandHandler("editthu", edit_income_command))
-            app.add_handler(CommandHandler("editchi", edit_expense_command))
-            app.add_handler(CommandHandler("suathu", edit_income_command))
-            app.add_handler(CommandHandler("suachi", edit_expense_command))
-            app.add_handler(CommandHandler("grant", grant_command))
-            app.add_handler(CommandHandler("myperm", myperm_command))
-            app.add_handler(CommandHandler("export", export_master_command))
-            app.add_handler(CommandHandler("lang", lang_command))
-            app.add_handler(CommandHandler("export_secure", export_secure_command))
-            app.add_handler(CommandHandler("export_expense", export_expense_command))
-            app.add_handler(CommandHandler("sells", sells_command))
-            app.add_handler(CommandHandler("delsell", delete_sell_command))
-            app.add_handler(CommandHandler("editsell", edit_sell_command))
-            app.add_handler(CommandHandler("sells", sells_command))
-            app.add_handler(CommandHandler("addsell", addsell_command))
-            app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_members))
-            app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, left_chat_member))
-            app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-            app.add_handler(CallbackQueryHandler(handle_sell_confirmation, pattern="^(confirm_sell_|cancel_sell)"))
-            app.add_handler(CallbackQueryHandler(handle_callback))
-
-            # === MULTI-GROUP SYSTEM HANDLERS ===
-            app.add_handler(CommandHandler("setmaster", mg_setmaster_command))
-            app.add_handler(CommandHandler("masterinfo", mg_masterinfo_command))
-
-            # ── MODERATION COMMANDS ──────────────────────────
-            app.add_handler(CommandHandler("mod", mod_menu_command))
-            app.add_handler(CommandHandler("ban", mod_ban_command))
-            app.add_handler(CommandHandler("unban", mod_unban_command))
-            app.add_handler(CommandHandler("kick", mod_kick_command))
-            app.add_handler(CommandHandler("mute", mod_mute_command))
-            app.add_handler(CommandHandler("unmute", mod_unmute_command))
-            app.add_handler(CommandHandler("warn", mod_warn_command))
-            app.add_handler(CommandHandler("unwarn", mod_unwarn_command))
-            app.add_handler(CommandHandler("warns", mod_warns_command))
-            app.add_handler(CommandHandler("setwarn", mod_setwarn_command))
-            app.add_handler(CommandHandler("setcaptcha", mod_setcaptcha_command))
-            app.add_handler(CommandHandler("setflood", mod_setflood_command))
-            app.add_handler(CommandHandler("setwelcome", mod_setwelcome_command))
-            app.add_handler(CommandHandler("welcomeoff", mod_welcome_off_command))
-            app.add_handler(CommandHandler("setrules", mod_setrules_command))
-            app.add_handler(CommandHandler("rules", mod_rules_command))
-            app.add_handler(CommandHandler("filter", mod_filter_command))
-            app.add_handler(CommandHandler("unfilter", mod_unfilter_command))
-            app.add_handler(CommandHandler("filters", mod_filters_list_command))
-            app.add_handler(CommandHandler("addcmd", mod_addcmd_command))
-            app.add_handler(CommandHandler("delcmd", mod_delcmd_command))
-            app.add_handler(CommandHandler("cmds", mod_cmds_list_command))
-            app.add_handler(CommandHandler("purge", mod_purge_command))
-            app.add_handler(CommandHandler("spurge", mod_spurge_command))
-            app.add_handler(CommandHandler("adminlogs", mod_logs_command))
-            app.add_handler(CommandHandler("report", mod_report_command))
-            app.add_handler(CommandHandler("newfed", mod_newfed_command))
-            app.add_handler(CommandHandler("joinfed", mod_joinfed_command))
-            app.add_handler(CommandHandler("leavefed", mod_leavefed_command))
-            app.add_handler(CommandHandler("fban", mod_fban_command))
-            app.add_handler(CommandHandler("funban", mod_funban_command))
-            app.add_handler(CommandHandler("fedinfo", mod_fedinfo_command))
-            # Callback handler cho moderation
-            app.add_handler(CallbackQueryHandler(handle_mod_callback, pattern="^mod_"))
-            app.add_handler(CommandHandler("addchild", mg_addchild_command))
-            app.add_handler(CommandHandler("removechild", mg_removechild_command))
-            app.add_handler(CommandHandler("features", mg_features_command))
-            app.add_handler(CommandHandler("crossban", mg_crossban_command))
-            app.add_handler(CommandHandler("crossunban", mg_crossunban_command))
-            app.add_handler(CommandHandler("banlist", mg_banlist_command))
-            app.add_handler(CommandHandler("broadcast", mg_broadcast_command))
-        
-            logger.info("✅ Đã đăng ký handlers")
+            app = create_application()
+            logger.info("✅ Đã tạo Telegram Application và đăng ký handlers")
             
             # Khởi động thông minh
             smart_startup()
             
-            # Chạy bot
-            if render_config.is_render and render_config.render_url:
-                # Webhook mode: Flask đã chạy, cần giữ main thread alive
-                logger.info("⏳ Bot running in webhook mode...")
-                while True:
-                    time.sleep(60)
-                    check_memory_usage()
-            else:
-                # Polling mode
-                logger.info("⏳ Bot running in polling mode...")
-                app.run_polling(timeout=30, drop_pending_updates=True)
+            # Chạy bot: webhook (server HTTP chung event loop) hoặc polling, có supervisor restart
+            webhook_mode = bool(render_config.is_render and render_config.render_url)
+            logger.info(f"⏳ Bot running in {'webhook' if webhook_mode else 'polling'} mode...")
+            exit_code = asyncio.run(run_supervised(webhook_mode))
             
         except Exception as e:
-            logger.error(f"❌ LỖI: {e}", exc_info=True)
-            time.sleep(5)
-            os.execv(sys.executable, ['python'] + sys.argv)
+            logger.critical(f"💥 LỖI KHỞI ĐỘNG: {e}", exc_info=True)
+            exit_code = 1
+        stop_logging(log_listener)
+        sys.exit(exit_code)
 
 except Exception as e:
+    # Lỗi khi nạp module: execv lại chỉ lặp vô hạn, để nền tảng (Render) khởi động lại process
     logger.critical(f"💥 LỖI NGHIÊM TRỌNG: {e}", exc_info=True)
-    time.sleep(10)
-    os.execv(sys.executable, ['python'] + sys.argv)
-
+    stop_logging(log_listener)
+    sys.exit(1)